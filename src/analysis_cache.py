@@ -0,0 +1,360 @@
+"""
+食事解析の類似テキストキャッシュ（analyze_meal_with_gemini の手前に置く）
+
+「鶏むね肉 100g」と「鶏胸肉100グラム」のような表記違いの入力で、前回の解析結果を再利用する。
+正規化したテキストをベクトル化してプロセス内のベクトル索引に保持し、
+最も近い過去の入力の類似度がしきい値以上（かつ数量が一致）なら Gemini を呼ばない。
+
+ベクトル化は文字 n-gram のハッシュ（オフラインでも動く）を常に使い、
+secrets の [gemini] embedding_model が設定されていれば Gemini の埋め込みを優先する。
+再利用した結果の一部はバックグラウンドで解析し直して比較し（監査）、
+ヒット率と誤再利用率を report() で確認してしきい値を調整する。
+
+あわせて、Gemini が返す品目ごとの内訳を IngredientCache に蓄積し、
+既知の品目だけでできた食事（「白米と味噌汁と焼き鮭」など）はローカルで合計する。
+"""
+
+import random
+import re
+import threading
+import zlib
+from collections import deque
+
+import numpy as np
+import streamlit as st
+
+from config import get_gemini_client, get_executor
+from food_search import normalize_food_text, quantities
+from meal_estimator import char_ngrams
+
+HASHING_DIM = 2048
+# ベクトル化の方式ごとの再利用のしきい値（コサイン類似度）
+SIMILARITY_THRESHOLDS = {"hashing": 0.9, "gemini": 0.95}
+MAX_ENTRIES = 5000
+AUDIT_RATE = 0.05       # 再利用した結果のうち、解析し直して確かめる割合
+AUDIT_TOLERANCE = 0.2   # 監査で再解析したカロリーとの差がこの割合を超えたら誤再利用とみなす
+ITEM_SUM_TOLERANCE = 0.2  # 品目の内訳の合計が全体のカロリーとこの割合以上ずれていたら内訳を登録しない
+# 解析結果の出どころ（analyze_meal_with_gemini の段階）
+ANALYSIS_SOURCES = ("food_table", "ingredients", "shared", "similar", "gemini")
+
+
+def hashing_vector(text):
+    """正規化したテキストの文字 n-gram を符号付きハッシュで固定長に畳み込んだ単位ベクトル（空なら None）"""
+    vec = np.zeros(HASHING_DIM, dtype=np.float32)
+    for gram, count in char_ngrams(normalize_food_text(text)).items():
+        h = zlib.crc32(gram.encode("utf-8"))
+        vec[h % HASHING_DIM] += -count if h & 0x80000000 else count
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else None
+
+
+def gemini_embedding(text, model):
+    """Gemini の埋め込みベクトル（単位ベクトル）"""
+    res = get_gemini_client().models.embed_content(model=model, contents=normalize_food_text(text))
+    vec = np.asarray(res.embeddings[0].values, dtype=np.float32)
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else None
+
+
+class AnalysisCache:
+    """
+    解析結果のベクトル索引（容量を超えたら古いものから上書き）
+
+    cache.lookup(text)        # {"result", "text", "similarity", "space", "slot"} / None
+    cache.store(text, result)
+    cache.report()            # ヒット率・誤再利用率など
+    """
+
+    def __init__(self, embedding_model=None, thresholds=SIMILARITY_THRESHOLDS,
+                 capacity=MAX_ENTRIES, audit_rate=AUDIT_RATE):
+        self.embedding_model = embedding_model
+        self.thresholds = dict(thresholds)
+        self.capacity = capacity
+        self.audit_rate = audit_rate
+        self._lock = threading.Lock()
+        self._entries = []   # スロット -> {"text", "quantities", "result"}
+        self._next = 0       # 次に書き込むスロット
+        self._spaces = {}    # 方式 -> (ベクトル行列 (capacity, dim), 有効フラグ)
+        self._vector_memo = {}  # 直近の入力のベクトル（lookup → store で同じ入力を2回埋め込まない）
+        self.audit_log = deque(maxlen=50)
+        self._stats = {"lookups": 0, "hits": 0, "audits": 0, "false_reuses": 0}
+        self._sources = dict.fromkeys(ANALYSIS_SOURCES, 0)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._next = 0
+            self._spaces.clear()
+            self._vector_memo.clear()
+            self.audit_log.clear()
+            self._stats = dict.fromkeys(self._stats, 0)
+            self._sources = dict.fromkeys(ANALYSIS_SOURCES, 0)
+
+    def __len__(self):
+        return len(self._entries)
+
+    # --- ベクトル化 ---
+
+    def _vectors(self, text):
+        """方式ごとのベクトル。Gemini の埋め込みに失敗したらハッシュだけを使う"""
+        memo = self._vector_memo.get(text)
+        if memo is not None:
+            return memo
+        vectors = {}
+        if self.embedding_model:
+            try:
+                vec = gemini_embedding(text, self.embedding_model)
+                if vec is not None:
+                    vectors["gemini"] = vec
+            except Exception as e:
+                print(f"Embedding error: {e}")
+        vec = hashing_vector(text)
+        if vec is not None:
+            vectors["hashing"] = vec
+        if len(self._vector_memo) >= 32:
+            self._vector_memo.clear()
+        self._vector_memo[text] = vectors
+        return vectors
+
+    # --- 参照・登録 ---
+
+    def lookup(self, text):
+        """
+        最も近い過去の入力の解析結果を返す（しきい値未満・数量が違う場合は None）
+        Gemini の埋め込みが得られればその空間で、なければハッシュの空間で探す
+        """
+        vectors = self._vectors(text)
+        qty = quantities(text)
+        with self._lock:
+            self._stats["lookups"] += 1
+            for space in ("gemini", "hashing"):
+                if space not in vectors or space not in self._spaces:
+                    continue
+                matrix, valid = self._spaces[space]
+                if len(vectors[space]) != matrix.shape[1]:
+                    continue
+                n = len(self._entries)
+                sims = matrix[:n] @ vectors[space]
+                sims[~valid[:n]] = -1.0
+                threshold = self.thresholds[space]
+                for slot in np.argsort(-sims)[:5]:
+                    if sims[slot] < threshold:
+                        break
+                    entry = self._entries[slot]
+                    if entry["quantities"] == qty:
+                        self._stats["hits"] += 1
+                        return {"result": entry["result"], "text": entry["text"],
+                                "similarity": float(sims[slot]), "space": space, "slot": int(slot)}
+                break  # 優先する空間で見つからなければ再利用しない
+        return None
+
+    def store(self, text, result):
+        """解析結果を登録する（容量を超えたら最も古いスロットを上書き）"""
+        vectors = self._vectors(text)
+        if not vectors:
+            return
+        with self._lock:
+            slot = self._next
+            entry = {"text": text, "quantities": quantities(text), "result": result}
+            if slot < len(self._entries):
+                self._entries[slot] = entry
+            else:
+                self._entries.append(entry)
+            self._next = (slot + 1) % self.capacity
+            for _, valid in self._spaces.values():
+                valid[slot] = False
+            for space, vec in vectors.items():
+                if space not in self._spaces:
+                    self._spaces[space] = (
+                        np.zeros((self.capacity, len(vec)), dtype=np.float32),
+                        np.zeros(self.capacity, dtype=bool),
+                    )
+                matrix, valid = self._spaces[space]
+                if len(vec) == matrix.shape[1]:
+                    matrix[slot] = vec
+                    valid[slot] = True
+
+    # --- 監査 ---
+
+    def maybe_audit(self, text, hit, analyze):
+        """
+        再利用した結果の一部（audit_rate）を、バックグラウンドで analyze() により解析し直して比べる
+        カロリーの差が AUDIT_TOLERANCE を超えたら誤再利用として記録し、再利用元を無効にして
+        この入力の正しい結果を登録する
+        """
+        if random.random() >= self.audit_rate:
+            return None
+        return get_executor().submit(self._audit, text, hit, analyze)
+
+    def _audit(self, text, hit, analyze):
+        fresh = analyze()
+        if not fresh:
+            return None
+        cached_cal, fresh_cal = hit["result"][3], fresh[3]
+        false_reuse = abs(fresh_cal - cached_cal) > AUDIT_TOLERANCE * max(fresh_cal, 1)
+        with self._lock:
+            self._stats["audits"] += 1
+            if false_reuse:
+                self._stats["false_reuses"] += 1
+                slot = hit["slot"]
+                if slot < len(self._entries) and self._entries[slot]["text"] == hit["text"]:
+                    for _, valid in self._spaces.values():
+                        valid[slot] = False
+            self.audit_log.append({
+                "text": text, "cached_text": hit["text"], "similarity": hit["similarity"],
+                "space": hit["space"], "cached_cal": cached_cal, "fresh_cal": fresh_cal,
+                "false_reuse": false_reuse,
+            })
+        if false_reuse:
+            self.store(text, fresh)
+        return false_reuse
+
+    def record_source(self, source):
+        """解析結果の出どころ（ANALYSIS_SOURCES）を数える"""
+        with self._lock:
+            self._sources[source] = self._sources.get(source, 0) + 1
+
+    def report(self):
+        """ヒット率・監査件数・誤再利用率・解析の出どころ（Gemini が必要だった割合）などの集計"""
+        with self._lock:
+            s = dict(self._stats)
+            s["entries"] = len(self._entries)
+            s["hit_rate"] = s["hits"] / s["lookups"] if s["lookups"] else 0.0
+            s["false_reuse_rate"] = s["false_reuses"] / s["audits"] if s["audits"] else 0.0
+            s["thresholds"] = dict(self.thresholds)
+            s["recent_audits"] = list(self.audit_log)
+            s["sources"] = dict(self._sources)
+        total = sum(s["sources"].values())
+        s["gemini_share"] = s["sources"]["gemini"] / total if total else 0.0
+        return s
+
+
+# --- 品目ごとの内訳キャッシュ ---
+
+# 品目の区切り（「と」は品目名の一部のこともあるので、分割候補として別に扱う）
+_ITEM_SEP_RE = re.compile(r"[、,，・+＋&＆/／\n\s]+")
+
+
+def split_meal_text(text):
+    """食事の説明を、読点・カンマ・空白などの明確な区切りで分ける"""
+    return [seg for seg in _ITEM_SEP_RE.split(text or "") if seg]
+
+
+def segment_items(segment, is_known):
+    """
+    区切りのない部分（「白米と味噌汁と焼き鮭」など）を、「と」の位置で
+    すべての断片が is_known(断片) を満たすように分割する（できなければ None）
+    「とんかつ」のように「と」を含む品目名もそのまま扱えるよう、分割位置は動的計画法で選ぶ
+    """
+    cuts = [i for i, ch in enumerate(segment) if ch == "と"]
+    n = len(segment)
+    best = {0: []}  # 開始位置 -> そこまでの分割
+    for start in [0] + [c + 1 for c in cuts]:
+        if start not in best:
+            continue
+        for end in [c for c in cuts if c > start] + [n]:
+            piece = segment[start:end]
+            if piece and is_known(piece):
+                nxt = end + 1 if end < n else n
+                if nxt not in best:
+                    best[nxt] = best[start] + [piece]
+    return best.get(n)
+
+
+class IngredientCache:
+    """
+    品目名（正規化済み）ごとの栄養素 (p, f, c, cal, 鉄, 葉酸, カルシウム, ビタミンD)
+    Gemini の内訳から蓄積し、既知の品目だけでできた食事をローカルで合計する（プロセス共有）
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items = {}  # 正規化した品目名 -> {"name", "result", "count"}
+        self._stats = {"lookups": 0, "assembled": 0}
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._stats = dict.fromkeys(self._stats, 0)
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, name):
+        item = self._items.get(normalize_food_text(name))
+        return item["result"] if item else None
+
+    def store_items(self, items, total):
+        """
+        Gemini の内訳 [{"name", "cal", "p", ...}, ...] を登録する
+        内訳の合計カロリーが全体（total の cal）と大きくずれているときは信用せず登録しない
+        Returns: 登録した品目数
+        """
+        results = []
+        for item in items or []:
+            name = str(item.get("name") or "").strip()
+            if not normalize_food_text(name):
+                continue
+            results.append((name, (
+                item.get("p", 0), item.get("f", 0), item.get("c", 0), item.get("cal", 0),
+                item.get("iron_mg", 0), item.get("folate_ug", 0),
+                item.get("calcium_mg", 0), item.get("vitamin_d_ug", 0),
+            )))
+        if not results:
+            return 0
+        item_cal = sum(r[3] or 0 for _, r in results)
+        total_cal = total[3] or 0
+        if abs(item_cal - total_cal) > ITEM_SUM_TOLERANCE * max(total_cal, 1):
+            return 0
+        with self._lock:
+            for name, result in results:
+                key = normalize_food_text(name)
+                prev = self._items.get(key)
+                self._items[key] = {"name": name, "result": result, "count": (prev["count"] + 1) if prev else 1}
+        return len(results)
+
+    def assemble(self, text, fallback=None):
+        """
+        食事の説明が既知の品目だけでできていれば、その合計を返す（1品でも未知なら None）
+        fallback(品目名) は内訳キャッシュにない品目の栄養素を返す関数（成分表など）
+        """
+        def resolve(piece):
+            return self.get(piece) or (fallback(piece) if fallback else None)
+
+        with self._lock:
+            self._stats["lookups"] += 1
+        parts = []
+        for seg in split_meal_text(text):
+            pieces = segment_items(seg, lambda piece: resolve(piece) is not None)
+            if pieces is None:
+                return None
+            parts.extend(resolve(piece) for piece in pieces)
+        if not parts:
+            return None
+        with self._lock:
+            self._stats["assembled"] += 1
+        return tuple(sum(part[i] or 0 for part in parts) for i in range(8))
+
+    def report(self):
+        """登録品目数とローカル合計のヒット率"""
+        with self._lock:
+            s = dict(self._stats)
+            s["items"] = len(self._items)
+        s["hit_rate"] = s["assembled"] / s["lookups"] if s["lookups"] else 0.0
+        return s
+
+
+@st.cache_resource
+def get_analysis_cache():
+    """プロセス全体で共有する解析キャッシュ（[gemini] embedding_model が設定されていれば埋め込みを使う）"""
+    try:
+        embedding_model = st.secrets["gemini"].get("embedding_model")
+    except Exception:
+        embedding_model = None
+    return AnalysisCache(embedding_model=embedding_model)
+
+
+@st.cache_resource
+def get_ingredient_cache():
+    """プロセス全体で共有する品目ごとの内訳キャッシュ"""
+    return IngredientCache()
@@ -4,6 +4,11 @@ import pathlib as _pathlib
 from datetime import date
 
 from config import get_supabase, get_gemini_client
+from deadlines import TIMEOUT_NOTICE, clear_deadline, is_timeout, start_deadline
+from gemini_usage import set_current_user
+from metrics import start_metrics_exporter
+from profiling import profiling_enabled, run_profiled
+from tracing import debug_panel_enabled, finish_trace, render_debug_panel, span, start_trace
 
 # --- ページ設定（必ず最初に1回だけ） ---
 st.set_page_config(page_title="AI PFC Manager", layout="centered")
@@ -106,8 +111,14 @@ st.markdown(f"""
 """, unsafe_allow_html=True)
 
 # --- 共通初期化 ---
-supabase = get_supabase()
-get_gemini_client()
+# このリランの処理時間を記録する（?debug=<token> でサイドバーに表示）
+trace = start_trace()
+# 外部呼び出しに使える時間の予算（Gemini / DB のタイムアウトはこの残り時間から決める。deadlines.py）
+start_deadline()
+with span("app.init"):
+    supabase = get_supabase()
+    get_gemini_client()
+    start_metrics_exporter()
 
 if "current_date" not in st.session_state:
     st.session_state.current_date = date.today()
@@ -123,12 +134,17 @@ class _DefaultUser:
 
 if "user" not in st.session_state:
     st.session_state["user"] = _DefaultUser()
+# Gemini の利用台帳に記録するユーザー（gemini_usage.py）
+set_current_user(st.session_state["user"].id)
 
 # AIモデルのデフォルト値
 if "selected_model" not in st.session_state:
     st.session_state["selected_model"] = "gemini-flash-latest"
 
 # --- ページルーティング（Streamlit推奨方式 / グループ分け） ---
+# プロファイルを取るセッションでは、保存したプロファイルの一覧ページも出す（profiling.py）
+profiling = profiling_enabled()
+profiles_page = st.Page("pages/profiles.py", title="プロファイル", icon="🔬")
 pg = st.navigation({
     "メイン": [
         st.Page("pages/meal_record.py", title="食事記録", icon="🍽️", default=True),
@@ -137,6 +153,23 @@ pg = st.navigation({
     ],
     "その他": [
         st.Page("pages/settings.py", title="設定", icon="⚙️"),
-    ],
+    ] + ([profiles_page] if profiling else []),
 })
-pg.run()
+trace.label = pg.title
+try:
+    with span(f"page.{pg.title}"):
+        if profiling and pg.title != profiles_page.title:
+            run_profiled(pg.run, pg.title)
+        else:
+            pg.run()
+except Exception as e:
+    # 外部サービスが応答しないときは、ページの残りを諦めて案内を出す（st.rerun() などの中断はそのまま通す）
+    if not is_timeout(e):
+        raise
+    print(f"[app] タイムアウト: {type(e).__name__} - {e}")
+    st.warning(TIMEOUT_NOTICE)
+finally:
+    finish_trace(trace)
+    clear_deadline()
+if debug_panel_enabled():
+    render_debug_panel(trace)
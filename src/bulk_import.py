@@ -0,0 +1,183 @@
+"""
+食事のまとめて取り込み（他のアプリからの移行用）
+
+貼り付けたテキストを (日付, 食事タイプ, 食事内容) に分け、数件ずつ1回の
+Gemini 呼び出しにまとめて、並行数を制限して解析する。解析できたものから
+複数行の挿入でまとめて保存し、進み具合と処理速度（件/分）を報告する。
+
+    items, errors = parse_bulk_meals("3/1 朝 トースト / 昼 ラーメン\\n3/2 夜 カレー", today=date.today())
+    report = import_meals(supabase, user_id, items, model_name, nonce, on_progress=...)
+"""
+
+import re
+import time
+import unicodedata
+from concurrent.futures import FIRST_COMPLETED, wait
+from datetime import date
+
+from config import get_bulk_executor
+from services import analyze_meals_batch, build_meal_log_row, make_idempotency_key, save_meal_logs
+
+BATCH_SIZE = 5        # 1回の Gemini 呼び出しでまとめて解析する件数
+MAX_CONCURRENCY = 3   # 同時に実行する解析の数（config.get_bulk_executor() の本数と揃える）
+INSERT_CHUNK = 50     # 1回の挿入でまとめて保存する行数
+
+# 食事タイプの書き方 -> 食事記録ページの食事タイプ（長いものから照合する）
+MEAL_TYPE_ALIASES = {
+    "朝食": "朝食", "朝ごはん": "朝食", "朝ご飯": "朝食", "朝": "朝食",
+    "昼食": "昼食", "昼ごはん": "昼食", "昼ご飯": "昼食", "ランチ": "昼食", "昼": "昼食",
+    "夕食": "夕食", "夕ごはん": "夕食", "夕ご飯": "夕食", "夕飯": "夕食", "晩ごはん": "夕食", "晩ご飯": "夕食",
+    "夜ごはん": "夕食", "夜ご飯": "夕食", "ディナー": "夕食", "夕": "夕食", "晩": "夕食", "夜": "夕食",
+    "間食": "間食", "おやつ": "間食",
+    "夜食": "夜食",
+}
+
+_DATE = r"(?:(?P<year>\d{4})[/\-.年])?(?P<month>\d{1,2})[/\-.月](?P<day>\d{1,2})日?(?:\([^)]*\))?"
+_MEAL = "|".join(sorted(map(re.escape, MEAL_TYPE_ALIASES), key=len, reverse=True))
+# 日付・食事タイプは、行頭・空白・区切り記号の直後にあり、空白・コロン・行末が続くものだけを区切りとみなす
+# （「1/2個」の 1/2 や「朝霧」の 朝 は区切りにしない）
+_TOKEN_RE = re.compile(
+    rf"(?<![^\s/,、|])(?:(?P<date>{_DATE})|(?P<meal>{_MEAL}))(?=[\s:]|$)",
+    re.MULTILINE,
+)
+_EDGE_CHARS = " \t\r\n/,、|:"
+
+
+def parse_bulk_meals(text, today=None):
+    """
+    貼り付けたテキストを食事ごとに分ける
+    日付（3/1・2026/3/1・3月1日(日) など）はその後の食事すべてに、食事タイプ（朝・昼・夜・おやつ など）は
+    次の区切りまでの食事内容に適用する。年を省略した日付は today 以前で最も近い年とみなし、
+    日付が出てくる前の食事は today の食事とする。
+
+    Returns: (items, errors)
+        items: [{"index", "meal_date", "meal_type", "text"}, ...]（出てきた順）
+        errors: 食事タイプが分からなかった部分や、存在しない日付の文字列のリスト
+    """
+    today = today or date.today()
+    text = unicodedata.normalize("NFKC", text or "")
+    items, errors = [], []
+    current_date, current_meal = today, None
+
+    def flush(chunk):
+        chunk = " ".join(line.strip(_EDGE_CHARS) for line in chunk.splitlines())
+        chunk = chunk.strip(_EDGE_CHARS)
+        if not chunk:
+            return
+        if current_meal is None or current_date is None:
+            errors.append(chunk)
+        else:
+            items.append({"index": len(items), "meal_date": current_date, "meal_type": current_meal, "text": chunk})
+
+    pos = 0
+    for m in _TOKEN_RE.finditer(text):
+        flush(text[pos:m.start()])
+        pos = m.end()
+        if m.group("date"):
+            current_date = _resolve_date(m, today)
+            current_meal = None
+            if current_date is None:
+                errors.append(m.group("date"))
+        else:
+            current_meal = MEAL_TYPE_ALIASES[m.group("meal")]
+    flush(text[pos:])
+    return items, errors
+
+
+def _resolve_date(m, today):
+    """日付の一致から date を作る（存在しない日付なら None）"""
+    month, day = int(m.group("month")), int(m.group("day"))
+    try:
+        if m.group("year"):
+            return date(int(m.group("year")), month, day)
+        d = date(today.year, month, day)
+        return d if d <= today else date(today.year - 1, month, day)
+    except ValueError:
+        return None
+
+
+def run_bulk_import(items, analyze_batch, save_rows, batch_size=BATCH_SIZE,
+                    max_concurrency=MAX_CONCURRENCY, insert_chunk=INSERT_CHUNK,
+                    on_progress=None, executor=None):
+    """
+    食事を batch_size 件ずつ analyze_batch(texts) -> [結果 or None, ...] で解析し（同時に max_concurrency 件まで）、
+    解析できたものを insert_chunk 行ずつ save_rows([(item, 結果), ...]) -> 保存件数 で保存する。
+    on_progress(report) は解析が1回終わるたびに呼び出し元のスレッドで呼ぶ（進み具合の表示用）。
+
+    Returns: {"items", "batches", "analyzed", "saved", "failed": [item, ...], "save_errors", "elapsed", "items_per_min"}
+    """
+    executor = executor or get_bulk_executor()
+    batches = iter([items[i:i + batch_size] for i in range(0, len(items), batch_size)])
+    report = {
+        "items": len(items), "batches": -(-len(items) // batch_size), "analyzed": 0, "saved": 0,
+        "failed": [], "save_errors": 0, "elapsed": 0.0, "items_per_min": 0.0,
+    }
+    started = time.perf_counter()
+    in_flight = {}
+    rows = []
+
+    def submit_next():
+        batch = next(batches, None)
+        if batch:
+            in_flight[executor.submit(analyze_batch, [item["text"] for item in batch])] = batch
+
+    def save(chunk):
+        try:
+            report["saved"] += save_rows(chunk)
+        except Exception as e:
+            print(f"[bulk_import] 保存エラー: {e}")
+            report["save_errors"] += len(chunk)
+
+    def update():
+        report["elapsed"] = time.perf_counter() - started
+        done = report["analyzed"] + len(report["failed"])
+        report["items_per_min"] = done / report["elapsed"] * 60 if report["elapsed"] else 0.0
+        if on_progress:
+            on_progress(report)
+
+    for _ in range(max_concurrency):
+        submit_next()
+    while in_flight:
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            batch = in_flight.pop(future)
+            try:
+                results = future.result()
+            except Exception as e:
+                print(f"[bulk_import] 解析エラー: {e}")
+                results = [None] * len(batch)
+            for item, result in zip(batch, results):
+                if result:
+                    rows.append((item, result))
+                    report["analyzed"] += 1
+                else:
+                    report["failed"].append(item)
+            submit_next()
+        while len(rows) >= insert_chunk:
+            save(rows[:insert_chunk])
+            del rows[:insert_chunk]
+        update()
+    if rows:
+        save(rows)
+    update()
+    return report
+
+
+def import_meals(supabase, user_id, items, model_name, nonce, **kwargs):
+    """
+    parse_bulk_meals() の食事を解析して meal_logs に保存する（引数は run_bulk_import() と同じものを渡せる）
+    冪等キーは nonce（貼り付けたテキストごとの値）と食事の位置から作るので、同じ取り込みを二重に保存しない
+    """
+    def save_rows(pairs):
+        rows = [
+            build_meal_log_row(
+                user_id, item["meal_date"], item["meal_type"], item["text"], *result,
+                idempotency_key=make_idempotency_key(
+                    user_id, item["meal_date"], item["meal_type"], f"bulk:{item['index']}:{item['text']}", nonce,
+                ),
+            )
+            for item, result in pairs
+        ]
+        return sum(1 for row in save_meal_logs(supabase, rows) if row)
+
+    return run_bulk_import(items, lambda texts: analyze_meals_batch(texts, model_name), save_rows, **kwargs)
@@ -1,12 +1,160 @@
+import functools
+import hashlib
+import html
+import math
+import threading
+from collections import OrderedDict
+
+import pandas as pd
 import plotly.graph_objects as go
+import plotly.io as pio
+import streamlit as st
+
+from metrics import cache_requests
+from tracing import traced
 
 # --- カラー定数 ---
 TEAL = "#00ACC1"
 TEAL_LIGHT = "rgba(0, 172, 193, 0.15)"
 RED = "#FF5252"
 TEXT_COLOR = "#111"
+GRID_COLOR = "rgba(0,0,0,0.08)"
+FONT_FAMILY = "sans-serif"
+
+RENDERERS = ("svg", "plotly")
+FIGURE_CACHE_SIZE = 64  # プロセス全体で保持するグラフの数（古く使われていないものから捨てる）
+
+
+# --- グラフのメモ化 ---
+class ChartFigure(go.Figure):
+    """
+    組み立て後に freeze() すると、to_dict()（st.plotly_chart が毎回呼ぶ）と to_json() の結果を
+    1度だけ作って使い回す Figure。memoize_figure() でキャッシュしたものはセッション間で共有するので変更しないこと
+    """
+
+    def freeze(self):
+        self._payload = super().to_dict()
+        self._json = pio.to_json(self._payload, validate=False)
+        return self
+
+    def to_dict(self):
+        payload = getattr(self, "_payload", None)
+        return payload if payload is not None else super().to_dict()
+
+    def to_json(self, *args, **kwargs):
+        cached = getattr(self, "_json", None)
+        if cached is not None and not args and not kwargs:
+            return cached
+        return super().to_json(*args, **kwargs)
+
+
+def _feed(h, value):
+    h.update(type(value).__name__.encode())
+    if isinstance(value, pd.DataFrame):
+        h.update(repr(list(value.columns)).encode())
+        h.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+    elif isinstance(value, dict):
+        for key in sorted(value, key=str):
+            _feed(h, key)
+            _feed(h, value[key])
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _feed(h, item)
+    else:
+        h.update(repr(value).encode())
+    h.update(b"\x1f")
+
+
+def input_hash(*args, **kwargs):
+    """グラフの入力（数値・文字列・dict・list・DataFrame）のハッシュ"""
+    h = hashlib.sha1()
+    _feed(h, args)
+    _feed(h, kwargs)
+    return h.hexdigest()
+
 
+class FigureCache:
+    """入力のハッシュ → 組み立て済みのグラフ（ChartFigure または SVG の文字列。LRU）"""
 
+    def __init__(self, maxsize=FIGURE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._figures = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            fig = self._figures.get(key)
+            if fig is not None:
+                self._figures.move_to_end(key)
+            return fig
+
+    def put(self, key, fig):
+        with self._lock:
+            self._figures[key] = fig
+            self._figures.move_to_end(key)
+            while len(self._figures) > self.maxsize:
+                self._figures.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._figures.clear()
+
+    def __len__(self):
+        return len(self._figures)
+
+
+# リランのたびに呼ばれるので、@st.cache_resource の関数呼び出しを挟まずモジュールで1つだけ持つ
+figure_cache = FigureCache()
+
+
+def memoize_figure(name):
+    """
+    ChartFigure（または SVG の文字列）を返すグラフ関数を、入力のハッシュでメモ化するデコレーター
+    入力が変わらないリランでは組み立て・to_dict()・JSON への変換をせずに前回の結果を返す
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (name, input_hash(*args, **kwargs))
+            fig = figure_cache.get(key)
+            if fig is not None:
+                cache_requests.inc(function=name, result="hit")
+                return fig
+            cache_requests.inc(function=name, result="miss")
+            fig = func(*args, **kwargs)
+            if isinstance(fig, ChartFigure):
+                fig.freeze()
+            figure_cache.put(key, fig)
+            return fig
+        return wrapper
+    return decorator
+
+
+def _summary_rows(data_dict):
+    """達成率グラフの行（上から順に (ラベル, 達成率%, 右側の数値テキスト)）"""
+    rows = []
+    for label, d in data_dict.items():
+        raw_target = d["target"]
+        raw_current = d["current"]
+        # None ガード: Supabase が null を返した場合でも計算できるようにする
+        safe_current = raw_current if raw_current is not None else 0
+        raw_target_val = raw_target if raw_target is not None else 0
+        safe_target = raw_target_val if raw_target_val > 0 else 1
+        ratio = (safe_current / safe_target) * 100
+        disp_target = int(raw_target) if raw_target is not None else 0
+        disp_current = int(raw_current) if raw_current is not None else 0
+        rows.append((label, ratio, f"{disp_current} / {disp_target} {d['unit']}"))
+    return rows
+
+
+def _summary_x_max(ratios):
+    """達成率グラフの横軸の右端（右側の数値テキストの余白を含む）"""
+    x_display_max = max(max(ratios, default=0), 100)
+    return x_display_max + max(x_display_max * 0.45, 50)
+
+
+@traced("chart.summary")
+@memoize_figure("chart.summary")
 def create_summary_chart(data_dict):
     """
     B案デザインの達成率グラフを作成（Plotly版）
@@ -14,6 +162,7 @@ def create_summary_chart(data_dict):
     - 超過時はバー2分割（通常色＋赤）＋吹き出し＋100%マーカー
     - 左側に円形ラベル
     - 背景透過
+    - 同じ入力ではキャッシュした Figure を返す（memoize_figure）
 
     data_dict = {
         'Cal': {'current': 673, 'target': 1210, 'unit': 'kcal'},
@@ -23,38 +172,19 @@ def create_summary_chart(data_dict):
 
     Returns: plotly.graph_objects.Figure
     """
-    labels = list(data_dict.keys())
     # 上からCal, P, F, Cの順 → Plotlyも下から描画するので逆順
-    labels.reverse()
+    rows = _summary_rows(data_dict)[::-1]
+    labels = [label for label, _, _ in rows]
+    ratios = [ratio for _, ratio, _ in rows]
+    value_texts = [vtext for _, _, vtext in rows]
 
     n = len(labels)
     y_pos = list(range(n))
 
-    # --- データの準備 ---
-    ratios = []
-    value_texts = []
-
-    for label in labels:
-        d = data_dict[label]
-        raw_target = d["target"]
-        raw_current = d["current"]
-        # None ガード: Supabase が null を返した場合でも計算できるようにする
-        safe_current = raw_current if raw_current is not None else 0
-        raw_target_val = raw_target if raw_target is not None else 0
-        safe_target = raw_target_val if raw_target_val > 0 else 1
-        ratio = (safe_current / safe_target) * 100
-        ratios.append(ratio)
-        disp_target = int(raw_target) if raw_target is not None else 0
-        disp_current = int(raw_current) if raw_current is not None else 0
-        value_texts.append(f"{disp_current} / {disp_target} {d['unit']}")
-
-    max_ratio = max(ratios) if ratios else 0
-    x_display_max = max(max_ratio, 100)
-    x_max = x_display_max + max(x_display_max * 0.45, 50)
-
+    x_max = _summary_x_max(ratios)
     bar_width = 0.50
 
-    fig = go.Figure()
+    fig = ChartFigure()
 
     # ============================================================
     # 1) トラックバー（背景レール）— 常に100%幅
@@ -184,3 +314,258 @@ def create_summary_chart(data_dict):
     )
 
     return fig
+
+
+# --- SVG 版（静的なグラフを Plotly.js なしで描く） ---
+def _num(v):
+    """SVG の座標（小数2桁まで）"""
+    return f"{v:.2f}".rstrip("0").rstrip(".")
+
+
+def _svg(height, body, label):
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="100%" height="{height}" role="img" '
+        f'aria-label="{html.escape(label)}" font-family="{FONT_FAMILY}" style="display:block">{body}</svg>'
+    )
+
+
+@traced("chart.summary_svg")
+@memoize_figure("chart.summary_svg")
+def create_summary_svg(data_dict):
+    """
+    create_summary_chart() と同じデザインの達成率グラフをインラインの SVG で作る
+    横方向は % で指定するので、コンテナの幅に合わせて伸び縮みしても文字の大きさは変わらない
+
+    Returns: SVG の文字列（st.html で表示する）
+    """
+    rows = _summary_rows(data_dict)
+    n = len(rows)
+    height = 230
+    x_max = _summary_x_max([ratio for _, ratio, _ in rows])
+    # Plotly 版の横軸 [-16, x_max] を左右の余白を除いた 2%〜98% に対応させる
+    def x(v):
+        return 2 + (v + 16) / (x_max + 16) * 96
+
+    def w(v):
+        return v / (x_max + 16) * 96
+
+    pitch = (height - 20) / (n + 0.2)
+    bar_h = pitch * 0.5
+    parts = []
+    for i, (label, ratio, vtext) in enumerate(rows):
+        cy = 10 + (0.6 + i) * pitch
+        top = _num(cy - bar_h / 2)
+        bar = f'y="{top}" height="{_num(bar_h)}"'
+        parts.append(f'<rect x="{_num(x(0))}%" width="{_num(w(100))}%" {bar} fill="{TEAL_LIGHT}"/>')
+        parts.append(f'<rect x="{_num(x(0))}%" width="{_num(w(min(ratio, 100)))}%" {bar} fill="{TEAL}"/>')
+        text = html.escape(vtext)
+        if ratio > 100:
+            parts.append(f'<rect x="{_num(x(100))}%" width="{_num(w(ratio - 100))}%" {bar} fill="{RED}"/>')
+            parts.append(
+                f'<line x1="{_num(x(100))}%" x2="{_num(x(100))}%" y1="{top}" y2="{_num(cy + bar_h / 2)}" '
+                f'stroke="#555" stroke-width="1" stroke-dasharray="2,2"/>'
+            )
+            text += f'  <tspan font-weight="bold">({int(ratio)}%)</tspan>'
+        parts.append(f'<circle cx="{_num(x(-8))}%" cy="{_num(cy)}" r="14" fill="{TEAL}"/>')
+        parts.append(
+            f'<text x="{_num(x(-8))}%" y="{_num(cy)}" text-anchor="middle" dominant-baseline="central" '
+            f'font-size="9" font-weight="900" font-family="Arial Black, Arial, sans-serif" fill="white">'
+            f'{html.escape(label)}</text>'
+        )
+        parts.append(
+            f'<text x="{_num(x(ratio + 2))}%" y="{_num(cy)}" dominant-baseline="central" '
+            f'font-size="11" fill="{TEXT_COLOR}" xml:space="preserve">{text}</text>'
+        )
+    return _svg(height, "".join(parts), "達成率")
+
+
+def _nice_ticks(vmax, count=5):
+    """0 から vmax までを覆うきりのよい目盛り（1・2・2.5・5 × 10^k 刻み）"""
+    if not vmax or vmax <= 0 or math.isnan(vmax):
+        return [0, 1]
+    raw = vmax / count
+    magnitude = 10 ** math.floor(math.log10(raw))
+    step = next(m * magnitude for m in (1, 2, 2.5, 5, 10) if m * magnitude >= raw)
+    top = math.ceil(vmax / step) * step
+    return [round(i * step, 6) for i in range(int(round(top / step)) + 1)]
+
+
+def _fmt_tick(v):
+    return f"{int(v):,}" if float(v).is_integer() else f"{v:g}"
+
+
+def _x_labels(labels, y):
+    """横軸のラベル（多いときは8個程度に間引く）"""
+    n = max(len(labels), 1)
+    step = math.ceil(len(labels) / 8) if labels else 1
+    return [
+        f'<text x="{_num(10 + (i + 0.5) * 88 / n)}%" y="{y}" text-anchor="middle" font-size="10" '
+        f'fill="{TEXT_COLOR}">{html.escape(str(labels[i]))}</text>'
+        for i in range(0, len(labels), step)
+    ]
+
+
+def _trend_panel(n, values, bar_color, top_px, plot_h, bar_name="", line=None, line_color=TEAL, line_name=None,
+                 avg=None, avg_text=None, avg_color=None, target=None, target_text=None, target_fill=None,
+                 target_line_color=None, show_legend=False, title=None):
+    """推移グラフ1段分の SVG 要素（縦 top_px から plot_h の高さ。凡例・題名はその上の余白に置く）"""
+    line_vals = [v for v in (line or []) if v is not None and not math.isnan(v)]
+    ticks = _nice_ticks(max([*values, *line_vals, avg or 0, (target or 0) * 1.05], default=0) * 1.05)
+    vmax = ticks[-1]
+
+    # 描画領域は横 10%〜98%。中は viewBox（横は日数・縦は0〜100）で描く
+    def y(v):
+        return 100 * (1 - v / vmax)
+
+    def y_px(v):
+        return top_px + plot_h * (1 - v / vmax)
+
+    inner = []
+    for t in ticks:
+        inner.append(f'<line x1="0" x2="{n}" y1="{_num(y(t))}" y2="{_num(y(t))}" stroke="{GRID_COLOR}" '
+                     f'stroke-width="1" vector-effect="non-scaling-stroke"/>')
+    if target:
+        inner.append(f'<rect x="0" width="{n}" y="{_num(y(target))}" height="{_num(100 - y(target))}" '
+                     f'fill="{target_fill or TEAL_LIGHT}"/>')
+    for i, v in enumerate(values):
+        if v:
+            inner.append(f'<rect x="{_num(i + 0.1)}" width="0.8" y="{_num(y(v))}" height="{_num(100 - y(v))}" '
+                         f'fill="{bar_color}"/>')
+    if target:
+        inner.append(f'<line x1="0" x2="{n}" y1="{_num(y(target))}" y2="{_num(y(target))}" '
+                     f'stroke="{target_line_color or line_color}" stroke-width="1" vector-effect="non-scaling-stroke"/>')
+    if avg is not None:
+        inner.append(f'<line x1="0" x2="{n}" y1="{_num(y(avg))}" y2="{_num(y(avg))}" '
+                     f'stroke="{avg_color or line_color}" stroke-width="2" vector-effect="non-scaling-stroke"/>')
+    if line is not None:
+        points = " ".join(f"{_num(i + 0.5)},{_num(y(v))}" for i, v in enumerate(line)
+                          if v is not None and not math.isnan(v))
+        if points:
+            inner.append(f'<polyline points="{points}" fill="none" stroke="{line_color}" stroke-width="2.5" '
+                         f'stroke-linejoin="round" vector-effect="non-scaling-stroke"/>')
+
+    parts = [
+        f'<svg x="10%" y="{top_px}" width="88%" height="{plot_h}" viewBox="0 0 {n} 100" '
+        f'preserveAspectRatio="none" overflow="visible">{"".join(inner)}</svg>'
+    ]
+    # 縦軸の目盛り
+    for t in ticks:
+        parts.append(f'<text x="9%" y="{_num(y_px(t))}" text-anchor="end" dominant-baseline="central" '
+                     f'font-size="10" fill="{TEXT_COLOR}">{_fmt_tick(t)}</text>')
+    # 注釈（目標は左上・平均は右上）
+    if target and target_text:
+        parts.append(f'<text x="10.5%" y="{_num(y_px(target) - 4)}" font-size="11" '
+                     f'fill="{TEXT_COLOR}">{html.escape(target_text)}</text>')
+    if avg is not None and avg_text:
+        parts.append(f'<text x="97.5%" y="{_num(y_px(avg) - 4)}" text-anchor="end" font-size="10" '
+                     f'fill="{TEXT_COLOR}">{html.escape(avg_text)}</text>')
+    # 題名（左上）と凡例（上部中央）
+    if title:
+        parts.append(f'<text x="1%" y="{top_px - 16}" font-size="12" font-weight="bold" '
+                     f'fill="{TEXT_COLOR}">{html.escape(title)}</text>')
+    if show_legend:
+        legend = f'<tspan fill="{bar_color}">■</tspan> {html.escape(bar_name)}'
+        if line is not None and line_name:
+            legend += f'  <tspan fill="{line_color}">━</tspan> {html.escape(line_name)}'
+        parts.append(f'<text x="{"98%" if title else "50%"}" y="{top_px - 16}" '
+                     f'text-anchor="{"end" if title else "middle"}" font-size="11" fill="{TEXT_COLOR}" '
+                     f'xml:space="preserve">{legend}</text>')
+    return parts
+
+
+@traced("chart.trend_svg")
+def create_trend_svg(labels, values, bar_color, height, **panel):
+    """
+    ダッシュボードの推移グラフ（日ごとの棒＋移動平均の線 or 平均線＋目標の帯と線）をインラインの SVG で作る
+    pages/dashboard.py の Plotly 版（create_nutrient_chart / create_calorie_chart）と同じ要素・配色にする
+
+    labels / values: 日ごとのラベルと値
+    panel: bar_name / line（移動平均。NaN の日は線をつなぐ）/ line_color / line_name /
+           avg（期間全体の平均の線）/ avg_text / target（0 からの帯と線）/ target_text / target_fill /
+           target_line_color / show_legend
+
+    Returns: SVG の文字列（st.html で表示する）
+    """
+    top_px, bottom_px = 30, 20
+    parts = _trend_panel(max(len(labels), 1), values, bar_color, top_px, height - top_px - bottom_px, **panel)
+    parts += _x_labels(labels, height - 5)
+    return _svg(height, "".join(parts), panel.get("bar_name") or "推移")
+
+
+@traced("chart.stacked_trend_svg")
+def create_stacked_trend_svg(labels, panels, panel_height=150):
+    """
+    推移グラフを縦に並べた1枚の SVG（横軸は共通で、日付のラベルは一番下だけに付ける）
+    panels: [{"values", "bar_color", "title", ...create_trend_svg() の panel と同じ引数}, ...]
+
+    Returns: SVG の文字列（st.html で表示する）
+    """
+    n = max(len(labels), 1)
+    header_px, gap_px, bottom_px = 26, 8, 20
+    parts = []
+    for i, panel in enumerate(panels):
+        panel = dict(panel)
+        top = i * panel_height + header_px
+        parts += _trend_panel(n, panel.pop("values"), panel.pop("bar_color"), top,
+                              panel_height - header_px - gap_px, **panel)
+    height = len(panels) * panel_height + bottom_px
+    parts += _x_labels(labels, height - 5)
+    return _svg(height, "".join(parts), "PFC・カロリーの推移")
+
+
+def chart_renderer():
+    """
+    グラフの描画方法。既定は "svg"（Plotly.js と Figure の JSON を送らない）
+    secrets の [charts] renderer = "plotly" で従来の Plotly（staticPlot）に戻せる
+    """
+    try:
+        renderer = st.secrets.get("charts", {}).get("renderer", "svg")
+    except Exception:
+        renderer = "svg"
+    return renderer if renderer in RENDERERS else "svg"
+
+
+def render_chart(svg_builder, figure_builder, *args, **kwargs):
+    """同じ引数で SVG 版（st.html）か Plotly 版（静的な st.plotly_chart）のどちらかを描画する"""
+    if chart_renderer() == "plotly":
+        st.plotly_chart(figure_builder(*args, **kwargs), use_container_width=True, config={"staticPlot": True})
+    else:
+        st.html(svg_builder(*args, **kwargs))
+
+
+def create_trace_waterfall(spans):
+    """
+    デバッグパネル用: 1回のリランのスパンをウォーターフォール（開始時刻から所要時間の横棒）で表示
+    spans: tracing.Trace.spans（開始順。depth で字下げする）
+
+    Returns: plotly.graph_objects.Figure
+    """
+    n = len(spans)
+    labels = [f"{'　' * s['depth']}{s['name']}" for s in spans]
+    fig = go.Figure(go.Bar(
+        y=list(range(n)),
+        x=[max(s["duration_ms"], 0.1) for s in spans],
+        base=[s["start_ms"] for s in spans],
+        orientation="h",
+        marker=dict(color=[RED if s["name"].startswith(("supabase.", "gemini.")) else TEAL for s in spans]),
+        text=[f"{s['duration_ms']:.1f}ms" for s in spans],
+        textposition="outside",
+        cliponaxis=False,
+        hoverinfo="none",
+    ))
+    fig.update_layout(
+        template="none",
+        height=max(120, 22 * n + 40),
+        margin=dict(l=10, r=40, t=10, b=30),
+        paper_bgcolor="rgba(0,0,0,0)",
+        plot_bgcolor="rgba(0,0,0,0)",
+        xaxis=dict(title="ms", fixedrange=True),
+        yaxis=dict(
+            tickvals=list(range(n)),
+            ticktext=labels,
+            autorange="reversed",
+            fixedrange=True,
+        ),
+        font=dict(size=10, color=TEXT_COLOR),
+    )
+    return fig
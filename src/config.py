@@ -1,6 +1,12 @@
+import contextvars
 import streamlit as st
-from supabase import create_client, Client
+from concurrent.futures import ThreadPoolExecutor
+from supabase import ClientOptions, create_client, Client
 from google import genai
+from google.genai import types
+
+from deadlines import DB_TIMEOUT, GEMINI_TIMEOUT
+from tracing import instrument_gemini, instrument_supabase
 
 # --- Supabase接続 ---
 @st.cache_resource
@@ -10,7 +16,11 @@ def init_supabase():
         url = st.secrets["supabase"]["url"]
         # service_key が設定されていればサーバーサイド用として使用（RLS をバイパス）
         key = st.secrets["supabase"].get("service_key") or st.secrets["supabase"]["key"]
-        return create_client(url, key)
+        # クエリごとの所要時間をトレースに記録する（tracing.py）
+        # 応答しないクエリでリランが止まらないよう、1回のクエリの上限を設定する（既定は120秒）
+        # リラン中のクエリは db_calls.execute_query() が残りの予算に合わせてさらに短くする
+        options = ClientOptions(postgrest_client_timeout=DB_TIMEOUT)
+        return instrument_supabase(create_client(url, key, options=options))
     return None
 
 def get_supabase() -> Client:
@@ -30,5 +40,30 @@ def get_supabase() -> Client:
 def get_gemini_client():
     """Gemini APIクライアントを初期化して返す"""
     if "gemini" in st.secrets:
-        return genai.Client(api_key=st.secrets["gemini"]["api_key"])
+        # 呼び出しごとのタイムアウトは gemini_usage.generate_content() がリランの残り時間から設定する
+        http_options = types.HttpOptions(timeout=int(GEMINI_TIMEOUT * 1000))
+        return instrument_gemini(genai.Client(api_key=st.secrets["gemini"]["api_key"], http_options=http_options))
     return None
+
+# --- バックグラウンド処理 ---
+class _ContextExecutor(ThreadPoolExecutor):
+    """submit() した時点のコンテキスト変数（Gemini の利用者など）を引き継いで実行するスレッドプール"""
+
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+@st.cache_resource
+def get_executor() -> ThreadPoolExecutor:
+    """DB再取得などのバックグラウンド処理で共有するスレッドプールを返す"""
+    return _ContextExecutor(max_workers=4, thread_name_prefix="pfc-bg")
+
+
+@st.cache_resource
+def get_bulk_executor() -> ThreadPoolExecutor:
+    """
+    まとめて取り込み専用のスレッドプールを返す
+    長く続く一括解析が get_executor() の共有スレッドプールを占有しないよう分けている
+    （同時に複数の取り込みが走っても、解析の並行数は合わせてこの本数まで）
+    """
+    return _ContextExecutor(max_workers=3, thread_name_prefix="pfc-bulk")
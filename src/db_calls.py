@@ -0,0 +1,125 @@
+"""
+Supabase の呼び出しの再試行（指数バックオフ＋ジッター）とエラーの分類
+
+services.py などの DB 操作はすべて execute_query() でクエリを実行する。
+一時的なエラー（タイムアウト・接続エラー・429・5xx）だけを再試行し、待ち時間は
+BASE_DELAY から倍々に MAX_DELAY まで延ばした範囲でランダムに決める（同時に失敗した呼び出しが揃って再試行しないように）。
+
+- 読み込みは何度実行しても同じなので再試行する
+- 書き込みは冪等キーのあるもの（同じキーの行は挿入されない upsert）だけを再試行する。
+  キーのない挿入・更新・削除は、タイムアウトでも実は反映されている可能性があるので再試行しない
+- 1回の呼び出し（再試行を含む）は CALL_BUDGET 秒まで。リランの予算（deadlines.py）が残っていなければそこで諦める
+- 各回の送信の前に deadlines.checkpoint() で予算と中断を確かめ、送信には DB_TIMEOUT と残りの予算の短いほうの
+  タイムアウトを付ける（クライアントに設定した DB_TIMEOUT のままだと、予算の残りが短くても最後まで待ってしまう）
+- 再試行の待ち時間は deadlines.pause() で待つので、新しいリランが要求されればすぐに中断する
+
+再試行・失敗は分類（kind）ごとにメトリクス（metrics.py）に数える。
+"""
+
+import random
+import time
+
+from deadlines import current_deadline, is_timeout, pause, timeout_for, DB_TIMEOUT, MIN_TIMEOUT
+from metrics import db_failures, db_retries, error_code
+
+MAX_ATTEMPTS = 3
+BASE_DELAY = 0.2   # 1回目の再試行の最大の待ち時間（秒）
+MAX_DELAY = 2.0    # 待ち時間の上限（秒）
+CALL_BUDGET = 8.0  # 1回の呼び出し（再試行を含む）に使える秒数
+
+RETRYABLE = frozenset(("timeout", "connection", "rate_limited", "server"))
+# 一時的な失敗を表す Postgres の SQLSTATE（文のキャンセル・直列化の失敗・デッドロック・接続数の上限）
+_TRANSIENT_SQLSTATES = frozenset(("57014", "40001", "40P01", "53300"))
+
+
+def classify_error(exc):
+    """
+    DB 呼び出しの例外の分類
+    timeout / connection / rate_limited / server は一時的な失敗（再試行する）、
+    conflict（ユニーク制約）/ client（その他の 4xx・SQL のエラー）/ unknown は再試行しない
+    """
+    if is_timeout(exc):
+        return "timeout"
+    name = type(exc).__name__
+    if isinstance(exc, ConnectionError) or any(s in name for s in ("Connect", "Network", "Protocol")):
+        return "connection"
+    code = getattr(exc, "code", None)
+    code = str(code) if code is not None else error_code(exc)
+    if code == "429":
+        return "rate_limited"
+    if (len(code) == 3 and code.startswith("5")) or code in _TRANSIENT_SQLSTATES or code.startswith("08"):
+        return "server"
+    if code == "23505":
+        return "conflict"
+    if code.isdigit() or code.startswith("PGRST") or len(code) == 5:
+        return "client"
+    return "unknown"
+
+
+def backoff_delay(attempt):
+    """attempt 回目（0 始まり）の失敗のあとに待つ秒数（full jitter）"""
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+
+
+def _fits_budget(delay, call_expires):
+    """待ってから呼び直しても、この呼び出しとリランの予算が残るか"""
+    after = time.monotonic() + delay
+    if after >= call_expires:
+        return False
+    deadline = current_deadline()
+    return deadline is None or deadline.expires - after >= MIN_TIMEOUT
+
+
+class _TimedSession:
+    """クエリが使う httpx.Client の代理。request() に呼び出しごとのタイムアウトを付ける（クライアントは共有のまま）"""
+
+    __slots__ = ("session", "timeout")
+
+    def __init__(self, session, timeout):
+        self.session = session
+        self.timeout = timeout
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(*args, **kwargs)
+
+    def __getattr__(self, attr):
+        return getattr(self.session, attr)
+
+
+def _with_timeout(query, timeout):
+    """
+    クエリの送信に timeout 秒の上限を付ける
+    postgrest のクエリはクエリごとの送信設定（request）に共有の httpx.Client を持つので、その参照だけを差し替える
+    """
+    request = getattr(query, "request", None)
+    session = getattr(request, "session", None)
+    if session is not None:
+        if isinstance(session, _TimedSession):
+            session = session.session
+        request.session = _TimedSession(session, timeout)
+    return query
+
+
+def execute_query(query, name, idempotent=True):
+    """
+    クエリ（supabase.table(...)... の execute() 前）を実行する
+    一時的なエラーなら idempotent のときだけ待ってから再試行し、それでも失敗すれば最後の例外を送出する
+    name はメトリクス・ログに使う呼び出し元の関数名
+    """
+    call_expires = time.monotonic() + CALL_BUDGET
+    for attempt in range(MAX_ATTEMPTS):
+        # リランの予算を使い切っていたり、新しいリランが要求されていれば呼ばずに中断する（timeout_for が確かめる）
+        timeout = timeout_for(DB_TIMEOUT)
+        try:
+            return _with_timeout(query, timeout).execute()
+        except Exception as e:
+            kind = classify_error(e)
+            delay = backoff_delay(attempt)
+            if (not idempotent or kind not in RETRYABLE or attempt + 1 == MAX_ATTEMPTS
+                    or not _fits_budget(delay, call_expires)):
+                db_failures.inc(function=name, kind=kind)
+                raise
+            db_retries.inc(function=name, kind=kind)
+            print(f"[{name}] {kind} のため {delay:.2f}秒後に再試行します: {e}")
+        pause(delay)
@@ -0,0 +1,140 @@
+"""
+リランごとの時間の予算（デッドライン）と、外部呼び出しのタイムアウト・協調的な中断
+
+app.py が1回のリランに PAGE_BUDGET 秒の予算を設定し、Gemini / Supabase の呼び出しは
+呼ぶ前に checkpoint() で予算と中断を確かめる。Gemini と Supabase（db_calls.execute_query()）は
+残りの予算から求めたタイムアウトを1回ごとに渡し、バックグラウンドの解析を待つときは wait_for() で短い間隔で待ちながら確かめる。
+ユーザーの操作で新しいリランが要求されていれば、Streamlit の中断（RerunException など）を送出して
+すぐにスクリプトのスレッドを解放する（待っていた Future は取り消すか結果を捨てる）。
+
+フラグメントだけのリランでは app.py が実行されないので、fragments.py の @fragment が予算を設定する。
+予算はリランを始めたスクリプトのスレッドだけに適用する。共有スレッドプールの処理（先行解析・
+確認ジョブなど）はリランをまたいで続くので、呼び出しごとの上限（GEMINI_TIMEOUT / DB_TIMEOUT）だけを使う。
+"""
+
+import contextlib
+import contextvars
+import threading
+import time
+from concurrent.futures import wait
+
+from streamlit.runtime.scriptrunner_utils.script_run_context import get_run_yield_check
+
+PAGE_BUDGET = 20.0     # 1回のリランで外部呼び出しに使える秒数
+GEMINI_TIMEOUT = 30.0  # Gemini の1回の呼び出しの上限（秒）
+DB_TIMEOUT = 10.0      # Supabase の1回のクエリの上限（秒。クライアントに設定し、execute_query() が予算に合わせて短くする）
+MIN_TIMEOUT = 1.0      # 残りの予算がこれより短ければ呼び出さない
+POLL_INTERVAL = 0.1    # wait_for() で中断を確かめる間隔（秒）
+
+# リランの途中でタイムアウトしたときの案内（app.py・fragments.py）
+TIMEOUT_NOTICE = "⏱️ サーバーの応答が遅いため、一部を表示できませんでした。しばらくしてから再読み込みしてください。"
+
+_current_deadline = contextvars.ContextVar("pfc_deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """リランの予算を使い切った"""
+
+
+class Deadline:
+    __slots__ = ("expires", "thread", "yield_check")
+
+    def __init__(self, budget):
+        self.expires = time.monotonic() + budget
+        self.thread = threading.get_ident()
+        # 新しいリランが要求されていれば Streamlit の中断を送出する関数（スクリプトの外では何もしない）
+        self.yield_check = get_run_yield_check() or (lambda: None)
+
+    def remaining(self):
+        return self.expires - time.monotonic()
+
+
+def start_deadline(budget=PAGE_BUDGET):
+    """このリランの予算を設定する（app.py の先頭で呼ぶ）"""
+    deadline = Deadline(budget)
+    _current_deadline.set(deadline)
+    return deadline
+
+
+def clear_deadline():
+    _current_deadline.set(None)
+
+
+@contextlib.contextmanager
+def without_deadline():
+    """まとめて取り込み・書き出しなど、ユーザーが明示的に始めた長い処理の間だけ予算を外す"""
+    token = _current_deadline.set(None)
+    try:
+        yield
+    finally:
+        _current_deadline.reset(token)
+
+
+def current_deadline():
+    """このスレッドのリランの予算（バックグラウンドのスレッドでは None）"""
+    deadline = _current_deadline.get()
+    if deadline is None or deadline.thread != threading.get_ident():
+        return None
+    return deadline
+
+
+def checkpoint():
+    """新しいリランが要求されていれば中断し、予算が残っていなければ DeadlineExceeded"""
+    deadline = current_deadline()
+    if deadline is None:
+        return
+    deadline.yield_check()
+    if deadline.remaining() < MIN_TIMEOUT:
+        raise DeadlineExceeded("リランの時間の予算を使い切りました")
+
+
+def timeout_for(limit):
+    """1回の呼び出しに使えるタイムアウト（秒）: 上限と残りの予算の短いほう"""
+    checkpoint()
+    deadline = current_deadline()
+    return limit if deadline is None else min(limit, deadline.remaining())
+
+
+def pause(seconds):
+    """
+    time.sleep() の代わりに、中断を確かめながら待つ（再試行の待ち時間など）
+    新しいリランが要求されたらすぐに Streamlit の中断を送出する
+    """
+    deadline = current_deadline()
+    until = time.monotonic() + seconds
+    while True:
+        if deadline is not None:
+            deadline.yield_check()
+        left = until - time.monotonic()
+        if left <= 0:
+            return
+        time.sleep(min(left, POLL_INTERVAL))
+
+
+def wait_for(future, limit=None):
+    """
+    Future の結果を、予算と中断を確かめながら待つ
+    予算を使い切ったら DeadlineExceeded（Future はそのまま残すので、呼び出し側で再利用・取り消しできる）
+    新しいリランが要求されたら Future を取り消して Streamlit の中断を送出する
+    """
+    deadline = current_deadline()
+    expires = time.monotonic() + limit if limit is not None else None
+    if deadline is not None:
+        expires = min(expires, deadline.expires) if expires is not None else deadline.expires
+    while True:
+        done, _ = wait([future], timeout=POLL_INTERVAL)
+        if done:
+            return future.result()
+        if deadline is not None:
+            try:
+                deadline.yield_check()
+            except BaseException:
+                future.cancel()
+                raise
+        if expires is not None and time.monotonic() >= expires:
+            raise DeadlineExceeded("時間内に結果が返ってきませんでした")
+
+
+def is_timeout(exc):
+    """タイムアウトによる例外か（予算切れ・httpx / google-genai のタイムアウトを含む）"""
+    return isinstance(exc, TimeoutError) or "Timeout" in type(exc).__name__
@@ -0,0 +1,260 @@
+"""
+食品成分データベース（日本食品標準成分表ベース）
+
+列ごとの .npy ファイル（data/food_composition/）をプロセスごとに1回だけ
+メモリマップで開き、栄養成分ページや services から参照する。
+栄養素は可食部100gあたりの値、portion_g は1食分の目安量（g）。
+
+データの再生成:
+    python food_db.py data/food_composition_seed.csv [成分表から変換したCSV ...]
+    python food_db.py --mext <日本食品標準成分表の Excel> data/food_composition_seed.csv
+
+--mext には文部科学省が公開している「日本食品標準成分表（八訂）増補2023年」の本表の Excel（約2,500品目・
+「表全体」シートを読む。読み込みに openpyxl が必要）を指定する。成分表の食品は食品群ごとのカテゴリ
+（おすすめ表示なし・1食分は100g）になり、検索・オートコンプリート・成分表の完全一致で使われる。
+"""
+
+import csv
+import json
+import pathlib
+import re
+import sys
+
+import numpy as np
+import streamlit as st
+
+DATA_DIR = pathlib.Path(__file__).parent / "data"
+DB_DIR = DATA_DIR / "food_composition"
+CATEGORIES_PATH = DATA_DIR / "food_categories.json"
+
+TEXT_COLUMNS = ("name", "icon", "portion")
+NUTRIENT_COLUMNS = ("kcal", "p", "f", "c", "iron_mg", "folate_ug", "calcium_mg", "vitamin_d_ug")
+NUMERIC_COLUMNS = ("category", "portion_g") + NUTRIENT_COLUMNS
+
+
+class FoodTable:
+    """メモリマップした食品成分表（行 = 食品、列 = NUMERIC_COLUMNS / TEXT_COLUMNS）"""
+
+    __slots__ = ("columns", "categories", "_names", "_name_index")
+
+    def __init__(self, columns, categories):
+        self.columns = columns        # 列名 -> np.ndarray（読み取り専用のメモリマップ）
+        self.categories = categories  # [{"title", "sort", "highlight", "featured"}, ...]
+        self._names = None
+        self._name_index = None
+
+    def __len__(self):
+        return len(self.columns["name"])
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def label(self, idx):
+        """表示用の食品名（アイコン付き）"""
+        icon = str(self.columns["icon"][idx])
+        name = str(self.columns["name"][idx])
+        return f"{icon} {name}" if icon else name
+
+    def category_indices(self, category):
+        """カテゴリ番号に属する行番号（カテゴリの並び順の設定に従ってソート済み）"""
+        idx = np.flatnonzero(self.columns["category"] == category)
+        sort = self.categories[category].get("sort", "kcal")
+        # 表示と同じ 0.1 単位で比較する（float32 の誤差で同値の並びが入れ替わらないように）
+        key = np.round(self.portion_values(sort, idx), 1)
+        if sort != "kcal":
+            key = -key  # P などは多い順
+        return idx[np.argsort(key, kind="stable")]
+
+    def portion_values(self, column, indices):
+        """指定行の1食分（目安量）あたりの値"""
+        return self.columns[column][indices].astype(np.float64) * self.columns["portion_g"][indices] / 100
+
+    def names(self):
+        """食品名の一覧（str のタプル。初回だけ名前の列を読み、以降は使い回す）"""
+        if self._names is None:
+            self._names = tuple(self.columns["name"].tolist())
+        return self._names
+
+    def find(self, name):
+        """食品名の完全一致で行番号を返す（見つからなければ None）"""
+        if self._name_index is None:
+            self._name_index = {n: i for i, n in enumerate(self.names())}
+        return self._name_index.get(name)
+
+    def search(self, query, limit=20):
+        """食品名の部分一致で行番号を返す（最大 limit 件、表の並び順）"""
+        if not query:
+            return np.empty(0, dtype=np.intp)
+        # np.char.find は呼ぶたびにメモリマップの名前の列を全件デコードするので、
+        # キャッシュした str の一覧を先頭から調べて limit 件で打ち切る
+        hits = []
+        for i, name in enumerate(self.names()):
+            if query in name:
+                hits.append(i)
+                if len(hits) >= limit:
+                    break
+        return np.array(hits, dtype=np.intp)
+
+    def nutrients(self, idx, grams=None):
+        """
+        指定量（省略時は1食分の目安量）あたりの栄養素を返す
+        Returns: {"kcal": ..., "p": ..., ..., "vitamin_d_ug": ...}（未収載の値は None）
+        """
+        if grams is None:
+            grams = float(self.columns["portion_g"][idx])
+        scale = grams / 100
+        result = {}
+        for col in NUTRIENT_COLUMNS:
+            val = float(self.columns[col][idx])
+            result[col] = None if np.isnan(val) else val * scale
+        return result
+
+
+def open_food_table(db_dir=DB_DIR):
+    """列ファイルをメモリマップで開いて FoodTable を返す"""
+    db_dir = pathlib.Path(db_dir)
+    meta = json.loads((db_dir / "meta.json").read_text(encoding="utf-8"))
+    columns = {
+        col: np.load(db_dir / f"{col}.npy", mmap_mode="r")
+        for col in TEXT_COLUMNS + NUMERIC_COLUMNS
+    }
+    return FoodTable(columns, meta["categories"])
+
+
+@st.cache_resource
+def get_food_table():
+    """アプリ全体で共有する食品成分表（プロセスごとに1回だけ開く）"""
+    return open_food_table()
+
+
+# --- データ生成 ---
+
+def build_food_table(records, categories, out_dir=DB_DIR):
+    """
+    食品レコードから列ファイルを書き出す
+    records: [{"name", "icon", "category"(タイトル), "portion", "portion_g", "kcal", "p", ...}, ...]
+    categories: [{"title", "sort", "highlight", "featured"}, ...]（records に現れた未知のカテゴリは末尾に追加）
+    """
+    out_dir = pathlib.Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    categories = [dict(c) for c in categories]
+    cat_index = {c["title"]: i for i, c in enumerate(categories)}
+    for r in records:
+        if r["category"] not in cat_index:
+            cat_index[r["category"]] = len(categories)
+            categories.append({"title": r["category"], "sort": "kcal", "highlight": False, "featured": False})
+
+    for col in TEXT_COLUMNS:
+        np.save(out_dir / f"{col}.npy", np.array([r.get(col) or "" for r in records], dtype=str))
+    np.save(out_dir / "category.npy", np.array([cat_index[r["category"]] for r in records], dtype=np.int16))
+    for col in ("portion_g",) + NUTRIENT_COLUMNS:
+        values = [_to_float(r.get(col)) for r in records]
+        np.save(out_dir / f"{col}.npy", np.array(values, dtype=np.float32))
+    (out_dir / "meta.json").write_text(
+        json.dumps({"categories": categories, "count": len(records)}, ensure_ascii=False, indent=1),
+        encoding="utf-8",
+    )
+
+
+def _to_float(val):
+    if val is None or val == "" or val == "-":
+        return np.nan
+    return float(val)
+
+
+# --- 日本食品標準成分表（文部科学省の Excel）からの変換 ---
+
+MEXT_SHEET = "表全体"
+MEXT_ID_ROW = 11  # 成分識別子（INFOODS の Tagname）の行（0 始まり。この次の行から食品）
+# 成分識別子 -> 列名（たんぱく質・脂質・炭水化物はアプリの表示と同じく従来の項目を使う）
+MEXT_COLUMNS = {
+    "ENERC_KCAL": "kcal", "PROT-": "p", "FAT-": "f", "CHOCDF-": "c",
+    "FE": "iron_mg", "FOL": "folate_ug", "CA": "calcium_mg", "VITD": "vitamin_d_ug",
+}
+MEXT_GROUPS = (
+    "穀類", "いも及びでん粉類", "砂糖及び甘味類", "豆類", "種実類", "野菜類", "果実類", "きのこ類", "藻類",
+    "魚介類", "肉類", "卵類", "乳類", "油脂類", "菓子類", "し好飲料類", "調味料及び香辛料類", "調理済み流通食品類",
+)
+_MEXT_TAG_RE = re.compile(r"＜[^＞]*＞")
+_MEXT_VALUE_RE = re.compile(r"[-+]?\d+(?:\.\d+)?")
+
+
+def read_mext_sheet(path):
+    """成分表の Excel の「表全体」シートを文字列のまま読む（openpyxl が必要）"""
+    import pandas as pd
+
+    return pd.read_excel(path, sheet_name=MEXT_SHEET, header=None, dtype=str)
+
+
+def _mext_value(cell):
+    """
+    成分表の値を数値にする
+    Tr（微量）は 0、(0.5) のような推定値は括弧を外した値、-（未測定）や空欄は空欄（NaN）
+    """
+    text = str(cell).strip() if cell is not None else ""
+    if text in ("", "-", "nan") or text.startswith("*"):
+        return ""
+    if "Tr" in text:
+        return 0.0
+    m = _MEXT_VALUE_RE.search(text)
+    return float(m.group(0)) if m else ""
+
+
+def mext_food_name(name):
+    """成分表の食品名から ＜魚類＞ のような分類の見出しを除き、全角空白を半角1つにする"""
+    name = _MEXT_TAG_RE.sub("", str(name)).replace("\u3000", " ")
+    return " ".join(name.split())
+
+
+def mext_records(frame):
+    """
+    「表全体」シート（header=None で読んだ DataFrame）を build_food_table() のレコードにする
+    列は成分識別子の行から探すので、版による列の増減には影響されない
+    """
+    ids = [str(v).strip() for v in frame.iloc[MEXT_ID_ROW]]
+    columns = {col: ids.index(tag) for tag, col in MEXT_COLUMNS.items() if tag in ids}
+    missing = set(MEXT_COLUMNS.values()) - set(columns)
+    if missing:
+        raise ValueError(f"成分表に列がありません: {', '.join(sorted(missing))}")
+    records = []
+    for row in frame.iloc[MEXT_ID_ROW + 1:].itertuples(index=False):
+        group, number, name = str(row[0]).strip(), str(row[1]).strip(), row[3]
+        if not number.isdigit() or not group.isdigit() or not 1 <= int(group) <= len(MEXT_GROUPS):
+            continue  # 注釈などの行
+        record = {
+            "name": mext_food_name(name), "icon": "", "category": f"{int(group):02d} {MEXT_GROUPS[int(group) - 1]}",
+            "portion": "100g", "portion_g": 100,
+        }
+        record.update({col: _mext_value(row[i]) for col, i in columns.items()})
+        records.append(record)
+    return records
+
+
+def _main(argv):
+    if not argv:
+        print(__doc__)
+        return 1
+    records = []
+    mext = []
+    while argv:
+        path, argv = argv[0], argv[1:]
+        if path == "--mext":
+            if not argv:
+                print(__doc__)
+                return 1
+            mext.extend(mext_records(read_mext_sheet(argv[0])))
+            argv = argv[1:]
+            continue
+        with open(path, encoding="utf-8") as f:
+            records.extend(csv.DictReader(f))
+    # 同梱の食品（1食分の目安量・アイコン付き）を先に置き、成分表の食品はその後ろに並べる
+    names = {r["name"] for r in records}
+    records.extend(r for r in mext if r["name"] not in names)
+    categories = json.loads(CATEGORIES_PATH.read_text(encoding="utf-8"))
+    build_food_table(records, categories)
+    print(f"{len(records)} 件を {DB_DIR} に書き出しました")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(_main(sys.argv[1:]))
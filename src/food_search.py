@@ -0,0 +1,283 @@
+"""
+食品名のオートコンプリート（前方一致トライ + 文字バイグラム索引）
+
+食品成分表・ユーザーのテンプレート・過去の食事名を候補として、
+入力のたびに 1ms 未満で順位付きの候補を返す。
+候補はすべて栄養素を持っているため、選ぶだけで Gemini を呼ばずに記録できる。
+
+    index = FoodSearchIndex(history_entries(rows))
+    search_suggestions("とりむね", index, get_food_index())
+"""
+
+import heapq
+import re
+import unicodedata
+
+import streamlit as st
+
+from food_db import get_food_table
+
+# 候補の出どころ（小さいほど上位に表示）
+SOURCE_RANK = {"template": 0, "history": 1, "food": 2}
+
+# 記録に使う栄養素の列（meal_logs のカラム名）
+ENTRY_NUTRIENTS = (
+    "calories", "p_val", "f_val", "c_val",
+    "iron_mg", "folate_ug", "calcium_mg", "vitamin_d_ug",
+)
+
+# food_db の列名 -> meal_logs のカラム名
+_FOOD_DB_COLUMNS = {
+    "kcal": "calories", "p": "p_val", "f": "f_val", "c": "c_val",
+    "iron_mg": "iron_mg", "folate_ug": "folate_ug",
+    "calcium_mg": "calcium_mg", "vitamin_d_ug": "vitamin_d_ug",
+}
+
+
+# --- 表記ゆれの正規化 ---
+
+# 食品名によく出る漢字表記 -> ひらがな（長いものから置換する）
+KANJI_READINGS = {
+    "御飯": "ごはん", "ご飯": "ごはん", "玄米": "げんまい", "白米": "はくまい", "餅": "もち",
+    "饂飩": "うどん", "蕎麦": "そば", "素麺": "そうめん", "麺": "めん",
+    "玉子": "たまご", "卵": "たまご", "胸": "むね", "豆腐": "とうふ", "納豆": "なっとう", "豆乳": "とうにゅう",
+    "牛乳": "ぎゅうにゅう", "鶏": "とり", "豚": "ぶた", "牛": "ぎゅう", "肉": "にく",
+    "鮭": "さけ", "鯖": "さば", "鮪": "まぐろ", "海老": "えび", "烏賊": "いか",
+    "味噌": "みそ", "醤油": "しょうゆ", "胡麻": "ごま",
+    "人参": "にんじん", "玉葱": "たまねぎ", "大根": "だいこん", "野菜": "やさい",
+}
+# 単位の表記ゆれ（カタカナをひらがなにした後で置換する）
+UNIT_ALIASES = {"ぐらむ": "g", "みりりっとる": "ml", "きろかろりー": "kcal"}
+_ALIASES = {**KANJI_READINGS, **UNIT_ALIASES}
+_READING_RE = re.compile("|".join(sorted(map(re.escape, _ALIASES), key=len, reverse=True)))
+_KATAKANA_TO_HIRAGANA = {code: code - 0x60 for code in range(0x30A1, 0x30F7)}
+_STRIP_RE = re.compile(r"[\s・()\[\]「」、。,.!?]+")
+_NUMBER_RE = re.compile(r"\d+(?:\.\d+)?")
+
+
+def normalize_food_text(text):
+    """
+    検索用に表記ゆれを揃える
+    全角/半角（NFKC）・大文字/小文字・カタカナ/ひらがな・よく使う漢字表記・単位を統一し、空白や記号を除く
+    """
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    text = text.translate(_KATAKANA_TO_HIRAGANA)
+    text = _READING_RE.sub(lambda m: _ALIASES[m.group(0)], text)
+    return _STRIP_RE.sub("", text)
+
+
+def quantities(text):
+    """テキスト中の数量（100g の 100 など）。数量が違う入力は似ていても同じ食事として扱わない"""
+    return tuple(sorted(float(n) for n in _NUMBER_RE.findall(unicodedata.normalize("NFKC", text or ""))))
+
+
+def _grams(key):
+    """索引に登録する文字 n-gram（1文字と2文字）"""
+    grams = set(key)
+    grams.update(key[i:i + 2] for i in range(len(key) - 1))
+    return grams
+
+
+# --- 索引 ---
+
+_IDS = ""  # トライのノードで「この接頭辞を持つ候補」を保持するキー（1文字の辞書キーとは衝突しない）
+
+
+class FoodSearchIndex:
+    """
+    候補の前方一致トライと文字 n-gram 転置索引
+
+    候補（entry）は {"label", "food_name", "source", "names", "count", <ENTRY_NUTRIENTS>} の dict。
+    names の各名前を正規化して索引に登録する。
+    各ポスティングリスト（トライのノード・n-gram）は候補の静的な順位
+    （出どころ → 使用回数 → 名前の短さ）で並べておき、検索時は先頭から limit 件で打ち切る。
+    """
+
+    __slots__ = ("entries", "_keys", "_rank", "_trie", "_grams", "_postings", "_by_name", "_dirty")
+
+    def __init__(self, entries=()):
+        self.entries = []
+        self._keys = []      # entry 番号 -> 正規化済みの名前のタプル
+        self._rank = []      # entry 番号 -> 静的な順位キー
+        self._trie = {}
+        self._grams = {}     # n-gram -> entry 番号のリスト
+        self._postings = []  # 並べ替え対象のリスト（トライのノードと n-gram）
+        self._by_name = {}   # (source, 正規化した names[0]) -> entry 番号
+        self._dirty = False
+        for entry in entries:
+            self.add(entry)
+        self._sort()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, entry):
+        """
+        候補を追加する。同じ出どころ・同じ名前（names の先頭）の候補が既にあれば、
+        栄養素を新しい値に置き換えて使用回数を加算する
+        """
+        self._dirty = True
+        name_key = (entry["source"], normalize_food_text(entry["names"][0]))
+        existing = self._by_name.get(name_key)
+        if existing is not None:
+            old = self.entries[existing]
+            count = old.get("count", 1) + entry.get("count", 1)
+            old.update(entry)
+            old["count"] = count
+            return existing
+
+        entry_id = len(self.entries)
+        keys = tuple(dict.fromkeys(k for k in map(normalize_food_text, entry["names"]) if k))
+        self.entries.append(entry)
+        self._keys.append(keys)
+        self._rank.append(None)
+        self._by_name[name_key] = entry_id
+        for key in keys:
+            node = self._trie
+            for ch in key:
+                node = node.setdefault(ch, {})
+                self._append(node, _IDS, entry_id)
+            for gram in _grams(key):
+                self._append(self._grams, gram, entry_id)
+        return entry_id
+
+    def _append(self, mapping, key, entry_id):
+        ids = mapping.get(key)
+        if ids is None:
+            ids = mapping[key] = []
+            self._postings.append(ids)
+        if not ids or ids[-1] != entry_id:
+            ids.append(entry_id)
+
+    def _sort(self):
+        """静的な順位を計算し直し、すべてのポスティングリストを順位順に並べ替える"""
+        self._rank = [
+            (SOURCE_RANK.get(e["source"], 9), -e.get("count", 1), min(map(len, keys), default=0), i)
+            for i, (e, keys) in enumerate(zip(self.entries, self._keys))
+        ]
+        rank = self._rank.__getitem__
+        for ids in self._postings:
+            ids.sort(key=rank)
+        self._dirty = False
+
+    def _prefix_ids(self, query):
+        node = self._trie
+        for ch in query:
+            node = node.get(ch)
+            if node is None:
+                return []
+        return node.get(_IDS, [])
+
+    def _infix_ids(self, query):
+        """部分一致の候補を順位順に返すイテレータ（最も短い n-gram のリストを走査して照合する）"""
+        if len(query) == 1:
+            return iter(self._grams.get(query, []))
+        shortest = None
+        for i in range(len(query) - 1):
+            ids = self._grams.get(query[i:i + 2])
+            if not ids:
+                return iter(())
+            if shortest is None or len(ids) < len(shortest):
+                shortest = ids
+        keys = self._keys
+        return (i for i in shortest if any(query in k for k in keys[i]))
+
+    def ranked(self, query, limit):
+        """
+        正規化済みクエリに一致する上位 limit 件を (順位キー, entry) の昇順で返す
+        順位: 前方一致 → 出どころ（テンプレート・履歴・成分表）→ 使用回数 → 名前の短さ
+        """
+        if not query:
+            return []
+        if self._dirty:
+            self._sort()
+        prefix = self._prefix_ids(query)[:limit]
+        results = [((0,) + self._rank[i], self.entries[i]) for i in prefix]
+        if len(results) < limit:
+            seen = set(prefix)
+            for i in self._infix_ids(query):
+                if i not in seen:
+                    results.append(((1,) + self._rank[i], self.entries[i]))
+                    if len(results) == limit:
+                        break
+        return results
+
+
+def search_suggestions(query, *indexes, limit=8):
+    """
+    複数の索引をまとめて検索し、上位 limit 件の候補を返す
+    同じ食事名は上位の出どころ（テンプレート > 履歴 > 成分表）の1件だけを残す
+    """
+    q = normalize_food_text(query)
+    if not q:
+        return []
+    per_index = [index.ranked(q, limit * 2) for index in indexes]
+    seen = set()
+    suggestions = []
+    for _, entry in heapq.merge(*per_index, key=lambda r: r[0]):
+        name = normalize_food_text(entry["food_name"])
+        if name in seen:
+            continue
+        seen.add(name)
+        suggestions.append(entry)
+        if len(suggestions) == limit:
+            break
+    return suggestions
+
+
+# --- 候補の生成 ---
+
+def _entry(source, food_name, label, names, nutrients, count=1):
+    entry = {"source": source, "food_name": food_name, "label": label, "names": names, "count": count}
+    for col in ENTRY_NUTRIENTS:
+        entry[col] = nutrients.get(col)
+    return entry
+
+
+def food_table_entries(table):
+    """食品成分表の各食品（1食分の目安量）を候補にする"""
+    entries = []
+    for idx in range(len(table)):
+        name = str(table["name"][idx])
+        portion = str(table["portion"][idx])
+        n = {_FOOD_DB_COLUMNS[k]: v for k, v in table.nutrients(idx).items()}
+        food_name = f"{name} {portion}" if portion else name
+        label = f"{table.label(idx)} {portion} · {round(n['calories'] or 0)}kcal"
+        entries.append(_entry("food", food_name, label, (name,), n))
+    return entries
+
+
+def template_entries(templates):
+    """meal_templates の各行を候補にする（テンプレート名と食事名の両方で検索できる）"""
+    return [
+        _entry("template", t["food_name"], f"⭐ {t['name']} · {t['calories']}kcal", (t["name"], t["food_name"]), t)
+        for t in templates
+    ]
+
+
+def history_entry(row):
+    """meal_logs の1行を履歴の候補にする"""
+    return _entry("history", row["food_name"], f"🕘 {row['food_name']} · {row['calories']}kcal", (row["food_name"],), row)
+
+
+def history_entries(rows):
+    """
+    meal_logs の行（新しい順）を、食事名ごとに1件の候補にまとめる
+    栄養素は最も新しい記録の値、count は記録回数
+    """
+    entries = {}
+    for row in rows:
+        key = normalize_food_text(row["food_name"])
+        if not key:
+            continue
+        if key in entries:
+            entries[key]["count"] += 1
+        else:
+            entries[key] = history_entry(row)
+    return list(entries.values())
+
+
+@st.cache_resource
+def get_food_index():
+    """食品成分表の候補索引（プロセスごとに1回だけ構築）"""
+    return FoodSearchIndex(food_table_entries(get_food_table()))
@@ -0,0 +1,51 @@
+"""
+キー付きフラグメント（st.fragment(key=...)）の共通処理
+
+フラグメントだけのリラン（st.rerun([キー]) やフラグメントの中のウィジェットの操作）では app.py が
+実行されないので、app.py がリランごとに設定する時間の予算（deadlines.py）と Gemini の利用者
+（gemini_usage.py）がない。@fragment(key) はフラグメントだけのリランのときに本体の前でこれらを設定し、
+タイムアウトしたらページ全体の代わりにフラグメントの中に案内を出す。
+ページ全体のリランでは app.py の予算・案内をそのまま使う。
+
+    @fragment("day_summary")
+    def day_summary():
+        ...
+"""
+
+import functools
+
+import streamlit as st
+from streamlit.runtime.scriptrunner_utils.script_run_context import get_script_run_ctx
+
+from deadlines import TIMEOUT_NOTICE, clear_deadline, is_timeout, start_deadline
+from gemini_usage import set_current_user_from_session
+
+
+def is_fragment_run():
+    """このリランがフラグメントだけの実行か"""
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return bool(ctx and ctx.fragment_ids_this_run)
+
+
+def fragment(key):
+    """st.fragment(key=key) に、フラグメントだけのリランの予算・利用者の設定とタイムアウトの案内を加える"""
+    def decorator(func):
+        @functools.wraps(func)
+        def body(*args, **kwargs):
+            if not is_fragment_run():
+                return func(*args, **kwargs)
+            start_deadline()
+            set_current_user_from_session()
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if not is_timeout(e):
+                    raise
+                print(f"[fragment] {key} のタイムアウト: {type(e).__name__} - {e}")
+                st.warning(TIMEOUT_NOTICE)
+            finally:
+                clear_deadline()
+
+        return st.fragment(body, key=key)
+
+    return decorator
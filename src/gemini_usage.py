@@ -0,0 +1,307 @@
+"""
+Gemini の利用台帳（ユーザーごと・全体の1日の予算と、モデルの自動切り替え）
+
+services.py の Gemini 呼び出しはすべて generate_content() を通り、呼び出しごとに
+（ユーザー・モデル・用途・トークン数・所要時間・結果）を gemini_usage テーブルに記録する。
+当日の使用量はプロセス内で集計し（初回だけテーブルから読み込む）、予算を使い切ったら
+呼び出さずに BudgetExceeded を送出する。残りが少なくなったら安いモデルに切り替え、
+429（レート制限）を返したモデルはしばらく（Retry-After の秒数、なければ RATE_LIMIT_COOLDOWN 秒）使わずに
+次のモデルで呼び直す。その日の上限（1日あたりのクォータ）による 429 のときだけ、そのモデルをその日のうちは使わない。
+
+日付は Gemini の無料枠がリセットされる太平洋時間（日本時間の17時）で区切る。
+
+    # secrets.toml（すべて任意）
+    [gemini_budget]
+    user_daily_tokens = 300000     # 0 なら無制限
+    global_daily_tokens = 3000000
+    low_ratio = 0.2                # 残りがこの割合を下回ったら安いモデルにする
+    fallback_models = ["gemini-2.5-flash-lite", "gemini-2.5-flash"]
+
+呼び出したユーザーは app.py が set_current_user() で設定する（共有スレッドプールの処理にも引き継がれる）。
+ウィジェットのコールバックは app.py より先に実行されるので、Gemini の処理を始めるコールバックは
+最初に set_current_user_from_session() を呼ぶ。
+"""
+
+import contextvars
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+
+import streamlit as st
+from google.genai import types
+
+from config import get_executor, init_supabase
+from db_calls import execute_query
+from deadlines import GEMINI_TIMEOUT, timeout_for
+from metrics import error_code
+
+QUOTA_TZ = ZoneInfo("America/Los_Angeles")
+DEFAULT_USER_DAILY_TOKENS = 300_000
+DEFAULT_GLOBAL_DAILY_TOKENS = 3_000_000
+DEFAULT_LOW_RATIO = 0.2
+# 残りが少ないとき・レート制限のときに使うモデル（安い順）。食事の解析（JSON の数値の推定）にはこれで足りる
+DEFAULT_FALLBACK_MODELS = ("gemini-2.5-flash-lite", "gemini-2.5-flash")
+RATE_LIMIT_COOLDOWN = 60  # 再試行までの秒数の指示がない 429 で、そのモデルを使わない秒数
+
+# 429 の本文の RetryInfo（"retryDelay": "23s"）
+_RETRY_DELAY_RE = re.compile(r"""retryDelay['"]?\s*:\s*['"]?(\d+(?:\.\d+)?)s""")
+
+# 呼び出し中のユーザー（スクリプトのスレッドで設定し、get_executor() の処理に引き継がれる）
+_current_user = contextvars.ContextVar("pfc_gemini_user", default=None)
+
+
+class BudgetExceeded(Exception):
+    """1日の予算を使い切った（またはすべてのモデルがレート制限中）"""
+
+
+def set_current_user(user_id):
+    _current_user.set(user_id)
+
+
+def set_current_user_from_session():
+    """
+    セッションのユーザーを呼び出し中のユーザーにする（ウィジェットのコールバック用）
+    コールバックはリランごとの新しいスレッドで app.py の set_current_user() より先に実行されるため、
+    そのままでは共有スレッドプールに渡した処理のユーザーが None になり、ユーザーごとの予算が効かない
+    """
+    user = st.session_state.get("user")
+    set_current_user(getattr(user, "id", None))
+
+
+def quota_day(now=None):
+    """使用量を区切る日（太平洋時間の日付）"""
+    return (now or datetime.now(timezone.utc)).astimezone(QUOTA_TZ).date()
+
+
+def is_rate_limited(exc):
+    return error_code(exc) == "429" or "RESOURCE_EXHAUSTED" in str(exc)
+
+
+def is_daily_quota(exc):
+    """1日あたりのクォータ（quotaId が "...PerDay..."）を使い切った 429 か（分あたりの制限なら False）"""
+    return "RESOURCE_EXHAUSTED" in str(exc) and "PerDay" in str(exc)
+
+
+def retry_after(exc):
+    """429 の再試行までの秒数（Retry-After ヘッダー、なければ本文の retryDelay）。分からなければ None"""
+    headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        pass
+    match = _RETRY_DELAY_RE.search(str(exc))
+    return float(match.group(1)) if match else None
+
+
+class UsageLedger:
+    """当日の使用量（ユーザーごと・全体のトークン数）と、レート制限中・その日の上限に達したモデル"""
+
+    def __init__(self, user_daily_tokens=DEFAULT_USER_DAILY_TOKENS, global_daily_tokens=DEFAULT_GLOBAL_DAILY_TOKENS,
+                 low_ratio=DEFAULT_LOW_RATIO, fallback_models=DEFAULT_FALLBACK_MODELS, load_day=None,
+                 clock=time.monotonic):
+        self.user_daily_tokens = user_daily_tokens
+        self.global_daily_tokens = global_daily_tokens
+        self.low_ratio = low_ratio
+        self.fallback_models = tuple(fallback_models)
+        self._load_day = load_day  # day -> その日の行 [{"user_id", "prompt_tokens", "output_tokens"}, ...]
+        self._lock = threading.Lock()
+        self._day = None
+        self._users = {}
+        self._total = 0
+        self._calls = 0
+        self._exhausted = set()  # その日の上限に達したモデル
+        self._cooldowns = {}     # レート制限中のモデル -> 使えるようになる時刻（clock の値）
+        self._clock = clock
+
+    def clear(self):
+        with self._lock:
+            self._day = None
+            self._users.clear()
+            self._total = 0
+            self._calls = 0
+            self._exhausted.clear()
+            self._cooldowns.clear()
+
+    def _roll(self, day):
+        """日付が変わったら集計をやり直す（その日の最初の1回だけ記録済みの行を読み込む）"""
+        if self._day == day:
+            return
+        self._day = day
+        self._users, self._total, self._calls = {}, 0, 0
+        self._exhausted = set()
+        rows = []
+        if self._load_day:
+            try:
+                rows = self._load_day(day)
+            except Exception as e:
+                print(f"[gemini_usage] 使用量の読み込みエラー: {e}")
+        for row in rows:
+            self._add(row.get("user_id"), (row.get("prompt_tokens") or 0) + (row.get("output_tokens") or 0))
+
+    def _add(self, user_id, tokens):
+        self._users[user_id] = self._users.get(user_id, 0) + tokens
+        self._total += tokens
+        self._calls += 1
+
+    def remaining_ratio(self, user_id, day=None):
+        """ユーザーと全体の予算のうち、残りの割合の小さいほう（予算なしなら 1.0）"""
+        with self._lock:
+            self._roll(day or quota_day())
+            ratios = [1.0]
+            if self.user_daily_tokens and user_id is not None:
+                ratios.append(1 - self._users.get(user_id, 0) / self.user_daily_tokens)
+            if self.global_daily_tokens:
+                ratios.append(1 - self._total / self.global_daily_tokens)
+        return max(min(ratios), 0.0)
+
+    def choose_models(self, requested, user_id, day=None):
+        """
+        呼び出しに使うモデルを試す順に返す
+        予算を使い切っていれば BudgetExceeded。残りが少なければ安いモデルを先に、レート制限中・その日の上限に達したモデルは除く
+        """
+        ratio = self.remaining_ratio(user_id, day)
+        if ratio <= 0:
+            raise BudgetExceeded("本日のAIの利用上限に達しました。日本時間の17時以降に再試行してください。")
+        if ratio < self.low_ratio:
+            order = self.fallback_models + (requested,)
+        else:
+            order = (requested,) + self.fallback_models
+        now = self._clock()
+        with self._lock:
+            order = [m for i, m in enumerate(order) if m not in order[:i]]
+            models = [m for m in order if m not in self._exhausted and self._cooldowns.get(m, now) <= now]
+            all_exhausted = all(m in self._exhausted for m in order)
+        if not models:
+            if all_exhausted:
+                raise BudgetExceeded("AIの利用上限に達しました。日本時間の17時以降に再試行してください。")
+            raise BudgetExceeded("AIが混み合っています。1分ほどしてから再試行してください。")
+        return models
+
+    def mark_exhausted(self, model, day=None):
+        """その日の上限に達したモデル（1日あたりのクォータの 429）をその日のうちは使わない"""
+        with self._lock:
+            self._roll(day or quota_day())
+            self._exhausted.add(model)
+
+    def cool_down(self, model, seconds=None):
+        """レート制限（429）を返したモデルを seconds 秒（指定がなければ RATE_LIMIT_COOLDOWN 秒）使わない"""
+        seconds = RATE_LIMIT_COOLDOWN if seconds is None else seconds
+        with self._lock:
+            self._cooldowns[model] = max(self._cooldowns.get(model, 0), self._clock() + seconds)
+
+    def record(self, user_id, tokens, day=None):
+        with self._lock:
+            self._roll(day or quota_day())
+            self._add(user_id, tokens)
+
+    def report(self, user_id=None):
+        """当日の使用量（設定画面用）"""
+        with self._lock:
+            self._roll(quota_day())
+            s = {
+                "day": self._day, "calls": self._calls, "total_tokens": self._total,
+                "user_tokens": self._users.get(user_id, 0),
+                "global_daily_tokens": self.global_daily_tokens, "user_daily_tokens": self.user_daily_tokens,
+                "exhausted": sorted(self._exhausted),
+                "cooling": sorted(m for m, until in self._cooldowns.items() if until > self._clock()),
+            }
+        s["remaining_ratio"] = self.remaining_ratio(user_id)
+        s["degraded"] = s["remaining_ratio"] < self.low_ratio
+        return s
+
+
+def _load_usage_day(day):
+    supabase = init_supabase()
+    if supabase is None:
+        return []
+    query = (
+        supabase.table("gemini_usage")
+        .select("user_id, prompt_tokens, output_tokens")
+        .eq("usage_date", day.isoformat())
+    )
+    return execute_query(query, "load_gemini_usage").data or []
+
+
+def _save_usage_row(row):
+    try:
+        supabase = init_supabase()
+        if supabase is not None:
+            # キーのない挿入なので再試行しない（タイムアウトでも反映されている可能性がある）
+            execute_query(supabase.table("gemini_usage").insert(row), "save_gemini_usage", idempotent=False)
+    except Exception as e:
+        print(f"[gemini_usage] 記録エラー: {e}")
+
+
+@st.cache_resource
+def get_usage_ledger():
+    """プロセス全体で共有する利用台帳（secrets の [gemini_budget] で予算を変えられる）"""
+    try:
+        conf = dict(st.secrets.get("gemini_budget", {}))
+    except Exception:
+        conf = {}
+    return UsageLedger(
+        user_daily_tokens=int(conf.get("user_daily_tokens", DEFAULT_USER_DAILY_TOKENS)),
+        global_daily_tokens=int(conf.get("global_daily_tokens", DEFAULT_GLOBAL_DAILY_TOKENS)),
+        low_ratio=float(conf.get("low_ratio", DEFAULT_LOW_RATIO)),
+        fallback_models=tuple(conf.get("fallback_models", DEFAULT_FALLBACK_MODELS)),
+        load_day=_load_usage_day,
+    )
+
+
+def _token_counts(response):
+    usage = getattr(response, "usage_metadata", None)
+    counts = []
+    for attr in ("prompt_token_count", "candidates_token_count"):
+        count = getattr(usage, attr, None)
+        counts.append(count if isinstance(count, int) else 0)
+    return counts
+
+
+def generate_content(client, model_name, contents, purpose, ledger=None, save_row=None):
+    """
+    client.models.generate_content() を予算の確認・モデルの切り替え・利用台帳への記録つきで呼ぶ
+    レート制限（429）なら次のモデルで呼び直し、それ以外の例外はそのまま送出する
+    1回ごとのタイムアウトはリランの残り時間から決める（残っていなければ呼ばずに DeadlineExceeded）
+    記録はバックグラウンドで書き込むので、呼び出しの応答は待たせない
+    """
+    ledger = ledger or get_usage_ledger()
+    save_row = save_row or (lambda row: get_executor().submit(_save_usage_row, row))
+    user_id = _current_user.get()
+    day = quota_day()
+
+    def log(model, outcome, started, prompt_tokens=0, output_tokens=0):
+        ledger.record(user_id, prompt_tokens + output_tokens, day)
+        save_row({
+            "user_id": user_id, "usage_date": day.isoformat(), "model": model, "purpose": purpose,
+            "prompt_tokens": prompt_tokens, "output_tokens": output_tokens,
+            "latency_ms": round((time.perf_counter() - started) * 1000), "outcome": outcome,
+        })
+
+    try:
+        models = ledger.choose_models(model_name, user_id, day)
+    except BudgetExceeded:
+        log(model_name, "budget_exceeded", time.perf_counter())
+        raise
+    for i, model in enumerate(models):
+        timeout_ms = int(timeout_for(GEMINI_TIMEOUT) * 1000)
+        config = types.GenerateContentConfig(http_options=types.HttpOptions(timeout=timeout_ms))
+        started = time.perf_counter()
+        try:
+            response = client.models.generate_content(model=model, contents=contents, config=config)
+        except Exception as e:
+            if is_rate_limited(e):
+                log(model, "rate_limited", started)
+                if is_daily_quota(e):
+                    ledger.mark_exhausted(model, day)
+                else:
+                    ledger.cool_down(model, retry_after(e))
+                if i + 1 < len(models):
+                    print(f"[gemini_usage] {model} がレート制限のため {models[i + 1]} で再試行します")
+                    continue
+            else:
+                log(model, "error", started)
+            raise
+        log(model, "ok", started, *_token_counts(response))
+        return response
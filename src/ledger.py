@@ -0,0 +1,145 @@
+"""
+1日分の食事ログを保持する台帳（DailyLedger）
+
+合計値は行の追加・削除のたびに差分で更新し、並べ替え済みリストや
+共有テキストなどの派生表示は変更があるまでキャッシュする。
+"""
+
+MEAL_ORDER = {"朝食": 0, "昼食": 1, "夕食": 2, "間食": 3, "夜食": 4}
+
+# 合計を保持する列（meal_logs のカラム名）
+NUTRIENT_FIELDS = (
+    "calories", "p_val", "f_val", "c_val",
+    "iron_mg", "folate_ug", "calcium_mg", "vitamin_d_ug",
+)
+
+
+class DailyLedger:
+    """
+    1日分の食事ログと栄養素の合計値
+
+    ledger = DailyLedger("2026-03-01", logs)
+    ledger.add(row)          # 挿入された行を追加（同じ id は無視）
+    ledger.remove(log_id)    # 削除した行を除去
+    ledger.pfc_totals        # {"cal": ..., "p": ..., "f": ..., "c": ...}
+    """
+
+    __slots__ = ("date_str", "_logs", "_totals", "_sorted", "_meals_detail", "_share")
+
+    def __init__(self, date_str, logs=()):
+        self.date_str = date_str
+        self._logs = {}  # id -> 行（挿入順を保持）
+        self._totals = dict.fromkeys(NUTRIENT_FIELDS, 0)
+        self._invalidate()
+        for row in logs:
+            self.add(row)
+
+    def _invalidate(self):
+        self._sorted = None
+        self._meals_detail = None
+        self._share = None
+
+    # --- 更新 ---
+
+    def add(self, row):
+        """行を追加して合計値を更新する。既に同じ id の行があれば何もせず False を返す"""
+        log_id = row["id"]
+        if log_id in self._logs:
+            return False
+        self._logs[log_id] = row
+        for field in NUTRIENT_FIELDS:
+            self._totals[field] += row.get(field) or 0
+        self._invalidate()
+        return True
+
+    def remove(self, log_id):
+        """行を除去して合計値を更新する。該当する行がなければ False を返す"""
+        row = self._logs.pop(log_id, None)
+        if row is None:
+            return False
+        for field in NUTRIENT_FIELDS:
+            self._totals[field] -= row.get(field) or 0
+        self._invalidate()
+        return True
+
+    # --- 参照 ---
+
+    def __len__(self):
+        return len(self._logs)
+
+    def __iter__(self):
+        return iter(self._logs.values())
+
+    def __contains__(self, log_id):
+        return log_id in self._logs
+
+    @property
+    def logs(self):
+        """挿入順のログのリスト"""
+        return list(self._logs.values())
+
+    def total(self, field):
+        """指定列の合計値"""
+        return self._totals[field]
+
+    @property
+    def pfc_totals(self):
+        """generate_pfc_summary() などに渡す形式の合計値"""
+        t = self._totals
+        return {"cal": t["calories"], "p": t["p_val"], "f": t["f_val"], "c": t["c_val"]}
+
+    @property
+    def micro_totals(self):
+        """微量栄養素の合計値"""
+        t = self._totals
+        return {
+            "iron": t["iron_mg"], "folate": t["folate_ug"],
+            "calcium": t["calcium_mg"], "vit_d": t["vitamin_d_ug"],
+        }
+
+    @property
+    def meal_types(self):
+        """記録済みの食事タイプ"""
+        return {row["meal_type"] for row in self._logs.values()}
+
+    def sorted_logs(self):
+        """食事タイプ順（朝食→夜食）に並べたログ"""
+        if self._sorted is None:
+            self._sorted = sorted(self._logs.values(), key=lambda x: MEAL_ORDER.get(x["meal_type"], 9))
+        return self._sorted
+
+    # --- テキスト化 ---
+
+    def meals_detail(self):
+        """AIプロンプト用の記録済み食事一覧"""
+        if self._meals_detail is None:
+            if self._logs:
+                self._meals_detail = "\n".join(
+                    f"・{m['meal_type']}: {m['food_name']}（{m['calories']}kcal / P:{m['p_val']}g F:{m['f_val']}g C:{m['c_val']}g）"
+                    for m in self.sorted_logs()
+                )
+            else:
+                self._meals_detail = "まだ記録なし"
+        return self._meals_detail
+
+    def share_text(self, title, targets):
+        """LINE / クリップボード共有用のテキスト（title・targets が同じ間はキャッシュを返す）"""
+        cache_key = (title, targets["cal"], targets["p"], targets["f"], targets["c"])
+        if self._share is not None and self._share[0] == cache_key:
+            return self._share[1]
+
+        share_lines = [f"🍽️ {title} の食事記録"]
+        if self._logs:
+            for m in self.sorted_logs():
+                share_lines.append(
+                    f"・{m['meal_type']}: {m['food_name']} "
+                    f"({m['calories']}kcal / P:{m['p_val']} F:{m['f_val']} C:{m['c_val']})"
+                )
+            t = self.pfc_totals
+            share_lines.append(f"\n合計: {int(t['cal'])}kcal（P:{int(t['p'])}g F:{int(t['f'])}g C:{int(t['c'])}g）")
+            share_lines.append(f"目標: {targets['cal']}kcal（P:{targets['p']}g F:{targets['f']}g C:{targets['c']}g）")
+        else:
+            share_lines.append("記録なし")
+        text = "\n".join(share_lines)
+        self._share = (cache_key, text)
+        return text
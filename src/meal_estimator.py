@@ -0,0 +1,164 @@
+"""
+過去の食事ログからの栄養素の即時推定（文字 n-gram TF-IDF + k近傍法）
+
+ユーザー自身の meal_logs を食事名ごとにまとめて索引化し、入力テキストに
+近い過去の食事の栄養素を類似度で重み付け平均して、確度つきの推定値を返す。
+確度が高ければ Gemini を呼ばずにそのまま記録し、低ければ仮の値で記録して
+バックグラウンドで analyze_meal_with_gemini() の結果に置き換える。
+
+    estimator = MealEstimator(rows)
+    estimator.estimate("鶏むね肉とご飯")  # {"calories": ..., "confidence": 0.92, ...}
+    estimator.add(row)                    # 記録のたびに差分で追加
+"""
+
+import math
+
+from food_search import normalize_food_text, quantities
+
+NGRAM_SIZES = (1, 2, 3)
+ESTIMATE_FIELDS = (
+    "calories", "p_val", "f_val", "c_val",
+    "iron_mg", "folate_ug", "calcium_mg", "vitamin_d_ug",
+)
+
+# この確度以上なら推定値のまま記録する（Gemini なし）
+HIGH_CONFIDENCE = 0.8
+# この確度以上なら仮の値で記録し、バックグラウンドで Gemini の解析に置き換える（未満は従来どおり）
+LOW_CONFIDENCE = 0.4
+MIN_SIMILARITY = 0.2
+
+
+def char_ngrams(text):
+    """正規化したテキストの文字 n-gram と出現回数"""
+    counts = {}
+    for n in NGRAM_SIZES:
+        for i in range(len(text) - n + 1):
+            gram = text[i:i + n]
+            counts[gram] = counts.get(gram, 0) + 1
+    return counts
+
+
+class MealEstimator:
+    """
+    食事名ごとの文書（n-gram の出現回数 + 栄養素の平均）の TF-IDF 索引
+
+    add() は転置索引に追記するだけで、IDF と文書ベクトルの大きさは
+    次の estimate() のときにまとめて計算し直す。
+    """
+
+    __slots__ = ("_docs", "_by_text", "_postings", "_df", "_norms")
+
+    def __init__(self, rows=()):
+        self._docs = []      # [{"text", "food_name", "quantities", "tf", "sums", "counts", "cal_sq", "rows"}, ...]
+        self._by_text = {}   # 正規化したテキスト -> 文書番号
+        self._postings = {}  # n-gram -> [(文書番号, 出現回数), ...]
+        self._df = {}        # n-gram -> 文書頻度
+        self._norms = None   # 文書番号 -> TF-IDF ベクトルの大きさ（None は再計算が必要）
+        for row in rows:
+            self.add(row)
+
+    def __len__(self):
+        return len(self._docs)
+
+    def add(self, row):
+        """meal_logs の1行を追加する（同じ食事名の文書があれば栄養素の平均に加える）"""
+        text = normalize_food_text(row.get("food_name"))
+        if not text:
+            return
+        doc_id = self._by_text.get(text)
+        if doc_id is None:
+            doc_id = len(self._docs)
+            tf = char_ngrams(text)
+            self._docs.append({
+                "text": text, "food_name": row["food_name"], "quantities": quantities(row["food_name"]), "tf": tf,
+                "sums": dict.fromkeys(ESTIMATE_FIELDS, 0.0), "counts": dict.fromkeys(ESTIMATE_FIELDS, 0),
+                "cal_sq": 0.0, "rows": 0,
+            })
+            self._by_text[text] = doc_id
+            for gram, count in tf.items():
+                self._postings.setdefault(gram, []).append((doc_id, count))
+                self._df[gram] = self._df.get(gram, 0) + 1
+            self._norms = None
+        doc = self._docs[doc_id]
+        doc["rows"] += 1
+        for field in ESTIMATE_FIELDS:
+            val = row.get(field)
+            if val is not None:
+                doc["sums"][field] += val
+                doc["counts"][field] += 1
+        doc["cal_sq"] += (row.get("calories") or 0) ** 2
+
+    def _idf(self, gram):
+        return math.log((1 + len(self._docs)) / (1 + self._df.get(gram, 0))) + 1
+
+    def _doc_norms(self):
+        if self._norms is None:
+            self._norms = [
+                math.sqrt(sum((count * self._idf(g)) ** 2 for g, count in doc["tf"].items()))
+                for doc in self._docs
+            ]
+        return self._norms
+
+    def neighbors(self, text, k=5):
+        """入力に近い過去の食事を (類似度, 文書) で類似度の高い順に最大 k 件返す"""
+        query = char_ngrams(normalize_food_text(text))
+        if not query or not self._docs:
+            return []
+        norms = self._doc_norms()
+        dots = {}
+        q_norm = 0.0
+        for gram, q_count in query.items():
+            idf = self._idf(gram)
+            q_weight = q_count * idf
+            q_norm += q_weight * q_weight
+            for doc_id, count in self._postings.get(gram, ()):
+                dots[doc_id] = dots.get(doc_id, 0.0) + q_weight * count * idf
+        q_norm = math.sqrt(q_norm)
+        scored = [(dot / (q_norm * norms[i]), i) for i, dot in dots.items()]
+        scored.sort(reverse=True)
+        return [(sim, self._docs[i]) for sim, i in scored[:k] if sim >= MIN_SIMILARITY]
+
+    def estimate(self, text, k=5):
+        """
+        過去の食事の栄養素から推定値を返す
+        同じ食事名の記録があればその平均を、なければ近傍を類似度の2乗で重み付け平均する。
+        数量（100g の 100 など）が入力と違う食事は、文字が似ていても近傍に使わない（「鶏むね肉 1000g」に
+        「鶏むね肉 100g」の値を使わない。analysis_cache.py の再利用と同じ条件）
+        確度 = 最も近い食事の類似度 ×（1 − カロリーのばらつき（変動係数、最大1））
+        Returns: {<ESTIMATE_FIELDS>, "confidence", "neighbors": [(食事名, 類似度), ...]} / 近傍がなければ None
+        """
+        qty = quantities(text)
+        found = [(sim, doc) for sim, doc in self.neighbors(text, k) if doc["quantities"] == qty]
+        if not found:
+            return None
+        exact = self._by_text.get(normalize_food_text(text))
+        if exact is not None and self._docs[exact]["quantities"] == qty:
+            found = [(1.0, self._docs[exact])]
+
+        result = {}
+        for field in ESTIMATE_FIELDS:
+            total = weight = 0.0
+            for sim, doc in found:
+                if doc["counts"][field]:
+                    w = sim * sim
+                    total += w * doc["sums"][field] / doc["counts"][field]
+                    weight += w
+            result[field] = total / weight if weight else None
+
+        result["confidence"] = found[0][0] * (1 - self._calorie_spread(found, result["calories"]))
+        result["neighbors"] = [(doc["food_name"], sim) for sim, doc in found]
+        return result
+
+    @staticmethod
+    def _calorie_spread(found, mean_cal):
+        """近傍（各食事の記録ごと）のカロリーの重み付き変動係数"""
+        if not mean_cal or mean_cal <= 0:
+            return 1.0
+        sq = weight = 0.0
+        for sim, doc in found:
+            n = doc["rows"]
+            w = sim * sim
+            # Σ(x - m)^2 = Σx^2 - 2mΣx + n m^2（食事名ごとに記録を展開せずに計算する）
+            sq += w * (doc["cal_sq"] - 2 * mean_cal * doc["sums"]["calories"] + n * mean_cal * mean_cal)
+            weight += w * n
+        return min(math.sqrt(max(sq, 0.0) / weight) / mean_cal, 1.0)
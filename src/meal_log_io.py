@@ -0,0 +1,199 @@
+"""
+食事ログ（meal_logs）の CSV / Parquet 書き出しと取り込み
+
+書き出しは id のキーセットページング（id > 前のページの最後の id）で PAGE_SIZE 行ずつ
+取得し、そのままファイルに追記するので、何年分の履歴でもメモリ使用量は1ページ分で一定。
+取り込みは CHUNK_SIZE 行ずつ検証し、冪等キー付きの一括 upsert で保存する
+（書き出した行の冪等キーをそのまま使うので、自分の書き出しを戻しても、同じファイルを2回取り込んでも重複しない）。
+
+    with open("meal_logs.parquet", "wb") as f:
+        export_meal_logs(iter_meal_log_pages(supabase, user_id), f, "parquet")
+    report = import_meal_logs(supabase, user_id, read_meal_log_rows(f, "parquet"))
+"""
+
+import codecs
+import csv
+import io
+import math
+import time
+from datetime import date, datetime, timezone
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from db_calls import execute_query
+from services import MICRO_COLUMNS, build_meal_log_row, make_idempotency_key, save_meal_logs
+
+PAGE_SIZE = 1000   # 書き出しで1回に取得する行数
+CHUNK_SIZE = 500   # 取り込みで1回に保存する行数
+MAX_ERRORS = 100   # 取り込みの報告に残す不正な行の数
+
+MEAL_TYPES = ("朝食", "昼食", "夕食", "間食", "夜食")
+NUTRIENT_COLUMNS = ("calories", "p_val", "f_val", "c_val")
+EXPORT_COLUMNS = ("meal_date", "meal_type", "food_name") + NUTRIENT_COLUMNS + MICRO_COLUMNS + ("created_at", "idempotency_key")
+FORMATS = {"csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+
+PARQUET_SCHEMA = pa.schema(
+    [("meal_date", pa.string()), ("meal_type", pa.string()), ("food_name", pa.string())]
+    + [(col, pa.float64()) for col in NUTRIENT_COLUMNS + MICRO_COLUMNS]
+    + [("created_at", pa.string()), ("idempotency_key", pa.string())]
+)
+
+
+# --- 書き出し ---
+
+def iter_meal_log_pages(supabase, user_id, page_size=PAGE_SIZE):
+    """ユーザーの全食事ログを id 順に page_size 行ずつ返すジェネレータ（キーセットページング）"""
+    columns = ", ".join(("id",) + EXPORT_COLUMNS)
+    last_id = None
+    while True:
+        query = supabase.table("meal_logs").select(columns).eq("user_id", user_id)
+        if last_id is not None:
+            query = query.gt("id", last_id)
+        rows = execute_query(query.order("id").limit(page_size), "iter_meal_log_pages").data or []
+        if rows:
+            yield rows
+        if len(rows) < page_size:
+            return
+        last_id = rows[-1]["id"]
+
+
+def export_meal_logs(pages, out, fmt):
+    """
+    ページごとの行を out（バイナリのファイルオブジェクト）に書き出す
+    CSV は Excel で開けるよう BOM 付き UTF-8、Parquet は1ページを1行グループにする
+    Returns: 書き出した行数
+    """
+    count = 0
+    if fmt == "csv":
+        text = io.TextIOWrapper(out, encoding="utf-8-sig", newline="", write_through=True)
+        writer = csv.DictWriter(text, fieldnames=EXPORT_COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+        for rows in pages:
+            writer.writerows(rows)
+            count += len(rows)
+        text.detach()  # out は呼び出し側で閉じる
+    elif fmt == "parquet":
+        with pq.ParquetWriter(out, PARQUET_SCHEMA) as writer:
+            for rows in pages:
+                table = pa.Table.from_pylist([_export_row(r) for r in rows], schema=PARQUET_SCHEMA)
+                writer.write_table(table)
+                count += len(rows)
+    else:
+        raise ValueError(f"未対応の形式です: {fmt}")
+    return count
+
+
+def _export_row(row):
+    out = {col: row.get(col) for col in EXPORT_COLUMNS}
+    for col in NUTRIENT_COLUMNS + MICRO_COLUMNS:
+        if out[col] is not None:
+            out[col] = float(out[col])
+    return out
+
+
+# --- 取り込み ---
+
+def read_meal_log_rows(f, fmt, batch_size=CHUNK_SIZE):
+    """書き出したファイル（バイナリ）の行を dict で1行ずつ返すジェネレータ"""
+    if fmt == "csv":
+        yield from csv.DictReader(codecs.getreader("utf-8-sig")(f))
+    elif fmt == "parquet":
+        for batch in pq.ParquetFile(f).iter_batches(batch_size=batch_size):
+            yield from batch.to_pylist()
+    else:
+        raise ValueError(f"未対応の形式です: {fmt}")
+
+
+def validate_meal_log_row(raw):
+    """
+    取り込む1行を検証して、保存する値に変換する
+    Returns: (値の dict, None) / (None, エラーメッセージ)
+    """
+    try:
+        meal_date = date.fromisoformat(str(raw.get("meal_date") or "").strip())
+    except ValueError:
+        return None, f"日付が不正です: {raw.get('meal_date')!r}"
+    meal_type = str(raw.get("meal_type") or "").strip()
+    if meal_type not in MEAL_TYPES:
+        return None, f"食事タイプが不正です: {meal_type!r}"
+    food_name = str(raw.get("food_name") or "").strip()
+    if not food_name:
+        return None, "食事名が空です"
+
+    values = {"meal_date": meal_date, "meal_type": meal_type, "food_name": food_name}
+    for col in NUTRIENT_COLUMNS + MICRO_COLUMNS:
+        val = _to_number(raw.get(col))
+        if val is None and col in NUTRIENT_COLUMNS:
+            val = 0.0
+        if val is not None and (math.isnan(val) or val < 0):
+            return None, f"{col} が不正です: {raw.get(col)!r}"
+        values[col] = val
+
+    created_at = str(raw.get("created_at") or "").strip()
+    if created_at:
+        try:
+            datetime.fromisoformat(created_at)
+        except ValueError:
+            return None, f"created_at が不正です: {created_at!r}"
+    values["created_at"] = created_at or None
+    values["idempotency_key"] = str(raw.get("idempotency_key") or "").strip() or None
+    return values, None
+
+
+def _to_number(val):
+    if val is None or val == "":
+        return None
+    try:
+        return float(val)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def import_meal_logs(supabase, user_id, rows, chunk_size=CHUNK_SIZE, on_progress=None):
+    """
+    rows（dict のイテラブル）を検証して chunk_size 行ずつ保存する
+    冪等キーは書き出した行のものをそのまま使う（元の行と同じキーになり、書き出したアカウントに戻しても重複しない）。
+    キーのない行（手で作ったファイルや、冪等キー導入前の行）は、行の内容と作成日時（なければファイル内の行番号）から作るので、
+    同じファイルの再取り込みは重複しない
+    on_progress(report) は1チャンク保存するたびに呼ぶ
+
+    Returns: {"rows", "saved", "invalid", "errors": [(行番号, メッセージ), ...], "elapsed", "rows_per_sec"}
+    """
+    report = {"rows": 0, "saved": 0, "invalid": 0, "errors": [], "elapsed": 0.0, "rows_per_sec": 0.0}
+    started = time.perf_counter()
+    now = datetime.now(timezone.utc).isoformat()
+    chunk = []
+
+    def flush():
+        report["saved"] += sum(1 for row in save_meal_logs(supabase, chunk) if row)
+        chunk.clear()
+        report["elapsed"] = time.perf_counter() - started
+        report["rows_per_sec"] = report["rows"] / report["elapsed"] if report["elapsed"] else 0.0
+        if on_progress:
+            on_progress(report)
+
+    for line_no, raw in enumerate(rows, start=2):  # CSV のヘッダーを1行目として数える
+        report["rows"] += 1
+        values, error = validate_meal_log_row(raw)
+        if error:
+            report["invalid"] += 1
+            if len(report["errors"]) < MAX_ERRORS:
+                report["errors"].append((line_no, error))
+            continue
+        origin = values["created_at"] or f"line{line_no}"
+        row = build_meal_log_row(
+            user_id, values["meal_date"], values["meal_type"], values["food_name"],
+            values["p_val"], values["f_val"], values["c_val"], values["calories"],
+            values["iron_mg"], values["folate_ug"], values["calcium_mg"], values["vitamin_d_ug"],
+            idempotency_key=values["idempotency_key"] or make_idempotency_key(
+                user_id, values["meal_date"], values["meal_type"], f"import:{origin}:{values['food_name']}", "import",
+            ),
+        )
+        # 一括挿入では全行の列を揃えるため、作成日時がない行は取り込んだ時刻にする
+        row["created_at"] = values["created_at"] or now
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            flush()
+    flush()
+    return report
@@ -0,0 +1,358 @@
+"""
+Gemini / Supabase の呼び出しとキャッシュのメトリクス（Prometheus のテキスト形式）
+
+tracing.py のクライアントの代理が呼び出しごとに所要時間・トークン数・エラーを記録し、
+キャッシュは observe_cache() で包んだ関数のヒット / ミスを数える。start_metrics_exporter() が
+別スレッドの HTTP サーバーで /metrics を公開し、ポートを開けない環境では JSONL ファイルに
+一定間隔でスナップショットを追記する。
+
+    # secrets.toml（すべて任意）
+    [metrics]
+    port = 9464          # 0 なら HTTP サーバーを起動せず JSONL だけに書く
+    sink = "/var/log/pfc/metrics.jsonl"
+    interval = 60
+
+依存パッケージを増やさないよう、prometheus_client は使わずテキスト形式を直接出力する。
+"""
+
+import functools
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import streamlit as st
+
+DEFAULT_PORT = 9464
+DEFAULT_SINK = os.path.join(tempfile.gettempdir(), "pfc-metrics.jsonl")
+DEFAULT_INTERVAL = 60          # JSONL に書き出す間隔（秒）
+SINK_MAX_BYTES = 10 * 1024 ** 2  # これを超えたら .1 に退避して書き直す
+
+GEMINI_BUCKETS = (0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30)
+SUPABASE_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class Counter:
+    """ラベルごとの累積値"""
+
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[n]) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(str(labels[n]) for n in self.labelnames), 0)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        """[(サンプル名, ラベルの dict, 値), ...]"""
+        with self._lock:
+            items = list(self._values.items())
+        return [(self.name, dict(zip(self.labelnames, key)), value) for key, value in items]
+
+
+class Histogram:
+    """ラベルごとの分布（バケットごとの累積件数・合計・件数）"""
+
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=GEMINI_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._values = {}  # ラベル -> [バケットごとの件数..., +Inf の件数, 合計]
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[n]) for n in self.labelnames)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+                    break
+            else:
+                data[len(self.buckets)] += 1
+            data[-1] += value
+
+    def count(self, **labels):
+        data = self._values.get(tuple(str(labels[n]) for n in self.labelnames))
+        return sum(data[:-1]) if data else 0
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(data)) for key, data in self._values.items()]
+        out = []
+        for key, data in items:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), data[:-1]):
+                cumulative += n
+                out.append((f"{self.name}_bucket", {**labels, "le": _format_value(bound)}, cumulative))
+            out.append((f"{self.name}_sum", labels, data[-1]))
+            out.append((f"{self.name}_count", labels, cumulative))
+        return out
+
+
+class Registry:
+    """メトリクスと、書き出し時に値を集める関数（collector）の一覧"""
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def clear(self):
+        for metric in self.metrics:
+            metric.clear()
+
+    def collect(self):
+        """[(メトリクス, [(サンプル名, ラベル, 値), ...]), ...]（collector の値は対応するメトリクスに足す）"""
+        extra = {}
+        for collector in self.collectors:
+            try:
+                for name, labels, value in collector():
+                    extra.setdefault(name, []).append((name, labels, value))
+            except Exception as e:
+                print(f"[metrics] 集計エラー: {e}")
+        return [(m, m.samples() + extra.get(m.name, [])) for m in self.metrics]
+
+    def render(self):
+        """Prometheus のテキスト形式（version 0.0.4）"""
+        lines = []
+        for metric, samples in self.collect():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in samples:
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """JSONL の1行分（{"ts", "samples": [{"name", "labels", "value"}, ...]}）"""
+        return {
+            "ts": datetime.now(timezone.utc).isoformat(),
+            "samples": [
+                {"name": name, "labels": labels, "value": value}
+                for _, samples in self.collect() for name, labels, value in samples
+            ],
+        }
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+# 呼び出しごとに記録するため、@st.cache_resource の関数呼び出しを挟まずモジュールで1つだけ持つ
+registry = Registry()
+
+gemini_latency = registry.register(Histogram(
+    "pfc_gemini_request_duration_seconds", "Gemini API の呼び出しの所要時間", ("model", "method"), GEMINI_BUCKETS,
+))
+gemini_tokens = registry.register(Counter(
+    "pfc_gemini_tokens_total", "Gemini API のトークン数（type=prompt/output）", ("model", "type"),
+))
+gemini_errors = registry.register(Counter(
+    "pfc_gemini_errors_total", "Gemini API の呼び出しエラー（code=429 はレート制限）", ("model", "code"),
+))
+gemini_parse_failures = registry.register(Counter(
+    "pfc_gemini_parse_failures_total", "Gemini の応答を JSON として読めなかった回数", ("function",),
+))
+supabase_latency = registry.register(Histogram(
+    "pfc_supabase_query_duration_seconds", "Supabase のクエリの所要時間", ("table", "op"), SUPABASE_BUCKETS,
+))
+supabase_errors = registry.register(Counter(
+    "pfc_supabase_errors_total", "Supabase のクエリのエラー", ("table", "op"),
+))
+db_retries = registry.register(Counter(
+    "pfc_db_retries_total", "DB 呼び出しの再試行（kind=timeout/connection/rate_limited/server）", ("function", "kind"),
+))
+db_failures = registry.register(Counter(
+    "pfc_db_failures_total", "再試行しても失敗した・再試行しなかった DB 呼び出し（kind はエラーの分類）", ("function", "kind"),
+))
+cache_requests = registry.register(Counter(
+    "pfc_cache_requests_total", "キャッシュした関数の呼び出し（result=hit/miss）", ("function", "result"),
+))
+
+
+def error_code(exc):
+    """例外の HTTP ステータス（google-genai の APIError は .code、httpx 系は .status_code）。なければ例外名"""
+    for attr in ("code", "status_code"):
+        code = getattr(exc, attr, None)
+        if isinstance(code, int):
+            return str(code)
+    return type(exc).__name__
+
+
+def record_gemini_usage(model, response):
+    """応答の usage_metadata からトークン数を記録する"""
+    usage = getattr(response, "usage_metadata", None)
+    for type_, attr in (("prompt", "prompt_token_count"), ("output", "candidates_token_count")):
+        count = getattr(usage, attr, None)
+        if isinstance(count, int) and count:
+            gemini_tokens.inc(count, model=model, type=type_)
+
+
+def observe_cache(name, cache):
+    """
+    cache（st.cache_data(...) など）でキャッシュした関数のヒット / ミスを数えるデコレーター
+    本体が実行されたらミス、されなければヒット
+
+        @observe_cache("fetch_meal_logs_range", st.cache_data(ttl=60))
+        def fetch_meal_logs_range(user_id, start_str, end_str): ...
+    """
+    def decorator(func):
+        state = threading.local()
+
+        @functools.wraps(func)
+        def body(*args, **kwargs):
+            state.ran = True
+            return func(*args, **kwargs)
+
+        cached = cache(body)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            state.ran = False
+            result = cached(*args, **kwargs)
+            cache_requests.inc(function=name, result="miss" if state.ran else "hit")
+            return result
+
+        wrapper.clear = cached.clear
+        return wrapper
+    return decorator
+
+
+def _collect_process_caches():
+    """プロセス内のキャッシュ（analysis_cache.py）のヒット / ミスを自前の集計から読む"""
+    from analysis_cache import get_analysis_cache, get_ingredient_cache
+
+    analysis = get_analysis_cache().report()
+    ingredients = get_ingredient_cache().report()
+    for function, hits, lookups in (
+        ("analysis_cache", analysis["hits"], analysis["lookups"]),
+        ("ingredient_cache", ingredients["assembled"], ingredients["lookups"]),
+    ):
+        yield cache_requests.name, {"function": function, "result": "hit"}, hits
+        yield cache_requests.name, {"function": function, "result": "miss"}, lookups - hits
+
+
+registry.collectors.append(_collect_process_caches)
+
+
+# --- 書き出し ---
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # アクセスログは出さない（スクレイプごとに出ると Streamlit のログが埋まる）
+
+
+class JsonlSink:
+    """一定間隔で registry.snapshot() を JSONL ファイルに追記するスレッド"""
+
+    def __init__(self, path, interval=DEFAULT_INTERVAL, max_bytes=SINK_MAX_BYTES):
+        self.path = path
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="pfc-metrics-sink", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def write(self):
+        """スナップショットを1行追記する（ファイルが max_bytes を超えていたら .1 に退避する）"""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+            os.replace(self.path, self.path + ".1")
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(registry.snapshot(), ensure_ascii=False) + "\n")
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                print(f"[metrics] JSONL 書き出しエラー: {e}")
+
+
+def _metrics_config():
+    try:
+        return dict(st.secrets.get("metrics", {}))
+    except Exception:
+        return {}
+
+
+@st.cache_resource
+def start_metrics_exporter():
+    """
+    /metrics を公開する HTTP サーバーを別スレッドで起動する（プロセスに1つ）
+    ポートを開けなければ（使用中・port = 0）JSONL ファイルへの書き出しに切り替える
+    Returns: ("http", ポート番号) / ("jsonl", ファイルのパス)
+    """
+    conf = _metrics_config()
+    port = int(conf.get("port", os.environ.get("PFC_METRICS_PORT", DEFAULT_PORT)))
+    if port:
+        try:
+            server = ThreadingHTTPServer((conf.get("host", "127.0.0.1"), port), _MetricsHandler)
+        except OSError as e:
+            print(f"[metrics] ポート {port} を開けないため JSONL に書き出します: {e}")
+        else:
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name="pfc-metrics-http", daemon=True).start()
+            return "http", server.server_address[1]
+    sink = JsonlSink(conf.get("sink", DEFAULT_SINK), float(conf.get("interval", DEFAULT_INTERVAL))).start()
+    return "jsonl", sink.path
@@ -7,8 +7,13 @@ import pandas as pd
 import plotly.graph_objects as go
 from datetime import date, timedelta
 
+from charts import ChartFigure, create_stacked_trend_svg, create_trend_svg, memoize_figure, render_chart
 from config import get_supabase
+from db_calls import execute_query
+from fragments import fragment
 from services import get_user_profile
+from metrics import observe_cache
+from tracing import traced
 
 supabase = get_supabase()
 
@@ -21,31 +26,26 @@ DEFAULT_USER_ID = "d8875444-a88a-4a31-947d-2174eefb80f0"
 
 
 # --- データ取得 ---
-@st.cache_data(ttl=60, show_spinner=False)
+@observe_cache("fetch_meal_logs_range", st.cache_data(ttl=60, show_spinner=False))
 def fetch_meal_logs_range(user_id: str, start_date: str, end_date: str):
-    """指定期間の meal_logs を取得（リトライ付き）"""
-    import time as _time
-    _supabase = get_supabase()
-    for attempt in range(3):
-        try:
-            res = (
-                _supabase.table("meal_logs")
-                .select("*")
-                .eq("user_id", user_id)
-                .gte("meal_date", start_date)
-                .lte("meal_date", end_date)
-                .order("meal_date", desc=False)
-                .execute()
-            )
-            return res.data if res and res.data else []
-        except Exception as e:
-            if attempt < 2:
-                _time.sleep(1)
-            else:
-                print(f"[fetch_meal_logs_range] データ取得エラー: {e}")
-                return []
+    """指定期間の meal_logs を取得（一時的なエラーは db_calls.execute_query() が再試行する）"""
+    query = (
+        get_supabase().table("meal_logs")
+        .select("*")
+        .eq("user_id", user_id)
+        .gte("meal_date", start_date)
+        .lte("meal_date", end_date)
+        .order("meal_date", desc=False)
+    )
+    try:
+        res = execute_query(query, "fetch_meal_logs_range")
+    except Exception as e:
+        print(f"[fetch_meal_logs_range] データ取得エラー: {e}")
+        return []
+    return res.data if res and res.data else []
 
 
+@traced("dataframe.aggregate_daily")
 def aggregate_daily(logs, start_date, days):
     rows = []
     weekdays = ["月", "火", "水", "木", "金", "土", "日"]
@@ -83,8 +83,10 @@ BLACK = "#111"
 
 
 # --- グラフ ---
+@traced("chart.calorie")
+@memoize_figure("chart.calorie")
 def create_calorie_chart(df, target_cal):
-    fig = go.Figure()
+    fig = ChartFigure()
     fig.add_trace(go.Bar(
         x=df["label"], y=df["calorie"],
         marker_color="rgba(0,172,193,0.45)", name="カロリー", marker_line_width=0,
@@ -138,9 +140,11 @@ def create_calorie_chart(df, target_cal):
     return fig
 
 
+@traced("chart.nutrient")
+@memoize_figure("chart.nutrient")
 def create_nutrient_chart(df, key, label, bar_color, line_color, target=0):
-    """P・F・C それぞれ個別のグラフを生成する共通関数"""
-    fig = go.Figure()
+    """P・F・C それぞれ個別のグラフを生成する共通関数（同じ期間・目標では前回の Figure を使い回す）"""
+    fig = ChartFigure()
     fig.add_trace(go.Bar(
         x=df["label"], y=df[key],
         marker_color=bar_color, name=label, marker_line_width=0,
@@ -192,6 +196,166 @@ def create_nutrient_chart(df, key, label, bar_color, line_color, target=0):
     return fig
 
 
+def _moving_average(df, key):
+    """Plotly 版と同じ移動平均（30日間は7日・14日間は3日。記録のない日は除く）と凡例名。7日間なら (None, None)"""
+    window = 7 if len(df) > 14 else 3 if len(df) > 7 else None
+    if window is None:
+        return None, None
+    series = df[key].replace(0, float("nan")).where(df["meal_count"] > 0)
+    return series.rolling(window, min_periods=1).mean().tolist(), f"移動平均({window}日)"
+
+
+@traced("chart.calorie_svg")
+@memoize_figure("chart.calorie_svg")
+def create_calorie_svg(df, target_cal):
+    """create_calorie_chart() の SVG 版"""
+    line, line_name = _moving_average(df, "calorie")
+    df_active = df[df["meal_count"] > 0]
+    avg = df_active["calorie"].mean() if line is None and len(df_active) > 0 else None
+    return create_trend_svg(
+        df["label"].tolist(), df["calorie"].tolist(), "rgba(0,172,193,0.45)", 200, bar_name="カロリー",
+        line=line, line_color=TEAL, line_name=line_name,
+        avg=avg, avg_text=f"平均 {int(avg)}kcal" if avg is not None else None,
+        target=target_cal, target_text=f"目標 {target_cal}kcal",
+        target_fill="rgba(0,172,193,0.10)", target_line_color="rgba(0,172,193,0.5)",
+        show_legend=len(df) > 7,
+    )
+
+
+@traced("chart.nutrient_svg")
+@memoize_figure("chart.nutrient_svg")
+def create_nutrient_svg(df, key, label, bar_color, line_color, target=0):
+    """create_nutrient_chart() の SVG 版"""
+    df_active = df[df["meal_count"] > 0]
+    line, line_name, avg = None, None, None
+    if len(df_active) > 0:
+        line, line_name = _moving_average(df, key)
+        if line is None:
+            avg = df_active[key].mean()
+    return create_trend_svg(
+        df["label"].tolist(), df[key].tolist(), bar_color, 180, bar_name=label,
+        line=line, line_color=line_color, line_name=line_name,
+        avg=avg, avg_text=f"平均 {int(avg)}g" if avg is not None else None,
+        target=target if target > 0 else None, target_text=f"目標 {target}g",
+        target_fill=bar_color.replace("0.45", "0.10").replace("0.35", "0.10"), target_line_color=line_color,
+        show_legend=len(df) > 7,
+    )
+
+
+# --- まとめて表示（P・F・C・カロリーを横軸を共有した1枚に） ---
+# (列, 題名, 棒の色, 線の色, 目標の線の色, 単位)
+PANELS = (
+    ("protein", "タンパク質 (P)", "rgba(0,172,193,0.45)", TEAL, TEAL, "g"),
+    ("fat", "脂質 (F)", "rgba(255,82,82,0.45)", PINK, PINK, "g"),
+    ("carb", "炭水化物 (C)", "rgba(85,85,85,0.35)", GREY_DARK, GREY_DARK, "g"),
+    ("calorie", "カロリー (kcal)", "rgba(0,172,193,0.45)", TEAL, "rgba(0,172,193,0.5)", "kcal"),
+)
+
+
+@traced("dataframe.dashboard_series")
+def dashboard_series(df):
+    """
+    まとめて表示する4段分の系列を、DataFrame を1回なめて作る
+    個別のグラフと同じく、7日間は期間全体の平均・14日/30日間は移動平均（P・F・C は記録がある期間だけ）
+
+    Returns: {列: {"values", "line", "avg"}}
+    """
+    keys = [key for key, *_ in PANELS]
+    active = df["meal_count"] > 0
+    values = df[keys]
+    window = 7 if len(df) > 14 else 3 if len(df) > 7 else None
+    has_data = bool(active.any())
+    ma = values.replace(0, float("nan")).where(active, axis=0).rolling(window, min_periods=1).mean() if window else None
+    avgs = values[active].mean() if has_data else None
+    series = {}
+    for key in keys:
+        show = has_data or key == "calorie"
+        series[key] = {
+            "values": values[key].tolist(),
+            "line": ma[key].tolist() if ma is not None and show else None,
+            "avg": float(avgs[key]) if window is None and has_data else None,
+        }
+    return series
+
+
+def _target_fill(bar_color):
+    return bar_color.replace("0.45", "0.10").replace("0.35", "0.10")
+
+
+@traced("chart.dashboard")
+@memoize_figure("chart.dashboard")
+def create_dashboard_chart(df, targets):
+    """
+    P・F・C・カロリーを横軸を共有した4段のサブプロットで1枚の Figure にする（targets: {列: 目標}）
+    make_subplots / add_hline(row=...) は1回ごとに Figure 全体を検証し直して遅いので、
+    トレース・軸・目標の帯と線・注釈をまとめて組み立ててから1回で Figure にする
+    """
+    series = dashboard_series(df)
+    window_name = f"移動平均({7 if len(df) > 14 else 3}日)" if len(df) > 7 else None
+    labels = df["label"].tolist()
+    rows, spacing = len(PANELS), 0.05
+    row_h = (1 - spacing * (rows - 1)) / rows
+    data, shapes, annotations = [], [], []
+    layout = {}
+    for i, (key, title, bar_color, line_color, target_line, unit) in enumerate(PANELS):
+        yref = "y" if i == 0 else f"y{i + 1}"
+        top = 1 - i * (row_h + spacing)
+        layout["yaxis" if i == 0 else f"yaxis{i + 1}"] = dict(
+            domain=[max(top - row_h, 0), top], gridcolor=GRID_COLOR, tickfont=AXIS_FONT, fixedrange=True,
+        )
+        annotations.append(dict(text=title, xref="paper", yref="paper", x=0, y=top, xanchor="left",
+                                yanchor="bottom", showarrow=False, font=dict(color=BLACK, size=12)))
+        values = series[key]
+        data.append(go.Bar(x=labels, y=values["values"], yaxis=yref, marker_color=bar_color,
+                           marker_line_width=0, name=title))
+        if values["line"] is not None:
+            data.append(go.Scatter(x=labels, y=values["line"], yaxis=yref, mode="lines",
+                                   line=dict(color=line_color, width=2.5), name=window_name, connectgaps=True))
+        if values["avg"] is not None:
+            shapes.append(dict(type="line", xref="x domain", x0=0, x1=1, yref=yref, y0=values["avg"],
+                               y1=values["avg"], line=dict(color=line_color, width=2)))
+            annotations.append(dict(text=f"平均 {int(values['avg'])}{unit}", xref="x domain", x=1, yref=yref,
+                                    y=values["avg"], xanchor="right", yanchor="bottom", showarrow=False,
+                                    font=dict(color=BLACK, size=10)))
+        target = targets.get(key) or 0
+        if target > 0:
+            shapes.append(dict(type="rect", xref="x domain", x0=0, x1=1, yref=yref, y0=0, y1=target,
+                               fillcolor=_target_fill(bar_color), line_width=0, layer="below"))
+            shapes.append(dict(type="line", xref="x domain", x0=0, x1=1, yref=yref, y0=target, y1=target,
+                               line=dict(color=target_line, width=1)))
+            annotations.append(dict(text=f"目標 {target}{unit}", xref="x domain", x=0, yref=yref, y=target,
+                                    xanchor="left", yanchor="bottom", showarrow=False,
+                                    font=dict(color=BLACK, size=11)))
+    layout.update(
+        height=150 * rows + 40, margin=dict(l=10, r=10, t=30, b=10),
+        paper_bgcolor="rgba(0,0,0,0)", plot_bgcolor="rgba(0,0,0,0)",
+        # 横軸は1本を全段で共有し、日付のラベルは一番下の段にだけ付ける
+        xaxis=dict(anchor=f"y{rows}", tickfont=AXIS_FONT, fixedrange=True),
+        showlegend=False, shapes=shapes, annotations=annotations,
+    )
+    return ChartFigure(data=data, layout=layout)
+
+
+@traced("chart.dashboard_svg")
+@memoize_figure("chart.dashboard_svg")
+def create_dashboard_svg(df, targets):
+    """create_dashboard_chart() の SVG 版（4段を1枚の SVG に縦に並べる）"""
+    series = dashboard_series(df)
+    window_name = f"移動平均({7 if len(df) > 14 else 3}日)" if len(df) > 7 else None
+    panels = []
+    for key, title, bar_color, line_color, target_line, unit in PANELS:
+        data = series[key]
+        target = targets.get(key) or 0
+        panels.append({
+            "values": data["values"], "bar_color": bar_color, "title": title, "bar_name": "日ごと",
+            "line": data["line"], "line_color": line_color, "line_name": window_name,
+            "avg": data["avg"], "avg_text": f"平均 {int(data['avg'])}{unit}" if data["avg"] is not None else None,
+            "target": target if target > 0 else None, "target_text": f"目標 {target}{unit}",
+            "target_fill": _target_fill(bar_color), "target_line_color": target_line,
+            "show_legend": data["line"] is not None,
+        })
+    return create_stacked_trend_svg(df["label"].tolist(), panels)
+
 
 # =========================================================
 # メイン
@@ -208,47 +372,62 @@ target_f   = profile.get("target_f") or 60
 target_c   = profile.get("target_c") or 250
 
 st.title("📊 PFCダッシュボード")
+targets = {"protein": target_p, "fat": target_f, "carb": target_c, "calorie": target_cal}
 
-# --- コントロール ---
-days = st.radio("表示期間", [7, 14, 30], index=0, horizontal=True,
-                format_func=lambda d: f"{d}日間", key="dash_range",
-                label_visibility="collapsed")
 
-# --- データ取得 ---
-today = date.today()
-start = today - timedelta(days=days - 1)
-logs = fetch_meal_logs_range(user_id, start.isoformat(), today.isoformat())
-df = aggregate_daily(logs, start, days)
-
-days_with_data = int((df["meal_count"] > 0).sum())
-total_meals = int(df["meal_count"].sum())
-df_active = df[df["meal_count"] > 0]
-avg_cal = int(df_active["calorie"].mean()) if days_with_data > 0 else 0
-avg_p = int(df_active["protein"].mean()) if days_with_data > 0 else 0
-avg_f = int(df_active["fat"].mean()) if days_with_data > 0 else 0
-avg_c = int(df_active["carb"].mean()) if days_with_data > 0 else 0
-
-st.caption(f"{days_with_data}日間のデータ · {total_meals}食記録 · 平均 {avg_cal:,} kcal/日  \n（P:{avg_p}g F:{avg_f}g C:{avg_c}g）")
-
-# --- PFC推移（個別グラフ） ---
-st.subheader("🏋️ PFC推移 (g)")
-st.caption("タンパク質 (P)")
-st.plotly_chart(
-    create_nutrient_chart(df, "protein", "タンパク質", "rgba(0,172,193,0.45)", TEAL, target_p),
-    use_container_width=True, config={"staticPlot": True},
-)
-st.caption("脂質 (F)")
-st.plotly_chart(
-    create_nutrient_chart(df, "fat", "脂質", "rgba(255,82,82,0.45)", PINK, target_f),
-    use_container_width=True, config={"staticPlot": True},
-)
-st.caption("炭水化物 (C)")
-st.plotly_chart(
-    create_nutrient_chart(df, "carb", "炭水化物", "rgba(85,85,85,0.35)", GREY_DARK, target_c),
-    use_container_width=True, config={"staticPlot": True},
-)
+@fragment("dashboard_charts")
+@traced("fragment.dashboard_charts")
+def dashboard_charts():
+    """
+    表示期間・表示方法のコントロールとグラフ
+    期間を切り替えてもこの部分だけを再実行する（プロフィール・目標はページの実行時に取得したものを使う）
+    """
+    # --- コントロール ---
+    col_range, col_mode = st.columns([3, 2], vertical_alignment="center")
+    with col_range:
+        days = st.radio("表示期間", [7, 14, 30], index=0, horizontal=True,
+                        format_func=lambda d: f"{d}日間", key="dash_range",
+                        label_visibility="collapsed")
+    with col_mode:
+        combined = st.toggle("まとめて表示", value=True, key="dash_combined")
+
+    # --- データ取得 ---
+    today = date.today()
+    start = today - timedelta(days=days - 1)
+    logs = fetch_meal_logs_range(user_id, start.isoformat(), today.isoformat())
+    df = aggregate_daily(logs, start, days)
+
+    days_with_data = int((df["meal_count"] > 0).sum())
+    total_meals = int(df["meal_count"].sum())
+    df_active = df[df["meal_count"] > 0]
+    avg_cal = int(df_active["calorie"].mean()) if days_with_data > 0 else 0
+    avg_p = int(df_active["protein"].mean()) if days_with_data > 0 else 0
+    avg_f = int(df_active["fat"].mean()) if days_with_data > 0 else 0
+    avg_c = int(df_active["carb"].mean()) if days_with_data > 0 else 0
+
+    st.caption(f"{days_with_data}日間のデータ · {total_meals}食記録 · 平均 {avg_cal:,} kcal/日  \n（P:{avg_p}g F:{avg_f}g C:{avg_c}g）")
+
+    if combined:
+        # --- PFC・カロリー推移（横軸を共有した1枚） ---
+        st.subheader("📈 PFC・カロリー推移")
+        render_chart(create_dashboard_svg, create_dashboard_chart, df, targets)
+        return
+
+    # --- PFC推移（個別グラフ） ---
+    st.subheader("🏋️ PFC推移 (g)")
+    st.caption("タンパク質 (P)")
+    render_chart(create_nutrient_svg, create_nutrient_chart,
+                 df, "protein", "タンパク質", "rgba(0,172,193,0.45)", TEAL, target_p)
+    st.caption("脂質 (F)")
+    render_chart(create_nutrient_svg, create_nutrient_chart,
+                 df, "fat", "脂質", "rgba(255,82,82,0.45)", PINK, target_f)
+    st.caption("炭水化物 (C)")
+    render_chart(create_nutrient_svg, create_nutrient_chart,
+                 df, "carb", "炭水化物", "rgba(85,85,85,0.35)", GREY_DARK, target_c)
+
+    # --- カロリー推移 ---
+    st.subheader("🔥 日次カロリー推移")
+    render_chart(create_calorie_svg, create_calorie_chart, df, target_cal)
+
 
-# --- カロリー推移 ---
-st.subheader("🔥 日次カロリー推移")
-st.plotly_chart(create_calorie_chart(df, target_cal),
-                use_container_width=True, config={"staticPlot": True})
+dashboard_charts()
@@ -4,22 +4,36 @@
 
 import streamlit as st
 import streamlit.components.v1 as components
-import pandas as pd
 import time
+import uuid
 import base64
 import urllib.parse
 from datetime import timedelta, date
 
-from config import get_supabase
+from config import get_executor, get_supabase
+from deadlines import is_timeout, start_deadline, wait_for
+from fragments import fragment
+from gemini_usage import BudgetExceeded, set_current_user_from_session
 from services import (
     analyze_meal_with_gemini,
     get_user_profile,
-    save_meal_log, get_meal_logs, delete_meal_log,
+    save_meal_log, save_meal_logs, build_meal_log_row, delete_meal_log, prefetch_meal_logs,
+    make_idempotency_key, find_meal_log_by_idempotency_key,
+    start_day_reconciliation, apply_day_reconciliations, start_estimate_confirmation,
     # generate_meal_advice,  # アドバイス機能を一時無効化
-    generate_pfc_summary,
-    get_meal_templates, delete_meal_template,
+    generate_pfc_summary, build_week_strip_labels,
+    suggest_meal_plan, format_meal_plan, polish_meal_plan_with_gemini,
+    get_meal_templates, delete_meal_template, get_food_name_history,
+    SpeculativeAnalysis, get_speculation_stats,
 )
-from charts import create_summary_chart
+from charts import create_summary_chart, create_summary_svg, render_chart
+from ledger import DailyLedger
+from food_search import (
+    FoodSearchIndex, search_suggestions, get_food_index,
+    template_entries, history_entries, history_entry,
+)
+from meal_estimator import MealEstimator, HIGH_CONFIDENCE, LOW_CONFIDENCE
+from text_pause import paused_text, watch_text_pause
 
 supabase = get_supabase()
 
@@ -68,17 +82,39 @@ if "user" not in st.session_state:
 user = st.session_state["user"]
 selected_model = st.session_state.get("selected_model", "gemini-flash-latest")
 profile = get_user_profile(user.id)
+target_cal = profile.get("target_calories") or 2000
+target_p   = profile.get("target_p") or 100
+target_f   = profile.get("target_f") or 60
+target_c   = profile.get("target_c") or 250
+targets = {"cal": target_cal, "p": target_p, "f": target_f, "c": target_c}
 
 
 st.title("食事記録")
 
 # --- 日付ナビゲーション ---
+# 日付の切り替えはブラウザ遷移（?date=...）ではなくセッション内の状態として扱う。
+# URL の date パラメータはブックマーク・リロード用に同期だけしておく。
 params = st.query_params
-if "date" in params:
+if "date" in params and params["date"] != st.session_state.get("date_param_applied"):
     try:
         st.session_state.current_date = date.fromisoformat(params["date"])
     except ValueError:
         pass
+    st.session_state["date_param_applied"] = params["date"]
+
+
+def _select_date(d):
+    """週カレンダーの日付タップ時のコールバック"""
+    st.session_state.current_date = d
+    st.query_params["date"] = d.isoformat()
+    st.session_state["date_param_applied"] = d.isoformat()
+    st.rerun()  # カレンダーは fragment 内なので、日付変更時はページ全体を再描画する
+
+
+# --- 日別ログキャッシュ（{日付ISO文字列: DailyLedger}）---
+# 週カレンダーの範囲を1回の範囲クエリで取得しておき、隣接日への移動では再取得しない
+PREFETCH_RADIUS = 6  # 週カレンダー内のどの日をタップしても再取得が不要な範囲
+day_cache = st.session_state.setdefault("day_logs_cache", {}).setdefault(user.id, {})
 
 # --- 週カレンダービュー ---
 current_date = st.session_state.current_date
@@ -88,61 +124,94 @@ week_days = [current_date + timedelta(days=i - 3) for i in range(7)]
 
 display_date_large = f"{current_date.year}.{current_date.month}.{current_date.day}"
 
-DAY_NAMES = ["月", "火", "水", "木", "金", "土", "日"]
-day_cells_html = ""
-for d in week_days:
-    is_selected = (d == current_date)
-    is_sunday = (d.weekday() == 6)
-    is_today_cell = (d == today)
-    date_str = d.isoformat()
-    day_num = d.day
-    day_name = "今日" if is_today_cell else DAY_NAMES[d.weekday()]
-    name_color = "#FF3B30" if is_sunday else "inherit"
-
-    if is_selected:
-        day_cells_html += (
-            f'<div class="day-cell day-cell--active">'
-            f'<span class="day-name" style="color:{name_color};">{day_name}</span>'
-            f'<span class="day-num">{day_num}</span>'
-            f'</div>'
-        )
-    else:
-        day_cells_html += (
-            f'<a href="?date={date_str}" target="_self" class="day-cell">'
-            f'<span class="day-name" style="color:{name_color};">{day_name}</span>'
-            f'<span class="day-num">{day_num}</span>'
-            f'</a>'
-        )
+sunday_css = "".join(
+    f".st-key-day_{d.isoformat()} button p::first-line {{ color:#FF3B30; }}"
+    for d in week_days if d.weekday() == 6
+)
 
 st.markdown(f"""
 <style>
     .week-header {{ text-align:center; margin:0.3rem 0 0.6rem 0; }}
-    .week-date-large {{ font-size:1.3rem; font-weight:700; margin-bottom:0.6rem; display:block; }}
-    .week-strip {{ display:flex; justify-content:space-around; align-items:center; }}
-    .day-cell {{
-        display:flex; flex-direction:column; align-items:center;
-        padding:0.3rem 0.6rem; border-radius:0.7rem;
-        text-decoration:none !important; color:inherit; gap:0.1rem; min-width:2rem;
+    .week-date-large {{ font-size:1.3rem; font-weight:700; display:block; }}
+    .st-key-week_strip [data-testid="stHorizontalBlock"] {{
+        flex-wrap: nowrap !important;
+        gap: 0.2rem !important;
     }}
-    a.day-cell, a.day-cell:hover, a.day-cell:visited {{
-        text-decoration:none !important;
+    .st-key-week_strip [data-testid="stColumn"] {{
+        flex: 1 1 0 !important;
+        min-width: 0 !important;
+        width: auto !important;
+    }}
+    .st-key-week_strip button {{
+        min-height: 3.6rem;
+        padding: 0.2rem 0 !important;
+        border: none !important;
+        border-radius: 0.7rem !important;
+        background: transparent !important;
     }}
-    .day-cell--active {{ background:rgba(0,172,193,0.18); }}
-    .day-name {{ font-size:0.75rem; }}
-    .day-num {{ font-size:1.05rem; font-weight:700; }}
-    @media (prefers-color-scheme: dark) {{
-        .day-cell--active {{ background:rgba(0,172,193,0.28); }}
+    .st-key-week_strip button[kind="primary"] {{
+        background: rgba(0,172,193,0.18) !important;
     }}
+    .st-key-week_strip button p {{
+        white-space: pre-line;
+        line-height: 1.2;
+        font-size: 1.05rem !important;
+        font-weight: 700;
+    }}
+    .st-key-week_strip button p::first-line {{ font-size: 0.75rem; font-weight: 400; }}
+    .st-key-week_strip button p span {{ font-size: 0.6rem; font-weight: 700; }}
+    {sunday_css}
 </style>
 <div class="week-header">
     <span class="week-date-large">{display_date_large}</span>
-    <div class="week-strip">{day_cells_html}</div>
 </div>
 """, unsafe_allow_html=True)
 
+# 週カレンダーの7日分を1回の範囲クエリで取得（キャッシュ済みなら通信なし）。
+# 各日のカロリーバッジもこのキャッシュから集計する
+prefetch_meal_logs(supabase, user.id, day_cache, week_days)
+
+# --- ローカル台帳の更新とバックグラウンド突き合わせ ---
+# 保存・削除のあとはページ全体をリランして再取得するのではなく、挿入された行／削除した id で
+# 日別キャッシュをその場で更新し、影響するフラグメントだけを再描画する。
+# DB との突き合わせはバックグラウンドで行い、次の描画時に反映する
+pending_reconciliations = st.session_state.setdefault("pending_reconciliations", {})
+DAY_FRAGMENTS = ["calendar", "day_summary", "history"]
+
+
+def _current_ledger():
+    """表示中の日の台帳を取得（完了済みのバックグラウンド突き合わせを先に反映）"""
+    apply_day_reconciliations(day_cache, pending_reconciliations)
+    date_str = st.session_state.current_date.isoformat()
+    return day_cache.get(date_str) or DailyLedger(date_str)
+
+
+def _after_local_update(date_str):
+    """ローカル台帳を更新した後、その日の DB 再取得をバックグラウンドで開始する"""
+    pending_reconciliations[date_str] = start_day_reconciliation(supabase, user.id, date_str)
+
+
+@fragment("calendar")
+def week_calendar():
+    """週カレンダー（保存・削除後にカロリーバッジだけを更新できるよう fragment にする）"""
+    apply_day_reconciliations(day_cache, pending_reconciliations)
+    with st.container(key="week_strip"):
+        week_labels = build_week_strip_labels(week_days, today, day_cache, target_cal)
+        for col, (d, label) in zip(st.columns(7), week_labels):
+            with col:
+                st.button(
+                    label,
+                    key=f"day_{d.isoformat()}",
+                    type="primary" if d == current_date else "secondary",
+                    use_container_width=True,
+                    on_click=_select_date, args=(d,),
+                )
+
+
+week_calendar()
+
 # --- データ取得 ---
 current_date_str = st.session_state.current_date.isoformat()
-logs = get_meal_logs(supabase, user.id, current_date_str)
 
 # --- 食事入力 ---
 
@@ -154,7 +223,7 @@ st.markdown('<p style="font-size:14px; margin-bottom:0">食べたもの</p>', un
 
 templates = get_meal_templates(supabase, user.id)
 
-@st.fragment
+@fragment("template_buttons")
 def template_buttons(templates):
     """テンプレートボタン（fragment で部分再実行し切り替えを高速化）"""
     st.markdown("""<style>
@@ -204,116 +273,311 @@ if templates:
             del st.session_state["selected_template"]
             st.rerun()
 
+# ── 食品検索（オートコンプリート） ──────────────────────
+# 成分表・テンプレート・過去の食事名から入力中に候補を出し、選んだ候補は
+# その栄養素でそのまま記録する（Gemini を呼ばない）。
+# 過去の食事名の索引（と栄養素の推定器）はセッションで1回だけ構築し、記録のたびに差分で追加する
+food_history_indexes = st.session_state.setdefault("food_history_index", {})
+meal_estimators = st.session_state.setdefault("meal_estimator", {})
+if user.id not in food_history_indexes or user.id not in meal_estimators:
+    history_rows = get_food_name_history(supabase, user.id)
+    food_history_indexes[user.id] = FoodSearchIndex(history_entries(history_rows))
+    meal_estimators[user.id] = MealEstimator(history_rows)
+history_index = food_history_indexes[user.id]
+meal_estimator = meal_estimators[user.id]
+
+template_sig = tuple((t["id"], t["name"], t["food_name"], t["calories"]) for t in templates)
+if st.session_state.get("template_index_sig") != template_sig:
+    st.session_state["template_index_sig"] = template_sig
+    st.session_state["template_index"] = FoodSearchIndex(template_entries(templates))
+search_indexes = (st.session_state["template_index"], history_index, get_food_index())
+
+
+def _on_pick(entry):
+    """候補ボタンのコールバック。候補の栄養素で記録し、影響するフラグメントだけを再描画する"""
+    set_current_user_from_session()
+    meal_date = st.session_state.current_date
+    meal_type = st.session_state["meal_type"]
+    pick_key = make_idempotency_key(
+        user.id, meal_date, meal_type,
+        f"pick:{entry['source']}:{entry['food_name']}", st.query_params["submit_nonce"],
+    )
+    # 成分表の候補は未収載（-）の値が None のことがある。PFC・カロリーは推定値で記録するときと同じく 0 にする
+    row = save_meal_log(
+        supabase, user.id, meal_date, meal_type, entry["food_name"],
+        entry["p_val"] or 0, entry["f_val"] or 0, entry["c_val"] or 0, entry["calories"] or 0,
+        iron_mg=entry["iron_mg"], folate_ug=entry["folate_ug"],
+        calcium_mg=entry["calcium_mg"], vitamin_d_ug=entry["vitamin_d_ug"],
+        idempotency_key=pick_key,
+    ) or find_meal_log_by_idempotency_key(supabase, pick_key)
+    st.toast(f"✅ {entry['food_name']} を記録しました！ {round(entry['calories'] or 0)}kcal")
+
+    date_str = meal_date.isoformat()
+    if row:
+        day_cache.setdefault(date_str, DailyLedger(date_str)).add(row)
+        history_index.add(history_entry(row))
+        meal_estimator.add(row)
+    _after_local_update(date_str)
+    st.query_params["submit_nonce"] = uuid.uuid4().hex[:12]
+    st.session_state["food_query"] = ""
+    st.rerun(DAY_FRAGMENTS + ["food_search"])
+
+
+@fragment("food_search")
+def food_search():
+    """入力中の候補表示（live 入力のたびにこの fragment だけを再実行する）"""
+    query = st.text_input(
+        "食品を検索", key="food_query", type="search", live="200ms",
+        label_visibility="collapsed", placeholder="🔍 食品・テンプレート・履歴から検索（選ぶとすぐ記録）",
+    )
+    for i, entry in enumerate(search_suggestions(query, *search_indexes, limit=6)):
+        st.button(entry["label"], key=f"suggest_{i}", use_container_width=True, on_click=_on_pick, args=(entry,))
+
+
+food_search()
+
 # ── テキスト入力 ──────────────────────────────────
-food_text = st.text_area("食べたもの", height=60, key="food_text", label_visibility="collapsed", placeholder="ここに食事を入力")
+# 入力が 800ms 止まるたびに（text_pause のコンポーネントが知らせる）、過去の記録からの推定値（food_estimate
+# フラグメント）だけを更新する。推定で記録できない入力は、その時点で AI解析を先行して始めておき、
+# 記録時にテキストが同じならその結果を使う。複数行の食事を書けるよう text_area のままにし、
+# 値が確定したとき（入力欄から離れる・Ctrl+Enter）も同じ処理をする
+SPECULATION_PAUSE_MS = 800
+speculation = st.session_state.setdefault("speculation", SpeculativeAnalysis(get_speculation_stats()))
+
+
+def _update_speculation(text):
+    """入力途中のテキストで、AI解析が必要なら先行解析を始める（推定値で記録できるなら取り消す）"""
+    set_current_user_from_session()  # 先行解析の Gemini 呼び出しをこのユーザーの予算で数える
+    st.session_state["food_text_draft"] = text
+    estimate = meal_estimator.estimate(text) if text.strip() else None
+    if estimate and estimate["confidence"] >= LOW_CONFIDENCE:
+        speculation.cancel()  # 推定値で記録するので Gemini は使わない
+    else:
+        speculation.start(text, selected_model)
 
-# ── 記録ボタン ──────────────────────────────────
-st.markdown("""<style>
-    .st-key-record_btn_area button,
-    .st-key-record_btn_area button p {
-        background-color: #06C755 !important;
-        color: white !important;
-        border-color: #06C755 !important;
-    }
-</style>""", unsafe_allow_html=True)
-with st.container(key="record_btn_area"):
-    submitted = st.button("記録する", use_container_width=True, key="record_meal")
-if submitted:
-    has_template = "selected_template" in st.session_state
-    has_text = bool(food_text and food_text.strip())
 
-    # コールドスタート時の再接続でボタン押下イベントが多重送信され、
-    # Gemini APIが短時間に連続呼び出しされるのを防ぐための重複送信ガード
-    submit_key = (str(st.session_state.current_date), meal_type, food_text, has_template)
-    now = time.time()
-    is_duplicate = (
-        st.session_state.get("last_submit_key") == submit_key
-        and now - st.session_state.get("last_submit_time", 0) < 8
-    )
+def _on_food_text_change():
+    """入力が確定したときのコールバック"""
+    _update_speculation(st.session_state.get("food_text", ""))
+    st.rerun(["food_estimate"])
 
-    if is_duplicate:
-        pass
-    elif not has_template and not has_text:
-        st.warning("テンプレートを選択するか、食べたものを入力してください。")
+
+def _on_food_text_pause():
+    """入力が止まったときのコールバック（food_estimate フラグメントの中なので、リランはそのフラグメントだけ）"""
+    _update_speculation(paused_text("food_text_pause") or "")
+
+
+food_text = st.text_area(
+    "食べたもの", height=60, key="food_text", label_visibility="collapsed", placeholder="ここに食事を入力",
+    on_change=_on_food_text_change,
+)
+
+
+@fragment("food_estimate")
+def food_estimate():
+    """過去の自分の記録からの仮の推定値と確度（入力途中のテキストで表示する）"""
+    watch_text_pause("food_text", SPECULATION_PAUSE_MS, key="food_text_pause", on_pause=_on_food_text_pause)
+    text = st.session_state.get("food_text_draft", st.session_state.get("food_text", ""))
+    estimate = meal_estimator.estimate(text) if text.strip() else None
+    if not estimate or estimate["confidence"] < LOW_CONFIDENCE:
+        if speculation.key == (text, selected_model):
+            st.caption("🤖 AIで解析を始めています（このまま記録するとすぐ終わります）")
+    if not estimate:
+        return
+    if estimate["confidence"] >= HIGH_CONFIDENCE:
+        note = "このまま記録します"
+    elif estimate["confidence"] >= LOW_CONFIDENCE:
+        note = "仮の値で記録し、AIで確認します"
     else:
-        st.session_state["last_submit_key"] = submit_key
-        st.session_state["last_submit_time"] = now
-        saved = False
+        note = "AIで解析します"
+    st.caption(
+        f"📎 過去の記録から推定: 約{round(estimate['calories'] or 0)}kcal "
+        f"P:{round(estimate['p_val'] or 0)} F:{round(estimate['f_val'] or 0)} C:{round(estimate['c_val'] or 0)}"
+        f"（確度 {estimate['confidence']:.0%}・{note}）"
+    )
 
-        # テンプレート登録（AI解析なし）
-        if has_template:
-            sel = st.session_state["selected_template"]
-            save_meal_log(
-                supabase, user.id,
-                st.session_state.current_date,
-                meal_type,
-                sel["food_name"],
-                sel["p_val"], sel["f_val"], sel["c_val"], sel["calories"],
-            )
-            del st.session_state["selected_template"]
-            st.toast(f"✅ {sel['name']} を登録しました！")
-            saved = True
 
-        # テキスト入力（AI解析）
+food_estimate()
+
+# --- 送信ごとの冪等キー ---
+# コールドスタート時の再接続でボタン押下イベントが多重送信されても、
+# 同じ送信を二重に記録（＋Gemini呼び出し）しないよう、送信ノンスを URL に保持する。
+# 再接続で新しいセッションになっても URL は残るため、同じ冪等キーが再生成される
+if "submit_nonce" not in st.query_params:
+    st.query_params["submit_nonce"] = uuid.uuid4().hex[:12]
+
+
+def _on_record():
+    """記録ボタンのコールバック。保存した行でローカル台帳を更新し、影響するフラグメントだけを再描画する"""
+    set_current_user_from_session()
+    meal_date = st.session_state.current_date
+    meal_type = st.session_state["meal_type"]
+    food_text = st.session_state.get("food_text", "")
+    submit_nonce = st.query_params["submit_nonce"]
+    has_template = "selected_template" in st.session_state
+    has_text = bool(food_text and food_text.strip())
+
+    if not has_template and not has_text:
+        st.session_state["record_warning"] = "テンプレートを選択するか、食べたものを入力してください。"
+        return
+    # コールバックはページより先に実行されるので、解析の待ち時間にはここで予算を設定する（deadlines.py）
+    start_deadline()
+
+    new_rows = []     # 1回の挿入でまとめて保存する行
+    saved_rows = []   # 保存済みだった行
+    toasts = []
+    confirm_estimate = False     # 仮の推定値で記録するか（バックグラウンドで Gemini の解析に置き換える）
+    pending_confirmation = None  # 仮の推定値で記録した行
+    text_key = None
+
+    # テキスト入力: AI解析が必要なら最初に始め（先行解析があればそれを使う）、以下の処理と並行させる
+    estimate = meal_estimator.estimate(food_text) if has_text else None
+    needs_analysis = has_text and not (estimate and estimate["confidence"] >= LOW_CONFIDENCE)
+    if needs_analysis:
+        speculation.submit(food_text, selected_model)
+    elif has_text:
+        speculation.cancel()  # 推定値で記録するので Gemini は使わない
+
+    # テンプレート（AI解析なし）
+    template_save = None  # AI解析を待つ間に保存しているテンプレートの行
+    if has_template:
+        sel = st.session_state["selected_template"]
+        tpl_key = make_idempotency_key(user.id, meal_date, meal_type, f"template:{sel['id']}", submit_nonce)
+        tpl_row = build_meal_log_row(
+            user.id, meal_date, meal_type, sel["food_name"],
+            sel["p_val"], sel["f_val"], sel["c_val"], sel["calories"],
+            idempotency_key=tpl_key,
+        )
+        if needs_analysis:
+            # 解析を待つ前に共有スレッドプールで保存を始める（冪等キー付きの upsert なので再送でも二重にならない）
+            template_save = get_executor().submit(save_meal_logs, supabase, [tpl_row])
+        else:
+            new_rows.append(tpl_row)
+        toasts.append(f"✅ {sel['name']} を登録しました！")
+
+    saved = []
+    try:
+        # テキスト入力（過去の記録からの推定、または AI解析）
         if has_text:
-            result = analyze_meal_with_gemini(food_text, selected_model)
-            if result:
-                p, f, c, cal, iron, folate, calcium, vit_d = result
-                save_meal_log(supabase, user.id, st.session_state.current_date, meal_type, food_text, p, f, c, cal,
-                              iron_mg=iron, folate_ug=folate, calcium_mg=calcium, vitamin_d_ug=vit_d)
-                st.toast(f"✅ 記録しました！ {cal}kcal")
-                saved = True
+            text_key = make_idempotency_key(user.id, meal_date, meal_type, f"text:{food_text}", submit_nonce)
+            # 同じ送信が既に保存済みなら、その解析結果を使う（解析中の結果は捨てる）
+            existing = find_meal_log_by_idempotency_key(supabase, text_key)
+            if existing:
+                speculation.cancel()
+                saved_rows.append(existing)
+                toasts.append(f"✅ 記録済みです {existing['calories']}kcal")
+            elif not needs_analysis:
+                # 過去の自分の記録に近い食事は推定値ですぐ記録する（確度が低ければ後で Gemini で確認）
+                new_rows.append(build_meal_log_row(
+                    user.id, meal_date, meal_type, food_text,
+                    estimate["p_val"] or 0, estimate["f_val"] or 0, estimate["c_val"] or 0, estimate["calories"] or 0,
+                    iron_mg=estimate["iron_mg"], folate_ug=estimate["folate_ug"],
+                    calcium_mg=estimate["calcium_mg"], vitamin_d_ug=estimate["vitamin_d_ug"],
+                    idempotency_key=text_key,
+                ))
+                if estimate["confidence"] >= HIGH_CONFIDENCE:
+                    toasts.append(f"✅ 記録しました！ 約{round(estimate['calories'] or 0)}kcal（過去の記録から推定）")
+                else:
+                    confirm_estimate = True
+                    toasts.append(f"✅ 仮の値で記録しました 約{round(estimate['calories'] or 0)}kcal（AIで確認中）")
             else:
-                st.warning("AI解析に失敗したため記録されませんでした。もう一度お試しください。")
+                # 解析はバックグラウンドのスレッドで動くので、予算切れ・タイムアウトの案内はここで出す
+                try:
+                    result = speculation.take(food_text, selected_model)
+                except BudgetExceeded as e:
+                    result = None
+                    st.session_state["record_warning"] = f"⚠️ {e}"
+                except Exception as e:
+                    if not is_timeout(e):
+                        raise
+                    result = None
+                    if speculation.key == (food_text, selected_model):  # 待ちきれなかっただけで、解析は続いている
+                        st.session_state["record_warning"] = "⏱️ AI解析が時間内に終わりませんでした。解析は続けているので、もう一度「記録」を押してください。"
+                    else:
+                        st.session_state["record_warning"] = "⏱️ AI解析が時間内に終わりませんでした。しばらくしてからもう一度お試しください。"
+                if result:
+                    p, f, c, cal, iron, folate, calcium, vit_d = result
+                    new_rows.append(build_meal_log_row(
+                        user.id, meal_date, meal_type, food_text, p, f, c, cal,
+                        iron_mg=iron, folate_ug=folate, calcium_mg=calcium, vitamin_d_ug=vit_d,
+                        idempotency_key=text_key,
+                    ))
+                    toasts.append(f"✅ 記録しました！ {cal}kcal")
+                elif "record_warning" not in st.session_state:
+                    st.session_state["record_warning"] = "AI解析に失敗したため記録されませんでした。もう一度お試しください。"
+
+        # 残りの行を1回の挿入で保存する（重複で挿入されなかった行は保存済みの行を探す）
+        saved = list(zip(new_rows, save_meal_logs(supabase, new_rows)))
+    finally:
+        # 解析が例外で終わっても、先に保存を始めたテンプレートの行は待って台帳に反映する（例外はその後に送出される）
+        if template_save:
+            saved.insert(0, (tpl_row, wait_for(template_save)[0]))
+        for new_row, row in saved:
+            row = row or find_meal_log_by_idempotency_key(supabase, new_row["idempotency_key"])
+            saved_rows.append(row)
+            if row and new_row["idempotency_key"] == text_key:
+                if confirm_estimate:
+                    pending_confirmation = row
+                elif needs_analysis:
+                    history_index.add(history_entry(row))
+                    meal_estimator.add(row)
+        if has_template:
+            del st.session_state["selected_template"]
+        for message in toasts:
+            st.toast(message)
+
+        # ローカル台帳に挿入された行を追加（行が取れなかった分はバックグラウンドの突き合わせで反映される）
+        date_str = meal_date.isoformat()
+        if saved_rows:
+            ledger = day_cache.setdefault(date_str, DailyLedger(date_str))
+            for row in saved_rows:
+                if row:
+                    ledger.add(row)
+            _after_local_update(date_str)
+
+    if not saved_rows:
+        return  # 失敗時はページ全体をリランして警告を表示する
+
+    if pending_confirmation:
+        # 確認ジョブも最後に当日分を再取得するので、通常の突き合わせの代わりにこちらを待つ
+        pending_reconciliations[date_str] = start_estimate_confirmation(
+            supabase, user.id, pending_confirmation["id"], date_str, food_text, selected_model,
+        )
 
-        # 保存が成功した場合のみ画面を再描画する（失敗時のエラー/警告表示を残すため）
-        if saved:
-            st.rerun()
+    # 次の送信は別物として扱うため、送信ノンスを更新する
+    st.query_params["submit_nonce"] = uuid.uuid4().hex[:12]
 
-# --- グラフ + アドバイス ---
-total_p = total_f = total_c = total_cal = 0
-total_iron = total_folate = total_calcium = total_vit_d = 0.0
-if logs and logs.data:
-    df = pd.DataFrame(logs.data)
-    total_p = df["p_val"].sum()
-    total_f = df["f_val"].sum()
-    total_c = df["c_val"].sum()
-    total_cal = df["calories"].sum()
-    total_iron   = df["iron_mg"].fillna(0).sum()   if "iron_mg"    in df.columns else 0.0
-    total_folate = df["folate_ug"].fillna(0).sum() if "folate_ug"   in df.columns else 0.0
-    total_calcium= df["calcium_mg"].fillna(0).sum()if "calcium_mg"  in df.columns else 0.0
-    total_vit_d  = df["vitamin_d_ug"].fillna(0).sum() if "vitamin_d_ug" in df.columns else 0.0
+    if "record_warning" not in st.session_state:
+        st.rerun(DAY_FRAGMENTS + (["template_buttons"] if has_template else []))
 
-target_cal = profile.get("target_calories") or 2000
-target_p   = profile.get("target_p") or 100
-target_f   = profile.get("target_f") or 60
-target_c   = profile.get("target_c") or 250
 
-chart_data = {
-    "Cal": {"current": total_cal, "target": target_cal, "unit": "kcal"},
-    "P":   {"current": total_p,   "target": target_p,   "unit": "g"},
-    "F":   {"current": total_f,   "target": target_f,   "unit": "g"},
-    "C":   {"current": total_c,   "target": target_c,   "unit": "g"},
-}
-chart_fig = create_summary_chart(chart_data)
-st.plotly_chart(chart_fig, use_container_width=True, config={"staticPlot": True})
-
-# --- PFCサマリー ---
-totals = {"cal": total_cal, "p": total_p, "f": total_f, "c": total_c}
-targets = {"cal": target_cal, "p": target_p, "f": target_f, "c": target_c}
-logged_meals = logs.data if logs and logs.data else []
+def _on_delete(log):
+    """削除ボタンのコールバック。ローカル台帳から行を除き、影響するフラグメントだけを再描画する"""
+    delete_meal_log(supabase, log["id"])
+    date_str = log["meal_date"]
+    if date_str in day_cache:
+        day_cache[date_str].remove(log["id"])
+    _after_local_update(date_str)
+    st.rerun(DAY_FRAGMENTS)
+
 
-summary_line = generate_pfc_summary(totals, targets)
-st.markdown(f"<p style='font-size:1.1rem; font-weight:bold; margin:0.2rem 0;'>{summary_line}</p>", unsafe_allow_html=True)
+# ── 記録ボタン ──────────────────────────────────
+st.markdown("""<style>
+    .st-key-record_btn_area button,
+    .st-key-record_btn_area button p {
+        background-color: #06C755 !important;
+        color: white !important;
+        border-color: #06C755 !important;
+    }
+</style>""", unsafe_allow_html=True)
+with st.container(key="record_btn_area"):
+    st.button("記録する", use_container_width=True, key="record_meal", on_click=_on_record)
+if "record_warning" in st.session_state:
+    st.warning(st.session_state.pop("record_warning"))
 
-# --- 微量栄養素サマリー ---
+# --- グラフ + アドバイス ---
 MICRO_TARGETS = {"iron": 10.5, "folate": 240.0, "calcium": 650.0, "vit_d": 8.5}
-micro_items = [
-    ("鉄",      total_iron,    MICRO_TARGETS["iron"],    "mg"),
-    ("葉酸",    total_folate,  MICRO_TARGETS["folate"],  "µg"),
-    ("カルシウム", total_calcium, MICRO_TARGETS["calcium"], "mg"),
-    ("ビタミンD",  total_vit_d,   MICRO_TARGETS["vit_d"],   "µg"),
-]
+
 
 def _micro_color(current, target):
     ratio = current / target if target else 0
@@ -324,18 +588,67 @@ def _micro_color(current, target):
     else:
         return "#9e9e9e"
 
-micro_html = "<div style='display:flex; flex-wrap:nowrap; gap:0.5rem; justify-content:space-between; overflow-x:auto;'>"
-for label, cur, tgt, unit in micro_items:
-    color = _micro_color(cur, tgt)
-    micro_html += (
-        f"<div style='flex:1; min-width:3.5rem; text-align:center;'>"
-        f"<div style='font-size:0.75rem; color:#888; white-space:nowrap;'>{label}</div>"
-        f"<div style='font-size:1rem; font-weight:bold; color:{color};'>{cur:.1f}</div>"
-        f"<div style='font-size:0.7rem; color:#aaa; white-space:nowrap;'>/{tgt}{unit}</div>"
-        f"</div>"
-    )
-micro_html += "</div>"
-st.markdown(micro_html, unsafe_allow_html=True)
+
+@fragment("day_summary")
+def day_summary():
+    """達成率グラフ・PFCサマリー・微量栄養素"""
+    ledger = _current_ledger()
+    totals = ledger.pfc_totals
+    micro = ledger.micro_totals
+
+    chart_data = {
+        "Cal": {"current": totals["cal"], "target": target_cal, "unit": "kcal"},
+        "P":   {"current": totals["p"],   "target": target_p,   "unit": "g"},
+        "F":   {"current": totals["f"],   "target": target_f,   "unit": "g"},
+        "C":   {"current": totals["c"],   "target": target_c,   "unit": "g"},
+    }
+    render_chart(create_summary_svg, create_summary_chart, chart_data)
+
+    # --- PFCサマリー ---
+    summary_line = generate_pfc_summary(totals, targets)
+    st.markdown(f"<p style='font-size:1.1rem; font-weight:bold; margin:0.2rem 0;'>{summary_line}</p>", unsafe_allow_html=True)
+
+    # --- 微量栄養素サマリー ---
+    micro_items = [
+        ("鉄",      micro["iron"],    MICRO_TARGETS["iron"],    "mg"),
+        ("葉酸",    micro["folate"],  MICRO_TARGETS["folate"],  "µg"),
+        ("カルシウム", micro["calcium"], MICRO_TARGETS["calcium"], "mg"),
+        ("ビタミンD",  micro["vit_d"],   MICRO_TARGETS["vit_d"],   "µg"),
+    ]
+    micro_html = "<div style='display:flex; flex-wrap:nowrap; gap:0.5rem; justify-content:space-between; overflow-x:auto;'>"
+    for label, cur, tgt, unit in micro_items:
+        color = _micro_color(cur, tgt)
+        micro_html += (
+            f"<div style='flex:1; min-width:3.5rem; text-align:center;'>"
+            f"<div style='font-size:0.75rem; color:#888; white-space:nowrap;'>{label}</div>"
+            f"<div style='font-size:1rem; font-weight:bold; color:{color};'>{cur:.1f}</div>"
+            f"<div style='font-size:0.7rem; color:#aaa; white-space:nowrap;'>/{tgt}{unit}</div>"
+            f"</div>"
+        )
+    micro_html += "</div>"
+    st.markdown(micro_html, unsafe_allow_html=True)
+
+    # --- 残りの食事のおすすめ（ローカルで最適化、AIはひとことだけ任意で） ---
+    meal_plan = suggest_meal_plan(ledger, targets, profile, templates)
+    if meal_plan:
+        with st.expander("💡 残りの食事のおすすめ"):
+            plan_text = format_meal_plan(meal_plan)
+            st.markdown(plan_text)
+            plan_comments = st.session_state.setdefault("plan_comments", {})
+            comment_key = (ledger.date_str, plan_text)
+            if comment_key in plan_comments:
+                st.caption(plan_comments[comment_key])
+            elif st.button("🏋️ トレーナーのひとこと（AI）", key="polish_plan"):
+                with st.spinner("🏋️ ひとことを考え中..."):
+                    comment = polish_meal_plan_with_gemini(plan_text, selected_model, profile)
+                if comment:
+                    plan_comments[comment_key] = comment
+                    st.caption(comment)
+                else:
+                    st.warning("⚠️ AIのひとことを取得できませんでした")
+
+
+day_summary()
 
 # --- AIアドバイス（一時無効化） ---
 # if "advice_cache" not in st.session_state:
@@ -396,130 +709,129 @@ st.markdown(micro_html, unsafe_allow_html=True)
 #         st.session_state["advice_needs_refresh"] = True
 #         st.rerun()
 
-# --- 履歴 ---
-MEAL_ORDER = {"朝食": 0, "昼食": 1, "夕食": 2, "間食": 3, "夜食": 4}
-st.subheader("履歴")
-if logs and logs.data:
-    sorted_logs = sorted(logs.data, key=lambda x: MEAL_ORDER.get(x["meal_type"], 9))
-    for log in sorted_logs:
-        with st.expander(f"{log['meal_type']}: {log['food_name'][:15]}..."):
-            st.write(f"**{log['food_name']}**")
-            st.write(f"🔥 {log['calories']}kcal | P:{log['p_val']} F:{log['f_val']} C:{log['c_val']}")
-            if st.button("削除", key=f"del_{log['id']}"):
-                delete_meal_log(supabase, log['id'])
-                st.rerun()
-else:
-    st.info("まだ記録がありません")
-
-# --- 共有 ---
-st.divider()
-st.subheader("共有")
-
-share_lines = [f"🍽️ {display_date_large} の食事記録"]
-if logged_meals:
-    sorted_share = sorted(logged_meals, key=lambda x: MEAL_ORDER.get(x["meal_type"], 9))
-    for m in sorted_share:
-        share_lines.append(
-            f"・{m['meal_type']}: {m['food_name']} "
-            f"({m['calories']}kcal / P:{m['p_val']} F:{m['f_val']} C:{m['c_val']})"
-        )
-    share_lines.append(f"\n合計: {int(total_cal)}kcal（P:{int(total_p)}g F:{int(total_f)}g C:{int(total_c)}g）")
-    share_lines.append(f"目標: {target_cal}kcal（P:{target_p}g F:{target_f}g C:{target_c}g）")
-else:
-    share_lines.append("記録なし")
-share_text = "\n".join(share_lines)
-
-line_text = urllib.parse.quote(share_text)
-share_text_escaped = base64.b64encode(share_text.encode()).decode()
-gemini_text = share_text + "\n\nこのあとの食事を提案してください。"
-gemini_text_escaped = base64.b64encode(gemini_text.encode()).decode()
-components.html(
-    f"""
-    <style>
-        body {{ margin: 0; padding: 0; font-family: sans-serif; }}
-        .btn {{
-            display: block; width: 100%; padding: 0.5rem; margin-bottom: 0.5rem;
-            border-radius: 0.5rem; font-size: 0.9rem; box-sizing: border-box;
-            text-align: center; cursor: pointer; text-decoration: none;
-            font-family: sans-serif;
-        }}
-        .btn-line {{
-            border: 1px solid #06C755; background: #06C755; color: white;
-        }}
-        .btn-copy {{
-            border: 1px solid #ccc; background: #f0f2f6; color: #31333f;
-        }}
-        .btn-gemini {{
-            border: 1px solid #1a73e8; background: #1a73e8; color: white;
-        }}
-        @media (prefers-color-scheme: dark) {{
-            .btn-copy {{ background: #262730; color: #fafafa; border-color: #555; }}
-        }}
-    </style>
-    <a href="https://line.me/R/share?text={line_text}" target="_blank" class="btn btn-line">LINEで共有</a>
-    <button id="geminiBtn" class="btn btn-gemini" onclick="
-        const bytes = Uint8Array.from(atob('{gemini_text_escaped}'), c => c.charCodeAt(0));
-        const text = new TextDecoder().decode(bytes);
-        const btn = document.getElementById('geminiBtn');
-        const label = '✨ Geminiに相談';
-        if (navigator.clipboard && window.isSecureContext) {{
-            navigator.clipboard.writeText(text).then(() => {{
-                btn.textContent = '✅ コピーしました！';
-                setTimeout(() => {{ btn.textContent = label; }}, 3000);
-            }}).catch(() => {{ fallbackGemini(text, btn, label); }});
-        }} else {{
-            fallbackGemini(text, btn, label);
-        }}
-        function fallbackGemini(text, btn, label) {{
-            const ta = document.createElement('textarea');
-            ta.value = text;
-            ta.style.position = 'fixed';
-            ta.style.opacity = '0';
-            document.body.appendChild(ta);
-            ta.focus();
-            ta.select();
-            try {{
-                document.execCommand('copy');
-                btn.textContent = '✅ コピーしました！';
-                setTimeout(() => {{ btn.textContent = label; }}, 3000);
-            }} catch (e) {{
-                btn.textContent = '❌ コピー失敗';
-                setTimeout(() => {{ btn.textContent = label; }}, 2000);
+# --- 履歴 + 共有 ---
+@fragment("history")
+def history():
+    """当日の履歴と共有ボタン"""
+    ledger = _current_ledger()
+
+    st.subheader("履歴")
+    if ledger:
+        for log in ledger.sorted_logs():
+            with st.expander(f"{log['meal_type']}: {log['food_name'][:15]}..."):
+                st.write(f"**{log['food_name']}**")
+                st.write(f"🔥 {log['calories']}kcal | P:{log['p_val']} F:{log['f_val']} C:{log['c_val']}")
+                st.button("削除", key=f"del_{log['id']}", on_click=_on_delete, args=(log,))
+    else:
+        st.info("まだ記録がありません")
+
+    # --- 共有 ---
+    st.divider()
+    st.subheader("共有")
+
+    share_text = ledger.share_text(display_date_large, targets)
+
+    line_text = urllib.parse.quote(share_text)
+    share_text_escaped = base64.b64encode(share_text.encode()).decode()
+    gemini_text = share_text + "\n\nこのあとの食事を提案してください。"
+    gemini_text_escaped = base64.b64encode(gemini_text.encode()).decode()
+    components.html(
+        f"""
+        <style>
+            body {{ margin: 0; padding: 0; font-family: sans-serif; }}
+            .btn {{
+                display: block; width: 100%; padding: 0.5rem; margin-bottom: 0.5rem;
+                border-radius: 0.5rem; font-size: 0.9rem; box-sizing: border-box;
+                text-align: center; cursor: pointer; text-decoration: none;
+                font-family: sans-serif;
+            }}
+            .btn-line {{
+                border: 1px solid #06C755; background: #06C755; color: white;
+            }}
+            .btn-copy {{
+                border: 1px solid #ccc; background: #f0f2f6; color: #31333f;
+            }}
+            .btn-gemini {{
+                border: 1px solid #1a73e8; background: #1a73e8; color: white;
+            }}
+            @media (prefers-color-scheme: dark) {{
+                .btn-copy {{ background: #262730; color: #fafafa; border-color: #555; }}
+            }}
+        </style>
+        <a href="https://line.me/R/share?text={line_text}" target="_blank" class="btn btn-line">LINEで共有</a>
+        <button id="geminiBtn" class="btn btn-gemini" onclick="
+            const bytes = Uint8Array.from(atob('{gemini_text_escaped}'), c => c.charCodeAt(0));
+            const text = new TextDecoder().decode(bytes);
+            const btn = document.getElementById('geminiBtn');
+            const label = '✨ Geminiに相談';
+            if (navigator.clipboard && window.isSecureContext) {{
+                navigator.clipboard.writeText(text).then(() => {{
+                    btn.textContent = '✅ コピーしました！';
+                    setTimeout(() => {{ btn.textContent = label; }}, 3000);
+                }}).catch(() => {{ fallbackGemini(text, btn, label); }});
+            }} else {{
+                fallbackGemini(text, btn, label);
             }}
-            document.body.removeChild(ta);
-        }}
-    ">✨ Geminiに相談</button>
-    <button id="copyBtn" class="btn btn-copy" onclick="
-        const bytes = Uint8Array.from(atob('{share_text_escaped}'), c => c.charCodeAt(0));
-        const text = new TextDecoder().decode(bytes);
-        const btn = document.getElementById('copyBtn');
-        if (navigator.clipboard && window.isSecureContext) {{
-            navigator.clipboard.writeText(text).then(() => {{
-                btn.textContent = '✅ コピーしました！';
-                setTimeout(() => {{ btn.textContent = 'クリップボードにコピー'; }}, 2000);
-            }}).catch(() => {{ fallbackCopy(text, btn, 'クリップボードにコピー'); }});
-        }} else {{
-            fallbackCopy(text, btn, 'クリップボードにコピー');
-        }}
-        function fallbackCopy(text, btn, label) {{
-            const ta = document.createElement('textarea');
-            ta.value = text;
-            ta.style.position = 'fixed';
-            ta.style.opacity = '0';
-            document.body.appendChild(ta);
-            ta.focus();
-            ta.select();
-            try {{
-                document.execCommand('copy');
-                btn.textContent = '✅ コピーしました！';
-                setTimeout(() => {{ btn.textContent = label; }}, 2000);
-            }} catch (e) {{
-                btn.textContent = '❌ コピー失敗';
-                setTimeout(() => {{ btn.textContent = label; }}, 2000);
+            function fallbackGemini(text, btn, label) {{
+                const ta = document.createElement('textarea');
+                ta.value = text;
+                ta.style.position = 'fixed';
+                ta.style.opacity = '0';
+                document.body.appendChild(ta);
+                ta.focus();
+                ta.select();
+                try {{
+                    document.execCommand('copy');
+                    btn.textContent = '✅ コピーしました！';
+                    setTimeout(() => {{ btn.textContent = label; }}, 3000);
+                }} catch (e) {{
+                    btn.textContent = '❌ コピー失敗';
+                    setTimeout(() => {{ btn.textContent = label; }}, 2000);
+                }}
+                document.body.removeChild(ta);
             }}
-            document.body.removeChild(ta);
-        }}
-    ">クリップボードにコピー</button>
-    """,
-    height=130,
+        ">✨ Geminiに相談</button>
+        <button id="copyBtn" class="btn btn-copy" onclick="
+            const bytes = Uint8Array.from(atob('{share_text_escaped}'), c => c.charCodeAt(0));
+            const text = new TextDecoder().decode(bytes);
+            const btn = document.getElementById('copyBtn');
+            if (navigator.clipboard && window.isSecureContext) {{
+                navigator.clipboard.writeText(text).then(() => {{
+                    btn.textContent = '✅ コピーしました！';
+                    setTimeout(() => {{ btn.textContent = 'クリップボードにコピー'; }}, 2000);
+                }}).catch(() => {{ fallbackCopy(text, btn, 'クリップボードにコピー'); }});
+            }} else {{
+                fallbackCopy(text, btn, 'クリップボードにコピー');
+            }}
+            function fallbackCopy(text, btn, label) {{
+                const ta = document.createElement('textarea');
+                ta.value = text;
+                ta.style.position = 'fixed';
+                ta.style.opacity = '0';
+                document.body.appendChild(ta);
+                ta.focus();
+                ta.select();
+                try {{
+                    document.execCommand('copy');
+                    btn.textContent = '✅ コピーしました！';
+                    setTimeout(() => {{ btn.textContent = label; }}, 2000);
+                }} catch (e) {{
+                    btn.textContent = '❌ コピー失敗';
+                    setTimeout(() => {{ btn.textContent = label; }}, 2000);
+                }}
+                document.body.removeChild(ta);
+            }}
+        ">クリップボードにコピー</button>
+        """,
+        height=130,
+    )
+
+
+history()
+
+# --- 前後の日のプリフェッチ ---
+# 画面描画が終わった後に実行するので表示は待たせない。次の日付移動はキャッシュから即時描画される
+prefetch_meal_logs(
+    supabase, user.id, day_cache,
+    [current_date + timedelta(days=i) for i in range(-PREFETCH_RADIUS, PREFETCH_RADIUS + 1)],
 )
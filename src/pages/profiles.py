@@ -0,0 +1,48 @@
+"""
+🔬 プロファイルページ（profiling.py が有効なセッションでのみ表示）
+保存したリランのプロファイルを所要時間の長い順に並べ、選んだリランの上位の関数を表示します。
+"""
+
+import os
+
+import streamlit as st
+
+from profiling import PROFILE_DIR, list_profiles
+
+st.title("🔬 プロファイル")
+st.caption(f"保存先: {PROFILE_DIR}（.prof は `python -m pstats` や snakeviz で開けます）")
+
+profiles = list_profiles()
+if not profiles:
+    st.info("まだプロファイルがありません。ほかのページを開くと、リランごとに保存されます。")
+    st.stop()
+
+# --- 遅かったリラン ---
+st.dataframe(
+    [{"所要時間(ms)": p["duration_ms"], "ページ": p["label"], "日時": p["started"]} for p in profiles],
+    hide_index=True,
+    use_container_width=True,
+)
+
+# --- 上位の関数 ---
+selected = st.selectbox(
+    "リラン",
+    range(len(profiles)),
+    format_func=lambda i: f"{profiles[i]['duration_ms']:.0f}ms  {profiles[i]['label']}  {profiles[i]['started']}",
+)
+profile = profiles[selected]
+st.dataframe(
+    [
+        {"関数": f["function"], "累積(ms)": f["cumtime_ms"], "自身(ms)": f["tottime_ms"],
+         "呼び出し": f["calls"], "場所": f"{f['file']}:{f['line']}"}
+        for f in profile["top"]
+    ],
+    hide_index=True,
+    use_container_width=True,
+)
+
+prof_path = os.path.join(PROFILE_DIR, profile["prof"])
+if os.path.exists(prof_path):
+    with open(prof_path, "rb") as f:
+        st.download_button("📥 .prof をダウンロード", f.read(), file_name=profile["prof"],
+                           mime="application/octet-stream", on_click="ignore")
@@ -4,11 +4,22 @@
 
 import streamlit as st
 import time
+import hashlib
+import tempfile
 
 from config import get_supabase
+from deadlines import without_deadline
 from services import (
     get_available_gemini_models, get_user_profile, update_user_profile,
     get_meal_templates, save_meal_template, delete_meal_template,
+    get_speculation_stats,
+)
+from analysis_cache import get_analysis_cache, get_ingredient_cache
+from gemini_usage import get_usage_ledger
+from shared_cache import get_shared_cache
+from bulk_import import parse_bulk_meals, import_meals
+from meal_log_io import (
+    FORMATS, iter_meal_log_pages, export_meal_logs, read_meal_log_rows, import_meal_logs,
 )
 
 supabase = get_supabase()
@@ -62,6 +73,60 @@ if selected != current_model:
     st.session_state["selected_model"] = selected
     st.success(f"✅ モデルを **{selected}** に変更しました")
 
+# --- 本日のAI利用状況（予算とモデルの自動切り替え） ---
+usage = get_usage_ledger().report(user_id)
+c1, c2, c3 = st.columns(3)
+c1.metric("本日の利用（あなた）", f"{usage['user_tokens']:,}",
+          f"上限 {usage['user_daily_tokens']:,} トークン" if usage["user_daily_tokens"] else "上限なし", delta_color="off")
+c2.metric("本日の利用（全体）", f"{usage['total_tokens']:,}",
+          f"上限 {usage['global_daily_tokens']:,} トークン" if usage["global_daily_tokens"] else "上限なし", delta_color="off")
+c3.metric("残り", f"{usage['remaining_ratio']:.0%}", f"{usage['calls']}回", delta_color="off")
+if usage["degraded"] or usage["exhausted"] or usage["cooling"]:
+    limited = usage["exhausted"] + usage["cooling"]
+    st.caption(
+        "⚠️ 残りが少ないため、解析には軽量なモデルを優先して使っています"
+        + (f"（利用制限中: {', '.join(limited)}）" if limited else "")
+    )
+
+# --- 類似テキストキャッシュの状況（しきい値の調整用） ---
+with st.expander("📈 解析キャッシュの状況"):
+    report = get_analysis_cache().report()
+    c1, c2, c3 = st.columns(3)
+    c1.metric("ヒット率", f"{report['hit_rate']:.0%}", f"{report['hits']}/{report['lookups']}件", delta_color="off")
+    c2.metric("誤再利用率", f"{report['false_reuse_rate']:.0%}", f"監査 {report['audits']}件", delta_color="off")
+    c3.metric("登録数", report["entries"])
+    st.caption("しきい値: " + " / ".join(f"{k} {v}" for k, v in report["thresholds"].items()))
+    ingredients = get_ingredient_cache().report()
+    sources = report["sources"]
+    c1, c2, c3 = st.columns(3)
+    c1.metric("Geminiが必要だった割合", f"{report['gemini_share']:.0%}", f"{sources['gemini']}/{sum(sources.values())}件", delta_color="off")
+    c2.metric("品目の組み合わせで解決", f"{ingredients['hit_rate']:.0%}", f"{ingredients['assembled']}/{ingredients['lookups']}件", delta_color="off")
+    c3.metric("既知の品目", ingredients["items"])
+    st.caption(
+        "解析の出どころ: "
+        f"成分表 {sources['food_table']} / 品目の組み合わせ {sources['ingredients']} / "
+        f"他のワーカーの解析 {sources['shared']} / 類似入力 {sources['similar']} / Gemini {sources['gemini']}"
+    )
+    shared = get_shared_cache().report()
+    st.caption(
+        f"共有キャッシュ（{shared['backend']}）: ヒット率 {shared['hit_rate']:.0%} / "
+        f"プロセス内 {shared['l1_entries']}件 / 受け取った無効化 {shared['invalidations']}件 / エラー {shared['errors']}件"
+    )
+    speculation = get_speculation_stats().report()
+    st.caption(
+        f"入力中の先行解析: {speculation['started']}件 / 記録に使われた {speculation['committed']}件 / "
+        f"取り消し {speculation['cancelled']}件（先行解析:記録 = {speculation['ratio']:.1f}:1）"
+    )
+    if report["recent_audits"]:
+        st.dataframe(
+            [
+                {"入力": a["text"], "再利用元": a["cached_text"], "類似度": round(a["similarity"], 3),
+                 "再利用kcal": a["cached_cal"], "再解析kcal": a["fresh_cal"], "誤再利用": "⚠️" if a["false_reuse"] else ""}
+                for a in reversed(report["recent_audits"])
+            ],
+            hide_index=True,
+        )
+
 st.divider()
 
 # =========================================================
@@ -204,3 +269,105 @@ if templates:
             if st.button("🗑️", key=f"del_tpl_{tpl['id']}"):
                 delete_meal_template(supabase, tpl["id"])
                 st.rerun()
+
+st.divider()
+
+# =========================================================
+# 食事のまとめて取り込み
+# =========================================================
+st.subheader("📥 食事のまとめて取り込み")
+st.caption("他のアプリの記録を貼り付けると、日付・食事タイプごとに分けてまとめてAI解析・記録します")
+
+bulk_text = st.text_area(
+    "取り込む記録", height=160, key="bulk_text",
+    placeholder="3/1 朝 トースト / 昼 ラーメン / 夜 カレー\n3/2 朝 ヨーグルト、バナナ / おやつ コーヒー",
+)
+bulk_items, bulk_errors = parse_bulk_meals(bulk_text)
+if bulk_text.strip():
+    st.caption(
+        f"{len(bulk_items)}件の食事を読み取りました"
+        + (f"（読み取れなかった部分 {len(bulk_errors)}件）" if bulk_errors else "")
+    )
+    if bulk_errors:
+        with st.expander("読み取れなかった部分（日付・食事タイプを確認してください）"):
+            for err in bulk_errors:
+                st.text(err)
+    if bulk_items:
+        st.dataframe(
+            [{"日付": item["meal_date"].isoformat(), "食事タイプ": item["meal_type"], "内容": item["text"]}
+             for item in bulk_items],
+            hide_index=True, height=200,
+        )
+
+if st.button("📥 取り込む", key="bulk_import", disabled=not bulk_items, use_container_width=True):
+    progress = st.progress(0.0, text="解析中…")
+
+    def _show_progress(report):
+        done = report["analyzed"] + len(report["failed"])
+        progress.progress(
+            done / report["items"],
+            text=f"{done}/{report['items']}件 解析・{report['saved']}件 保存（{report['items_per_min']:.0f}件/分）",
+        )
+
+    # 同じ貼り付けを二重に取り込まないよう、テキストから冪等キーのノンスを作る
+    nonce = hashlib.sha256(bulk_text.encode()).hexdigest()[:12]
+    # 明示的に始めた長い処理なので、リランの予算は外す（呼び出しごとの上限はそのまま）
+    with without_deadline():
+        report = import_meals(
+            supabase, user_id, bulk_items, st.session_state.get("selected_model", "gemini-flash-latest"), nonce,
+            on_progress=_show_progress,
+        )
+    # 食事記録ページのセッション内のログ・履歴の索引は作り直す
+    for key in ("day_logs_cache", "food_history_index", "meal_estimator"):
+        st.session_state.pop(key, None)
+    st.success(
+        f"✅ {report['saved']}件を記録しました"
+        f"（{report['elapsed']:.1f}秒・{report['items_per_min']:.0f}件/分・解析 {report['batches']}回）"
+    )
+    if report["failed"] or report["save_errors"]:
+        st.warning(
+            f"解析できなかった食事 {len(report['failed'])}件・保存に失敗した食事 {report['save_errors']}件: "
+            + " / ".join(f"{item['meal_date']:%m/%d} {item['meal_type']} {item['text']}" for item in report["failed"])
+        )
+
+st.divider()
+
+# =========================================================
+# データの書き出し・取り込み
+# =========================================================
+st.subheader("💾 データの書き出し・取り込み")
+st.caption("食事ログの全履歴を CSV / Parquet で書き出し、書き出したファイルを取り込めます")
+
+export_fmt = st.radio("形式", list(FORMATS), horizontal=True, key="export_fmt", format_func=str.upper)
+
+
+def _export_file():
+    """ダウンロードボタンを押したときに、1000行ずつ取得して一時ファイルに書き出す"""
+    out = tempfile.SpooledTemporaryFile(max_size=8 * 2**20)
+    export_meal_logs(iter_meal_log_pages(supabase, user_id), out, export_fmt)
+    out.seek(0)
+    return out
+
+
+st.download_button(
+    "⬇️ 食事ログを書き出す", data=_export_file, file_name=f"meal_logs.{export_fmt}",
+    mime=FORMATS[export_fmt], key="export_meal_logs", on_click="ignore", use_container_width=True,
+)
+
+uploaded = st.file_uploader("書き出したファイルを取り込む", type=list(FORMATS), key="import_file")
+if uploaded and st.button("⬆️ 取り込む", key="import_meal_logs", use_container_width=True):
+    import_progress = st.empty()
+
+    def _show_import_progress(report):
+        import_progress.caption(f"{report['rows']}行を検証・{report['saved']}行を保存（{report['rows_per_sec']:,.0f}行/秒）")
+
+    import_fmt = uploaded.name.rsplit(".", 1)[-1].lower()
+    with without_deadline():
+        report = import_meal_logs(supabase, user_id, read_meal_log_rows(uploaded, import_fmt),
+                                  on_progress=_show_import_progress)
+    for key in ("day_logs_cache", "food_history_index", "meal_estimator"):
+        st.session_state.pop(key, None)
+    st.success(f"✅ {report['saved']}行を取り込みました（{report['rows']}行中・既にあった行は除く）")
+    if report["invalid"]:
+        st.warning(f"不正な行 {report['invalid']}件を飛ばしました")
+        st.dataframe([{"行": line, "内容": msg} for line, msg in report["errors"]], hide_index=True)
@@ -0,0 +1,147 @@
+"""
+リランごとのプロファイル（cProfile）の取得
+
+本番で遅いページを調べるため、有効にしたセッションでは app.py が pg.run() を cProfile で
+包んで実行し、リランごとに .prof（pstats / snakeviz で開ける）と、所要時間・上位の関数を
+まとめた .json を PROFILE_DIR に保存する。保存数は MAX_PROFILES で、古いものから消す。
+一覧は「🔬 プロファイル」ページ（有効なときだけナビゲーションに出る）で見る。
+
+有効にする方法:
+    - 環境変数 PFC_PROFILE=1（全セッション）
+    - ?profile=<secrets の [debug] token>（そのセッションのみ。ページを移っても続く）
+
+無効なときは profiling_enabled() の判定だけで、プロファイラは起動しない。
+cProfile はスクリプトのスレッドだけを計測する（共有スレッドプールの処理は含まない）。
+"""
+
+import cProfile
+import json
+import os
+import pstats
+import re
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import streamlit as st
+
+PROFILE_PARAM = "profile"
+PROFILE_ENV = "PFC_PROFILE"
+PROFILE_DIR = os.environ.get("PFC_PROFILE_DIR") or os.path.join(tempfile.gettempdir(), "pfc-profiles")
+MAX_PROFILES = 50   # 保存しておくリランの数
+TOP_FUNCTIONS = 30  # .json に残す関数の数（累積時間の大きい順）
+
+# 同時に複数のプロファイラを有効にできない Python があるため、1度に1リランだけ計測する
+_profiler_lock = threading.Lock()
+
+
+def profiling_enabled():
+    """このセッションのリランをプロファイルするか"""
+    if st.session_state.get("profile_reruns") or os.environ.get(PROFILE_ENV) == "1":
+        return True
+    if PROFILE_PARAM not in st.query_params:
+        return False
+    try:
+        token = st.secrets.get("debug", {}).get("token")
+    except Exception:
+        return False
+    if token and st.query_params.get(PROFILE_PARAM) == token:
+        st.session_state["profile_reruns"] = True
+        return True
+    return False
+
+
+def run_profiled(func, label, directory=None):
+    """
+    func() を cProfile で計測しながら実行して、結果を directory に保存する
+    st.rerun() / st.stop() などで中断しても、そこまでの結果を保存する
+    ほかのセッションを計測中なら計測せずに実行する
+    """
+    if not _profiler_lock.acquire(blocking=False):
+        return func()
+    profiler = cProfile.Profile()
+    started = datetime.now()
+    t0 = time.perf_counter()
+    try:
+        profiler.enable()
+        try:
+            return func()
+        finally:
+            profiler.disable()
+            duration_ms = (time.perf_counter() - t0) * 1000
+    finally:
+        _profiler_lock.release()
+        try:
+            save_profile(profiler, label, started, duration_ms, directory or PROFILE_DIR)
+        except Exception as e:
+            print(f"[profiling] 保存エラー: {e}")
+
+
+def save_profile(profiler, label, started, duration_ms, directory=PROFILE_DIR, max_profiles=MAX_PROFILES):
+    """.prof と概要の .json を保存し、古いものを消す。Returns: .json のパス"""
+    os.makedirs(directory, exist_ok=True)
+    safe_label = re.sub(r"[^\w-]+", "_", label)
+    stem = f"{started:%Y%m%d-%H%M%S-%f}_{safe_label}"
+    prof_path = os.path.join(directory, stem + ".prof")
+    profiler.dump_stats(prof_path)
+    summary = {
+        "label": label,
+        "started": started.isoformat(timespec="seconds"),
+        "duration_ms": round(duration_ms, 1),
+        "prof": os.path.basename(prof_path),
+        "top": top_functions(pstats.Stats(profiler)),
+    }
+    json_path = os.path.join(directory, stem + ".json")
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False)
+    _rotate(directory, max_profiles)
+    return json_path
+
+
+def top_functions(stats, limit=TOP_FUNCTIONS):
+    """pstats.Stats から累積時間の大きい関数 [{"function", "file", "line", "calls", "tottime_ms", "cumtime_ms"}, ...]"""
+    rows = []
+    for (file, line, name), (_, calls, tottime, cumtime, _) in stats.stats.items():
+        rows.append({
+            "function": name, "file": _short_path(file), "line": line, "calls": calls,
+            "tottime_ms": round(tottime * 1000, 2), "cumtime_ms": round(cumtime * 1000, 2),
+        })
+    rows.sort(key=lambda r: r["cumtime_ms"], reverse=True)
+    return rows[:limit]
+
+
+def _short_path(path):
+    """site-packages 以下やアプリのディレクトリ以下は相対パスにする（一覧を読みやすくする）"""
+    for marker in ("site-packages" + os.sep, os.path.dirname(os.path.abspath(__file__)) + os.sep):
+        if marker in path:
+            return path.split(marker, 1)[1]
+    return path
+
+
+def _rotate(directory, max_profiles):
+    summaries = sorted(f for f in os.listdir(directory) if f.endswith(".json"))
+    for name in summaries[:-max_profiles] if max_profiles else summaries:
+        stem = name[:-len(".json")]
+        for ext in (".json", ".prof"):
+            try:
+                os.remove(os.path.join(directory, stem + ext))
+            except FileNotFoundError:
+                pass
+
+
+def list_profiles(directory=PROFILE_DIR):
+    """保存済みのプロファイルの概要（所要時間の長い順）"""
+    if not os.path.isdir(directory):
+        return []
+    summaries = []
+    for name in os.listdir(directory):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, name), encoding="utf-8") as f:
+                summaries.append(json.load(f))
+        except (OSError, ValueError):
+            continue  # 書き込み中・ローテーションで消えたもの
+    summaries.sort(key=lambda s: s["duration_ms"], reverse=True)
+    return summaries
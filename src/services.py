@@ -1,12 +1,28 @@
 import streamlit as st
 import json
+import hashlib
+import re
+import threading
+from datetime import timedelta
 
-from config import get_supabase, get_gemini_client
+import numpy as np
+
+from config import get_supabase, get_gemini_client, get_executor
+from db_calls import execute_query
+from deadlines import DeadlineExceeded, is_timeout, wait_for
+from ledger import DailyLedger
+from food_db import get_food_table
+from food_search import normalize_food_text
+from analysis_cache import get_analysis_cache, get_ingredient_cache
+from gemini_usage import BudgetExceeded, generate_content
+from metrics import gemini_parse_failures
+from shared_cache import get_shared_cache, shared_cached
+from tracing import traced
 
 
 # --- Gemini関連 ---
 
-@st.cache_data(ttl=3600)
+@shared_cached("gemini_models", "get_available_gemini_models")
 def get_available_gemini_models():
     """Gemini APIから利用可能なテキスト生成モデル一覧を取得"""
     try:
@@ -42,44 +58,207 @@ def get_available_gemini_models():
     return ["gemini-3-flash", "gemini-2.5-flash", "gemini-3-pro"]
 
 
+def lookup_food_nutrients(text):
+    """
+    食品成分表に名前が完全一致する食品があれば、1食分（目安量）の栄養素を
+    analyze_meal_with_gemini と同じ形式 (p, f, c, cal, 鉄, 葉酸, カルシウム, ビタミンD) で返す
+    """
+    table = get_food_table()
+    idx = table.find(text.strip())
+    if idx is None:
+        return None
+    n = table.nutrients(idx)
+    return (
+        round(n["p"], 1), round(n["f"], 1), round(n["c"], 1), round(n["kcal"]),
+        n["iron_mg"], n["folate_ug"], n["calcium_mg"], n["vitamin_d_ug"],
+    )
+
+
+def _request_meal_analysis(text, model_name):
+    """
+    Gemini に解析を依頼して ((p, f, c, cal, 鉄, 葉酸, カルシウム, ビタミンD), 品目ごとの内訳) を返す
+    内訳は [{"name", "cal", "p", ...}, ...]（返ってこなければ空リスト）。例外はそのまま送出
+    """
+    client = get_gemini_client()
+    prompt = f"""
+    あなたは栄養管理AIです。以下の食事内容から、カロリー、タンパク質(P)、脂質(F)、炭水化物(C)、
+    鉄(iron_mg)、葉酸(folate_ug)、カルシウム(calcium_mg)、ビタミンD(vitamin_d_ug)を推測してください。
+    あわせて、食事に含まれる品目ごとの内訳を items に入れてください（name は入力に書かれた表記のまま）。
+
+    食事内容: "{text}"
+
+    回答は以下のJSON形式のみで出力してください（マークダウン不要）:
+    {{"cal": int, "p": int, "f": int, "c": int, "iron_mg": float, "folate_ug": float, "calcium_mg": float, "vitamin_d_ug": float,
+      "items": [{{"name": str, "cal": int, "p": int, "f": int, "c": int, "iron_mg": float, "folate_ug": float, "calcium_mg": float, "vitamin_d_ug": float}}]}}
+    例: {{"cal": 500, "p": 20, "f": 15, "c": 60, "iron_mg": 2.5, "folate_ug": 80.0, "calcium_mg": 150.0, "vitamin_d_ug": 3.0,
+      "items": [{{"name": "白米", "cal": 250, "p": 4, "f": 0, "c": 55, "iron_mg": 0.2, "folate_ug": 5.0, "calcium_mg": 5.0, "vitamin_d_ug": 0.0}}, ...]}}
+    """
+    res = generate_content(client, model_name, prompt, "analyze_meal")
+    return _parse_meal_analysis(_load_gemini_json(res, "analyze_meal"))
+
+
+def _load_gemini_json(res, function):
+    """Gemini の応答テキストを JSON として読む（読めなければ失敗数を数えて例外をそのまま送出）"""
+    json_str = res.text.strip().replace("```json", "").replace("```", "")
+    try:
+        return json.loads(json_str)
+    except ValueError:
+        gemini_parse_failures.inc(function=function)
+        raise
+
+
+def _parse_meal_analysis(data):
+    """Gemini の解析結果（1食分の JSON）を ((p, f, c, cal, 鉄, 葉酸, カルシウム, ビタミンD), 内訳) にする"""
+    result = (
+        data.get("p", 0), data.get("f", 0), data.get("c", 0), data.get("cal", 0),
+        data.get("iron_mg", 0), data.get("folate_ug", 0),
+        data.get("calcium_mg", 0), data.get("vitamin_d_ug", 0),
+    )
+    items = data.get("items")
+    return result, items if isinstance(items, list) else []
+
+
+def _request_meal_analysis_batch(texts, model_name):
+    """
+    複数の食事を1回の Gemini 呼び出しで解析して [(結果, 内訳), ...]（texts と同じ順）を返す
+    返ってきた件数が合わなければ ValueError。例外はそのまま送出
+    """
+    client = get_gemini_client()
+    meals = "\n".join(f"{i + 1}. {text}" for i, text in enumerate(texts))
+    prompt = f"""
+    あなたは栄養管理AIです。以下の{len(texts)}件の食事それぞれについて、カロリー、タンパク質(P)、脂質(F)、炭水化物(C)、
+    鉄(iron_mg)、葉酸(folate_ug)、カルシウム(calcium_mg)、ビタミンD(vitamin_d_ug)を推測してください。
+    あわせて、食事に含まれる品目ごとの内訳を items に入れてください（name は入力に書かれた表記のまま）。
+
+    食事内容:
+    {meals}
+
+    回答は以下のJSON形式のみで出力してください（マークダウン不要）。meals は食事内容と同じ順・同じ件数にしてください:
+    {{"meals": [{{"cal": int, "p": int, "f": int, "c": int, "iron_mg": float, "folate_ug": float, "calcium_mg": float, "vitamin_d_ug": float,
+      "items": [{{"name": str, "cal": int, "p": int, "f": int, "c": int, "iron_mg": float, "folate_ug": float, "calcium_mg": float, "vitamin_d_ug": float}}]}}]}}
+    """
+    res = generate_content(client, model_name, prompt, "analyze_meals_batch")
+    meals = _load_gemini_json(res, "analyze_meals_batch").get("meals")
+    count = len(meals) if isinstance(meals, list) else 0  # meals が数値・オブジェクトでも件数の不一致として扱う
+    if count != len(texts):
+        raise ValueError(f"解析結果の件数が一致しません（{len(texts)}件中 {count}件）")
+    return [_parse_meal_analysis(m) for m in meals]
+
+
+def _analyze_locally(text, model_name):
+    """
+    APIを呼ばずに解析できれば結果を返す（できなければ None）
+    成分表の食品 → 既知の品目だけの組み合わせ（品目の内訳キャッシュ）→ 同じ入力の解析結果（プロセス間の共有キャッシュ）
+    → 過去に解析した入力に十分近いもの（類似テキストキャッシュ）
+    """
+    cache = get_analysis_cache()
+    local = lookup_food_nutrients(text)
+    if local:
+        cache.record_source("food_table")
+        return local
+
+    assembled = get_ingredient_cache().assemble(text, fallback=lookup_food_nutrients)
+    if assembled:
+        cache.record_source("ingredients")
+        return assembled
+
+    key = normalize_food_text(text)
+    shared = get_shared_cache().get("meal_analysis", key) if key else None
+    if shared is not None:
+        # ほかのワーカープロセスが同じ入力を解析済み: このプロセスの類似テキストキャッシュにも載せる
+        result = tuple(shared)
+        cache.record_source("shared")
+        cache.store(text, result)
+        return result
+
+    hit = cache.lookup(text)
+    if hit:
+        cache.record_source("similar")
+        # 再利用した結果の一部はバックグラウンドで解析し直して誤再利用を監査する
+        cache.maybe_audit(text, hit, lambda: _request_meal_analysis(text, model_name)[0])
+        return hit["result"]
+    return None
+
+
+def _remember_analysis(text, result, items):
+    """Gemini の解析結果を類似テキストキャッシュ・共有キャッシュと品目の内訳キャッシュに登録する"""
+    cache = get_analysis_cache()
+    cache.record_source("gemini")
+    cache.store(text, result)
+    key = normalize_food_text(text)
+    if key:
+        get_shared_cache().set("meal_analysis", key, list(result))
+    get_ingredient_cache().store_items(items, result)
+
+
+@traced("services.analyze_meal")
 def analyze_meal_with_gemini(text, model_name="gemini-3-flash"):
-    """GeminiでPFC・カロリー・主要ビタミン/ミネラルを解析"""
+    """
+    GeminiでPFC・カロリー・主要ビタミン/ミネラルを解析
+    次の順に手元で解決できればAPIを呼ばない:
+    成分表の食品 → 既知の品目だけの組み合わせ（品目の内訳キャッシュ）→ 過去に解析した入力に十分近いもの（類似テキストキャッシュ）
+    共有スレッドプールからも呼ぶので画面には何も出さない。予算切れ（BudgetExceeded）とタイムアウトは
+    そのまま送出し、案内はスクリプトのスレッドの呼び出し側で表示する。それ以外の失敗は None
+    """
     if len(text) < 2:
         return None
+    local = _analyze_locally(text, model_name)
+    if local:
+        return local
+
     try:
-        client = get_gemini_client()
-        prompt = f"""
-        あなたは栄養管理AIです。以下の食事内容から、カロリー、タンパク質(P)、脂質(F)、炭水化物(C)、
-        鉄(iron_mg)、葉酸(folate_ug)、カルシウム(calcium_mg)、ビタミンD(vitamin_d_ug)を推測してください。
+        result, items = _request_meal_analysis(text, model_name)
+    except BudgetExceeded:
+        raise
+    except Exception as e:
+        if is_timeout(e):
+            raise
+        print(f"[analyze_meal] 解析エラー: {type(e).__name__} - {e}")
+        return None
+    _remember_analysis(text, result, items)
+    return result
 
-        食事内容: "{text}"
 
-        回答は以下のJSON形式のみで出力してください（マークダウン不要）:
-        {{"cal": int, "p": int, "f": int, "c": int, "iron_mg": float, "folate_ug": float, "calcium_mg": float, "vitamin_d_ug": float}}
-        例: {{"cal": 500, "p": 20, "f": 15, "c": 60, "iron_mg": 2.5, "folate_ug": 80.0, "calcium_mg": 150.0, "vitamin_d_ug": 3.0}}
-        """
-        res = client.models.generate_content(model=model_name, contents=prompt)
-        json_str = res.text.strip().replace("```json", "").replace("```", "")
-        data = json.loads(json_str)
-        return (
-            data.get("p", 0), data.get("f", 0), data.get("c", 0), data.get("cal", 0),
-            data.get("iron_mg", 0), data.get("folate_ug", 0),
-            data.get("calcium_mg", 0), data.get("vitamin_d_ug", 0),
-        )
+@traced("services.analyze_meals_batch")
+def analyze_meals_batch(texts, model_name="gemini-3-flash"):
+    """
+    複数の食事をまとめて解析する（一括取り込み用・バックグラウンドのスレッドから呼ぶ）
+    手元で解決できないものだけを1回の Gemini 呼び出しにまとめる
+
+    Returns: texts と同じ順の結果 (p, f, c, cal, 鉄, 葉酸, カルシウム, ビタミンD) のリスト（解析できなかったものは None）
+    """
+    results = [None] * len(texts)
+    misses = []
+    for i, text in enumerate(texts):
+        if len(text) < 2:
+            continue
+        results[i] = _analyze_locally(text, model_name)
+        if results[i] is None:
+            misses.append(i)
+    if not misses:
+        return results
+    try:
+        analyzed = _request_meal_analysis_batch([texts[i] for i in misses], model_name)
     except Exception as e:
-        # 画面上にデバッグ用のエラー内容を表示
-        st.error(f"Error: {type(e).__name__} - {str(e)}")
+        print(f"[analyze_meals_batch] 解析エラー: {e}")
+        return results
+    for i, (result, items) in zip(misses, analyzed):
+        _remember_analysis(texts[i], result, items)
+        results[i] = result
+    return results
 
-        return None
 
-def analyze_meal_with_advice(text, model_name, profile, logged_meals, totals, targets, meal_type):
-    """GeminiでPFC解析とアドバイスを1回のAPI呼び出しで同時に取得する"""
+def analyze_meal_with_advice(text, model_name, profile, ledger, targets, meal_type):
+    """
+    GeminiでPFC解析とアドバイスを1回のAPI呼び出しで同時に取得する
+    ledger は当日分の DailyLedger（記録済みの食事・合計値をここから取る）
+    """
     if len(text) < 2:
         return None
 
     # --- アドバイス用のコンテキストを構築 ---
     # 記録済みのタイミングを取得（今回の記録分も含める）
-    logged_types = set(m["meal_type"] for m in logged_meals) if logged_meals else set()
+    logged_types = ledger.meal_types
     logged_types.add(meal_type)  # 今回記録する分を追加
     all_types = ["朝食", "昼食", "夕食", "間食", "夜食"]
     remaining_types = [t for t in all_types if t not in logged_types]
@@ -93,14 +272,9 @@ def analyze_meal_with_advice(text, model_name, profile, logged_meals, totals, ta
     dislikes = profile.get("dislikes") or "特になし"
     prefs = profile.get("preferences") or "特になし"
 
-    # 記録済みの食事内容をテキスト化
-    if logged_meals:
-        meals_detail = "\n".join(
-            f"・{m['meal_type']}: {m['food_name']}（{m['calories']}kcal / P:{m['p_val']}g F:{m['f_val']}g C:{m['c_val']}g）"
-            for m in logged_meals
-        )
-    else:
-        meals_detail = "まだ記録なし"
+    # 記録済みの食事内容をテキスト化（台帳側でキャッシュ済み）
+    meals_detail = ledger.meals_detail()
+    totals = ledger.pfc_totals
 
     # +/-表記の準備
     def fmt(val):
@@ -162,9 +336,8 @@ def analyze_meal_with_advice(text, model_name, profile, logged_meals, totals, ta
 例:
 {{"cal": 500, "p": 20, "f": 15, "c": 60, "advice": "💪素晴らしいタンパク質量です！..."}}
 """
-        res = client.models.generate_content(model=model_name, contents=prompt)
-        json_str = res.text.strip().replace("```json", "").replace("```", "")
-        data = json.loads(json_str)
+        res = generate_content(client, model_name, prompt, "analyze_meal_with_advice")
+        data = _load_gemini_json(res, "analyze_meal_with_advice")
 
         p = data.get("p", 0)
         f = data.get("f", 0)
@@ -203,6 +376,237 @@ def generate_pfc_summary(totals, targets):
         return f"🔥 {abs(int(rem_cal))}kcalオーバー！（P: {fmt_p}g / F: {fmt_f}g / C: {fmt_c}g）"
 
 
+# --- 週カレンダーのカロリーバッジ ---
+
+WEEKDAY_NAMES = ["月", "火", "水", "木", "金", "土", "日"]
+
+
+def calorie_badge_color(kcal, target):
+    """日別カロリーの目標達成度に応じたバッジ色（Streamlit のカラー名）を返す"""
+    if not kcal:
+        return None
+    ratio = kcal / target if target else 0
+    if ratio > 1.1:
+        return "red"
+    elif ratio >= 0.8:
+        return "green"
+    elif ratio >= 0.5:
+        return "orange"
+    else:
+        return "gray"
+
+
+def build_week_strip_labels(week_days, today, day_cache, target_cal):
+    """
+    週カレンダーの各日のボタンラベルを生成（AIもDBも使わない）
+    day_cache は prefetch_meal_logs() で埋めた {日付ISO文字列: DailyLedger}。
+
+    Returns: [(date, label), ...]  label は「曜日\\n日\\n:色[kcal]」形式
+    """
+    labels = []
+    for d in week_days:
+        day_name = "今日" if d == today else WEEKDAY_NAMES[d.weekday()]
+        ledger = day_cache.get(d.isoformat())
+        kcal = ledger.total("calories") if ledger is not None else 0
+        color = calorie_badge_color(kcal, target_cal)
+        badge = f":{color}[{int(kcal)}]" if color else "·"
+        labels.append((d, f"{day_name}\n{d.day}\n{badge}"))
+    return labels
+
+
+# --- ローカルの献立提案（PFC最適化） ---
+# 残りの目標 P/F/C を未記録の食事タイミングに配分し、成分表・テンプレートから
+# 最もよく合う組み合わせを numpy の全探索で選ぶ（Gemini を使わず数十ms以内）
+
+PLAN_NUTRIENTS = ("cal", "p", "f", "c")
+MAIN_MEAL_SHARES = {"朝食": 0.3, "昼食": 0.35, "夕食": 0.35}
+PLAN_GROUP_SIZE = 12  # カテゴリごとに組み合わせへ残す候補数
+# 目標からのずれの重み（不足・超過別。P の不足、カロリーと F の超過を重く見る）
+_PLAN_UNDER_WEIGHT = np.array([1.0, 1.5, 1.0, 1.0])
+_PLAN_OVER_WEIGHT = np.array([1.5, 1.0, 1.5, 1.0])
+
+
+def split_remaining_targets(totals, targets, logged_types):
+    """
+    残りの目標（目標 − 記録済みの合計）を未記録の食事タイミングに配分する
+    朝昼夕がすべて記録済みなら、残りが 100kcal 以上のときだけ間食に割り当てる
+    Returns: {meal_type: {"cal", "p", "f", "c"}}
+    """
+    remaining = {k: max(targets[k] - totals[k], 0) for k in PLAN_NUTRIENTS}
+    slots = [m for m in MAIN_MEAL_SHARES if m not in logged_types]
+    if not slots:
+        return {"間食": remaining} if remaining["cal"] >= 100 else {}
+    share_total = sum(MAIN_MEAL_SHARES[m] for m in slots)
+    return {
+        m: {k: v * MAIN_MEAL_SHARES[m] / share_total for k, v in remaining.items()}
+        for m in slots
+    }
+
+
+def _dislike_tokens(dislikes):
+    """プロフィールの苦手な食べ物（読点・カンマ・空白区切り）を正規化したトークンにする"""
+    tokens = re.split(r"[、,，・/／\s]+", dislikes or "")
+    return [t for t in map(normalize_food_text, tokens) if t]
+
+
+@st.cache_resource
+def _food_plan_candidates():
+    """献立提案に使う成分表の候補（おすすめ表示のカテゴリのみ、1食分の目安量）"""
+    table = get_food_table()
+    featured = [i for i, cat in enumerate(table.categories) if cat.get("featured")]
+    idx = np.flatnonzero(np.isin(table["category"], featured))
+    names = [f"{table['name'][i]} {table['portion'][i]}".strip() for i in idx]
+    values = np.column_stack([table.portion_values(col, idx) for col in ("kcal", "p", "f", "c")])
+    return {
+        "names": names,
+        "keys": [normalize_food_text(str(table["name"][i])) for i in idx],
+        "groups": table["category"][idx].astype(np.int64),
+        "values": np.nan_to_num(values),
+    }
+
+
+def build_plan_candidates(templates=(), dislikes=""):
+    """
+    成分表とテンプレートから献立の候補を作る（苦手な食べ物を含むものは除く）
+    テンプレートは1食分として扱う（group = -1）
+    Returns: {"names": [...], "groups": ndarray, "values": ndarray (N, 4: cal, p, f, c)}
+    """
+    base = _food_plan_candidates()
+    names, keys = list(base["names"]), list(base["keys"])
+    groups, values = base["groups"], base["values"]
+    if templates:
+        names += [t["name"] for t in templates]
+        keys += [normalize_food_text(f"{t['name']} {t['food_name']}") for t in templates]
+        groups = np.concatenate([groups, np.full(len(templates), -1)])
+        values = np.vstack([values, [[t["calories"] or 0, t["p_val"] or 0, t["f_val"] or 0, t["c_val"] or 0] for t in templates]])
+
+    tokens = _dislike_tokens(dislikes)
+    keep = np.array([not any(t in k for t in tokens) for k in keys], dtype=bool)
+    return {
+        "names": [n for n, ok in zip(names, keep) if ok],
+        "groups": groups[keep],
+        "values": values[keep].reshape(-1, 4),
+    }
+
+
+def _plan_errors(totals, target, scale):
+    """候補の合計（..., 4）と目標のずれ（重み付き二乗誤差）"""
+    d = (totals - target) / scale
+    weight = np.where(d > 0, _PLAN_OVER_WEIGHT, _PLAN_UNDER_WEIGHT)
+    return (weight * d * d).sum(axis=-1)
+
+
+def optimize_meal_slot(target, candidates, scale, top_k=2, exclude=()):
+    """
+    1回の食事の目標に最も合う組み合わせを選ぶ
+    成分表の候補はカテゴリ（主食・メイン・タンパク源）から0〜1品ずつ選ぶ全組み合わせを
+    ブロードキャストで一括評価し、テンプレートは単品の1食として同じ基準で比べる。
+    exclude: 使わない候補の番号（前の食事で提案したもの）
+    Returns: [{"items": [名前, ...], "indices": [候補の番号, ...], "cal", "p", "f", "c"}, ...]
+             （ずれの小さい順に最大 top_k 件）
+    """
+    target = np.array([target[k] for k in PLAN_NUTRIENTS], dtype=np.float64)
+    scale = np.maximum(np.array([scale[k] for k in PLAN_NUTRIENTS], dtype=np.float64), 1.0)
+    groups, values = candidates["groups"], candidates["values"]
+    usable = np.ones(len(groups), dtype=bool)
+    usable[list(exclude)] = False
+
+    # カテゴリごとに、単品で「目標 ÷ カテゴリ数」に近い候補だけを残す
+    group_ids = [g for g in np.unique(groups) if g >= 0]
+    options = []
+    for g in group_ids:
+        idx = np.flatnonzero((groups == g) & usable)
+        if len(idx):
+            err = _plan_errors(values[idx], target / len(group_ids), scale)
+            options.append(idx[np.argsort(err, kind="stable")[:PLAN_GROUP_SIZE]])
+
+    combos, combo_values = [], []
+    if options:
+        # 各カテゴリの先頭に「選ばない」（栄養素 0）を置いて直積を作る
+        grids = np.meshgrid(*[np.arange(len(o) + 1) for o in options], indexing="ij")
+        choice = np.stack([grid.ravel() for grid in grids], axis=1)[1:]  # 全カテゴリ「選ばない」を除く
+        total = np.zeros((len(choice), 4))
+        for col, opt in enumerate(options):
+            padded = np.vstack([np.zeros((1, 4)), values[opt]])
+            total += padded[choice[:, col]]
+        combos.extend(
+            [opt[c - 1] for opt, c in zip(options, row) if c > 0] for row in choice
+        )
+        combo_values.append(total)
+
+    tpl_idx = np.flatnonzero((groups == -1) & usable)
+    combos.extend([i] for i in tpl_idx)
+    combo_values.append(values[tpl_idx])
+    if not combos:
+        return []
+
+    all_values = np.vstack(combo_values)
+    errors = _plan_errors(all_values, target, scale)
+    top = np.argsort(errors, kind="stable")[:top_k]
+    return [
+        {
+            "items": [candidates["names"][i] for i in combos[j]],
+            "indices": [int(i) for i in combos[j]],
+            **{k: float(v) for k, v in zip(PLAN_NUTRIENTS, all_values[j])},
+        }
+        for j in top
+    ]
+
+
+def suggest_meal_plan(ledger, targets, profile, templates=(), top_k=2):
+    """
+    未記録の食事タイミングごとに、残りの P/F/C に最も合う組み合わせを返す（Gemini不使用）
+    前の食事で1番目に提案した品目は、次の食事では使わない
+    Returns: [{"meal_type", "target": {...}, "plans": [...]}, ...]
+    """
+    slot_targets = split_remaining_targets(ledger.pfc_totals, targets, ledger.meal_types)
+    if not slot_targets:
+        return []
+    candidates = build_plan_candidates(templates, (profile or {}).get("dislikes"))
+    # 1食分のずれの大きさの基準（1日の目標の 1/3）
+    scale = {k: targets[k] / 3 for k in PLAN_NUTRIENTS}
+    used = set()
+    result = []
+    for meal_type, target in slot_targets.items():
+        plans = optimize_meal_slot(target, candidates, scale, top_k=top_k, exclude=used)
+        if plans:
+            used.update(plans[0]["indices"])
+            result.append({"meal_type": meal_type, "target": target, "plans": plans})
+    return result
+
+
+def format_meal_plan(meal_plan):
+    """suggest_meal_plan() の結果を表示用のテキストにする"""
+    lines = []
+    for slot in meal_plan:
+        for rank, plan in enumerate(slot["plans"]):
+            head = f"**{slot['meal_type']}**" if rank == 0 else "　　"
+            lines.append(
+                f"{head} {' + '.join(plan['items'])}"
+                f"（約{int(plan['cal'])}kcal / P:{int(plan['p'])} F:{int(plan['f'])} C:{int(plan['c'])}）"
+            )
+    return "  \n".join(lines)
+
+
+def polish_meal_plan_with_gemini(plan_text, model_name, profile):
+    """ローカルで選んだ献立をもとに、Gemini にトレーナー口調のひとことを書いてもらう（任意）"""
+    try:
+        client = get_gemini_client()
+        prompt = f"""あなたはマッチョなパーソナルトレーナーです。
+以下は残りの食事のおすすめの組み合わせです（内容は変えないでください）。
+{plan_text}
+
+好きな食べ物: {(profile or {}).get("likes") or "特になし"}
+その他要望: {(profile or {}).get("preferences") or "特になし"}
+
+この提案を、絵文字を使って明るく励ますひとこと（80〜150文字、ですます調、マークダウンなし、数値なし）にしてください。"""
+        res = generate_content(client, model_name, prompt, "polish_meal_plan")
+        return res.text.strip()
+    except Exception as e:
+        print(f"Meal plan polish error: {e}")
+        return None
+
+
 # --- generate_meal_advice は一時無効化 ---
 # def generate_meal_advice(model_name, profile, logged_meals, totals, targets):
 #     """Geminiで残りの食事アドバイスを生成"""
@@ -254,12 +658,12 @@ def generate_pfc_summary(totals, targets):
 
 # --- DB操作: profiles ---
 
-@st.cache_data(ttl=300)
+@shared_cached("profiles", "get_user_profile")
 def get_user_profile(user_id):
     """ユーザー設定を取得"""
     try:
         supabase = get_supabase()
-        data = supabase.table("profiles").select("*").eq("id", user_id).execute()
+        data = execute_query(supabase.table("profiles").select("*").eq("id", user_id), "get_user_profile")
         if data.data:
             return data.data[0]
         return {}
@@ -269,15 +673,45 @@ def get_user_profile(user_id):
 
 def update_user_profile(supabase, user_id, updates):
     """ユーザー設定を更新"""
-    supabase.table("profiles").update(updates).eq("id", user_id).execute()
-    get_user_profile.clear()
+    execute_query(supabase.table("profiles").update(updates).eq("id", user_id), "update_user_profile", idempotent=False)
+    # ほかのワーカープロセスの L1 にも無効化メッセージで届く
+    get_user_profile.invalidate(user_id)
 
 
 # --- DB操作: meal_logs ---
 
-def save_meal_log(supabase, user_id, meal_date, meal_type, text, p, f, c, cal,
-                  iron_mg=None, folate_ug=None, calcium_mg=None, vitamin_d_ug=None):
-    """食事ログをDBに保存"""
+def make_idempotency_key(user_id, meal_date, meal_type, content, nonce):
+    """
+    送信1回分を一意に表す冪等キーを生成する。
+    content はテキスト入力なら "text:<食事内容>"、テンプレートなら "template:<id>"。
+    nonce はクライアント側で送信フォームごとに発行し、記録成功時に更新する値。
+    """
+    raw = "\x1f".join([str(user_id), meal_date.isoformat(), meal_type, content, nonce])
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def find_meal_log_by_idempotency_key(supabase, idempotency_key):
+    """冪等キーで保存済みの食事ログを探す（見つからなければ None）"""
+    try:
+        query = supabase.table("meal_logs") \
+            .select("*") \
+            .eq("idempotency_key", idempotency_key) \
+            .limit(1)
+        res = execute_query(query, "find_meal_log_by_idempotency_key")
+        return res.data[0] if res.data else None
+    except Exception as e:
+        print(f"[find_meal_log_by_idempotency_key] データ取得エラー: {e}")
+        return None
+
+
+# 栄養素の列（省略時は NULL）。複数行をまとめて保存するときは全行の列を揃える
+MICRO_COLUMNS = ("iron_mg", "folate_ug", "calcium_mg", "vitamin_d_ug")
+
+
+def build_meal_log_row(user_id, meal_date, meal_type, text, p, f, c, cal,
+                       iron_mg=None, folate_ug=None, calcium_mg=None, vitamin_d_ug=None,
+                       idempotency_key=None):
+    """meal_logs に挿入する1行分の dict を作る（値の丸めもここで行う）"""
     row = {
         "user_id": user_id,
         "meal_date": meal_date.isoformat(),
@@ -293,39 +727,324 @@ def save_meal_log(supabase, user_id, meal_date, meal_type, text, p, f, c, cal,
         row["calcium_mg"] = round(calcium_mg, 1)
     if vitamin_d_ug is not None:
         row["vitamin_d_ug"] = round(vitamin_d_ug, 1)
-    supabase.table("meal_logs").insert(row).execute()
+    if idempotency_key:
+        row["idempotency_key"] = idempotency_key
+    return row
+
+
+def save_meal_log(supabase, user_id, meal_date, meal_type, text, p, f, c, cal,
+                  iron_mg=None, folate_ug=None, calcium_mg=None, vitamin_d_ug=None,
+                  idempotency_key=None):
+    """
+    食事ログをDBに保存
+    idempotency_key を渡した場合、同じキーの行が既にあれば何もしない（ユニーク制約で重複排除）
+    一時的なエラーで再試行するのは idempotency_key を渡した場合だけ
+
+    Returns: 挿入された行（重複で挿入されなかった場合は None）
+    """
+    row = build_meal_log_row(user_id, meal_date, meal_type, text, p, f, c, cal,
+                             iron_mg, folate_ug, calcium_mg, vitamin_d_ug, idempotency_key)
+    if idempotency_key:
+        query = supabase.table("meal_logs").upsert(row, on_conflict="idempotency_key", ignore_duplicates=True)
+    else:
+        query = supabase.table("meal_logs").insert(row)
+    res = execute_query(query, "save_meal_log", idempotent=bool(idempotency_key))
+    return res.data[0] if res.data else None
+
+
+def save_meal_logs(supabase, rows):
+    """
+    build_meal_log_row() で作った複数行を1回の挿入で保存する（テンプレートとテキストを同時に記録するときなど）
+    冪等キーのある行は save_meal_log() と同じく、同じキーの行が既にあれば挿入しない
+    （冪等キーは全行に付けるか、どの行にも付けない）
+
+    Returns: rows と同じ順の、挿入された行のリスト（重複で挿入されなかった行は None）
+    """
+    if not rows:
+        return []
+    # 一括挿入では全行の列を揃える（ない栄養素は NULL）
+    payload = [{**dict.fromkeys(MICRO_COLUMNS), **row} for row in rows]
+    if all(row.get("idempotency_key") for row in rows):
+        query = supabase.table("meal_logs").upsert(payload, on_conflict="idempotency_key", ignore_duplicates=True)
+        res = execute_query(query, "save_meal_logs")
+        inserted = {r.get("idempotency_key"): r for r in res.data or []}
+        return [inserted.get(row["idempotency_key"]) for row in rows]
+    res = execute_query(supabase.table("meal_logs").insert(payload), "save_meal_logs", idempotent=False)
+    data = res.data or []
+    return data + [None] * (len(rows) - len(data))
 
 
 def get_meal_logs(supabase, user_id, date_str):
-    """指定日の食事ログを取得"""
+    """指定日の食事ログを取得（再試行しても失敗すれば例外を送出する）"""
+    query = supabase.table("meal_logs").select("*").eq("user_id", user_id).eq("meal_date", date_str)
+    return execute_query(query, "get_meal_logs")
+
+
+def get_meal_logs_range(supabase, user_id, start_str, end_str):
+    """指定期間の食事ログを1回のクエリで取得（エラー時は None）"""
     try:
-        return supabase.table("meal_logs").select("*").eq("user_id", user_id).eq("meal_date", date_str).execute()
+        query = supabase.table("meal_logs") \
+            .select("*") \
+            .eq("user_id", user_id) \
+            .gte("meal_date", start_str) \
+            .lte("meal_date", end_str)
+        return execute_query(query, "get_meal_logs_range").data or []
     except Exception as e:
-        print(f"[get_meal_logs] データ取得エラー: {e}")
+        print(f"[get_meal_logs_range] データ取得エラー: {e}")
         return None
 
 
+def get_food_name_history(supabase, user_id, limit=1000):
+    """
+    オートコンプリート用に、過去の食事ログ（食事名と栄養素）を新しい順に取得
+    Returns: 行のリスト（エラー時は空リスト）
+    """
+    try:
+        query = supabase.table("meal_logs") \
+            .select("food_name, calories, p_val, f_val, c_val, iron_mg, folate_ug, calcium_mg, vitamin_d_ug") \
+            .eq("user_id", user_id) \
+            .order("created_at", desc=True) \
+            .limit(limit)
+        return execute_query(query, "get_food_name_history").data or []
+    except Exception as e:
+        print(f"Food name history error: {e}")
+        return []
+
+
+def group_logs_by_date(logs, date_strs):
+    """ログを日付（ISO文字列）ごとに振り分ける。記録のない日も空リストで埋める"""
+    grouped = {d: [] for d in date_strs}
+    for log in logs:
+        bucket = grouped.get(log.get("meal_date"))
+        if bucket is not None:
+            bucket.append(log)
+    return grouped
+
+
+def prefetch_meal_logs(supabase, user_id, day_cache, days):
+    """
+    day_cache（{日付ISO文字列: DailyLedger}）に未取得の日だけを、
+    1回の範囲クエリでまとめて取得して格納する。
+
+    Returns: 全ての日がキャッシュ済みになれば True（取得失敗時は False）
+    """
+    missing = [d for d in days if d.isoformat() not in day_cache]
+    if not missing:
+        return True
+    start, end = min(missing), max(missing)
+    rows = get_meal_logs_range(supabase, user_id, start.isoformat(), end.isoformat())
+    if rows is None:
+        return False
+    span = [(start + timedelta(days=i)).isoformat() for i in range((end - start).days + 1)]
+    # 範囲内の取得済みの日は上書きしない（ローカルで更新済みの可能性があるため）
+    for date_str, day_logs in group_logs_by_date(rows, span).items():
+        if date_str not in day_cache:
+            day_cache[date_str] = DailyLedger(date_str, day_logs)
+    return True
+
+
 def delete_meal_log(supabase, log_id):
     """食事ログを削除"""
-    supabase.table("meal_logs").delete().eq("id", log_id).execute()
+    execute_query(supabase.table("meal_logs").delete().eq("id", log_id), "delete_meal_log", idempotent=False)
+
+
+def update_meal_log_nutrients(supabase, log_id, p, f, c, cal,
+                              iron_mg=None, folate_ug=None, calcium_mg=None, vitamin_d_ug=None):
+    """記録済みの食事ログの栄養素を更新（仮の推定値を解析結果で置き換えるときに使う）"""
+    row = {"p_val": round(p), "f_val": round(f), "c_val": round(c), "calories": round(cal)}
+    for field, val in (("iron_mg", iron_mg), ("folate_ug", folate_ug),
+                       ("calcium_mg", calcium_mg), ("vitamin_d_ug", vitamin_d_ug)):
+        if val is not None:
+            row[field] = round(val, 1)
+    execute_query(supabase.table("meal_logs").update(row).eq("id", log_id), "update_meal_log_nutrients",
+                  idempotent=False)
+
+
+def _confirm_estimated_meal_log(supabase, user_id, log_id, date_str, text, model_name):
+    """仮の推定値で記録した行を Gemini で解析し直して更新し、その日のログを再取得する"""
+    try:
+        result = analyze_meal_with_gemini(text, model_name)
+    except Exception as e:  # 予算切れ・タイムアウトでも仮の推定値のまま残す
+        print(f"[confirm_estimated_meal_log] 解析エラー: {type(e).__name__} - {e}")
+        result = None
+    if result:
+        p, f, c, cal, iron, folate, calcium, vit_d = result
+        try:
+            update_meal_log_nutrients(supabase, log_id, p, f, c, cal, iron, folate, calcium, vit_d)
+        except Exception as e:
+            print(f"[confirm_estimated_meal_log] 更新エラー: {e}")
+    return get_meal_logs_range(supabase, user_id, date_str, date_str)
+
+
+def start_estimate_confirmation(supabase, user_id, log_id, date_str, text, model_name):
+    """
+    仮の推定値で記録した行の確認（Gemini 解析 → 更新 → 当日分の再取得）をバックグラウンドで開始する
+    返り値の Future は start_day_reconciliation() と同じく当日分の行を返すので、
+    pending_reconciliations に入れれば apply_day_reconciliations() で台帳に反映される
+    """
+    return get_executor().submit(_confirm_estimated_meal_log, supabase, user_id, log_id, date_str, text, model_name)
+
+
+# --- 入力中の先行解析 ---
+
+# 記録1件あたりに許す先行解析の数（使われずに終わる Gemini 呼び出しの上限）
+SPECULATION_MAX_RATIO = 3
+
+
+class SpeculationStats:
+    """先行解析の集計（プロセス共有）。started / committed が使われなかった呼び出しの目安になる"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {"started": 0, "committed": 0, "cancelled": 0}
+
+    def count(self, key):
+        with self._lock:
+            self._counts[key] += 1
+
+    def clear(self):
+        with self._lock:
+            self._counts = dict.fromkeys(self._counts, 0)
+
+    def report(self):
+        """開始・記録に使われた・取り消した件数と、先行解析:記録 の比"""
+        with self._lock:
+            s = dict(self._counts)
+        s["ratio"] = s["started"] / s["committed"] if s["committed"] else float(s["started"])
+        return s
+
+
+@st.cache_resource
+def get_speculation_stats():
+    """プロセス全体で共有する先行解析の集計"""
+    return SpeculationStats()
+
+
+class SpeculativeAnalysis:
+    """
+    入力中の食事テキストの先行解析（セッションごとに1つ）
+    入力が止まったら start() で解析をバックグラウンドで始め、記録時に take() で
+    同じテキストの結果を受け取る。テキストが変わったら前の解析は取り消す
+    （実行前なら取り消し、実行中なら結果を捨てる）。
+    記録時に先行解析がなければ submit() で通常の解析として始め、他の処理と並行して待てる。
+    """
+
+    def __init__(self, stats=None):
+        self.stats = stats or SpeculationStats()
+        self.key = None     # (テキスト, モデル名)
+        self.future = None
+        self.speculative = False  # future が先行解析（集計の対象）か
+        self.started = 0    # このセッションで始めた数
+        self.committed = 0  # このセッションで記録に使われた数
+
+    def allowed(self):
+        """先行解析の数が記録数の SPECULATION_MAX_RATIO 倍（＋1件分）を超えていなければ True"""
+        return self.started < SPECULATION_MAX_RATIO * (self.committed + 1)
+
+    def start(self, text, model_name):
+        """テキストの解析をバックグラウンドで始める（同じテキストで実行中・完了済みなら何もしない）"""
+        key = (text, model_name)
+        if self.future is not None and self.key == key:
+            return self.future
+        self.cancel()
+        if len(text.strip()) < 2 or not self.allowed():
+            return None
+        self.key = key
+        self.future = get_executor().submit(analyze_meal_with_gemini, text, model_name)
+        self.speculative = True
+        self.started += 1
+        self.stats.count("started")
+        return self.future
+
+    def submit(self, text, model_name):
+        """
+        記録時に呼ぶ。同じテキストの先行解析があればそれを、なければ新しく始めた解析の Future を返す
+        （記録に必要な解析なので上限の対象外・先行解析の集計にも含めない）。結果は take() で受け取る
+        """
+        key = (text, model_name)
+        if self.future is None or self.key != key:
+            self.cancel()
+            self.key = key
+            self.future = get_executor().submit(analyze_meal_with_gemini, text, model_name)
+            self.speculative = False
+        return self.future
+
+    def cancel(self):
+        """先行解析を取り消す"""
+        if self.future is not None:
+            self.future.cancel()
+            if self.speculative:
+                self.stats.count("cancelled")
+        self.key = None
+        self.future = None
+
+    def take(self, text, model_name):
+        """
+        記録時に呼ぶ。同じテキストの先行解析があればその結果を返す（実行中なら完了を待つ）
+        なければ（または解析に失敗していれば）None を返すので、呼び出し側で通常どおり解析する
+        リランの予算内に終わらなければ DeadlineExceeded（解析は続けるので、同じテキストで記録し直せば結果を使う。
+        このとき self.key は残る）。解析自体が予算切れ（BudgetExceeded）・タイムアウトで失敗したらその例外を送出する
+        """
+        if self.future is None or self.key != (text, model_name):
+            self.cancel()
+            return None
+        future, speculative = self.future, self.speculative
+        self.key = None
+        self.future = None
+        try:
+            result = wait_for(future)
+        except DeadlineExceeded:
+            self.key, self.future, self.speculative = (text, model_name), future, speculative
+            raise
+        except Exception as e:
+            if isinstance(e, BudgetExceeded) or is_timeout(e):
+                raise  # 呼び出し側で案内を表示する
+            print(f"[speculative_analysis] 先行解析エラー: {e}")
+            return None
+        if result and speculative:
+            self.committed += 1
+            self.stats.count("committed")
+        return result
+
+
+def start_day_reconciliation(supabase, user_id, date_str):
+    """指定日のログをバックグラウンドでDBから再取得する（ローカル更新との突き合わせ用）"""
+    return get_executor().submit(get_meal_logs_range, supabase, user_id, date_str, date_str)
+
+
+def apply_day_reconciliations(day_cache, pending):
+    """
+    完了したバックグラウンド再取得の結果で day_cache の該当日を置き換える。
+    pending は {日付ISO文字列: Future}。同じ日に書き込みが続いた場合は最新の Future だけを保持すること。
+    """
+    for date_str, future in list(pending.items()):
+        if not future.done():
+            continue
+        del pending[date_str]
+        try:
+            rows = future.result()
+        except Exception as e:
+            print(f"[apply_day_reconciliations] 再取得エラー: {e}")
+            continue
+        if rows is not None:
+            day_cache[date_str] = DailyLedger(date_str, rows)
 
 
 # ── テンプレート操作 ──────────────────────────────────────
 
 def get_meal_templates(supabase, user_id: str):
     """ユーザーのテンプレート一覧を取得"""
-    res = supabase.table("meal_templates") \
+    query = supabase.table("meal_templates") \
         .select("*") \
         .eq("user_id", user_id) \
-        .order("created_at", desc=False) \
-        .execute()
-    return res.data or []
+        .order("created_at", desc=False)
+    return execute_query(query, "get_meal_templates").data or []
 
 
 def save_meal_template(supabase, user_id: str, name: str, food_name: str,
                        p: float, f: float, c: float, cal: float, meal_type: str = None):
     """テンプレートを保存"""
-    supabase.table("meal_templates").insert({
+    query = supabase.table("meal_templates").insert({
         "user_id":   user_id,
         "name":      name,
         "food_name": food_name,
@@ -334,9 +1053,11 @@ def save_meal_template(supabase, user_id: str, name: str, food_name: str,
         "c_val":     c,
         "calories":  cal,
         "meal_type": meal_type,
-    }).execute()
+    })
+    execute_query(query, "save_meal_template", idempotent=False)
 
 
 def delete_meal_template(supabase, template_id: str):
     """テンプレートを削除"""
-    supabase.table("meal_templates").delete().eq("id", template_id).execute()
+    execute_query(supabase.table("meal_templates").delete().eq("id", template_id), "delete_meal_template",
+                  idempotent=False)
@@ -0,0 +1,367 @@
+"""
+複数のワーカープロセスで共有するキャッシュ（プロフィール・Gemini のモデル一覧・食事の解析結果）
+
+st.cache_data / st.cache_resource はプロセスごとなので、ロードバランサーの後ろで Streamlit を
+複数プロセス動かすと、プロセスごとにキャッシュが冷えていて、あるプロセスでの無効化（プロフィールの更新など）が
+ほかのプロセスに届かない。services.py のキャッシュはこのモジュールを通し、置き場所（バックエンド）を
+secrets の [shared_cache] backend で切り替える。
+
+- "sqlite": 同じホストのプロセスで1つの SQLite ファイル（WAL モード。読み込みは書き込みを待たない）を共有する
+- "memory"（既定）: プロセス内の辞書。1プロセスで動かすとき・テストでの SQLite の代わり
+
+値は JSON にして置く（呼び出すたびに別のオブジェクトを返すので、呼び出し元が書き換えてもキャッシュは変わらない）。
+名前空間（NAMESPACE_TTLS）ごとに TTL を持ち、[shared_cache.ttl] で上書きできる。
+
+読み込みはまずプロセス内の L1（最大 L1_SIZE 件・LRU）を見て、なければバックエンドを読む。
+無効化はバックエンドの値を消したうえで無効化メッセージ（連番の表）を書き、各プロセスは
+SYNC_INTERVAL 秒ごとに新しいメッセージを読んで L1 から消す（ほかのプロセスでの更新が最大 SYNC_INTERVAL 秒遅れて届く）。
+メッセージは MESSAGE_RETENTION 秒で消すので、それより長く読んでいなかったプロセスは L1 をすべて捨てる。
+
+バックエンドは get / set / delete / publish / messages / latest_message_id / purge / clear を持つクラスで、
+Redis などに置き換えるときも同じメソッドを用意すればよい。
+"""
+
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import streamlit as st
+
+from metrics import cache_requests
+
+# 名前空間ごとの TTL（秒）
+NAMESPACE_TTLS = {
+    "profiles": 300,                 # ユーザーのプロフィール（更新時に無効化）
+    "gemini_models": 3600,           # Gemini のモデル一覧
+    "meal_analysis": 7 * 24 * 3600,  # 食事のテキストごとの解析結果
+}
+DEFAULT_TTL = 300
+L1_SIZE = 1024
+SYNC_INTERVAL = 1.0        # 無効化メッセージを読みに行く間隔（秒）
+PURGE_INTERVAL = 60.0      # 期限切れの値・古いメッセージを消す間隔（秒）
+MESSAGE_RETENTION = 600.0  # 無効化メッセージを残す秒数
+DEFAULT_SQLITE_PATH = os.path.join("/tmp", "pfc-shared-cache.sqlite3")
+BUSY_TIMEOUT = 2.0         # ほかのプロセスの書き込みを待つ上限（秒）
+
+_MISSING = object()
+
+
+# --- バックエンド ---
+
+class MemoryBackend:
+    """プロセス内の辞書に置くバックエンド（1プロセスで動かすとき・テスト用）"""
+
+    name = "memory"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}   # (名前空間, 鍵) -> (JSON, 期限)
+        self._messages = []  # [(連番, 名前空間, 鍵, 時刻)]（鍵が None なら名前空間全体）
+        self._next_id = 1
+
+    def get(self, namespace, key, now):
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+        return entry if entry is not None and entry[1] > now else None
+
+    def set(self, namespace, key, value, expires):
+        with self._lock:
+            self._entries[(namespace, key)] = (value, expires)
+
+    def delete(self, namespace, key=None):
+        with self._lock:
+            if key is not None:
+                self._entries.pop((namespace, key), None)
+            else:
+                for k in [k for k in self._entries if k[0] == namespace]:
+                    del self._entries[k]
+
+    def publish(self, namespace, key, now):
+        with self._lock:
+            self._messages.append((self._next_id, namespace, key, now))
+            self._next_id += 1
+
+    def messages(self, after_id):
+        """after_id より新しい無効化メッセージ [(連番, 名前空間, 鍵)]"""
+        with self._lock:
+            return [(i, ns, key) for i, ns, key, _ in self._messages if i > after_id]
+
+    def latest_message_id(self):
+        with self._lock:
+            return self._next_id - 1
+
+    def purge(self, now, messages_before):
+        with self._lock:
+            for k in [k for k, (_, expires) in self._entries.items() if expires <= now]:
+                del self._entries[k]
+            self._messages = [m for m in self._messages if m[3] >= messages_before]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._messages.clear()
+
+
+class SQLiteBackend:
+    """
+    同じホストのプロセスで共有する SQLite ファイル（WAL モード）のバックエンド
+    Streamlit はリランごとにスクリプトのスレッドを作るので、スレッドごとではなく1本の接続をロックして使う
+    （1回の読み書きは数十µs なので、プロセス内で順番に実行しても待ちはほとんどない）
+    """
+
+    name = "sqlite"
+
+    _SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS entries ("
+        " namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires REAL NOT NULL,"
+        " PRIMARY KEY (namespace, key))",
+        "CREATE TABLE IF NOT EXISTS invalidations ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT, namespace TEXT NOT NULL, key TEXT, created REAL NOT NULL)",
+    )
+
+    def __init__(self, path=DEFAULT_SQLITE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # WAL では NORMAL でもファイルは壊れない（電源断で直前の書き込みを失うだけで、キャッシュには十分）
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in self._SCHEMA:
+            self._conn.execute(statement)
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def get(self, namespace, key, now):
+        rows = self._execute(
+            "SELECT value, expires FROM entries WHERE namespace = ? AND key = ? AND expires > ?", (namespace, key, now),
+        )
+        return rows[0] if rows else None
+
+    def set(self, namespace, key, value, expires):
+        self._execute(
+            "INSERT OR REPLACE INTO entries (namespace, key, value, expires) VALUES (?, ?, ?, ?)",
+            (namespace, key, value, expires),
+        )
+
+    def delete(self, namespace, key=None):
+        if key is not None:
+            self._execute("DELETE FROM entries WHERE namespace = ? AND key = ?", (namespace, key))
+        else:
+            self._execute("DELETE FROM entries WHERE namespace = ?", (namespace,))
+
+    def publish(self, namespace, key, now):
+        self._execute("INSERT INTO invalidations (namespace, key, created) VALUES (?, ?, ?)", (namespace, key, now))
+
+    def messages(self, after_id):
+        return self._execute("SELECT id, namespace, key FROM invalidations WHERE id > ? ORDER BY id", (after_id,))
+
+    def latest_message_id(self):
+        # MAX(id) は古いメッセージを消すと戻ってしまうので、AUTOINCREMENT の連番を読む
+        rows = self._execute("SELECT seq FROM sqlite_sequence WHERE name = 'invalidations'")
+        return rows[0][0] if rows else 0
+
+    def purge(self, now, messages_before):
+        self._execute("DELETE FROM entries WHERE expires <= ?", (now,))
+        self._execute("DELETE FROM invalidations WHERE created < ?", (messages_before,))
+
+    def clear(self):
+        self._execute("DELETE FROM entries")
+        self._execute("DELETE FROM invalidations")
+
+
+# --- 共有キャッシュ ---
+
+class SharedCache:
+    """
+    バックエンドの前にプロセス内の L1 を置いた共有キャッシュ
+    バックエンドのエラー（ファイルのロックなど）はログに出してミスとして扱う（キャッシュが原因で画面を止めない）
+    """
+
+    def __init__(self, backend, ttls=None, l1_size=L1_SIZE, sync_interval=SYNC_INTERVAL, clock=time.time):
+        self.backend = backend
+        self.ttls = {**NAMESPACE_TTLS, **(ttls or {})}
+        self._l1_size = l1_size
+        self._sync_interval = sync_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._l1 = OrderedDict()  # (名前空間, 鍵) -> (JSON, 期限)
+        self._stats = {"lookups": 0, "l1_hits": 0, "backend_hits": 0, "invalidations": 0, "errors": 0}
+        self._last_message = self._call("latest_message_id", default=0)
+        self._next_sync = 0.0
+        self._next_purge = 0.0
+
+    def _call(self, method, *args, default=None):
+        try:
+            return getattr(self.backend, method)(*args)
+        except Exception as e:
+            with self._lock:
+                self._stats["errors"] += 1
+            print(f"[shared_cache] {self.backend.name}.{method} エラー: {e}")
+            return default
+
+    def ttl(self, namespace):
+        return self.ttls.get(namespace, DEFAULT_TTL)
+
+    def get(self, namespace, key, default=None):
+        """値（なければ default）"""
+        now = self._clock()
+        self.sync(now)
+        with self._lock:
+            self._stats["lookups"] += 1
+            entry = self._l1.get((namespace, key))
+            if entry is not None and entry[1] > now:
+                self._l1.move_to_end((namespace, key))
+                self._stats["l1_hits"] += 1
+                return json.loads(entry[0])
+        entry = self._call("get", namespace, key, now)
+        if entry is None:
+            return default
+        self._remember(namespace, key, entry[0], entry[1])
+        with self._lock:
+            self._stats["backend_hits"] += 1
+        return json.loads(entry[0])
+
+    def set(self, namespace, key, value):
+        """値を置く（名前空間の TTL で期限切れになる）"""
+        now = self._clock()
+        payload = json.dumps(value, ensure_ascii=False)
+        expires = now + self.ttl(namespace)
+        self._call("set", namespace, key, payload, expires)
+        self._remember(namespace, key, payload, expires)
+        self._maybe_purge(now)
+
+    def invalidate(self, namespace, key=None):
+        """鍵（None なら名前空間全体）の値を消し、ほかのプロセスにも無効化メッセージで知らせる"""
+        now = self._clock()
+        self._call("delete", namespace, key)
+        self._call("publish", namespace, key, now)
+        self._evict(namespace, key)
+
+    def sync(self, now=None, force=False):
+        """ほかのプロセスからの無効化メッセージを読んで L1 から消す（SYNC_INTERVAL 秒に1回）"""
+        now = self._clock() if now is None else now
+        with self._lock:
+            if not force and now < self._next_sync:
+                return
+            self._next_sync = now + self._sync_interval
+            after = self._last_message
+        messages = self._call("messages", after, default=None)
+        if messages is None:
+            return
+        first = messages[0][0] if messages else self._call("latest_message_id", default=after) + 1
+        if after and first > after + 1:
+            # 読まないうちに消えたメッセージがある（MESSAGE_RETENTION 秒以上読んでいなかった）: L1 をすべて捨てる
+            with self._lock:
+                self._l1.clear()
+                self._last_message = first - 1
+        for message_id, namespace, key in messages:
+            self._evict(namespace, key)
+            with self._lock:
+                self._stats["invalidations"] += 1
+        if messages:
+            with self._lock:
+                self._last_message = max(self._last_message, messages[-1][0])
+
+    def _remember(self, namespace, key, payload, expires):
+        with self._lock:
+            self._l1[(namespace, key)] = (payload, expires)
+            self._l1.move_to_end((namespace, key))
+            while len(self._l1) > self._l1_size:
+                self._l1.popitem(last=False)
+
+    def _evict(self, namespace, key):
+        with self._lock:
+            if key is not None:
+                self._l1.pop((namespace, key), None)
+            else:
+                for k in [k for k in self._l1 if k[0] == namespace]:
+                    del self._l1[k]
+
+    def _maybe_purge(self, now):
+        with self._lock:
+            if now < self._next_purge:
+                return
+            self._next_purge = now + PURGE_INTERVAL
+        self._call("purge", now, now - MESSAGE_RETENTION)
+
+    def clear(self):
+        """L1 とバックエンドを空にする（テスト用）"""
+        self._call("clear")
+        with self._lock:
+            self._l1.clear()
+            self._stats = dict.fromkeys(self._stats, 0)
+            self._last_message = 0
+            self._next_sync = self._next_purge = 0.0
+
+    def report(self):
+        """バックエンド・L1 の件数・ヒット率・受け取った無効化の件数"""
+        with self._lock:
+            s = dict(self._stats)
+            s["l1_entries"] = len(self._l1)
+        s["backend"] = self.backend.name
+        hits = s["l1_hits"] + s["backend_hits"]
+        s["hit_rate"] = hits / s["lookups"] if s["lookups"] else 0.0
+        return s
+
+
+def cache_key(*args, **kwargs):
+    """関数の引数から鍵を作る（引数は JSON にできるもの）"""
+    if not kwargs and len(args) == 1 and isinstance(args[0], str):
+        return args[0]
+    return json.dumps([args, kwargs], ensure_ascii=False, sort_keys=True, default=str)
+
+
+def shared_cached(namespace, name):
+    """
+    関数の戻り値を共有キャッシュの namespace に置くデコレーター（戻り値は JSON にできるもの）
+    ヒット / ミスは metrics の cache_requests に function=name で数える
+
+        @shared_cached("profiles", "get_user_profile")
+        def get_user_profile(user_id): ...
+
+        get_user_profile.invalidate(user_id)  # その引数の値をすべてのプロセスで無効化
+        get_user_profile.clear()              # 名前空間全体を無効化
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            cache = get_shared_cache()
+            key = cache_key(*args, **kwargs)
+            value = cache.get(namespace, key, _MISSING)
+            if value is not _MISSING:
+                cache_requests.inc(function=name, result="hit")
+                return value
+            cache_requests.inc(function=name, result="miss")
+            value = func(*args, **kwargs)
+            cache.set(namespace, key, value)
+            return value
+
+        wrapper.invalidate = lambda *args, **kwargs: get_shared_cache().invalidate(namespace, cache_key(*args, **kwargs))
+        wrapper.clear = lambda: get_shared_cache().invalidate(namespace)
+        return wrapper
+    return decorator
+
+
+@st.cache_resource
+def get_shared_cache():
+    """プロセス全体で使う共有キャッシュ（secrets の [shared_cache] でバックエンド・ファイル・TTL を変えられる）"""
+    try:
+        conf = dict(st.secrets.get("shared_cache", {}))
+    except Exception:
+        conf = {}
+    ttls = {namespace: float(ttl) for namespace, ttl in dict(conf.get("ttl", {})).items()}
+    backend = MemoryBackend()
+    if conf.get("backend") == "sqlite":
+        try:
+            backend = SQLiteBackend(conf.get("path", DEFAULT_SQLITE_PATH))
+        except Exception as e:
+            print(f"[shared_cache] SQLite を開けないためプロセス内のキャッシュを使います: {e}")
+    elif conf.get("backend") not in (None, "memory"):
+        print(f"[shared_cache] 不明なバックエンド {conf.get('backend')!r} のためプロセス内のキャッシュを使います")
+    return SharedCache(backend, ttls=ttls)
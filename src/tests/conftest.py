@@ -8,3 +8,41 @@ import os
 ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if ROOT not in sys.path:
     sys.path.insert(0, ROOT)
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def _clear_analysis_cache():
+    """解析の類似テキストキャッシュと品目の内訳キャッシュはプロセス共有のため、テストごとに空にする"""
+    from analysis_cache import get_analysis_cache, get_ingredient_cache
+    get_analysis_cache().clear()
+    get_ingredient_cache().clear()
+    yield
+
+
+@pytest.fixture(autouse=True)
+def _clear_shared_cache():
+    """プロセス間の共有キャッシュ（テストではプロセス内のバックエンド）は、テストごとに空にする"""
+    from shared_cache import get_shared_cache
+    get_shared_cache().clear()
+    yield
+
+
+@pytest.fixture(autouse=True)
+def _clear_figure_cache():
+    """メモ化したグラフはプロセス共有のため、テストごとに空にする"""
+    from charts import figure_cache
+    figure_cache.clear()
+    yield
+
+
+@pytest.fixture(autouse=True)
+def _clear_usage_ledger(monkeypatch):
+    """Gemini の利用台帳はプロセス共有のため、テストごとに空にする（DB の読み書きはしない）"""
+    import gemini_usage
+    ledger = gemini_usage.get_usage_ledger()
+    ledger.clear()
+    ledger._load_day = None
+    monkeypatch.setattr(gemini_usage, "_save_usage_row", lambda row: None)
+    yield
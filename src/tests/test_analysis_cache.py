@@ -0,0 +1,164 @@
+"""
+analysis_cache.py のユニットテスト
+
+Gemini（埋め込み・再解析）はモックで差し替える。
+"""
+from unittest.mock import MagicMock
+
+import numpy as np
+import pytest
+
+from analysis_cache import AnalysisCache, IngredientCache, hashing_vector, quantities, segment_items, split_meal_text
+
+RESULT = (23, 2, 0, 116, 0.3, 10.0, 4.0, 0.1)
+
+
+class TestHashingVector:
+    def test_unit_length_and_stable(self):
+        vec = hashing_vector("鶏むね肉とご飯")
+        assert np.linalg.norm(vec) == pytest.approx(1.0, abs=1e-5)
+        assert np.array_equal(vec, hashing_vector("鶏むね肉とご飯"))
+
+    def test_spelling_variants_are_identical(self):
+        """漢字・カタカナ・単位の表記違いは同じベクトルになること"""
+        assert float(hashing_vector("鶏むね肉 100g") @ hashing_vector("鶏胸肉100グラム")) == pytest.approx(1.0, abs=1e-5)
+
+    def test_empty(self):
+        assert hashing_vector("  ") is None
+
+
+class TestQuantities:
+    def test_numbers_extracted_and_normalized(self):
+        assert quantities("ご飯１５０g と 卵2個") == (2.0, 150.0)
+        assert quantities("鶏むね肉 100.0g") == quantities("鶏むね肉100g")
+
+
+class TestAnalysisCache:
+    """AnalysisCache: 再利用の判定・容量・埋め込みの切り替えを検証"""
+
+    def test_near_duplicate_hit(self):
+        cache = AnalysisCache(audit_rate=0)
+        cache.store("鶏むね肉 100g", RESULT)
+        hit = cache.lookup("鶏胸肉100グラム")
+        assert hit["result"] == RESULT
+        assert hit["text"] == "鶏むね肉 100g"
+        assert hit["space"] == "hashing"
+
+    def test_different_meal_misses(self):
+        cache = AnalysisCache(audit_rate=0)
+        cache.store("鶏むね肉とご飯", RESULT)
+        assert cache.lookup("鶏もも肉とご飯") is None
+
+    def test_different_quantity_misses(self):
+        """類似していても数量が違えば再利用しないこと"""
+        cache = AnalysisCache(audit_rate=0)
+        cache.store("鶏むね肉 100g", RESULT)
+        assert cache.lookup("鶏むね肉 200g") is None
+
+    def test_capacity_overwrites_oldest(self):
+        cache = AnalysisCache(capacity=2, audit_rate=0)
+        for text in ("納豆ご飯", "カレーライス", "醤油ラーメン"):
+            cache.store(text, RESULT)
+        assert len(cache) == 2
+        assert cache.lookup("納豆ご飯") is None
+        assert cache.lookup("醤油ラーメン") is not None
+
+    def test_gemini_embedding_preferred(self, mocker):
+        """埋め込みモデルが設定されていれば、その空間で探すこと"""
+        embed = mocker.patch("analysis_cache.gemini_embedding", return_value=np.array([1.0, 0.0], dtype=np.float32))
+        cache = AnalysisCache(embedding_model="text-embedding", audit_rate=0)
+        cache.store("親子丼", RESULT)
+        hit = cache.lookup("おやこどん（並）")
+        assert hit["space"] == "gemini"
+        assert embed.call_count == 2
+
+    def test_embedding_error_falls_back_to_hashing(self, mocker):
+        mocker.patch("analysis_cache.gemini_embedding", side_effect=Exception("offline"))
+        cache = AnalysisCache(embedding_model="text-embedding", audit_rate=0)
+        cache.store("鶏むね肉 100g", RESULT)
+        assert cache.lookup("鶏胸肉 100グラム")["space"] == "hashing"
+
+    def test_report_hit_rate(self):
+        cache = AnalysisCache(audit_rate=0)
+        cache.store("納豆ご飯", RESULT)
+        cache.lookup("納豆ごはん")
+        cache.lookup("カレーライス")
+        report = cache.report()
+        assert report["lookups"] == 2 and report["hits"] == 1
+        assert report["hit_rate"] == pytest.approx(0.5)
+
+
+class TestAudit:
+    """監査: 再解析との比較で誤再利用を記録すること"""
+
+    def test_false_reuse_recorded_and_corrected(self, mocker):
+        mocker.patch("analysis_cache.get_executor", return_value=MagicMock(submit=lambda fn, *a: fn(*a)))
+        cache = AnalysisCache(audit_rate=1.0)
+        cache.store("鶏むね肉 100g", RESULT)
+        hit = cache.lookup("鶏胸肉100グラム")
+        fresh = (30, 10, 5, 300, 0, 0, 0, 0)
+        assert cache.maybe_audit("鶏胸肉100グラム", hit, lambda: fresh) is True
+        report = cache.report()
+        assert report["audits"] == 1 and report["false_reuses"] == 1
+        assert report["recent_audits"][0]["fresh_cal"] == 300
+        # 誤再利用した入力は正しい結果で登録し直される
+        assert cache.lookup("鶏胸肉100グラム")["result"] == fresh
+
+    def test_matching_audit_is_not_false_reuse(self, mocker):
+        mocker.patch("analysis_cache.get_executor", return_value=MagicMock(submit=lambda fn, *a: fn(*a)))
+        cache = AnalysisCache(audit_rate=1.0)
+        cache.store("納豆ご飯", RESULT)
+        hit = cache.lookup("納豆ごはん")
+        assert cache.maybe_audit("納豆ごはん", hit, lambda: (23, 2, 0, 120, 0, 0, 0, 0)) is False
+        assert cache.report()["false_reuse_rate"] == 0.0
+
+    def test_no_audit_when_rate_zero(self):
+        cache = AnalysisCache(audit_rate=0)
+        assert cache.maybe_audit("x", {"result": RESULT}, lambda: RESULT) is None
+
+
+def _item(name, cal, p=0):
+    return {"name": name, "cal": cal, "p": p, "f": 0, "c": 0,
+            "iron_mg": 0.0, "folate_ug": 0.0, "calcium_mg": 0.0, "vitamin_d_ug": 0.0}
+
+
+class TestSegmentation:
+    def test_split_on_separators(self):
+        assert split_meal_text("白米、味噌汁 焼き鮭・納豆") == ["白米", "味噌汁", "焼き鮭", "納豆"]
+
+    def test_to_inside_item_name(self):
+        known = {"とんかつ", "白米"}
+        assert segment_items("とんかつと白米", known.__contains__) == ["とんかつ", "白米"]
+        assert segment_items("とんかつと納豆", known.__contains__) is None
+
+
+class TestIngredientCache:
+    ITEMS = [_item("白米", 250, 4), _item("味噌汁", 40, 3), _item("焼き鮭", 150, 20)]
+
+    def test_assemble_known_items(self):
+        cache = IngredientCache()
+        assert cache.store_items(self.ITEMS, (27, 0, 0, 440, 0, 0, 0, 0)) == 3
+        result = cache.assemble("焼き鮭と白米")
+        assert result[3] == 400
+        assert result[0] == 24
+        assert cache.assemble("みそ汁、白米")[3] == 290  # 表記ゆれは正規化して照合する
+
+    def test_unknown_item_is_miss(self):
+        cache = IngredientCache()
+        cache.store_items(self.ITEMS, (27, 0, 0, 440, 0, 0, 0, 0))
+        assert cache.assemble("白米と納豆") is None
+        report = cache.report()
+        assert report["lookups"] == 1
+        assert report["assembled"] == 0
+
+    def test_fallback_for_unknown_items(self):
+        cache = IngredientCache()
+        cache.store_items(self.ITEMS, (27, 0, 0, 440, 0, 0, 0, 0))
+        natto = (8, 5, 6, 90, 1.5, 60.0, 40.0, 0.0)
+        fallback = {"納豆": natto}.get
+        assert cache.assemble("白米と納豆", fallback=fallback)[3] == 340
+
+    def test_inconsistent_breakdown_not_stored(self):
+        cache = IngredientCache()
+        assert cache.store_items(self.ITEMS, (27, 0, 0, 900, 0, 0, 0, 0)) == 0
+        assert len(cache) == 0
@@ -0,0 +1,123 @@
+"""
+bulk_import.py のユニットテスト
+
+解析（Gemini）と保存（Supabase）は関数で差し替える。
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from unittest.mock import MagicMock
+
+from bulk_import import parse_bulk_meals, run_bulk_import, import_meals
+
+TODAY = date(2026, 3, 10)
+RESULT = (20, 15, 60, 500, 1.0, 50.0, 100.0, 1.0)
+
+
+class TestParseBulkMeals:
+    def test_dates_and_meal_types(self):
+        items, errors = parse_bulk_meals("3/1 朝 トースト / 昼 ラーメン / 夜 カレー\n3/2 おやつ：プリン", today=TODAY)
+        assert [(i["meal_date"], i["meal_type"], i["text"]) for i in items] == [
+            (date(2026, 3, 1), "朝食", "トースト"),
+            (date(2026, 3, 1), "昼食", "ラーメン"),
+            (date(2026, 3, 1), "夕食", "カレー"),
+            (date(2026, 3, 2), "間食", "プリン"),
+        ]
+        assert errors == []
+
+    def test_date_formats_and_year_inference(self):
+        items, _ = parse_bulk_meals("2025/12/31 夜食 カップ麺\n12月30日(火)\n朝食 おにぎり\n3/9 朝 パン", today=TODAY)
+        assert [i["meal_date"] for i in items] == [date(2025, 12, 31), date(2025, 12, 30), date(2026, 3, 9)]
+
+    def test_fractions_and_words_are_not_separators(self):
+        """「1/2個」や「朝霧」のように区切りの後に空白がないものは食事内容の一部として扱うこと"""
+        items, _ = parse_bulk_meals("3/1 昼 ピザ 1/2枚と朝霧ヨーグルト", today=TODAY)
+        assert [i["text"] for i in items] == ["ピザ 1/2枚と朝霧ヨーグルト"]
+
+    def test_unknown_parts_are_errors(self):
+        items, errors = parse_bulk_meals("メモ\n2/30 朝 パン\n3/1 朝 ごはん", today=TODAY)
+        assert [i["text"] for i in items] == ["ごはん"]
+        assert errors == ["メモ", "2/30", "パン"]
+
+    def test_fullwidth_input(self):
+        items, _ = parse_bulk_meals("３／１　朝　トースト", today=TODAY)
+        assert items[0]["meal_date"] == date(2026, 3, 1)
+        assert items[0]["text"] == "トースト"
+
+
+def _items(n):
+    return [{"index": i, "meal_date": TODAY, "meal_type": "昼食", "text": f"食事{i}"} for i in range(n)]
+
+
+class TestRunBulkImport:
+    def test_bounded_concurrency_and_chunked_saves(self):
+        lock = threading.Lock()
+        running = {"now": 0, "max": 0}
+
+        def analyze(texts):
+            with lock:
+                running["now"] += 1
+                running["max"] = max(running["max"], running["now"])
+            time.sleep(0.01)
+            with lock:
+                running["now"] -= 1
+            return [RESULT] * len(texts)
+
+        chunks = []
+        progress = []
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            report = run_bulk_import(
+                _items(23), analyze, lambda rows: chunks.append(len(rows)) or len(rows),
+                batch_size=3, max_concurrency=2, insert_chunk=10,
+                on_progress=lambda r: progress.append(r["analyzed"]), executor=executor,
+            )
+
+        assert running["max"] <= 2
+        assert report["batches"] == 8
+        assert report["analyzed"] == report["saved"] == 23
+        assert chunks == [10, 10, 3]
+        assert progress[-1] == 23
+        assert report["items_per_min"] > 0
+
+    def test_failed_items_are_reported(self):
+        def analyze(texts):
+            if "食事0" in texts:
+                raise RuntimeError("rate limited")
+            return [None if t == "食事4" else RESULT for t in texts]
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            report = run_bulk_import(_items(6), analyze, len, batch_size=2, executor=executor)
+
+        assert sorted(i["text"] for i in report["failed"]) == ["食事0", "食事1", "食事4"]
+        assert report["saved"] == 3
+
+    def test_default_executor_is_not_shared_pool(self):
+        """取り込みの解析は共有スレッドプール（pfc-bg）ではなく取り込み専用のプールで動く"""
+        threads = set()
+
+        def analyze(texts):
+            threads.add(threading.current_thread().name)
+            return [RESULT] * len(texts)
+
+        report = run_bulk_import(_items(12), analyze, len, batch_size=2)
+        assert report["saved"] == 12
+        assert threads and all(name.startswith("pfc-bulk") for name in threads)
+
+
+class TestImportMeals:
+    def test_rows_saved_with_bulk_idempotency_keys(self, mocker):
+        mocker.patch("bulk_import.analyze_meals_batch", side_effect=lambda texts, model: [RESULT] * len(texts))
+        supabase = MagicMock()
+        supabase.table.return_value.upsert.return_value.execute.side_effect = (
+            lambda: MagicMock(data=supabase.table.return_value.upsert.call_args.args[0])
+        )
+        items, _ = parse_bulk_meals("3/1 朝 トースト / 間食 コーヒー / 間食 コーヒー", today=TODAY)
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            report = import_meals(supabase, "u1", items, "gemini-flash", "n1", executor=executor)
+
+        assert report["saved"] == 3
+        rows = supabase.table.return_value.upsert.call_args.args[0]
+        assert [r["meal_type"] for r in rows] == ["朝食", "間食", "間食"]
+        assert len({r["idempotency_key"] for r in rows}) == 3  # 同じ食事が2回あっても別の行として残す
@@ -2,10 +2,21 @@
 charts.py のユニットテスト
 
 create_summary_chart は plotly のみに依存する純粋関数なのでモック不要。
+SVG 版は xml.etree で読めること（整形式）と要素の数を確認する。
 """
+import json
+import statistics
+import time
+import xml.etree.ElementTree as ET
+
+import pandas as pd
 import pytest
 import plotly.graph_objects as go
-from charts import create_summary_chart
+import streamlit as st
+from charts import (
+    RED, FigureCache, _nice_ticks, chart_renderer, create_summary_chart, create_stacked_trend_svg, create_summary_svg,
+    create_trend_svg, figure_cache, input_hash,
+)
 
 
 # 標準的なテスト用データ
@@ -102,3 +113,196 @@ class TestCreateSummaryChart:
         }
         fig = create_summary_chart(none_current_data)
         assert isinstance(fig, go.Figure)
+
+
+class TestCreateTraceWaterfall:
+    """create_trace_waterfall: デバッグパネルのウォーターフォール"""
+
+    def test_bars_start_at_span_offsets(self):
+        from charts import create_trace_waterfall
+        spans = [
+            {"name": "page.食事記録", "start_ms": 0.0, "duration_ms": 120.0, "depth": 0, "attrs": None},
+            {"name": "supabase.meal_logs.select", "start_ms": 10.0, "duration_ms": 80.0, "depth": 1, "attrs": None},
+        ]
+        fig = create_trace_waterfall(spans)
+        assert list(fig.data[0].base) == [0.0, 10.0]
+        assert list(fig.data[0].x) == [120.0, 80.0]
+        assert fig.layout.yaxis.ticktext[1].endswith("supabase.meal_logs.select")
+
+
+class TestFigureMemoization:
+    """memoize_figure: 入力のハッシュによるグラフのメモ化"""
+
+    def test_same_input_reuses_figure_and_payload(self):
+        fig = create_summary_chart(SAMPLE_DATA)
+        again = create_summary_chart({k: dict(v) for k, v in SAMPLE_DATA.items()})
+        assert again is fig
+        # st.plotly_chart が呼ぶ to_dict() と JSON も作り直さない
+        assert fig.to_dict() is fig.to_dict()
+        assert fig.to_json() is fig.to_json()
+        assert json.loads(fig.to_json())["layout"]["height"] == 230
+
+    def test_changed_value_rebuilds(self):
+        fig = create_summary_chart(SAMPLE_DATA)
+        changed = {**SAMPLE_DATA, "P": {"current": 81, "target": 100, "unit": "g"}}
+        assert create_summary_chart(changed) is not fig
+
+    def test_dataframe_hash_follows_values(self):
+        df = pd.DataFrame({"label": ["3/1", "3/2"], "calorie": [1800, 2100]})
+        assert input_hash(df, 2000) == input_hash(df.copy(), 2000)
+        assert input_hash(df, 2000) != input_hash(df, 2100)
+        df2 = df.copy()
+        df2.loc[1, "calorie"] = 2101
+        assert input_hash(df, 2000) != input_hash(df2, 2000)
+
+    def test_lru_keeps_recent(self):
+        cache = FigureCache(maxsize=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        assert (cache.get("a"), cache.get("b"), cache.get("c")) == (1, None, 3)
+
+    @pytest.mark.benchmark
+    def test_benchmark_cold_vs_warm(self):
+        """同じ入力のリラン（warm）は、組み立て＋シリアライズ（cold）より桁違いに速い"""
+        def render():
+            return create_summary_chart(SAMPLE_DATA).to_json()
+
+        cold = []
+        for _ in range(5):
+            figure_cache.clear()
+            started = time.perf_counter()
+            render()
+            cold.append(time.perf_counter() - started)
+        warm = []
+        for _ in range(50):
+            started = time.perf_counter()
+            render()
+            warm.append(time.perf_counter() - started)
+
+        cold_ms, warm_ms = statistics.median(cold) * 1000, statistics.median(warm) * 1000
+        print(f"\ncreate_summary_chart: cold {cold_ms:.2f}ms / warm {warm_ms:.3f}ms")
+        assert warm_ms * 10 < cold_ms
+
+
+SVG_NS = "{http://www.w3.org/2000/svg}"
+
+
+class TestCreateSummarySvg:
+    """create_summary_svg: 達成率グラフの SVG 版"""
+
+    def test_well_formed_with_one_row_per_label(self):
+        root = ET.fromstring(create_summary_svg(SAMPLE_DATA))
+        assert root.get("width") == "100%"
+        assert len(root.findall(f"{SVG_NS}circle")) == 4
+        labels = [t.text for t in root.findall(f"{SVG_NS}text")][::2]
+        assert labels == ["Cal", "P", "F", "C"]
+
+    def test_over_target_adds_excess_bar_and_marker(self):
+        over = {**SAMPLE_DATA, "P": {"current": 150, "target": 100, "unit": "g"}}
+        root = ET.fromstring(create_summary_svg(over))
+        assert [r.get("fill") for r in root.findall(f"{SVG_NS}rect")].count(RED) == 1
+        assert len(root.findall(f"{SVG_NS}line")) == 1
+        assert "(150%)" in create_summary_svg(over)
+
+    def test_none_and_zero_targets(self):
+        data = {"Cal": {"current": None, "target": None, "unit": "kcal"}, "P": {"current": 10, "target": 0, "unit": "g"}}
+        ET.fromstring(create_summary_svg(data))
+
+    def test_escapes_text_and_memoizes(self):
+        svg = create_summary_svg({"<P>": {"current": 1, "target": 2, "unit": "g&"}})
+        assert "&lt;P&gt;" in svg and "g&amp;" in svg
+        assert create_summary_svg({"<P>": {"current": 1, "target": 2, "unit": "g&"}}) is svg
+
+    @pytest.mark.benchmark
+    def test_smaller_than_plotly_payload_and_faster(self):
+        started = time.perf_counter()
+        svg = create_summary_svg(SAMPLE_DATA)
+        svg_ms = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        payload = create_summary_chart(SAMPLE_DATA).to_json()
+        plotly_ms = (time.perf_counter() - started) * 1000
+        print(f"\nsummary: svg {len(svg)}B {svg_ms:.2f}ms / plotly json {len(payload)}B {plotly_ms:.2f}ms（+ Plotly.js）")
+        assert svg_ms < plotly_ms
+
+
+class TestCreateTrendSvg:
+    """create_trend_svg: ダッシュボードの推移グラフの SVG 版"""
+
+    LABELS = [f"3/{d}" for d in range(1, 15)]
+
+    def test_bars_line_target_and_legend(self):
+        values = [0 if d % 4 == 0 else 1800 + d for d in range(14)]
+        line = [float("nan")] + [1850.0] * 13
+        svg = create_trend_svg(self.LABELS, values, "rgba(0,172,193,0.45)", 200, bar_name="カロリー",
+                               line=line, line_name="移動平均(3日)", target=2000, target_text="目標 2000kcal",
+                               show_legend=True)
+        root = ET.fromstring(svg)
+        plot = root.find(f"{SVG_NS}svg")
+        bars = [r for r in plot.findall(f"{SVG_NS}rect") if r.get("width") == "0.8"]
+        assert len(bars) == sum(1 for v in values if v)
+        # NaN の日を飛ばして線をつなぐ
+        assert len(plot.find(f"{SVG_NS}polyline").get("points").split()) == 13
+        texts = "".join(root.itertext())
+        assert "目標 2000kcal" in texts and "移動平均(3日)" in texts
+        # 横軸のラベルは8個程度に間引く
+        assert sum(1 for t in root.findall(f"{SVG_NS}text") if t.text in self.LABELS) == 7
+
+    def test_average_line_without_target(self):
+        svg = create_trend_svg(self.LABELS[:7], [50] * 7, "rgba(85,85,85,0.35)", 180, avg=50, avg_text="平均 50g")
+        root = ET.fromstring(svg)
+        assert "平均 50g" in "".join(root.itertext())
+        assert len(root.find(f"{SVG_NS}svg").findall(f"{SVG_NS}polyline")) == 0
+
+    def test_empty_period(self):
+        ET.fromstring(create_trend_svg(self.LABELS[:7], [0] * 7, "rgba(0,172,193,0.45)", 180))
+
+    @pytest.mark.parametrize("vmax, top", [(0, 1), (95, 100), (2100, 2500), (7.5, 8)])
+    def test_nice_ticks(self, vmax, top):
+        ticks = _nice_ticks(vmax)
+        assert ticks[0] == 0 and ticks[-1] == top
+
+
+class TestCreateStackedTrendSvg:
+    """create_stacked_trend_svg: ダッシュボードの4段まとめた推移グラフ"""
+
+    LABELS = [f"3/{d}" for d in range(1, 15)]
+
+    def _panels(self):
+        return [
+            {"values": [80 + d for d in range(14)], "bar_color": "rgba(0,172,193,0.45)", "title": "タンパク質 (P)",
+             "line": [80.0] * 14, "line_name": "移動平均(3日)", "show_legend": True},
+            {"values": [50] * 14, "bar_color": "rgba(255,82,82,0.45)", "title": "脂質 (F)",
+             "target": 60, "target_text": "目標 60g"},
+            {"values": [0] * 14, "bar_color": "rgba(0,172,193,0.45)", "title": "カロリー (kcal)"},
+        ]
+
+    def test_one_plot_and_title_per_panel(self):
+        root = ET.fromstring(create_stacked_trend_svg(self.LABELS, self._panels(), panel_height=150))
+        assert root.get("height") == str(3 * 150 + 20)
+        assert len(root.findall(f"{SVG_NS}svg")) == 3
+        texts = [t.text for t in root.findall(f"{SVG_NS}text")]
+        for title in ("タンパク質 (P)", "脂質 (F)", "カロリー (kcal)", "目標 60g"):
+            assert texts.count(title) == 1
+        assert "".join(root.itertext()).count("移動平均(3日)") == 1
+
+    def test_date_labels_only_once(self):
+        """横軸は共通なので、日付のラベルは一番下の段にだけ付ける"""
+        root = ET.fromstring(create_stacked_trend_svg(self.LABELS, self._panels()))
+        assert sum(1 for t in root.findall(f"{SVG_NS}text") if t.text in self.LABELS) == 7
+
+    def test_does_not_consume_panels(self):
+        panels = self._panels()
+        create_stacked_trend_svg(self.LABELS, panels)
+        assert panels == self._panels()
+
+
+class TestChartRenderer:
+    def test_default_svg_and_plotly_option(self, monkeypatch):
+        monkeypatch.setattr(st, "secrets", {})
+        assert chart_renderer() == "svg"
+        monkeypatch.setattr(st, "secrets", {"charts": {"renderer": "plotly"}})
+        assert chart_renderer() == "plotly"
+        monkeypatch.setattr(st, "secrets", {"charts": {"renderer": "canvas"}})
+        assert chart_renderer() == "svg"
@@ -0,0 +1,169 @@
+"""
+db_calls.py のユニットテスト
+
+クエリは execute() の side_effect で失敗を再現し、待ち時間は pause を差し替えて記録する（実際には待たない）。
+"""
+from datetime import date
+from unittest.mock import MagicMock
+
+import httpx
+import pytest
+from postgrest import SyncPostgrestClient
+from postgrest.exceptions import APIError
+
+import db_calls
+import gemini_usage
+import metrics
+from db_calls import backoff_delay, classify_error, execute_query
+from deadlines import DB_TIMEOUT, MIN_TIMEOUT, DeadlineExceeded, clear_deadline, start_deadline
+from gemini_usage import _save_usage_row as save_usage_row  # conftest が差し替える前の関数
+from services import get_meal_logs_range, save_meal_log
+
+
+def _api_error(code):
+    return APIError({"message": "error", "code": code})
+
+
+@pytest.fixture(autouse=True)
+def pauses(monkeypatch):
+    waited = []
+    monkeypatch.setattr(db_calls, "pause", waited.append)
+    metrics.registry.clear()
+    yield waited
+    clear_deadline()
+
+
+def _query(*results):
+    query = MagicMock()
+    query.execute.side_effect = list(results)
+    return query
+
+
+class TestClassifyError:
+    """classify_error: 再試行するエラーの見分け"""
+
+    @pytest.mark.parametrize("exc, kind", [
+        (httpx.ReadTimeout("slow"), "timeout"),
+        (httpx.ConnectError("refused"), "connection"),
+        (httpx.RemoteProtocolError("closed"), "connection"),
+        (_api_error("429"), "rate_limited"),
+        (_api_error("503"), "server"),
+        (_api_error("40001"), "server"),
+        (_api_error("23505"), "conflict"),
+        (_api_error("PGRST116"), "client"),
+        (_api_error("400"), "client"),
+        (ValueError("bad"), "unknown"),
+    ])
+    def test_kinds(self, exc, kind):
+        assert classify_error(exc) == kind
+
+
+class TestExecuteQuery:
+    """execute_query: 再試行・予算・メトリクス"""
+
+    def test_read_retries_transient_errors(self, pauses):
+        query = _query(httpx.ReadTimeout("slow"), _api_error("503"), "ok")
+        assert execute_query(query, "read") == "ok"
+        assert query.execute.call_count == 3
+        assert len(pauses) == 2
+        assert metrics.db_retries.value(function="read", kind="timeout") == 1
+        assert metrics.db_retries.value(function="read", kind="server") == 1
+
+    def test_gives_up_after_max_attempts(self, pauses):
+        query = _query(*[httpx.ConnectError("refused")] * db_calls.MAX_ATTEMPTS)
+        with pytest.raises(httpx.ConnectError):
+            execute_query(query, "read")
+        assert query.execute.call_count == db_calls.MAX_ATTEMPTS
+        assert metrics.db_failures.value(function="read", kind="connection") == 1
+
+    def test_non_idempotent_write_is_not_retried(self, pauses):
+        query = _query(httpx.ReadTimeout("slow"), "ok")
+        with pytest.raises(httpx.ReadTimeout):
+            execute_query(query, "write", idempotent=False)
+        assert query.execute.call_count == 1
+        assert pauses == []
+
+    def test_client_error_is_not_retried(self):
+        query = _query(_api_error("23505"), "ok")
+        with pytest.raises(APIError):
+            execute_query(query, "read")
+        assert query.execute.call_count == 1
+        assert metrics.db_failures.value(function="read", kind="conflict") == 1
+
+    def test_stops_when_rerun_budget_is_spent(self, monkeypatch):
+        monkeypatch.setattr(db_calls, "backoff_delay", lambda attempt: db_calls.BASE_DELAY)
+        start_deadline(MIN_TIMEOUT + db_calls.BASE_DELAY / 2)  # 待ってから呼び直すと予算が MIN_TIMEOUT を切る
+        query = _query(httpx.ReadTimeout("slow"), "ok")
+        with pytest.raises(httpx.ReadTimeout):
+            execute_query(query, "read")
+        assert query.execute.call_count == 1
+
+    def test_spent_budget_skips_the_call(self):
+        start_deadline(MIN_TIMEOUT / 2)
+        query = _query("ok")
+        with pytest.raises(DeadlineExceeded):
+            execute_query(query, "read")
+        assert query.execute.call_count == 0
+
+    def test_each_request_gets_a_timeout_from_the_budget(self):
+        """送信ごとに DB_TIMEOUT と残りの予算の短いほうを httpx のタイムアウトとして付ける（クライアントは共有のまま）"""
+        timeouts = []
+
+        def handler(request):
+            timeouts.append(request.extensions["timeout"]["read"])
+            if len(timeouts) == 1:
+                raise httpx.ReadTimeout("slow", request=request)
+            return httpx.Response(200, json=[{"id": 1}])
+
+        http_client = httpx.Client(transport=httpx.MockTransport(handler), timeout=DB_TIMEOUT)
+        client = SyncPostgrestClient("http://db.test", http_client=http_client)
+        assert execute_query(client.table("meal_logs").select("*"), "read").data == [{"id": 1}]
+        assert timeouts == [DB_TIMEOUT, DB_TIMEOUT]
+
+        start_deadline(3.0)
+        timeouts.clear()
+        execute_query(client.table("meal_logs").select("*"), "read")
+        assert len(timeouts) == 2 and all(MIN_TIMEOUT < t <= 3.0 for t in timeouts)
+        assert timeouts[1] <= timeouts[0]
+        assert http_client.timeout.read == DB_TIMEOUT
+
+    def test_backoff_grows_with_jitter(self):
+        for attempt in range(6):
+            assert 0 <= backoff_delay(attempt) <= min(db_calls.MAX_DELAY, db_calls.BASE_DELAY * 2 ** attempt)
+
+
+class TestServicesUseWrapper:
+    """services.py の DB 操作は execute_query() を通る"""
+
+    def _supabase(self, *results):
+        supabase = MagicMock()
+        table = supabase.table.return_value
+        for builder in (table.select.return_value, table.upsert.return_value, table.insert.return_value):
+            builder.eq.return_value = builder
+            builder.gte.return_value = builder
+            builder.lte.return_value = builder
+            builder.execute.side_effect = list(results)
+        return supabase
+
+    def test_range_read_retries(self):
+        supabase = self._supabase(httpx.ReadTimeout("slow"), MagicMock(data=[{"id": 1}]))
+        assert get_meal_logs_range(supabase, "u", "2026-03-01", "2026-03-01") == [{"id": 1}]
+
+    def test_write_with_idempotency_key_retries(self):
+        supabase = self._supabase(httpx.ReadTimeout("slow"), MagicMock(data=[{"id": 1}]))
+        row = save_meal_log(supabase, "u", date(2026, 3, 1), "昼食", "ご飯", 1, 2, 3, 4, idempotency_key="k")
+        assert row == {"id": 1}
+
+    def test_write_without_key_is_not_retried(self):
+        supabase = self._supabase(httpx.ReadTimeout("slow"), MagicMock(data=[{"id": 1}]))
+        with pytest.raises(httpx.ReadTimeout):
+            save_meal_log(supabase, "u", date(2026, 3, 1), "昼食", "ご飯", 1, 2, 3, 4)
+        assert supabase.table.return_value.insert.return_value.execute.call_count == 1
+
+    def test_usage_row_is_not_retried(self, monkeypatch):
+        """Gemini の利用台帳の記録もキーのない挿入なので、タイムアウトでも再試行しない"""
+        supabase = self._supabase(httpx.ReadTimeout("slow"), MagicMock(data=[{"id": 1}]))
+        monkeypatch.setattr(gemini_usage, "init_supabase", lambda: supabase)
+        save_usage_row({"model": "gemini-3-flash"})  # 失敗はログに残すだけ
+        assert supabase.table.return_value.insert.return_value.execute.call_count == 1
+        assert metrics.db_failures.value(function="save_gemini_usage", kind="timeout") == 1
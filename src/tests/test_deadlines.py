@@ -0,0 +1,168 @@
+"""
+deadlines.py のユニットテスト
+
+Streamlit の中断は yield_check を差し替えて再現する（スクリプトの外では yield_check は何もしない）。
+"""
+import threading
+import time
+from concurrent.futures import Future
+from unittest.mock import MagicMock
+
+import httpx
+import pytest
+
+import deadlines
+from db_calls import execute_query
+from deadlines import (
+    DeadlineExceeded, checkpoint, clear_deadline, current_deadline, is_timeout, pause, start_deadline, timeout_for,
+    wait_for, without_deadline,
+)
+from gemini_usage import UsageLedger, generate_content
+from services import SpeculativeAnalysis
+from tracing import instrument_supabase
+
+
+class _Rerun(BaseException):
+    """Streamlit の RerunException の代わり（Exception ではないので except Exception では捕まらない）"""
+
+
+@pytest.fixture(autouse=True)
+def _clear():
+    yield
+    clear_deadline()
+
+
+@pytest.fixture
+def fast_poll(monkeypatch):
+    monkeypatch.setattr(deadlines, "POLL_INTERVAL", 0.01)
+
+
+class TestDeadline:
+    """start_deadline / checkpoint / timeout_for: 予算の確認"""
+
+    def test_no_deadline_uses_limit(self):
+        checkpoint()
+        assert timeout_for(30.0) == 30.0
+
+    def test_timeout_is_capped_by_remaining_budget(self):
+        start_deadline(5.0)
+        assert 4.0 < timeout_for(30.0) <= 5.0
+        assert timeout_for(2.0) == 2.0
+
+    def test_exhausted_budget_raises(self):
+        start_deadline(0.0)
+        with pytest.raises(DeadlineExceeded):
+            checkpoint()
+        with pytest.raises(TimeoutError):
+            timeout_for(30.0)
+
+    def test_other_threads_are_not_limited(self):
+        """共有スレッドプールの処理にはリランの予算を適用しない"""
+        start_deadline(0.0)
+        seen = []
+        thread = threading.Thread(target=lambda: seen.append((current_deadline(), timeout_for(30.0))))
+        thread.start()
+        thread.join()
+        assert seen == [(None, 30.0)]
+
+    def test_without_deadline(self):
+        start_deadline(0.0)
+        with without_deadline():
+            checkpoint()
+        with pytest.raises(DeadlineExceeded):
+            checkpoint()
+
+    def test_rerun_request_interrupts(self):
+        deadline = start_deadline(10.0)
+        deadline.yield_check = MagicMock(side_effect=_Rerun())
+        with pytest.raises(_Rerun):
+            checkpoint()
+
+
+class TestWaitFor:
+    """wait_for: 予算と中断を確かめながら Future を待つ"""
+
+    def test_returns_result(self, fast_poll):
+        start_deadline(5.0)
+        future = Future()
+        threading.Timer(0.05, future.set_result, ("ok",)).start()
+        assert wait_for(future) == "ok"
+
+    def test_deadline_keeps_future(self, fast_poll):
+        start_deadline(0.1)
+        future = Future()
+        started = time.monotonic()
+        with pytest.raises(DeadlineExceeded):
+            wait_for(future)
+        assert time.monotonic() - started < 1.0
+        assert not future.cancelled()
+
+    def test_rerun_cancels_future(self, fast_poll):
+        deadline = start_deadline(10.0)
+        deadline.yield_check = MagicMock(side_effect=_Rerun())
+        future = Future()
+        with pytest.raises(_Rerun):
+            wait_for(future)
+        assert future.cancelled()
+
+    def test_limit_without_deadline(self, fast_poll):
+        with pytest.raises(DeadlineExceeded):
+            wait_for(Future(), limit=0.05)
+
+    def test_pause_is_interrupted_by_rerun(self, fast_poll):
+        deadline = start_deadline(10.0)
+        deadline.yield_check = MagicMock(side_effect=[None, None, _Rerun()])
+        started = time.monotonic()
+        with pytest.raises(_Rerun):
+            pause(5.0)
+        assert time.monotonic() - started < 1.0
+
+
+class TestIsTimeout:
+    def test_classifies_timeouts(self):
+        assert is_timeout(DeadlineExceeded())
+        assert is_timeout(httpx.ReadTimeout("slow"))
+        assert not is_timeout(RuntimeError("500"))
+
+
+class TestWiring:
+    """Gemini / Supabase / 先行解析の呼び出しが予算に従うこと"""
+
+    def test_gemini_timeout_follows_remaining_budget(self):
+        client = MagicMock()
+        client.models.generate_content.return_value = MagicMock(usage_metadata=None)
+        start_deadline(5.0)
+        generate_content(client, "gemini-3-flash", "prompt", "analyze_meal",
+                         ledger=UsageLedger(), save_row=lambda row: None)
+        timeout = client.models.generate_content.call_args.kwargs["config"].http_options.timeout
+        assert 4000 < timeout <= 5000
+
+    def test_gemini_not_called_when_budget_is_spent(self):
+        client = MagicMock()
+        start_deadline(0.0)
+        with pytest.raises(DeadlineExceeded):
+            generate_content(client, "gemini-3-flash", "prompt", "analyze_meal",
+                             ledger=UsageLedger(), save_row=lambda row: None)
+        client.models.generate_content.assert_not_called()
+
+    def test_query_not_executed_when_budget_is_spent(self):
+        raw = MagicMock()
+        supabase = instrument_supabase(raw)
+        start_deadline(0.0)
+        with pytest.raises(DeadlineExceeded):
+            execute_query(supabase.table("meal_logs").select("*").eq("user_id", "u"), "read")
+        raw.table.return_value.select.return_value.eq.return_value.execute.assert_not_called()
+
+    def test_speculation_kept_after_deadline(self, fast_poll):
+        """予算切れで待つのをやめても解析は残り、同じテキストで記録し直すと結果を使う"""
+        speculation = SpeculativeAnalysis()
+        future = Future()
+        speculation.key, speculation.future = ("ご飯", "m"), future
+        start_deadline(0.05)
+        with pytest.raises(DeadlineExceeded):
+            speculation.take("ご飯", "m")
+        assert speculation.future is future
+
+        future.set_result((1, 2, 3, 4, None, None, None, None))
+        start_deadline(5.0)
+        assert speculation.take("ご飯", "m") == (1, 2, 3, 4, None, None, None, None)
@@ -0,0 +1,180 @@
+"""
+food_db.py のユニットテスト
+
+同梱の成分表（data/food_composition/）と、tmp_path に生成した合成データで検証する。
+"""
+import math
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from food_db import open_food_table, build_food_table, mext_records, MEXT_ID_ROW, NUTRIENT_COLUMNS
+
+
+CATEGORIES = [
+    {"title": "主食", "sort": "kcal", "highlight": False, "featured": True},
+    {"title": "メイン", "sort": "p", "highlight": True, "featured": True},
+]
+
+
+def _record(name, category, portion_g, kcal, p, f, c, **micro):
+    row = {"name": name, "icon": "", "category": category, "portion": f"{portion_g}g",
+           "portion_g": portion_g, "kcal": kcal, "p": p, "f": f, "c": c}
+    row.update(micro)
+    return row
+
+
+@pytest.fixture
+def small_table(tmp_path):
+    build_food_table([
+        _record("白米", "主食", 150, 168, 2.5, 0.3, 37.1, iron_mg=0.1),
+        _record("うどん", "主食", 200, 105, 2.6, 0.3, 22.4),
+        _record("鶏むね肉", "メイン", 100, 116, 23.0, 1.9, 0.1),
+        _record("豚ロース", "メイン", 100, 263, 19.3, 19.2, 0.1),
+        _record("ひじき", "海藻類", 10, 180, 9.2, 3.2, 58.4),
+    ], CATEGORIES, tmp_path)
+    return open_food_table(tmp_path)
+
+
+class TestFoodTable:
+    """FoodTable: 列の読み込みと参照 API を検証"""
+
+    def test_columns_are_memory_mapped(self, small_table):
+        """数値列・文字列列がメモリマップとして開かれていること"""
+        assert isinstance(small_table["kcal"], np.memmap)
+        assert isinstance(small_table["name"], np.memmap)
+        assert len(small_table) == 5
+
+    def test_unknown_category_is_appended(self, small_table):
+        """records にだけ現れるカテゴリは末尾に（おすすめ表示なしで）追加されること"""
+        assert small_table.categories[2] == {"title": "海藻類", "sort": "kcal", "highlight": False, "featured": False}
+
+    def test_category_sort(self, small_table):
+        """主食は1食分のカロリー昇順、メインはP降順で並ぶこと"""
+        staple = [str(small_table["name"][i]) for i in small_table.category_indices(0)]
+        main = [str(small_table["name"][i]) for i in small_table.category_indices(1)]
+        assert staple == ["うどん", "白米"]  # 200g で 210kcal < 150g で 252kcal
+        assert main == ["鶏むね肉", "豚ロース"]
+
+    def test_find_exact_name(self, small_table):
+        """食品名の完全一致で行番号が返ること"""
+        assert small_table.find("鶏むね肉") == 2
+        assert small_table.find("鶏むね") is None
+
+    def test_search_substring(self, small_table):
+        """部分一致で検索できること"""
+        assert [str(small_table["name"][i]) for i in small_table.search("豚")] == ["豚ロース"]
+        assert len(small_table.search("")) == 0
+
+    def test_nutrients_scaled_to_portion(self, small_table):
+        """既定では1食分（目安量）あたりに換算されること"""
+        n = small_table.nutrients(0)
+        assert n["kcal"] == pytest.approx(252, abs=0.01)
+        assert n["iron_mg"] == pytest.approx(0.15, abs=0.001)
+
+    def test_nutrients_custom_grams(self, small_table):
+        """グラム数を指定すると、その量あたりに換算されること"""
+        assert small_table.nutrients(2, grams=50)["p"] == pytest.approx(11.5, abs=0.01)
+
+    def test_missing_nutrient_is_none(self, small_table):
+        """未収載（空欄）の栄養素は None になること"""
+        assert small_table.nutrients(1)["folate_ug"] is None
+
+
+class TestBundledTable:
+    """同梱の成分表が読み込めることを検証"""
+
+    def test_bundled_table_has_featured_categories(self):
+        table = open_food_table()
+        featured = [c["title"] for c in table.categories if c.get("featured")]
+        assert "🍚 主食" in featured
+        assert table.find("白米") is not None
+        assert table.label(table.find("鶏むね肉（皮なし）")) == "🍗 鶏むね肉（皮なし）"
+
+
+    def test_bundled_foods_have_micronutrients(self):
+        """同梱の食品は鉄・葉酸・カルシウム・ビタミンDがすべて収載されていること"""
+        table = open_food_table()
+        for col in ("iron_mg", "folate_ug", "calcium_mg", "vitamin_d_ug"):
+            assert not np.isnan(table[col]).any(), col
+        assert table.nutrients(table.find("卵"), grams=100)["vitamin_d_ug"] == pytest.approx(3.8, abs=0.01)
+
+
+class TestMextConversion:
+    """mext_records: 日本食品標準成分表の「表全体」シートの変換"""
+
+    IDS = ["", "", "", "", "REFUSE", "ENERC_KCAL", "PROT-", "FAT-", "CHOCDF-", "CA", "FE", "VITD", "FOL"]
+
+    def _sheet(self, *rows):
+        header = [[f"見出し{r}"] + [""] * (len(self.IDS) - 1) for r in range(MEXT_ID_ROW)]
+        return pd.DataFrame(header + [self.IDS] + [list(r) for r in rows], dtype=str)
+
+    def test_converts_rows_by_identifier(self):
+        frame = self._sheet(
+            ["10", "10003", "1234", "＜魚類＞\u3000（あじ類）\u3000まあじ\u3000皮つき\u3000生",
+             "55", "112", "19.7", "4.5", "(0.1)", "66", "0.6", "8.9", "5"],
+            ["1", "01088", "100", "こめ\u3000［水稲めし］\u3000精白米\u3000うるち米",
+             "0", "156", "2.5", "0.3", "37.1", "3", "0.1", "-", "Tr"],
+            ["", "", "", "注: (　)は推定値", "", "", "", "", "", "", "", "", ""],
+        )
+        aji, rice = mext_records(frame)
+        assert aji["name"] == "（あじ類） まあじ 皮つき 生"
+        assert aji["category"] == "10 魚介類" and aji["portion_g"] == 100
+        assert (aji["kcal"], aji["p"], aji["c"], aji["calcium_mg"], aji["vitamin_d_ug"]) == (112, 19.7, 0.1, 66, 8.9)
+        assert rice["category"] == "01 穀類"
+        assert rice["folate_ug"] == 0.0       # Tr（微量）
+        assert rice["vitamin_d_ug"] == ""     # -（未測定）は空欄
+
+    def test_builds_searchable_table(self, tmp_path):
+        frame = self._sheet(
+            ["12", "12004", "1", "鶏卵\u3000全卵\u3000生", "14", "142", "12.2", "10.2", "0.4", "46", "1.5", "3.8", "49"],
+        )
+        build_food_table(mext_records(frame), CATEGORIES, tmp_path)
+        table = open_food_table(tmp_path)
+        idx = table.find("鶏卵 全卵 生")
+        assert table.nutrients(idx)["folate_ug"] == pytest.approx(49)
+        assert table.categories[int(table["category"][idx])] == {
+            "title": "12 卵類", "sort": "kcal", "highlight": False, "featured": False}
+
+    def test_missing_column_raises(self):
+        frame = self._sheet()
+        frame.iloc[MEXT_ID_ROW, self.IDS.index("FOL")] = "FOLAC"
+        with pytest.raises(ValueError, match="folate_ug"):
+            mext_records(frame)
+
+
+class TestFoodTableBenchmark:
+    """成分表全体（約2,500品目）規模での起動・検索コストを測る簡易ベンチマーク（処理時間は表示のみ）"""
+
+    N = 2500
+
+    @pytest.mark.benchmark
+    def test_open_and_query(self, tmp_path):
+        rng = np.random.default_rng(0)
+        records = []
+        for i in range(self.N):
+            row = _record(f"食品{i:04d}", CATEGORIES[i % 2]["title"], 100, *rng.uniform(0, 300, 4))
+            row.update({col: rng.uniform(0, 50) for col in NUTRIENT_COLUMNS[4:]})
+            records.append(row)
+        build_food_table(records, CATEGORIES, tmp_path)
+
+        start = time.perf_counter()
+        table = open_food_table(tmp_path)
+        open_ms = (time.perf_counter() - start) * 1000
+
+        table.names()  # 名前の一覧は初回の検索で1回だけ作る（起動時のコストとして測る）
+        build_ms = (time.perf_counter() - start) * 1000 - open_ms
+
+        start = time.perf_counter()
+        table.category_indices(1)
+        hits = table.search("食品12")
+        table.nutrients(table.find("食品2499"))
+        query_ms = (time.perf_counter() - start) * 1000
+
+        # 処理時間は環境で揺れるので、数値は表示するだけにして結果の正しさを検証する
+        print(f"\n成分表 {self.N}品目: 起動 {open_ms:.2f}ms・名前一覧 {build_ms:.2f}ms・検索 {query_ms:.2f}ms")
+        assert len(table) == self.N
+        assert hits.tolist() == list(range(1200, 1220))  # 表の並び順に limit 件で打ち切る
+        assert not math.isnan(table.nutrients(0)["vitamin_d_ug"])
@@ -0,0 +1,128 @@
+"""
+food_search.py のユニットテスト
+
+索引は合成した候補から直接構築する（成分表は同梱データを使用）。
+"""
+import time
+
+import pytest
+
+from food_db import open_food_table
+from food_search import (
+    normalize_food_text, FoodSearchIndex, search_suggestions,
+    food_table_entries, template_entries, history_entries, history_entry,
+)
+
+
+def _row(food_name, calories=300, p=20, f=10, c=30):
+    return {"food_name": food_name, "calories": calories, "p_val": p, "f_val": f, "c_val": c,
+            "iron_mg": None, "folate_ug": None, "calcium_mg": None, "vitamin_d_ug": None}
+
+
+class TestNormalizeFoodText:
+    """normalize_food_text: 表記ゆれの統一を検証"""
+
+    def test_katakana_and_halfwidth_become_hiragana(self):
+        assert normalize_food_text("ヨーグルト") == normalize_food_text("ﾖｰｸﾞﾙﾄ") == "よーぐると"
+
+    def test_kanji_variants_share_reading(self):
+        """玉子 / 卵 / たまご / タマゴ が同じキーになること"""
+        keys = {normalize_food_text(t) for t in ("玉子", "卵", "たまご", "タマゴ")}
+        assert keys == {"たまご"}
+
+    def test_longest_kanji_wins(self):
+        """牛乳 は 牛 + 乳 ではなく ぎゅうにゅう に置換されること"""
+        assert normalize_food_text("牛乳") == "ぎゅうにゅう"
+
+    def test_units_unified(self):
+        """単位のカタカナ表記は記号に揃えること"""
+        assert normalize_food_text("鶏胸肉100グラム") == normalize_food_text("鶏むね肉 100g") == "とりむねにく100g"
+
+    def test_spaces_and_brackets_removed(self):
+        assert normalize_food_text("鶏むね肉 （皮なし）") == "とりむねにく皮なし"
+
+
+class TestFoodSearchIndex:
+    """FoodSearchIndex / search_suggestions: 一致と順位付けを検証"""
+
+    def test_prefix_ranks_before_infix(self):
+        index = FoodSearchIndex(history_entries([_row("焼き鮭定食"), _row("鮭おにぎり")]))
+        names = [e["food_name"] for e in search_suggestions("さけ", index)]
+        assert names == ["鮭おにぎり", "焼き鮭定食"]
+
+    def test_kana_query_matches_kanji_name(self):
+        index = FoodSearchIndex(history_entries([_row("納豆ご飯")]))
+        assert [e["food_name"] for e in search_suggestions("なっとう", index)] == ["納豆ご飯"]
+
+    def test_no_match(self):
+        index = FoodSearchIndex(history_entries([_row("納豆ご飯")]))
+        assert search_suggestions("カレー", index) == []
+        assert search_suggestions("", index) == []
+
+    def test_template_found_by_name_and_food_name(self):
+        """テンプレートはテンプレート名でも食事名でも見つかること"""
+        tpl = {"id": "t1", "name": "いつもの朝", "food_name": "トーストとゆで卵", "p_val": 15, "f_val": 8, "c_val": 35, "calories": 280}
+        index = FoodSearchIndex(template_entries([tpl]))
+        assert search_suggestions("いつもの", index)[0]["calories"] == 280
+        assert search_suggestions("ゆで玉子", index)[0]["calories"] == 280
+
+    def test_sources_ranked_and_deduplicated(self):
+        """同じ食事名は テンプレート > 履歴 > 成分表 の順で1件だけ残ること"""
+        food = FoodSearchIndex(food_table_entries(open_food_table()))
+        picked = food.entries[0]
+        history = FoodSearchIndex([history_entry(_row(picked["food_name"], calories=999))])
+        results = search_suggestions(picked["names"][0], history, food)
+        assert results[0]["source"] == "history"
+        assert [r["food_name"] for r in results].count(picked["food_name"]) == 1
+
+    def test_history_counts_repeated_meals(self):
+        """履歴は食事名ごとにまとめ、記録回数の多いものが上位になること"""
+        rows = [_row("鶏むね肉サラダ", calories=350), _row("鶏むね肉ソテー"), _row("鶏むね肉サラダ", calories=320)]
+        entries = history_entries(rows)
+        assert len(entries) == 2
+        index = FoodSearchIndex(entries)
+        top = search_suggestions("とりむね", index)[0]
+        assert top["food_name"] == "鶏むね肉サラダ"
+        assert top["calories"] == 350  # 新しい順の先頭（最新の記録）の値
+
+    def test_add_updates_existing_entry(self):
+        """同じ食事名を追加すると、新しい栄養素で置き換えて回数を加算すること"""
+        index = FoodSearchIndex([history_entry(_row("プロテイン", calories=120))])
+        index.add(history_entry(_row("プロテイン", calories=110)))
+        assert len(index) == 1
+        assert index.entries[0]["calories"] == 110
+        assert index.entries[0]["count"] == 2
+
+    def test_food_entries_carry_portion_nutrients(self):
+        """成分表の候補は1食分の栄養素を持ち、そのまま記録できること"""
+        table = open_food_table()
+        entry = food_table_entries(table)[table.find("白米")]
+        assert entry["food_name"].startswith("白米 ")
+        assert entry["calories"] == pytest.approx(table.nutrients(table.find("白米"))["kcal"])
+
+
+@pytest.mark.benchmark
+class TestFoodSearchBenchmark:
+    """成分表全体（約2,500品目）+ 履歴500件規模で、1打鍵あたり 1ms 未満で候補を返すこと"""
+
+    def test_keystroke_latency_under_1ms(self):
+        kana = "あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわ"
+        k = len(kana)
+        names = [f"{kana[i % k]}{kana[i * 7 % k]}{kana[i * 13 % k]}食品{i}" for i in range(2500)]
+        foods = [
+            {"source": "food", "food_name": n, "label": "", "names": (n,), "count": 1, "calories": 100}
+            for n in names
+        ]
+        food_index = FoodSearchIndex(foods)
+        history = FoodSearchIndex(history_entries([_row(f"鶏むね肉とご飯{i}") for i in range(500)]))
+
+        queries = []
+        for word in ("とりむねにく", "かきくけ", "あい", "食品12", "ごはん3"):
+            queries.extend(word[:n] for n in range(1, len(word) + 1))
+
+        search_suggestions("とり", history, food_index)  # ウォームアップ
+        start = time.perf_counter()
+        for q in queries:
+            search_suggestions(q, history, food_index)
+        per_keystroke_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        assert per_keystroke_ms < 1.0
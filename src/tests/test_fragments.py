@@ -0,0 +1,47 @@
+"""
+fragments.py のユニットテスト
+
+AppTest はフラグメントだけのリランを再現しないので、is_fragment_run() を差し替えて切り替える。
+"""
+from streamlit.testing.v1 import AppTest
+
+import fragments
+from deadlines import TIMEOUT_NOTICE
+
+
+def _script():
+    import streamlit as st
+
+    from deadlines import DeadlineExceeded, current_deadline
+    from fragments import fragment
+    from gemini_usage import _current_user
+
+    st.session_state.setdefault("user", type("User", (), {"id": "user-f"})())
+
+    @fragment("summary")
+    def summary():
+        st.session_state["deadline"] = current_deadline() is not None
+        st.session_state["gemini_user"] = _current_user.get()
+        raise DeadlineExceeded("予算切れ")
+
+    summary()
+    st.session_state["deadline_after"] = current_deadline() is not None
+
+
+class TestFragment:
+    def test_fragment_run_sets_deadline_and_shows_timeout(self, monkeypatch):
+        """フラグメントだけのリランでは予算と利用者を設定し、タイムアウトはフラグメントの中で案内する"""
+        monkeypatch.setattr(fragments, "is_fragment_run", lambda: True)
+        at = AppTest.from_function(_script).run()
+        assert not at.exception
+        assert len(at.warning) == 1 and at.warning[0].value in TIMEOUT_NOTICE  # 先頭の絵文字はアイコンになる
+        assert at.session_state["deadline"] is True
+        assert at.session_state["gemini_user"] == "user-f"
+        assert at.session_state["deadline_after"] is False  # 終わったら外す
+
+    def test_full_run_leaves_timeout_to_app(self, monkeypatch):
+        """ページ全体のリランでは何もせず、タイムアウトは app.py に任せる"""
+        monkeypatch.setattr(fragments, "is_fragment_run", lambda: False)
+        at = AppTest.from_function(_script).run()
+        assert at.session_state["deadline"] is False
+        assert [e.value for e in at.exception] == ["予算切れ"]
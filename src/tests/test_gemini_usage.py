@@ -0,0 +1,255 @@
+"""
+gemini_usage.py のユニットテスト
+
+Gemini クライアントは MagicMock、台帳への書き込みはリストに集めて確認する。
+"""
+import os
+import time
+from datetime import date, datetime, timezone
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import pytest
+from streamlit.testing.v1 import AppTest
+
+import analysis_cache
+import config
+import gemini_usage
+import services
+from config import get_executor
+from gemini_usage import (
+    BudgetExceeded, UsageLedger, _current_user, generate_content, quota_day, set_current_user,
+)
+
+DAY = date(2026, 3, 1)
+
+
+def _response(prompt=100, output=50, text="{}"):
+    res = MagicMock(text=text)
+    res.usage_metadata.prompt_token_count = prompt
+    res.usage_metadata.candidates_token_count = output
+    return res
+
+
+def _rate_limited(quota="GenerateRequestsPerMinutePerProjectPerModel-FreeTier", retry_delay=None):
+    details = f"'quotaId': '{quota}'" + (f", 'retryDelay': '{retry_delay}'" if retry_delay else "")
+    err = RuntimeError(f"429 RESOURCE_EXHAUSTED. {{{details}}}")
+    err.code = 429
+    return err
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture(autouse=True)
+def _user():
+    token = _current_user.set("user-a")
+    yield
+    _current_user.reset(token)
+
+
+class TestQuotaDay:
+    """quota_day: 太平洋時間の日付（日本時間の17時で切り替わる）"""
+
+    def test_switches_at_17_jst(self):
+        # 2026-03-01 16:59 JST = 2026-02-28 23:59 PST
+        assert quota_day(datetime(2026, 3, 1, 7, 59, tzinfo=timezone.utc)) == date(2026, 2, 28)
+        # 2026-03-01 17:00 JST = 2026-03-01 00:00 PST
+        assert quota_day(datetime(2026, 3, 1, 8, 0, tzinfo=timezone.utc)) == date(2026, 3, 1)
+
+
+class TestUsageLedger:
+    """UsageLedger: 予算とモデルの選択"""
+
+    def test_requested_model_first_when_budget_is_ample(self):
+        ledger = UsageLedger(user_daily_tokens=1000, global_daily_tokens=10000, fallback_models=("lite", "flash"))
+        assert ledger.choose_models("pro", "user-a", DAY) == ["pro", "lite", "flash"]
+
+    def test_cheapest_first_when_remaining_is_low(self):
+        ledger = UsageLedger(user_daily_tokens=1000, global_daily_tokens=10000, low_ratio=0.2,
+                             fallback_models=("lite", "flash"))
+        ledger.record("user-a", 850, DAY)
+        assert ledger.choose_models("pro", "user-a", DAY) == ["lite", "flash", "pro"]
+        # ほかのユーザーは自分の予算が残っていれば影響を受けない
+        assert ledger.choose_models("pro", "user-b", DAY)[0] == "pro"
+
+    def test_global_budget_applies_to_everyone(self):
+        ledger = UsageLedger(user_daily_tokens=0, global_daily_tokens=1000, fallback_models=("lite",))
+        ledger.record("user-a", 1000, DAY)
+        with pytest.raises(BudgetExceeded):
+            ledger.choose_models("pro", "user-b", DAY)
+
+    def test_rate_limited_models_cool_down(self):
+        clock = Clock()
+        ledger = UsageLedger(fallback_models=("lite",), clock=clock)
+        ledger.cool_down("pro")
+        ledger.cool_down("lite", 10)
+        with pytest.raises(BudgetExceeded, match="1分ほど"):
+            ledger.choose_models("pro", "user-a", DAY)
+        assert ledger.report()["cooling"] == ["lite", "pro"]
+        clock.now += 10
+        assert ledger.choose_models("pro", "user-a", DAY) == ["lite"]
+        clock.now += 50
+        assert ledger.choose_models("pro", "user-a", DAY) == ["pro", "lite"]
+
+    def test_exhausted_models_skipped_until_next_day(self):
+        ledger = UsageLedger(fallback_models=("lite", "flash"))
+        ledger.mark_exhausted("pro", DAY)
+        ledger.mark_exhausted("lite", DAY)
+        assert ledger.choose_models("pro", "user-a", DAY) == ["flash"]
+        ledger.mark_exhausted("flash", DAY)
+        with pytest.raises(BudgetExceeded, match="17時"):
+            ledger.choose_models("pro", "user-a", DAY)
+        assert ledger.choose_models("pro", "user-a", date(2026, 3, 2))[0] == "pro"
+
+    def test_loads_recorded_usage_once_per_day(self):
+        load = MagicMock(return_value=[
+            {"user_id": "user-a", "prompt_tokens": 600, "output_tokens": 400},
+            {"user_id": "user-b", "prompt_tokens": 10, "output_tokens": None},
+        ])
+        ledger = UsageLedger(user_daily_tokens=1000, global_daily_tokens=0, load_day=load)
+        with pytest.raises(BudgetExceeded):
+            ledger.choose_models("pro", "user-a", DAY)
+        assert ledger.remaining_ratio("user-b", DAY) == pytest.approx(0.99)
+        load.assert_called_once_with(DAY)
+
+    def test_load_failure_starts_from_zero(self):
+        ledger = UsageLedger(user_daily_tokens=1000, load_day=MagicMock(side_effect=RuntimeError("no table")))
+        assert ledger.remaining_ratio("user-a", DAY) == 1.0
+
+
+class TestGenerateContent:
+    """generate_content: 予算の確認・切り替え・台帳への記録"""
+
+    def test_records_tokens_and_outcome(self):
+        client = MagicMock()
+        client.models.generate_content.return_value = _response(120, 30)
+        ledger, rows = UsageLedger(), []
+
+        res = generate_content(client, "gemini-3-flash", "prompt", "analyze_meal", ledger=ledger, save_row=rows.append)
+
+        assert res.text == "{}"
+        (row,) = rows
+        assert row["user_id"] == "user-a"
+        assert row["model"] == "gemini-3-flash"
+        assert row["purpose"] == "analyze_meal"
+        assert (row["prompt_tokens"], row["output_tokens"], row["outcome"]) == (120, 30, "ok")
+        assert row["latency_ms"] >= 0
+        assert ledger.report("user-a")["user_tokens"] == 150
+
+    def test_rate_limit_falls_back_to_next_model(self):
+        client = MagicMock()
+        client.models.generate_content.side_effect = [_rate_limited(), _response(), _response()]
+        ledger, rows = UsageLedger(fallback_models=("gemini-2.5-flash-lite",)), []
+
+        generate_content(client, "gemini-3-pro", "prompt", "analyze_meal", ledger=ledger, save_row=rows.append)
+
+        models = [c.kwargs["model"] for c in client.models.generate_content.call_args_list]
+        assert models == ["gemini-3-pro", "gemini-2.5-flash-lite"]
+        assert [r["outcome"] for r in rows] == ["rate_limited", "ok"]
+        # 2回目以降は最初から切り替えたモデルを使う
+        generate_content(client, "gemini-3-pro", "prompt", "analyze_meal", ledger=ledger, save_row=rows.append)
+        assert client.models.generate_content.call_args.kwargs["model"] == "gemini-2.5-flash-lite"
+
+    def test_per_minute_limit_is_a_cooldown_not_a_day(self):
+        """分あたりの制限の 429 は retryDelay（なければ60秒）だけ外し、1日のクォータの 429 だけその日のうちは使わない"""
+        client = MagicMock()
+        client.models.generate_content.side_effect = [
+            _rate_limited(retry_delay="23s"), _rate_limited("GenerateRequestsPerDayPerProjectPerModel-FreeTier"),
+            _response(),
+        ]
+        clock = Clock()
+        ledger = UsageLedger(fallback_models=("lite", "flash"), clock=clock)
+
+        generate_content(client, "pro", "prompt", "analyze_meal", ledger=ledger, save_row=lambda row: None)
+        report = ledger.report()
+        assert (report["cooling"], report["exhausted"]) == (["pro"], ["lite"])
+        assert ledger.choose_models("pro", "user-a") == ["flash"]
+        clock.now += 23
+        assert ledger.choose_models("pro", "user-a") == ["pro", "flash"]
+
+    def test_degrades_to_cheapest_model_when_budget_is_low(self):
+        client = MagicMock()
+        client.models.generate_content.return_value = _response()
+        ledger = UsageLedger(user_daily_tokens=1000, low_ratio=0.2, fallback_models=("gemini-2.5-flash-lite",))
+        ledger.record("user-a", 900, quota_day())
+
+        generate_content(client, "gemini-3-pro", "prompt", "analyze_meal", ledger=ledger, save_row=lambda r: None)
+        assert client.models.generate_content.call_args.kwargs["model"] == "gemini-2.5-flash-lite"
+
+    def test_budget_exceeded_does_not_call_gemini(self):
+        client = MagicMock()
+        ledger, rows = UsageLedger(user_daily_tokens=100), []
+        ledger.record("user-a", 100, quota_day())
+
+        with pytest.raises(BudgetExceeded):
+            generate_content(client, "gemini-3-pro", "prompt", "analyze_meal", ledger=ledger, save_row=rows.append)
+        client.models.generate_content.assert_not_called()
+        assert rows[0]["outcome"] == "budget_exceeded"
+
+    def test_other_errors_are_not_retried(self):
+        client = MagicMock()
+        client.models.generate_content.side_effect = RuntimeError("500")
+        rows = []
+        with pytest.raises(RuntimeError):
+            generate_content(client, "gemini-3-pro", "prompt", "analyze_meal", ledger=UsageLedger(), save_row=rows.append)
+        assert client.models.generate_content.call_count == 1
+        assert rows[0]["outcome"] == "error"
+
+    def test_user_is_passed_to_background_threads(self):
+        """get_executor() は submit した時点のユーザーを引き継ぐ"""
+        set_current_user("user-bg")
+        assert get_executor().submit(_current_user.get).result() == "user-bg"
+
+
+class _EmptyQuery:
+    """どの select にも空の結果を返し、insert / upsert は渡した行をそのまま返すクエリ"""
+
+    def __init__(self):
+        self.data = []
+
+    def __getattr__(self, name):
+        def method(*args, **kwargs):
+            if name in ("insert", "upsert"):
+                self.data = args[0] if isinstance(args[0], list) else [args[0]]
+            return self
+        return method
+
+    def execute(self):
+        return SimpleNamespace(data=self.data)
+
+
+class TestCallbackUser:
+    """ウィジェットのコールバック（app.py の set_current_user() より先に実行される）から始めた呼び出しのユーザー"""
+
+    def test_record_callback_logs_session_user(self, monkeypatch):
+        rows = []
+        monkeypatch.setattr(gemini_usage, "_save_usage_row", rows.append)
+        supabase = MagicMock()
+        supabase.table.side_effect = lambda name: _EmptyQuery()
+        monkeypatch.setattr(config, "init_supabase", lambda: supabase)
+        client = MagicMock()
+        client.models.generate_content.return_value = _response(
+            text='{"cal": 500, "p": 30, "f": 15, "c": 60, "iron_mg": 2.5, "folate_ug": 80.0, '
+                 '"calcium_mg": 150.0, "vitamin_d_ug": 3.0}',
+        )
+        for module in (config, services, analysis_cache):
+            monkeypatch.setattr(module, "get_gemini_client", lambda: client)
+        monkeypatch.chdir(os.path.dirname(config.__file__))
+
+        at = AppTest.from_file("../app.py", default_timeout=30).run()
+        user_id = at.session_state["user"].id
+        at.text_area(key="food_text").set_value("謎の料理スペシャル")
+        at.button(key="record_meal").click().run()  # _on_record が共有スレッドプールで解析する
+
+        for _ in range(100):  # 台帳の行はバックグラウンドで書き込まれる
+            if rows:
+                break
+            time.sleep(0.01)
+        assert client.models.generate_content.call_count == 1
+        assert [(r["user_id"], r["purpose"]) for r in rows] == [(user_id, "analyze_meal")]
@@ -0,0 +1,122 @@
+"""
+ledger.py のユニットテスト
+
+DailyLedger は外部依存のない純粋なクラスなのでモック不要。
+"""
+import pytest
+from ledger import DailyLedger
+
+
+def _log(log_id, meal_type, cal, p, f, c, **micro):
+    row = {"id": log_id, "meal_type": meal_type, "food_name": f"食事{log_id}",
+           "calories": cal, "p_val": p, "f_val": f, "c_val": c}
+    row.update(micro)
+    return row
+
+
+LOGS = [
+    _log("a", "夕食", 700, 35, 20, 90, iron_mg=2.0),
+    _log("b", "朝食", 400, 20, 10, 50, iron_mg=1.5, calcium_mg=120.0),
+]
+TARGETS = {"cal": 2000, "p": 100, "f": 60, "c": 250}
+
+
+class TestDailyLedgerTotals:
+    """合計値の初期化と差分更新を検証"""
+
+    def test_initial_totals(self):
+        """初期化時に全行の合計が計算されること"""
+        ledger = DailyLedger("2026-03-01", LOGS)
+        assert ledger.pfc_totals == {"cal": 1100, "p": 55, "f": 30, "c": 140}
+        assert ledger.micro_totals == {"iron": 3.5, "folate": 0, "calcium": 120.0, "vit_d": 0}
+
+    def test_add_updates_totals(self):
+        """行の追加で合計が増えること"""
+        ledger = DailyLedger("2026-03-01", LOGS)
+        assert ledger.add(_log("c", "間食", 100, 5, 2, 10)) is True
+        assert ledger.pfc_totals == {"cal": 1200, "p": 60, "f": 32, "c": 150}
+        assert len(ledger) == 3
+
+    def test_add_same_id_is_ignored(self):
+        """同じ id の行は二重に加算されないこと"""
+        ledger = DailyLedger("2026-03-01", LOGS)
+        assert ledger.add(_log("a", "夕食", 700, 35, 20, 90)) is False
+        assert ledger.total("calories") == 1100
+
+    def test_remove_updates_totals(self):
+        """行の削除で合計が減ること"""
+        ledger = DailyLedger("2026-03-01", LOGS)
+        assert ledger.remove("a") is True
+        assert ledger.pfc_totals == {"cal": 400, "p": 20, "f": 10, "c": 50}
+        assert "a" not in ledger
+
+    def test_remove_unknown_id(self):
+        """存在しない id の削除は False を返し、合計が変わらないこと"""
+        ledger = DailyLedger("2026-03-01", LOGS)
+        assert ledger.remove("zzz") is False
+        assert ledger.total("calories") == 1100
+
+    def test_none_values_count_as_zero(self):
+        """Supabase の null 値は 0 として扱われること"""
+        ledger = DailyLedger("2026-03-01", [_log("n", "朝食", None, None, 5, None, vitamin_d_ug=None)])
+        assert ledger.pfc_totals == {"cal": 0, "p": 0, "f": 5, "c": 0}
+
+    def test_empty_ledger_is_falsy(self):
+        """記録のない台帳は偽として扱われること"""
+        assert not DailyLedger("2026-03-01")
+
+
+class TestDailyLedgerOrdering:
+    """食事タイプ順の並べ替えを検証"""
+
+    def test_sorted_by_meal_type(self):
+        """朝食→夕食の順に並ぶこと"""
+        ledger = DailyLedger("2026-03-01", LOGS)
+        assert [m["id"] for m in ledger.sorted_logs()] == ["b", "a"]
+
+    def test_sorted_is_cached_until_change(self):
+        """変更がなければ同じリストを返し、追加後は並べ直されること"""
+        ledger = DailyLedger("2026-03-01", LOGS)
+        first = ledger.sorted_logs()
+        assert ledger.sorted_logs() is first
+        ledger.add(_log("c", "昼食", 500, 20, 10, 60))
+        assert [m["id"] for m in ledger.sorted_logs()] == ["b", "c", "a"]
+
+    def test_meal_types(self):
+        """記録済みの食事タイプが取得できること"""
+        assert DailyLedger("2026-03-01", LOGS).meal_types == {"朝食", "夕食"}
+
+
+class TestDailyLedgerText:
+    """共有テキスト・プロンプト用テキストを検証"""
+
+    def test_share_text_format(self):
+        """共有テキストに各食事・合計・目標が含まれること"""
+        text = DailyLedger("2026-03-01", LOGS).share_text("2026.3.1", TARGETS)
+        lines = text.split("\n")
+        assert lines[0] == "🍽️ 2026.3.1 の食事記録"
+        assert lines[1] == "・朝食: 食事b (400kcal / P:20 F:10 C:50)"
+        assert "合計: 1100kcal（P:55g F:30g C:140g）" in text
+        assert text.endswith("目標: 2000kcal（P:100g F:60g C:250g）")
+
+    def test_share_text_empty(self):
+        """記録がなければ「記録なし」になること"""
+        assert DailyLedger("2026-03-01").share_text("2026.3.1", TARGETS).endswith("記録なし")
+
+    def test_share_text_cache_invalidated_on_change(self):
+        """行を追加・削除すると共有テキストが作り直されること"""
+        ledger = DailyLedger("2026-03-01", LOGS)
+        before = ledger.share_text("2026.3.1", TARGETS)
+        assert ledger.share_text("2026.3.1", TARGETS) is before
+        ledger.remove("a")
+        assert "合計: 400kcal" in ledger.share_text("2026.3.1", TARGETS)
+
+    def test_meals_detail(self):
+        """プロンプト用の食事一覧が生成されること（記録なしは「まだ記録なし」）"""
+        assert "・夕食: 食事a（700kcal / P:35g F:20g C:90g）" in DailyLedger("d", LOGS).meals_detail()
+        assert DailyLedger("d").meals_detail() == "まだ記録なし"
+
+    def test_slots_prevent_ad_hoc_attributes(self):
+        """__slots__ により任意の属性を追加できないこと"""
+        with pytest.raises(AttributeError):
+            DailyLedger("d").extra = 1
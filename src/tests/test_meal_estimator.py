@@ -0,0 +1,97 @@
+"""
+meal_estimator.py のユニットテスト
+"""
+import time
+
+import pytest
+
+from meal_estimator import MealEstimator, char_ngrams, HIGH_CONFIDENCE, LOW_CONFIDENCE
+
+
+def _row(food_name, calories, p=20, f=10, c=50, iron=None):
+    return {"food_name": food_name, "calories": calories, "p_val": p, "f_val": f, "c_val": c,
+            "iron_mg": iron, "folate_ug": None, "calcium_mg": None, "vitamin_d_ug": None}
+
+
+HISTORY = [
+    _row("鶏むね肉とご飯", 520, p=40, iron=1.0),
+    _row("鶏むね肉とご飯", 540, p=42, iron=1.2),
+    _row("鶏むね肉とブロッコリー", 300, p=38),
+    _row("納豆ご飯", 350, p=14),
+    _row("カレーライス", 800, p=20),
+]
+
+
+class TestCharNgrams:
+    def test_counts_1_to_3_grams(self):
+        grams = char_ngrams("ごはん")
+        assert grams["ご"] == 1 and grams["ごは"] == 1 and grams["ごはん"] == 1
+        assert len(grams) == 3 + 2 + 1
+
+
+class TestMealEstimator:
+    """MealEstimator: 近傍の選択・推定値・確度を検証"""
+
+    def test_exact_meal_uses_its_own_average(self):
+        """同じ食事名の記録があれば、その平均を高い確度で返すこと"""
+        est = MealEstimator(HISTORY).estimate("鶏むね肉とご飯")
+        assert est["calories"] == pytest.approx(530)
+        assert est["p_val"] == pytest.approx(41)
+        assert est["iron_mg"] == pytest.approx(1.1)
+        assert est["confidence"] >= HIGH_CONFIDENCE
+
+    def test_spelling_variants_match_as_exact(self):
+        """表記ゆれ（カタカナ・全角空白・漢字）は正規化して同じ食事として扱うこと"""
+        est = MealEstimator(HISTORY).estimate("鶏ムネ肉と　御飯")
+        assert est["neighbors"][0][0] == "鶏むね肉とご飯"
+        assert est["confidence"] >= HIGH_CONFIDENCE
+
+    def test_similar_meal_gets_medium_confidence(self):
+        est = MealEstimator(HISTORY).estimate("鶏むね肉とご飯大盛り")
+        assert est["neighbors"][0][0] == "鶏むね肉とご飯"
+        assert LOW_CONFIDENCE <= est["confidence"] < HIGH_CONFIDENCE
+
+    def test_unrelated_text_returns_none(self):
+        assert MealEstimator(HISTORY).estimate("パスタ") is None
+        assert MealEstimator().estimate("鶏むね肉") is None
+
+    def test_inconsistent_history_lowers_confidence(self):
+        """同じ食事名でもカロリーのばらつきが大きければ確度が下がること"""
+        est = MealEstimator([_row("外食", 200), _row("外食", 1400)]).estimate("外食")
+        assert est["confidence"] < LOW_CONFIDENCE
+
+    def test_different_quantity_is_not_used(self):
+        """グラム数が違う過去の食事は、文字が似ていても推定に使わないこと（10倍の量を100gの値で記録しない）"""
+        estimator = MealEstimator([_row("鶏むね肉 100g", 120, p=23), _row("鶏むね肉 200g", 240, p=46)])
+        assert estimator.estimate("鶏むね肉 1000g") is None
+        assert estimator.estimate("鶏むね肉 100.0g")["calories"] == pytest.approx(120)
+        est = estimator.estimate("鶏むね肉 200グラム")
+        assert est["calories"] == pytest.approx(240)
+        assert est["confidence"] >= HIGH_CONFIDENCE
+
+    def test_missing_micronutrients_stay_none(self):
+        est = MealEstimator(HISTORY).estimate("カレーライス")
+        assert est["folate_ug"] is None
+
+    def test_add_is_incremental(self):
+        """add() で追加した記録が次の推定に反映されること"""
+        estimator = MealEstimator(HISTORY)
+        assert estimator.estimate("オートミール") is None
+        estimator.add(_row("オートミール", 150))
+        assert estimator.estimate("オートミール")["calories"] == pytest.approx(150)
+        assert len(estimator) == len({r["food_name"] for r in HISTORY}) + 1
+
+
+@pytest.mark.benchmark
+class TestMealEstimatorBenchmark:
+    """履歴1,000件規模で、入力確定ごとの推定が数ms以内に返ること"""
+
+    def test_estimate_latency(self):
+        rows = [_row(f"定食{i % 300}と小鉢{i % 17}", 300 + i % 500) for i in range(1000)]
+        estimator = MealEstimator(rows)
+        estimator.estimate("定食1")  # IDF・ベクトルの大きさを計算
+        start = time.perf_counter()
+        for i in range(20):
+            estimator.estimate(f"定食{i}と小鉢")
+        per_call_ms = (time.perf_counter() - start) * 1000 / 20
+        assert per_call_ms < 20
@@ -0,0 +1,205 @@
+"""
+meal_log_io.py のユニットテスト
+
+Supabase は、id の範囲で行をその場で生成する合成テーブルで差し替える。
+"""
+import io
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import pytest
+
+from meal_log_io import (
+    EXPORT_COLUMNS, export_meal_logs, import_meal_logs, iter_meal_log_pages,
+    read_meal_log_rows, validate_meal_log_row,
+)
+
+MEAL_TYPES = ("朝食", "昼食", "夕食", "間食")
+
+
+def _synthetic_row(i):
+    return {
+        "id": i, "meal_date": f"20{20 + i // 36500:02d}-{i // 3000 % 12 + 1:02d}-{i // 100 % 28 + 1:02d}",
+        "meal_type": MEAL_TYPES[i % 4], "food_name": f"合成の食事{i % 500}",
+        "calories": 300 + i % 700, "p_val": 10 + i % 40, "f_val": 5 + i % 30, "c_val": 20 + i % 90,
+        "iron_mg": (i % 50) / 10 or None, "folate_ug": 80.0, "calcium_mg": 120.5, "vitamin_d_ug": None,
+        "created_at": f"2024-01-01T00:00:{i % 60:02d}.{i:06d}+00:00", "idempotency_key": f"key{i}",
+    }
+
+
+class _SyntheticQuery:
+    """select().eq().gt().order().limit().execute() だけを持つ合成の meal_logs（行は要求された分だけ生成する）"""
+
+    def __init__(self, table):
+        self.table, self.start, self.count = table, 0, None
+
+    def select(self, columns):
+        return self
+
+    def eq(self, column, value):
+        return self
+
+    def gt(self, column, value):
+        self.start = value + 1
+        return self
+
+    def order(self, column):
+        return self
+
+    def limit(self, n):
+        self.count = n
+        return self
+
+    def execute(self):
+        self.table.queries.append(self.start)
+        end = min(self.start + self.count, self.table.n_rows)
+        return SimpleNamespace(data=[_synthetic_row(i) for i in range(self.start, end)])
+
+
+class _SyntheticSupabase:
+    def __init__(self, n_rows):
+        self.n_rows = n_rows
+        self.queries = []
+
+    def table(self, name):
+        return _SyntheticQuery(self)
+
+
+class _UpsertSink:
+    """upsert された行を数えるだけの Supabase（track_keys=True なら冪等キーの重複を無視する）"""
+
+    def __init__(self, track_keys=True):
+        self.rows = 0
+        self.calls = 0
+        self.keys = set() if track_keys else None
+
+    def table(self, name):
+        return self
+
+    def upsert(self, payload, **kwargs):
+        self.calls += 1
+        if self.keys is None:
+            self.payload = payload
+        else:
+            self.payload = [r for r in payload if r["idempotency_key"] not in self.keys]
+            self.keys.update(r["idempotency_key"] for r in payload)
+        return self
+
+    def execute(self):
+        self.rows += len(self.payload)
+        return SimpleNamespace(data=self.payload)
+
+
+class TestExport:
+    def test_keyset_pages(self):
+        sb = _SyntheticSupabase(2500)
+        pages = list(iter_meal_log_pages(sb, "u1", page_size=1000))
+        assert [len(p) for p in pages] == [1000, 1000, 500]
+        assert sb.queries == [0, 1000, 2000]  # 2ページ目以降は前のページの最後の id から
+
+    @pytest.mark.parametrize("fmt", ["csv", "parquet"])
+    def test_roundtrip(self, fmt):
+        out = io.BytesIO()
+        assert export_meal_logs(iter_meal_log_pages(_SyntheticSupabase(1200), "u1", 500), out, fmt) == 1200
+        out.seek(0)
+        rows = list(read_meal_log_rows(out, fmt))
+        assert len(rows) == 1200
+        assert set(rows[0]) == set(EXPORT_COLUMNS)
+        values, error = validate_meal_log_row(rows[7])
+        assert error is None
+        assert values["food_name"] == "合成の食事7"
+        assert values["calories"] == 307
+
+
+class TestImport:
+    def test_validation(self):
+        ok = {"meal_date": "2026-03-01", "meal_type": "朝食", "food_name": "パン", "calories": "250", "p_val": ""}
+        values, error = validate_meal_log_row(ok)
+        assert error is None
+        assert values["p_val"] == 0.0
+        assert values["iron_mg"] is None
+        for bad in ({"meal_date": "3/1"}, {"meal_type": "ブランチ"}, {"food_name": " "},
+                    {"calories": "-5"}, {"p_val": "たくさん"}, {"created_at": "昨日"}):
+            assert validate_meal_log_row({**ok, **bad})[1] is not None
+
+    def test_chunked_upsert_is_idempotent(self):
+        csv_text = "﻿" + ",".join(EXPORT_COLUMNS) + "\n" + "".join(
+            f"2026-03-0{i % 9 + 1},昼食,食事{i},500,20,15,60,,,,,\n" for i in range(120)
+        ) + "2026-03-01,ブランチ,食事x,500,20,15,60,,,,,\n"
+        sink = _UpsertSink()
+        progress = []
+        report = import_meal_logs(sink, "u1", read_meal_log_rows(io.BytesIO(csv_text.encode()), "csv"),
+                                  chunk_size=50, on_progress=lambda r: progress.append(r["saved"]))
+        assert report["saved"] == 120
+        assert report["invalid"] == 1
+        assert report["errors"][0][0] == 122  # ヘッダーを1行目として数えた行番号
+        assert sink.calls == 3
+        assert progress == [50, 100, 120]
+
+        again = import_meal_logs(sink, "u1", read_meal_log_rows(io.BytesIO(csv_text.encode()), "csv"))
+        assert again["saved"] == 0  # 同じファイルの再取り込みは重複しない
+
+    @pytest.mark.parametrize("fmt", ["csv", "parquet"])
+    def test_restore_own_export_saves_nothing(self, fmt):
+        """書き出したファイルを同じユーザーに戻しても、元の行と冪等キーが同じなので1行も増えない"""
+        out = io.BytesIO()
+        export_meal_logs(iter_meal_log_pages(_SyntheticSupabase(1200), "u1", 500), out, fmt)
+        out.seek(0)
+        sink = _UpsertSink()
+        sink.keys.update(f"key{i}" for i in range(1200))  # DB に残っている元の行
+        report = import_meal_logs(sink, "u1", read_meal_log_rows(out, fmt))
+        assert report["rows"] == 1200
+        assert report["saved"] == 0
+
+
+def _export_import(n_rows, fmt, path):
+    """n_rows 行を書き出して取り込み、(書き出した行数, 書き出し秒数, 取り込みの報告) を返す"""
+    t0 = time.perf_counter()
+    with open(path, "wb") as f:
+        exported = export_meal_logs(iter_meal_log_pages(_SyntheticSupabase(n_rows), "u1"), f, fmt)
+    export_sec = time.perf_counter() - t0
+    with open(path, "rb") as f:
+        report = import_meal_logs(_UpsertSink(track_keys=False), "u1", read_meal_log_rows(f, fmt))
+    return exported, export_sec, report
+
+
+def _peak_memory(n_rows, fmt, path):
+    """書き出し・取り込みそれぞれのピークメモリ（バイト）"""
+    tracemalloc.start()
+    try:
+        with open(path, "wb") as f:
+            export_meal_logs(iter_meal_log_pages(_SyntheticSupabase(n_rows), "u1"), f, fmt)
+        _, export_peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        with open(path, "rb") as f:
+            import_meal_logs(_UpsertSink(track_keys=False), "u1", read_meal_log_rows(f, fmt))
+        _, import_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return export_peak, import_peak
+
+
+@pytest.mark.benchmark
+class TestBenchmark:
+    """10万行の合成データでの処理速度と、メモリ使用量が行数に比例しないこと（結果は docs/performance_policy.md に記録する）"""
+
+    @pytest.mark.parametrize("fmt", ["csv", "parquet"])
+    def test_throughput_100k_rows(self, fmt, tmp_path):
+        path = tmp_path / f"meal_logs.{fmt}"
+        exported, export_sec, report = _export_import(100_000, fmt, path)
+        print(
+            f"\n[{fmt}] 10万行: 書き出し {exported / export_sec:,.0f}行/秒・取り込み {report['rows_per_sec']:,.0f}行/秒"
+            f"（ファイル {path.stat().st_size / 2**20:.1f}MB）"
+        )
+        assert exported == report["saved"] == 100_000
+
+    @pytest.mark.parametrize("fmt", ["csv", "parquet"])
+    def test_peak_memory_is_flat(self, fmt, tmp_path):
+        """行数を4倍にしてもピークメモリがほぼ変わらない（1ページ・1チャンク分で頭打ちになる）こと"""
+        path = tmp_path / f"meal_logs.{fmt}"
+        small = _peak_memory(2_000, fmt, path)
+        large = _peak_memory(8_000, fmt, path)
+        print(f"\n[{fmt}] ピーク 2千行 {[f'{b / 2**20:.1f}MB' for b in small]} / 8千行 {[f'{b / 2**20:.1f}MB' for b in large]}")
+        assert large[0] < small[0] * 1.5
+        assert large[1] < small[1] * 1.5
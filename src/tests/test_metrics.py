@@ -0,0 +1,176 @@
+"""
+metrics.py のユニットテスト
+
+テキスト形式の出力・キャッシュのヒット / ミス・クライアントの代理からの記録・HTTP / JSONL の書き出しを確認する。
+"""
+import json
+import socket
+import threading
+import urllib.request
+from http.server import ThreadingHTTPServer
+from unittest.mock import MagicMock
+
+import pytest
+import streamlit as st
+
+import metrics
+from metrics import Counter, Histogram, JsonlSink, Registry, observe_cache, registry
+from tracing import instrument_gemini, instrument_supabase
+
+
+@pytest.fixture(autouse=True)
+def _clear_metrics():
+    registry.clear()
+    yield
+
+
+class TestTextFormat:
+    """Registry.render: Prometheus のテキスト形式"""
+
+    def test_counter_and_histogram(self):
+        reg = Registry()
+        c = reg.register(Counter("req_total", "requests", ("table",)))
+        h = reg.register(Histogram("lat_seconds", "latency", ("table",), buckets=(0.1, 1)))
+        c.inc(table="meal_logs")
+        c.inc(2, table="meal_logs")
+        h.observe(0.05, table="meal_logs")
+        h.observe(0.5, table="meal_logs")
+        h.observe(3, table="meal_logs")
+
+        text = reg.render()
+        assert "# TYPE req_total counter" in text
+        assert 'req_total{table="meal_logs"} 3' in text
+        assert "# TYPE lat_seconds histogram" in text
+        assert 'lat_seconds_bucket{table="meal_logs",le="0.1"} 1' in text
+        assert 'lat_seconds_bucket{table="meal_logs",le="1"} 2' in text
+        assert 'lat_seconds_bucket{table="meal_logs",le="+Inf"} 3' in text
+        assert 'lat_seconds_sum{table="meal_logs"} 3.55' in text
+        assert 'lat_seconds_count{table="meal_logs"} 3' in text
+        assert text.endswith("\n")
+
+    def test_label_values_escaped(self):
+        reg = Registry()
+        c = reg.register(Counter("x_total", "x", ("name",)))
+        c.inc(name='a"b\\c\nd')
+        assert 'x_total{name="a\\"b\\\\c\\nd"} 1' in reg.render()
+
+    def test_collector_samples_are_merged(self):
+        reg = Registry()
+        reg.register(Counter("hits_total", "hits", ("function",)))
+        reg.collectors.append(lambda: [("hits_total", {"function": "f"}, 7)])
+        assert 'hits_total{function="f"} 7' in reg.render()
+
+    def test_process_caches_exported(self):
+        text = registry.render()
+        assert 'pfc_cache_requests_total{function="analysis_cache",result="hit"} 0' in text
+        assert 'pfc_cache_requests_total{function="ingredient_cache",result="miss"} 0' in text
+
+
+class TestObserveCache:
+    """observe_cache: キャッシュした関数のヒット / ミス"""
+
+    def test_hit_and_miss(self):
+        calls = []
+
+        @observe_cache("double", st.cache_data)
+        def double(x):
+            calls.append(x)
+            return x * 2
+
+        double.clear()
+        assert double(2) == 4
+        assert double(2) == 4
+        assert double(3) == 6
+        assert calls == [2, 3]
+        assert metrics.cache_requests.value(function="double", result="miss") == 2
+        assert metrics.cache_requests.value(function="double", result="hit") == 1
+
+        double.clear()
+        double(2)
+        assert metrics.cache_requests.value(function="double", result="miss") == 3
+
+
+class TestInstrumentedClients:
+    """tracing.py の代理からのメトリクスの記録"""
+
+    def test_supabase_latency_and_errors_per_table(self):
+        client = MagicMock()
+        client.table.return_value.delete.return_value.eq.return_value.execute.side_effect = RuntimeError("down")
+        supabase = instrument_supabase(client)
+
+        supabase.table("meal_logs").select("*").execute()
+        with pytest.raises(RuntimeError):
+            supabase.table("meal_logs").delete().eq("id", 1).execute()
+
+        assert metrics.supabase_latency.count(table="meal_logs", op="select") == 1
+        assert metrics.supabase_latency.count(table="meal_logs", op="delete") == 1
+        assert metrics.supabase_errors.value(table="meal_logs", op="delete") == 1
+
+    def test_gemini_latency_tokens_and_429(self):
+        client = MagicMock()
+        res = MagicMock()
+        res.usage_metadata.prompt_token_count = 120
+        res.usage_metadata.candidates_token_count = 40
+        client.models.generate_content.return_value = res
+        gemini = instrument_gemini(client)
+
+        gemini.models.generate_content(model="gemini-3-flash", contents="x")
+        err = RuntimeError("RESOURCE_EXHAUSTED")
+        err.code = 429
+        client.models.generate_content.side_effect = err
+        with pytest.raises(RuntimeError):
+            gemini.models.generate_content(model="gemini-3-flash", contents="x")
+
+        assert metrics.gemini_latency.count(model="gemini-3-flash", method="generate_content") == 2
+        assert metrics.gemini_tokens.value(model="gemini-3-flash", type="prompt") == 120
+        assert metrics.gemini_tokens.value(model="gemini-3-flash", type="output") == 40
+        assert metrics.gemini_errors.value(model="gemini-3-flash", code="429") == 1
+
+    def test_parse_failure_counted(self, monkeypatch):
+        import services
+        gem = MagicMock()
+        gem.models.generate_content.return_value.text = "すみません、解析できませんでした"
+        monkeypatch.setattr(services, "get_gemini_client", lambda: gem)
+        with pytest.raises(ValueError):
+            services._request_meal_analysis("謎の料理", "gemini-3-flash")
+        assert metrics.gemini_parse_failures.value(function="analyze_meal") == 1
+
+
+class TestExport:
+    """HTTP エンドポイントと JSONL への書き出し"""
+
+    def test_http_endpoint(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), metrics._MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            metrics.cache_requests.inc(function="f", result="hit")
+            port = server.server_address[1]
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as res:
+                body = res.read().decode()
+                assert res.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+            assert 'pfc_cache_requests_total{function="f",result="hit"} 1' in body
+        finally:
+            server.shutdown()
+
+    def test_jsonl_sink_appends_and_rotates(self, tmp_path):
+        path = tmp_path / "m" / "metrics.jsonl"
+        sink = JsonlSink(str(path), max_bytes=1)
+        metrics.cache_requests.inc(function="f", result="miss")
+        sink.write()
+        line = json.loads(path.read_text().splitlines()[0])
+        assert {"name": "pfc_cache_requests_total", "labels": {"function": "f", "result": "miss"}, "value": 1} in line["samples"]
+        sink.write()
+        assert (tmp_path / "m" / "metrics.jsonl.1").exists()
+        assert len(path.read_text().splitlines()) == 1
+
+    def test_falls_back_to_jsonl_when_port_busy(self, monkeypatch, tmp_path):
+        busy = socket.socket()
+        busy.bind(("127.0.0.1", 0))
+        busy.listen()
+        sink = str(tmp_path / "metrics.jsonl")
+        monkeypatch.setattr(metrics, "_metrics_config",
+                            lambda: {"port": busy.getsockname()[1], "sink": sink, "interval": 3600})
+        try:
+            assert metrics.start_metrics_exporter.__wrapped__() == ("jsonl", sink)
+        finally:
+            busy.close()
@@ -0,0 +1,113 @@
+"""
+profiling.py のユニットテスト
+
+プロファイルは pytest の tmp_path に保存する。
+"""
+import cProfile
+import json
+import os
+import pstats
+from datetime import datetime, timedelta
+
+import pytest
+import streamlit as st
+
+import profiling
+from profiling import list_profiles, run_profiled
+
+
+def _slow():
+    return sum(i * i for i in range(20000))
+
+
+def _work():
+    _slow()
+    return "done"
+
+
+class TestRunProfiled:
+    """run_profiled: リランの計測と保存"""
+
+    def test_saves_prof_and_summary(self, tmp_path):
+        assert run_profiled(_work, "食事記録", directory=str(tmp_path)) == "done"
+
+        (summary,) = list_profiles(str(tmp_path))
+        assert summary["label"] == "食事記録"
+        assert summary["duration_ms"] > 0
+        assert "_slow" in [f["function"] for f in summary["top"]]
+        cum = [f["cumtime_ms"] for f in summary["top"]]
+        assert cum == sorted(cum, reverse=True)
+        # .prof は pstats で読める
+        stats = pstats.Stats(os.path.join(tmp_path, summary["prof"]))
+        assert any(name == "_slow" for (_, _, name) in stats.stats)
+
+    def test_saves_even_when_interrupted(self, tmp_path):
+        """st.rerun() / st.stop() の例外で中断しても保存する"""
+        def interrupted():
+            _slow()
+            raise RuntimeError("rerun")
+
+        with pytest.raises(RuntimeError):
+            run_profiled(interrupted, "設定", directory=str(tmp_path))
+        assert [p["label"] for p in list_profiles(str(tmp_path))] == ["設定"]
+
+    def test_runs_unprofiled_while_another_capture_is_active(self, tmp_path):
+        profiling._profiler_lock.acquire()
+        try:
+            assert run_profiled(_work, "x", directory=str(tmp_path)) == "done"
+        finally:
+            profiling._profiler_lock.release()
+        assert list_profiles(str(tmp_path)) == []
+
+
+class TestRotation:
+    """save_profile: 古いプロファイルを消して MAX_PROFILES 件に保つ"""
+
+    def test_keeps_latest(self, tmp_path):
+        base = datetime(2026, 3, 1, 12, 0, 0)
+        for i in range(5):
+            profiler = cProfile.Profile()
+            profiler.enable()
+            _slow()
+            profiler.disable()
+            profiling.save_profile(profiler, f"p{i}", base + timedelta(seconds=i), float(i), str(tmp_path), max_profiles=3)
+
+        assert sorted(p["label"] for p in list_profiles(str(tmp_path))) == ["p2", "p3", "p4"]
+        assert len([f for f in os.listdir(tmp_path) if f.endswith(".prof")]) == 3
+
+    def test_list_sorted_by_duration_and_skips_broken(self, tmp_path):
+        for name, ms in (("a", 10.0), ("b", 300.0), ("c", 50.0)):
+            (tmp_path / f"{name}.json").write_text(json.dumps({"label": name, "duration_ms": ms, "top": []}))
+        (tmp_path / "broken.json").write_text("{")
+        assert [p["label"] for p in list_profiles(str(tmp_path))] == ["b", "c", "a"]
+        assert list_profiles(str(tmp_path / "missing")) == []
+
+
+class TestProfilingEnabled:
+    """profiling_enabled: 環境変数・クエリパラメータでの有効化"""
+
+    @pytest.fixture(autouse=True)
+    def _session(self, monkeypatch):
+        state, params = {}, {}
+        monkeypatch.setattr(st, "session_state", state)
+        monkeypatch.setattr(st, "query_params", params)
+        monkeypatch.setattr(st, "secrets", {"debug": {"token": "s3cret"}})
+        monkeypatch.delenv(profiling.PROFILE_ENV, raising=False)
+        return state, params
+
+    def test_disabled_by_default(self):
+        assert profiling.profiling_enabled() is False
+
+    def test_env(self, monkeypatch):
+        monkeypatch.setenv(profiling.PROFILE_ENV, "1")
+        assert profiling.profiling_enabled() is True
+
+    def test_query_param_needs_token_and_sticks_to_session(self, _session):
+        state, params = _session
+        params["profile"] = "wrong"
+        assert profiling.profiling_enabled() is False
+        params["profile"] = "s3cret"
+        assert profiling.profiling_enabled() is True
+        params.clear()
+        assert profiling.profiling_enabled() is True
+        assert state["profile_reruns"] is True
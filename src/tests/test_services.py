@@ -84,6 +84,8 @@ class TestGeneratePfcSummary:
 # analyze_meal_with_gemini のテスト（Gemini API をモック）
 # ---------------------------------------------------------------------------
 
+from deadlines import DeadlineExceeded
+from gemini_usage import BudgetExceeded
 from services import analyze_meal_with_gemini
 
 
@@ -168,3 +170,737 @@ class TestAnalyzeMealWithGemini:
         assert folate == 0
         assert calcium == 0
         assert vit_d == 0
+
+
+# ---------------------------------------------------------------------------
+# group_logs_by_date / prefetch_meal_logs のテスト（Supabase をモック）
+# ---------------------------------------------------------------------------
+
+from datetime import date, timedelta
+from ledger import DailyLedger
+from services import group_logs_by_date, prefetch_meal_logs
+
+
+def _mock_range_supabase(rows):
+    """範囲クエリ（select→eq→gte→lte→execute）が rows を返す Supabase モック"""
+    supabase = MagicMock()
+    query = supabase.table.return_value.select.return_value.eq.return_value
+    query.gte.return_value.lte.return_value.execute.return_value = MagicMock(data=rows)
+    return supabase, query
+
+
+class TestGroupLogsByDate:
+    """group_logs_by_date: 日付ごとの振り分けを検証"""
+
+    def test_empty_days_are_filled(self):
+        """記録のない日も空リストとして含まれること"""
+        result = group_logs_by_date([], ["2026-03-01", "2026-03-02"])
+        assert result == {"2026-03-01": [], "2026-03-02": []}
+
+    def test_logs_outside_range_are_ignored(self):
+        """対象外の日付のログは無視されること"""
+        logs = [{"meal_date": "2026-03-01", "id": 1}, {"meal_date": "2026-02-01", "id": 2}]
+        result = group_logs_by_date(logs, ["2026-03-01"])
+        assert result == {"2026-03-01": [{"meal_date": "2026-03-01", "id": 1}]}
+
+
+class TestPrefetchMealLogs:
+    """prefetch_meal_logs: 未取得の日だけを1回の範囲クエリで取得することを検証"""
+
+    def test_single_range_query_for_week(self):
+        """7日分を1回のクエリで取得し、全日がキャッシュされること"""
+        days = [date(2026, 3, 1) + timedelta(days=i) for i in range(7)]
+        supabase, query = _mock_range_supabase([{"meal_date": "2026-03-03", "id": 1}])
+        cache = {}
+
+        assert prefetch_meal_logs(supabase, "u1", cache, days) is True
+
+        assert supabase.table.call_count == 1
+        query.gte.assert_called_once_with("meal_date", "2026-03-01")
+        query.gte.return_value.lte.assert_called_once_with("meal_date", "2026-03-07")
+        assert len(cache) == 7
+        assert cache["2026-03-03"].logs == [{"meal_date": "2026-03-03", "id": 1}]
+        assert len(cache["2026-03-01"]) == 0
+
+    def test_fully_cached_days_skip_query(self):
+        """全日がキャッシュ済みならクエリを発行しないこと"""
+        days = [date(2026, 3, 1), date(2026, 3, 2)]
+        supabase, _ = _mock_range_supabase([])
+        cache = {"2026-03-01": DailyLedger("2026-03-01"), "2026-03-02": DailyLedger("2026-03-02")}
+
+        assert prefetch_meal_logs(supabase, "u1", cache, days) is True
+        supabase.table.assert_not_called()
+
+    def test_only_missing_edge_is_fetched(self):
+        """隣の日に移動したときは、未取得の端の日だけを取得すること"""
+        days = [date(2026, 3, 2) + timedelta(days=i) for i in range(7)]
+        cache = {}
+        for i in range(7):
+            d = (date(2026, 3, 1) + timedelta(days=i)).isoformat()
+            cache[d] = DailyLedger(d)
+        supabase, query = _mock_range_supabase([])
+
+        prefetch_meal_logs(supabase, "u1", cache, days)
+
+        query.gte.assert_called_once_with("meal_date", "2026-03-08")
+        assert "2026-03-08" in cache
+
+    def test_cached_days_are_not_overwritten(self):
+        """範囲内の取得済みの日はローカルの内容が維持されること"""
+        days = [date(2026, 3, 1), date(2026, 3, 2), date(2026, 3, 3)]
+        cache = {"2026-03-02": DailyLedger("2026-03-02", [{"meal_date": "2026-03-02", "id": "local"}])}
+        supabase, _ = _mock_range_supabase([{"meal_date": "2026-03-02", "id": "db"}])
+
+        prefetch_meal_logs(supabase, "u1", cache, days)
+
+        assert cache["2026-03-02"].logs == [{"meal_date": "2026-03-02", "id": "local"}]
+
+    def test_query_error_returns_false(self, mocker):
+        """取得エラー時は False を返し、キャッシュを汚さないこと"""
+        supabase = MagicMock()
+        supabase.table.side_effect = Exception("network down")
+        cache = {}
+
+        assert prefetch_meal_logs(supabase, "u1", cache, [date(2026, 3, 1)]) is False
+        assert cache == {}
+
+
+# ---------------------------------------------------------------------------
+# 週カレンダーのカロリーバッジのテスト（純粋関数 — モック不要）
+# ---------------------------------------------------------------------------
+
+import time
+from services import calorie_badge_color, build_week_strip_labels
+
+
+class TestCalorieBadgeColor:
+    """calorie_badge_color: 目標達成度に応じた色分けを検証"""
+
+    def test_no_record_has_no_badge(self):
+        """記録なし（0kcal）はバッジなし（None）であること"""
+        assert calorie_badge_color(0, 2000) is None
+
+    def test_thresholds(self):
+        """達成率で gray / orange / green / red に分かれること"""
+        assert calorie_badge_color(500, 2000) == "gray"
+        assert calorie_badge_color(1200, 2000) == "orange"
+        assert calorie_badge_color(1900, 2000) == "green"
+        assert calorie_badge_color(2300, 2000) == "red"
+
+    def test_zero_target_no_division_by_zero(self):
+        """目標が0でも ZeroDivisionError が発生しないこと"""
+        assert calorie_badge_color(500, 0) == "gray"
+
+
+class TestBuildWeekStripLabels:
+    """build_week_strip_labels: 週カレンダーのラベル生成を検証"""
+
+    WEEK = [date(2026, 3, 2) + timedelta(days=i) for i in range(7)]  # 月〜日
+
+    def test_day_names_and_today(self):
+        """曜日名が入り、今日のセルは「今日」になること"""
+        labels = build_week_strip_labels(self.WEEK, date(2026, 3, 4), {}, 2000)
+        assert [lbl.split("\n")[0] for _, lbl in labels] == ["月", "火", "今日", "木", "金", "土", "日"]
+
+    def test_daily_kcal_badge(self):
+        """その日の合計カロリーが色付きバッジとして入ること（calories が None でも落ちない）"""
+        cache = {"2026-03-02": DailyLedger("2026-03-02", [
+            {"id": 1, "calories": 1200}, {"id": 2, "calories": 700}, {"id": 3, "calories": None},
+        ])}
+        labels = dict(build_week_strip_labels(self.WEEK, date(2026, 3, 9), cache, 2000))
+        assert labels[date(2026, 3, 2)] == "月\n2\n:green[1900]"
+        assert labels[date(2026, 3, 3)].endswith("·")
+
+
+@pytest.mark.benchmark
+class TestWeekStripBenchmark:
+    """週カレンダーのラベル生成がリラン時間に影響しないことを検証する簡易ベンチマーク"""
+
+    def test_label_build_is_sub_millisecond(self):
+        """1日5食×7日分のラベル生成が1回あたり1ms未満であること"""
+        week = [date(2026, 3, 2) + timedelta(days=i) for i in range(7)]
+        cache = {
+            d.isoformat(): DailyLedger(d.isoformat(), [{"id": j, "calories": 400 + j} for j in range(5)])
+            for d in week
+        }
+        runs = 500
+        start = time.perf_counter()
+        for _ in range(runs):
+            build_week_strip_labels(week, week[3], cache, 2000)
+        per_run_ms = (time.perf_counter() - start) / runs * 1000
+        assert per_run_ms < 1.0
+
+
+# ---------------------------------------------------------------------------
+# 冪等キー（make_idempotency_key / save_meal_log / find_meal_log_by_idempotency_key）
+# ---------------------------------------------------------------------------
+
+from services import make_idempotency_key, save_meal_log, find_meal_log_by_idempotency_key
+
+
+class TestIdempotencyKey:
+    """冪等キーの生成と save_meal_log での重複排除を検証"""
+
+    def test_same_submit_gives_same_key(self):
+        """同じ内容・同じノンスなら同じキーになること（再接続後の再送を同一視できる）"""
+        k1 = make_idempotency_key("u1", date(2026, 3, 1), "朝食", "text:納豆ご飯", "n1")
+        k2 = make_idempotency_key("u1", date(2026, 3, 1), "朝食", "text:納豆ご飯", "n1")
+        assert k1 == k2
+
+    def test_new_nonce_gives_new_key(self):
+        """ノンスが変われば（記録成功後の再入力）別のキーになること"""
+        k1 = make_idempotency_key("u1", date(2026, 3, 1), "朝食", "text:納豆ご飯", "n1")
+        k2 = make_idempotency_key("u1", date(2026, 3, 1), "朝食", "text:納豆ご飯", "n2")
+        assert k1 != k2
+
+    def test_template_and_text_do_not_collide(self):
+        """同じ送信内のテンプレート分とテキスト分は別のキーになること"""
+        k1 = make_idempotency_key("u1", date(2026, 3, 1), "朝食", "template:t1", "n1")
+        k2 = make_idempotency_key("u1", date(2026, 3, 1), "朝食", "text:t1", "n1")
+        assert k1 != k2
+
+    def test_save_with_key_uses_ignoring_upsert(self):
+        """キー付きの保存は、重複時に何もしない upsert になること"""
+        supabase = MagicMock()
+        save_meal_log(supabase, "u1", date(2026, 3, 1), "朝食", "納豆ご飯", 10, 5, 60, 330,
+                      idempotency_key="abc")
+        table = supabase.table.return_value
+        table.insert.assert_not_called()
+        row = table.upsert.call_args.args[0]
+        assert row["idempotency_key"] == "abc"
+        assert table.upsert.call_args.kwargs == {"on_conflict": "idempotency_key", "ignore_duplicates": True}
+
+    def test_save_without_key_uses_insert(self):
+        """キーなしの保存は従来どおり insert であること"""
+        supabase = MagicMock()
+        save_meal_log(supabase, "u1", date(2026, 3, 1), "朝食", "納豆ご飯", 10, 5, 60, 330)
+        table = supabase.table.return_value
+        table.upsert.assert_not_called()
+        assert "idempotency_key" not in table.insert.call_args.args[0]
+
+    def test_find_returns_existing_row(self):
+        """保存済みの行があればそれを返すこと"""
+        supabase = MagicMock()
+        query = supabase.table.return_value.select.return_value.eq.return_value.limit.return_value
+        query.execute.return_value = MagicMock(data=[{"id": "x", "calories": 330}])
+        assert find_meal_log_by_idempotency_key(supabase, "abc") == {"id": "x", "calories": 330}
+
+    def test_find_returns_none_on_error(self):
+        """取得エラー時は None を返すこと"""
+        supabase = MagicMock()
+        supabase.table.side_effect = Exception("network down")
+        assert find_meal_log_by_idempotency_key(supabase, "abc") is None
+
+
+# ---------------------------------------------------------------------------
+# ローカル台帳とDBの突き合わせ（apply_day_reconciliations）
+# ---------------------------------------------------------------------------
+
+from concurrent.futures import Future
+from services import apply_day_reconciliations
+
+
+def _done_future(result=None, exc=None):
+    future = Future()
+    if exc is not None:
+        future.set_exception(exc)
+    else:
+        future.set_result(result)
+    return future
+
+
+class TestApplyDayReconciliations:
+    """apply_day_reconciliations: バックグラウンド再取得結果の反映を検証"""
+
+    def test_done_result_replaces_day(self):
+        """完了した再取得の結果で該当日が置き換わり、pending から外れること"""
+        cache = {"2026-03-01": DailyLedger("2026-03-01", [{"id": "local"}])}
+        pending = {"2026-03-01": _done_future([{"id": "db"}])}
+        apply_day_reconciliations(cache, pending)
+        assert cache["2026-03-01"].logs == [{"id": "db"}]
+        assert pending == {}
+
+    def test_running_future_is_kept(self):
+        """未完了の再取得はそのまま残り、ローカルの内容が維持されること"""
+        cache = {"2026-03-01": DailyLedger("2026-03-01", [{"id": "local"}])}
+        pending = {"2026-03-01": Future()}
+        apply_day_reconciliations(cache, pending)
+        assert cache["2026-03-01"].logs == [{"id": "local"}]
+        assert "2026-03-01" in pending
+
+    def test_failed_fetch_keeps_local(self):
+        """再取得が失敗（None / 例外）した場合はローカルの内容が維持されること"""
+        local1 = DailyLedger("2026-03-01", [{"id": "local"}])
+        local2 = DailyLedger("2026-03-02", [{"id": "local2"}])
+        cache = {"2026-03-01": local1, "2026-03-02": local2}
+        pending = {
+            "2026-03-01": _done_future(None),
+            "2026-03-02": _done_future(exc=RuntimeError("boom")),
+        }
+        apply_day_reconciliations(cache, pending)
+        assert cache == {"2026-03-01": local1, "2026-03-02": local2}
+        assert pending == {}
+
+
+class TestSaveMealLogReturnsRow:
+    """save_meal_log: 挿入された行を返すことを検証（ローカル台帳の更新に使う）"""
+
+    def test_returns_inserted_row(self):
+        supabase = MagicMock()
+        supabase.table.return_value.insert.return_value.execute.return_value = MagicMock(data=[{"id": "new"}])
+        row = save_meal_log(supabase, "u1", date(2026, 3, 1), "朝食", "納豆ご飯", 10, 5, 60, 330)
+        assert row == {"id": "new"}
+
+    def test_ignored_duplicate_returns_none(self):
+        """冪等キーの重複で挿入されなかった場合は None を返すこと"""
+        supabase = MagicMock()
+        supabase.table.return_value.upsert.return_value.execute.return_value = MagicMock(data=[])
+        row = save_meal_log(supabase, "u1", date(2026, 3, 1), "朝食", "納豆ご飯", 10, 5, 60, 330,
+                            idempotency_key="abc")
+        assert row is None
+
+
+from services import build_meal_log_row, save_meal_logs
+
+
+class TestSaveMealLogs:
+    """save_meal_logs: テンプレートとテキストの行を1回の挿入で保存することを検証"""
+
+    def _rows(self):
+        return [
+            build_meal_log_row("u1", date(2026, 3, 1), "朝食", "納豆ご飯", 10, 5, 60, 330, idempotency_key="tpl"),
+            build_meal_log_row("u1", date(2026, 3, 1), "朝食", "味噌汁", 3, 1, 5, 40,
+                               iron_mg=0.51, idempotency_key="txt"),
+        ]
+
+    def test_single_upsert_with_uniform_columns(self):
+        supabase = MagicMock()
+        supabase.table.return_value.upsert.return_value.execute.return_value = MagicMock(
+            data=[{"id": "a", "idempotency_key": "tpl"}, {"id": "b", "idempotency_key": "txt"}])
+
+        saved = save_meal_logs(supabase, self._rows())
+
+        table = supabase.table.return_value
+        table.upsert.assert_called_once()
+        payload = table.upsert.call_args.args[0]
+        assert [set(r) for r in payload] == [set(payload[0])] * 2  # 全行の列が揃っている
+        assert payload[0]["iron_mg"] is None
+        assert payload[1]["iron_mg"] == 0.5
+        assert [r["id"] for r in saved] == ["a", "b"]
+
+    def test_ignored_duplicate_is_none_in_place(self):
+        """重複で挿入されなかった行は、その位置が None になること"""
+        supabase = MagicMock()
+        supabase.table.return_value.upsert.return_value.execute.return_value = MagicMock(
+            data=[{"id": "b", "idempotency_key": "txt"}])
+        saved = save_meal_logs(supabase, self._rows())
+        assert saved == [None, {"id": "b", "idempotency_key": "txt"}]
+
+    def test_empty_rows_skip_db(self):
+        supabase = MagicMock()
+        assert save_meal_logs(supabase, []) == []
+        supabase.table.assert_not_called()
+
+
+# ---------------------------------------------------------------------------
+# analyze_meal_with_advice のテスト（DailyLedger からプロンプトを構築）
+# ---------------------------------------------------------------------------
+
+from services import analyze_meal_with_advice
+
+
+class TestAnalyzeMealWithAdvice:
+    """analyze_meal_with_advice: 台帳の内容がプロンプトに反映されることを検証"""
+
+    def test_prompt_uses_ledger(self, mocker):
+        mock_response = MagicMock()
+        mock_response.text = '{"cal": 300, "p": 20, "f": 5, "c": 40, "advice": "💪いいですね"}'
+        mock_client = MagicMock()
+        mock_client.models.generate_content.return_value = mock_response
+        mocker.patch("services.get_gemini_client", return_value=mock_client)
+        ledger = DailyLedger("2026-03-01", [{
+            "id": 1, "meal_type": "朝食", "food_name": "納豆ご飯",
+            "calories": 400, "p_val": 15, "f_val": 6, "c_val": 70,
+        }])
+
+        result = analyze_meal_with_advice(
+            "サラダチキン", "gemini-flash", {}, ledger,
+            {"cal": 2000, "p": 100, "f": 60, "c": 250}, "昼食",
+        )
+
+        assert result == (20, 5, 40, 300, "💪いいですね")
+        prompt = mock_client.models.generate_content.call_args.kwargs["contents"]
+        assert "・朝食: 納豆ご飯（400kcal" in prompt
+        assert "カロリー: 400kcal / P: 15g" in prompt
+        assert "夕食、間食、夜食 がまだ未記録です" in prompt
+        assert ledger.meal_types == {"朝食"}  # 台帳自体は変更されないこと
+
+
+# ---------------------------------------------------------------------------
+# オートコンプリート用の食事名履歴（get_food_name_history）
+# ---------------------------------------------------------------------------
+
+from services import get_food_name_history
+
+
+class TestGetFoodNameHistory:
+    """get_food_name_history: 新しい順の取得とエラー時の挙動を検証"""
+
+    def test_returns_rows_newest_first(self):
+        supabase = MagicMock()
+        query = supabase.table.return_value.select.return_value.eq.return_value
+        query.order.return_value.limit.return_value.execute.return_value = MagicMock(data=[{"food_name": "納豆ご飯"}])
+        assert get_food_name_history(supabase, "u1", limit=50) == [{"food_name": "納豆ご飯"}]
+        query.order.assert_called_once_with("created_at", desc=True)
+        query.order.return_value.limit.assert_called_once_with(50)
+
+    def test_returns_empty_list_on_error(self):
+        supabase = MagicMock()
+        supabase.table.side_effect = Exception("network down")
+        assert get_food_name_history(supabase, "u1") == []
+
+
+# ---------------------------------------------------------------------------
+# ローカルの献立提案（split_remaining_targets / optimize_meal_slot / suggest_meal_plan）
+# ---------------------------------------------------------------------------
+
+import time
+import numpy as np
+from ledger import DailyLedger
+from services import (
+    split_remaining_targets, build_plan_candidates, optimize_meal_slot,
+    suggest_meal_plan, format_meal_plan, polish_meal_plan_with_gemini,
+)
+
+PLAN_TARGETS = {"cal": 2000, "p": 120, "f": 55, "c": 250}
+PLAN_SCALE = {k: v / 3 for k, v in PLAN_TARGETS.items()}
+
+
+def _candidates(items):
+    """[(名前, group, cal, p, f, c), ...] から候補を作る"""
+    return {
+        "names": [i[0] for i in items],
+        "groups": np.array([i[1] for i in items]),
+        "values": np.array([i[2:] for i in items], dtype=np.float64),
+    }
+
+
+class TestSplitRemainingTargets:
+    """split_remaining_targets: 残りの目標の配分を検証"""
+
+    def test_split_by_meal_shares(self):
+        totals = {"cal": 400, "p": 20, "f": 10, "c": 50}
+        slots = split_remaining_targets(totals, PLAN_TARGETS, {"朝食"})
+        assert list(slots) == ["昼食", "夕食"]
+        assert slots["昼食"]["cal"] == pytest.approx(800)
+        assert slots["夕食"]["p"] == pytest.approx(50)
+
+    def test_over_target_clamped_to_zero(self):
+        totals = {"cal": 2500, "p": 150, "f": 80, "c": 300}
+        assert split_remaining_targets(totals, PLAN_TARGETS, set())["朝食"]["cal"] == 0
+
+    def test_all_main_meals_logged(self):
+        """朝昼夕が記録済みなら、残りが 100kcal 以上のときだけ間食を提案すること"""
+        logged = {"朝食", "昼食", "夕食"}
+        assert list(split_remaining_targets({"cal": 1700, "p": 100, "f": 40, "c": 200}, PLAN_TARGETS, logged)) == ["間食"]
+        assert split_remaining_targets({"cal": 1950, "p": 100, "f": 40, "c": 200}, PLAN_TARGETS, logged) == {}
+
+
+class TestOptimizeMealSlot:
+    """optimize_meal_slot: 組み合わせの選択を検証"""
+
+    ITEMS = [
+        ("白米", 0, 250, 4, 0.5, 55),
+        ("パン", 0, 160, 5, 3, 28),
+        ("鶏むね", 1, 120, 23, 2, 0),
+        ("豚バラ", 1, 390, 14, 35, 0),
+        ("卵", 2, 90, 7, 6, 0),
+    ]
+
+    def test_picks_one_per_group_best_fit(self):
+        target = {"cal": 460, "p": 34, "f": 9, "c": 55}
+        plans = optimize_meal_slot(target, _candidates(self.ITEMS), PLAN_SCALE, top_k=1)
+        assert plans[0]["items"] == ["白米", "鶏むね", "卵"]
+        assert plans[0]["cal"] == pytest.approx(460)
+
+    def test_template_competes_as_whole_meal(self):
+        """目標に一致するテンプレートは、単品の1食として選ばれること"""
+        items = self.ITEMS + [("いつもの定食", -1, 600, 40, 15, 70)]
+        plans = optimize_meal_slot({"cal": 600, "p": 40, "f": 15, "c": 70}, _candidates(items), PLAN_SCALE)
+        assert plans[0]["items"] == ["いつもの定食"]
+
+    def test_exclude(self):
+        plans = optimize_meal_slot({"cal": 460, "p": 34, "f": 9, "c": 55}, _candidates(self.ITEMS), PLAN_SCALE,
+                                   top_k=1, exclude={2})
+        assert "鶏むね" not in plans[0]["items"]
+
+    def test_no_candidates(self):
+        assert optimize_meal_slot({"cal": 500, "p": 30, "f": 10, "c": 60}, _candidates([("卵", 2, 90, 7, 6, 0)]),
+                                  PLAN_SCALE, exclude={0}) == []
+
+
+class TestSuggestMealPlan:
+    """suggest_meal_plan: 苦手な食べ物の除外と食事ごとの提案を検証"""
+
+    def _ledger(self):
+        return DailyLedger("2026-03-01", [
+            {"id": "a", "meal_type": "朝食", "food_name": "トースト", "calories": 400, "p_val": 20, "f_val": 10, "c_val": 60},
+        ])
+
+    def test_dislikes_are_excluded(self):
+        candidates = build_plan_candidates(dislikes="納豆、ツナ")
+        assert not any("納豆" in n or "ツナ" in n for n in candidates["names"])
+        assert len(candidates["names"]) == len(candidates["values"])
+
+    def test_plan_per_unrecorded_slot(self):
+        plan = suggest_meal_plan(self._ledger(), PLAN_TARGETS, {"dislikes": "納豆"})
+        assert [s["meal_type"] for s in plan] == ["昼食", "夕食"]
+        assert all(not any("納豆" in i for p in s["plans"] for i in p["items"]) for s in plan)
+        # 昼食の1番目の提案で使った品目は、夕食の提案では使わない
+        lunch_items = set(plan[0]["plans"][0]["items"])
+        assert not lunch_items & {i for p in plan[1]["plans"] for i in p["items"]}
+        assert "**昼食**" in format_meal_plan(plan)
+
+    @pytest.mark.benchmark
+    def test_optimizer_benchmark_large_table(self):
+        """成分表全体（約2,500品目）規模の候補でも1食あたり数十ms以内に解けること"""
+        rng = np.random.default_rng(0)
+        items = [(f"食品{i}", i % 3, *rng.uniform([50, 0, 0, 0], [400, 30, 25, 60])) for i in range(2500)]
+        items += [(f"テンプレ{i}", -1, *rng.uniform([300, 10, 5, 30], [800, 50, 30, 100])) for i in range(20)]
+        candidates = _candidates(items)
+        start = time.perf_counter()
+        plans = optimize_meal_slot({"cal": 700, "p": 45, "f": 20, "c": 85}, candidates, PLAN_SCALE)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        assert len(plans) == 2
+        assert elapsed_ms < 50
+
+    def test_polish_returns_none_on_error(self, mocker):
+        mocker.patch("services.get_gemini_client", side_effect=Exception("quota"))
+        assert polish_meal_plan_with_gemini("**昼食** 白米", "gemini-flash", {}) is None
+
+
+# ---------------------------------------------------------------------------
+# 仮の推定値で記録した行のバックグラウンド確認（start_estimate_confirmation）
+# ---------------------------------------------------------------------------
+
+from services import update_meal_log_nutrients, start_estimate_confirmation
+
+
+class TestEstimateConfirmation:
+    """start_estimate_confirmation: Gemini の解析結果で行を更新し、当日分を再取得すること"""
+
+    def test_update_rounds_and_skips_missing_micros(self):
+        supabase = MagicMock()
+        update_meal_log_nutrients(supabase, "x", 30.4, 10.6, 60.2, 499.5, iron_mg=2.04)
+        payload = supabase.table.return_value.update.call_args.args[0]
+        assert payload == {"p_val": 30, "f_val": 11, "c_val": 60, "calories": 500, "iron_mg": 2.0}
+        supabase.table.return_value.update.return_value.eq.assert_called_once_with("id", "x")
+
+    def test_confirmation_updates_then_refetches(self, mocker):
+        mocker.patch("services.analyze_meal_with_gemini", return_value=(30, 10, 60, 500, 2.0, 80.0, 100.0, 1.0))
+        update = mocker.patch("services.update_meal_log_nutrients")
+        mocker.patch("services.get_meal_logs_range", return_value=[{"id": "x", "calories": 500}])
+        future = start_estimate_confirmation(MagicMock(), "u1", "x", "2026-03-01", "鶏むね肉", "gemini-flash")
+        assert future.result(timeout=5) == [{"id": "x", "calories": 500}]
+        assert update.call_args.args[1:6] == ("x", 30, 10, 60, 500)
+
+    def test_failed_analysis_keeps_estimate(self, mocker):
+        """解析に失敗した場合は更新せず、当日分の再取得だけを行うこと"""
+        mocker.patch("services.analyze_meal_with_gemini", return_value=None)
+        update = mocker.patch("services.update_meal_log_nutrients")
+        mocker.patch("services.get_meal_logs_range", return_value=[])
+        future = start_estimate_confirmation(MagicMock(), "u1", "x", "2026-03-01", "鶏むね肉", "gemini-flash")
+        assert future.result(timeout=5) == []
+        update.assert_not_called()
+
+    def test_budget_exceeded_keeps_estimate(self, mocker):
+        mocker.patch("services.analyze_meal_with_gemini", side_effect=BudgetExceeded("上限"))
+        update = mocker.patch("services.update_meal_log_nutrients")
+        mocker.patch("services.get_meal_logs_range", return_value=[{"id": "x"}])
+        future = start_estimate_confirmation(MagicMock(), "u1", "x", "2026-03-01", "鶏むね肉", "gemini-flash")
+        assert future.result(timeout=5) == [{"id": "x"}]
+        update.assert_not_called()
+
+
+# ---------------------------------------------------------------------------
+# 類似テキストキャッシュ・品目の内訳キャッシュ経由の解析（analyze_meal_with_gemini）
+# ---------------------------------------------------------------------------
+
+from analysis_cache import get_analysis_cache
+
+class TestAnalyzeMealWithCache:
+    """表記違いの入力は、前回の解析結果を再利用して Gemini を呼ばないこと"""
+
+    def test_variant_text_reuses_result(self, mocker):
+        mock_response = MagicMock()
+        mock_response.text = '{"cal": 116, "p": 23, "f": 2, "c": 0, "iron_mg": 0.3, "folate_ug": 10.0, "calcium_mg": 4.0, "vitamin_d_ug": 0.1}'
+        mock_client = MagicMock()
+        mock_client.models.generate_content.return_value = mock_response
+        mocker.patch("services.get_gemini_client", return_value=mock_client)
+        mocker.patch("analysis_cache.random.random", return_value=1.0)  # 監査しない
+
+        first = analyze_meal_with_gemini("鶏むね肉 100g", "gemini-flash")
+        second = analyze_meal_with_gemini("鶏胸肉100グラム", "gemini-flash")
+
+        assert first == second
+        assert mock_client.models.generate_content.call_count == 1
+
+    def test_failed_analysis_not_cached(self, mocker):
+        mock_client = MagicMock()
+        mock_client.models.generate_content.side_effect = Exception("API error")
+        mocker.patch("services.get_gemini_client", return_value=mock_client)
+        mocker.patch("services.st")
+
+        assert analyze_meal_with_gemini("鶏むね肉 100g", "gemini-flash") is None
+        assert analyze_meal_with_gemini("鶏むね肉 100g", "gemini-flash") is None
+        assert mock_client.models.generate_content.call_count == 2
+
+    def test_budget_and_timeout_are_raised_to_caller(self, mocker):
+        """共有スレッドプールでは画面に出せないので、予算切れ・タイムアウトは呼び出し側に送出すること"""
+        st = mocker.patch("services.st")
+        for error in (BudgetExceeded("本日のAIの利用上限に達しました"), DeadlineExceeded()):
+            mocker.patch("services._request_meal_analysis", side_effect=error)
+            with pytest.raises(type(error)):
+                analyze_meal_with_gemini("鶏むね肉 100g", "gemini-flash")
+        assert not st.method_calls
+
+    def test_breakdown_assembles_new_combination(self, mocker):
+        """内訳に出た品目だけの別の組み合わせは、Gemini を呼ばずにローカルで合計すること"""
+        mock_response = MagicMock()
+        mock_response.text = (
+            '{"cal": 440, "p": 27, "f": 6, "c": 70, "iron_mg": 1.0, "folate_ug": 20.0, "calcium_mg": 30.0, "vitamin_d_ug": 5.0,'
+            ' "items": ['
+            '{"name": "白米", "cal": 250, "p": 4, "f": 0, "c": 55, "iron_mg": 0.2, "folate_ug": 5.0, "calcium_mg": 5.0, "vitamin_d_ug": 0.0},'
+            '{"name": "味噌汁", "cal": 40, "p": 3, "f": 1, "c": 5, "iron_mg": 0.5, "folate_ug": 10.0, "calcium_mg": 20.0, "vitamin_d_ug": 0.0},'
+            '{"name": "焼き鮭", "cal": 150, "p": 20, "f": 5, "c": 0, "iron_mg": 0.3, "folate_ug": 5.0, "calcium_mg": 5.0, "vitamin_d_ug": 5.0}]}'
+        )
+        mock_client = MagicMock()
+        mock_client.models.generate_content.return_value = mock_response
+        mocker.patch("services.get_gemini_client", return_value=mock_client)
+
+        analyze_meal_with_gemini("白米と味噌汁と焼き鮭", "gemini-flash")
+        result = analyze_meal_with_gemini("焼き鮭、白米", "gemini-flash")
+
+        assert result[3] == 400
+        assert mock_client.models.generate_content.call_count == 1
+        report = get_analysis_cache().report()
+        assert report["sources"]["gemini"] == 1
+        assert report["sources"]["ingredients"] == 1
+        assert report["gemini_share"] == 0.5
+
+
+# ---------------------------------------------------------------------------
+# 入力中の先行解析（SpeculativeAnalysis）
+# ---------------------------------------------------------------------------
+
+from services import SpeculativeAnalysis, SpeculationStats, SPECULATION_MAX_RATIO
+
+SPEC_RESULT = (20, 15, 60, 500, 1.0, 50.0, 100.0, 1.0)
+
+
+class TestSpeculativeAnalysis:
+    def test_same_text_uses_speculative_result(self, mocker):
+        analyze = mocker.patch("services.analyze_meal_with_gemini", return_value=SPEC_RESULT)
+        spec = SpeculativeAnalysis(SpeculationStats())
+
+        spec.start("カレーライス", "gemini-flash")
+        spec.start("カレーライス", "gemini-flash")  # 同じテキストでは再解析しない
+        assert spec.take("カレーライス", "gemini-flash") == SPEC_RESULT
+
+        analyze.assert_called_once_with("カレーライス", "gemini-flash")
+        report = spec.stats.report()
+        assert report["started"] == 1
+        assert report["committed"] == 1
+        assert report["ratio"] == 1.0
+
+    def test_changed_text_is_not_used(self, mocker):
+        mocker.patch("services.analyze_meal_with_gemini", return_value=SPEC_RESULT)
+        spec = SpeculativeAnalysis(SpeculationStats())
+
+        spec.start("カレー", "gemini-flash")
+        spec.start("カレーライス", "gemini-flash")  # 前の解析は取り消す
+        assert spec.take("カレーライス大盛り", "gemini-flash") is None
+
+        report = spec.stats.report()
+        assert report["started"] == 2
+        assert report["cancelled"] == 2
+        assert report["committed"] == 0
+        assert spec.future is None
+
+    def test_speculation_bounded_by_commits(self, mocker):
+        mocker.patch("services.analyze_meal_with_gemini", return_value=SPEC_RESULT)
+        spec = SpeculativeAnalysis(SpeculationStats())
+
+        for i in range(SPECULATION_MAX_RATIO):
+            assert spec.start(f"食事{i}", "gemini-flash") is not None
+        assert spec.start("もう一品", "gemini-flash") is None  # 記録に使われないまま上限に達した
+
+        # 記録に使われた分だけ、また先行解析できる
+        spec.committed += 1
+        assert spec.start("もう一品", "gemini-flash") is not None
+
+    def test_submit_reuses_speculation_without_counting(self, mocker):
+        """記録時の submit() は同じテキストの先行解析を使い、なければ上限に関係なく解析を始めること"""
+        analyze = mocker.patch("services.analyze_meal_with_gemini", return_value=SPEC_RESULT)
+        spec = SpeculativeAnalysis(SpeculationStats())
+
+        spec.start("カレーライス", "gemini-flash")
+        spec.submit("カレーライス", "gemini-flash")
+        assert spec.take("カレーライス", "gemini-flash") == SPEC_RESULT
+        assert analyze.call_count == 1
+
+        spec.started = SPECULATION_MAX_RATIO * 10  # 上限に達していても記録時の解析は行う
+        spec.submit("ラーメン", "gemini-flash")
+        assert spec.take("ラーメン", "gemini-flash") == SPEC_RESULT
+        report = spec.stats.report()
+        assert report["started"] == 1
+        assert report["committed"] == 1
+
+    def test_budget_exceeded_reaches_take(self, mocker):
+        """バックグラウンドの解析の予算切れは、記録時の take() で呼び出し側に送出すること"""
+        mocker.patch("services.analyze_meal_with_gemini", side_effect=BudgetExceeded("上限"))
+        spec = SpeculativeAnalysis(SpeculationStats())
+        spec.start("カレーライス", "gemini-flash")
+        with pytest.raises(BudgetExceeded):
+            spec.take("カレーライス", "gemini-flash")
+        assert spec.key is None  # 失敗した解析は使い回さない
+
+
+# ---------------------------------------------------------------------------
+# まとめて解析（analyze_meals_batch）
+# ---------------------------------------------------------------------------
+
+from services import analyze_meals_batch
+
+
+class TestAnalyzeMealsBatch:
+    def _client(self, mocker, text):
+        mock_client = MagicMock()
+        mock_client.models.generate_content.return_value = MagicMock(text=text)
+        mocker.patch("services.get_gemini_client", return_value=mock_client)
+        return mock_client
+
+    def test_misses_share_one_call(self, mocker):
+        """手元で解決できない食事だけを1回の呼び出しにまとめ、入力と同じ順で返すこと"""
+        client = self._client(mocker, json.dumps({"meals": [
+            {"cal": 700, "p": 25, "f": 20, "c": 90},
+            {"cal": 800, "p": 20, "f": 30, "c": 100},
+        ]}))
+        mocker.patch("services.lookup_food_nutrients", side_effect=lambda t: SPEC_RESULT if t == "白米" else None)
+
+        results = analyze_meals_batch(["ラーメン", "白米", "カレー", "x"], "gemini-flash")
+
+        assert client.models.generate_content.call_count == 1
+        assert "1. ラーメン" in client.models.generate_content.call_args.kwargs["contents"]
+        assert [r and r[3] for r in results] == [700, 500, 800, None]
+
+    def test_count_mismatch_leaves_misses_empty(self, mocker):
+        self._client(mocker, json.dumps({"meals": [{"cal": 700}]}))
+        assert analyze_meals_batch(["ラーメン", "カレー"], "gemini-flash") == [None, None]
+
+    @pytest.mark.parametrize("meals", [2, {"cal": 700, "p": 25}, "700kcal"])
+    def test_non_list_meals_is_a_count_mismatch(self, mocker, capsys, meals):
+        """meals が配列でなければ、その型によらず0件として件数の不一致にすること"""
+        self._client(mocker, json.dumps({"meals": meals}))
+        assert analyze_meals_batch(["ラーメン", "カレー"], "gemini-flash") == [None, None]
+        assert "2件中 0件" in capsys.readouterr().out
@@ -0,0 +1,175 @@
+"""
+shared_cache.py のユニットテスト
+
+複数のワーカープロセスは、同じバックエンド（SQLite ファイル）を持つ SharedCache を2つ作って再現する
+（本物の別プロセスから書き込むテストも1つある）。時刻は clock を差し替えて進める。
+"""
+import subprocess
+import sys
+import textwrap
+from unittest.mock import MagicMock
+
+import pytest
+
+import metrics
+import shared_cache
+from analysis_cache import get_analysis_cache
+from services import _analyze_locally, _remember_analysis, get_user_profile, update_user_profile
+from shared_cache import MemoryBackend, SharedCache, SQLiteBackend, get_shared_cache, shared_cached
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    return MemoryBackend() if request.param == "memory" else SQLiteBackend(str(tmp_path / "cache.sqlite3"))
+
+
+class TestSharedCache:
+    """SharedCache: L1・名前空間ごとの TTL・無効化メッセージ"""
+
+    def test_get_returns_copy(self, backend, clock):
+        cache = SharedCache(backend, clock=clock)
+        cache.set("profiles", "u", {"target_p": 100})
+        value = cache.get("profiles", "u")
+        value["target_p"] = 0
+        assert cache.get("profiles", "u") == {"target_p": 100}
+        assert cache.get("profiles", "other", "none") == "none"
+
+    def test_namespace_ttls(self, backend, clock):
+        cache = SharedCache(backend, ttls={"profiles": 10}, clock=clock)
+        cache.set("profiles", "u", 1)
+        cache.set("gemini_models", "", ["gemini-3-flash"])
+        clock.now += 11
+        assert cache.get("profiles", "u") is None
+        assert cache.get("gemini_models", "") == ["gemini-3-flash"]
+        clock.now += 3600
+        assert cache.get("gemini_models", "") is None
+
+    def test_other_process_reads_backend(self, backend, clock):
+        a, b = SharedCache(backend, clock=clock), SharedCache(backend, clock=clock)
+        a.set("meal_analysis", "ごはん", [4, 0, 55, 250, 0, 0, 0, 0])
+        assert b.get("meal_analysis", "ごはん") == [4, 0, 55, 250, 0, 0, 0, 0]
+        assert b.report()["backend_hits"] == 1
+        b.get("meal_analysis", "ごはん")
+        assert b.report()["l1_hits"] == 1
+
+    def test_invalidation_reaches_other_process_l1(self, backend, clock):
+        a, b = SharedCache(backend, clock=clock), SharedCache(backend, clock=clock)
+        a.set("profiles", "u", {"target_p": 100})
+        b.get("profiles", "u")
+        a.invalidate("profiles", "u")
+        a.set("profiles", "u", {"target_p": 120})
+        # 無効化メッセージは SYNC_INTERVAL 秒ごとに読む（それまでは L1 の値）
+        assert b.get("profiles", "u") == {"target_p": 100}
+        clock.now += shared_cache.SYNC_INTERVAL
+        assert b.get("profiles", "u") == {"target_p": 120}
+        assert b.report()["invalidations"] == 1
+
+    def test_namespace_invalidation(self, backend, clock):
+        a, b = SharedCache(backend, clock=clock), SharedCache(backend, clock=clock)
+        for user in ("u1", "u2"):
+            a.set("profiles", user, {})
+            b.get("profiles", user)
+        a.set("gemini_models", "", ["m"])
+        a.invalidate("profiles")
+        b.sync(force=True)
+        assert b.get("profiles", "u1") is None and b.get("profiles", "u2") is None
+        assert b.get("gemini_models", "") == ["m"]
+
+    def test_missed_messages_drop_l1(self, backend, clock):
+        """MESSAGE_RETENTION 秒以上メッセージを読まなかったプロセスは L1 をすべて捨てる"""
+        a, b = SharedCache(backend, clock=clock), SharedCache(backend, clock=clock)
+        a.invalidate("profiles", "old")
+        b.sync(force=True)
+        a.set("profiles", "u", 1)
+        b.get("profiles", "u")
+        a.invalidate("profiles", "u")
+        backend.set("profiles", "u", '2', clock.now + 300)
+        backend.purge(clock.now, clock.now + 1)  # 読まないうちにメッセージが消える
+        b.sync(force=True)
+        assert b.get("profiles", "u") == 2
+
+    def test_l1_is_bounded(self, backend, clock):
+        cache = SharedCache(backend, l1_size=2, clock=clock)
+        for key in "abc":
+            cache.set("profiles", key, key)
+        assert cache.report()["l1_entries"] == 2
+        assert cache.get("profiles", "a") == "a"  # L1 から落ちてもバックエンドにある
+
+    def test_backend_errors_are_misses(self, clock):
+        backend = MagicMock(name="backend")
+        backend.name = "broken"
+        backend.get.side_effect = OSError("database is locked")
+        backend.messages.side_effect = OSError("database is locked")
+        cache = SharedCache(backend, clock=clock)
+        assert cache.get("profiles", "u") is None
+        assert cache.report()["errors"] >= 2
+
+
+class TestSQLiteAcrossProcesses:
+    def test_value_written_by_another_process(self, tmp_path):
+        path = str(tmp_path / "cache.sqlite3")
+        cache = SharedCache(SQLiteBackend(path))
+        script = textwrap.dedent(f"""
+            from shared_cache import SharedCache, SQLiteBackend
+            cache = SharedCache(SQLiteBackend({path!r}))
+            cache.set("profiles", "u", {{"target_p": 100}})
+            cache.invalidate("gemini_models")
+        """)
+        subprocess.run([sys.executable, "-c", script], check=True, cwd=shared_cache.__file__.rsplit("/", 1)[0])
+        assert cache.get("profiles", "u") == {"target_p": 100}
+        cache.sync(force=True)
+        assert cache.report()["invalidations"] == 1
+
+
+class TestSharedCached:
+    """@shared_cached: services のキャッシュ"""
+
+    def test_hit_miss_and_invalidate(self):
+        metrics.registry.clear()
+        calls = []
+
+        @shared_cached("profiles", "load")
+        def load(user_id):
+            calls.append(user_id)
+            return {"id": user_id}
+
+        assert load("u") == load("u") == {"id": "u"}
+        assert calls == ["u"]
+        load.invalidate("u")
+        load("u")
+        assert calls == ["u", "u"]
+        assert metrics.cache_requests.value(function="load", result="hit") == 1
+        assert metrics.cache_requests.value(function="load", result="miss") == 2
+
+    def test_profile_update_invalidates(self, mocker):
+        supabase = MagicMock()
+        builder = supabase.table.return_value.select.return_value.eq.return_value
+        builder.execute.side_effect = [MagicMock(data=[{"id": "u", "target_p": 100}]),
+                                       MagicMock(data=[{"id": "u", "target_p": 120}])]
+        mocker.patch("services.get_supabase", return_value=supabase)
+        assert get_user_profile("u")["target_p"] == 100
+        assert get_user_profile("u")["target_p"] == 100
+        update_user_profile(supabase, "u", {"target_p": 120})
+        assert get_user_profile("u")["target_p"] == 120
+
+    def test_analysis_shared_between_workers(self):
+        """ほかのワーカーが Gemini で解析した入力は、表記が違っても（正規化して同じなら）Gemini を呼ばずに使う"""
+        result = (27, 6, 70, 440, 1.0, 20.0, 30.0, 5.0)
+        _remember_analysis("白米と焼き鮭", result, [])
+        get_analysis_cache().clear()  # このプロセスの類似テキストキャッシュにはない（別のワーカー）
+        assert _analyze_locally("白米と焼き鮭 ", "gemini-flash") == result
+        assert get_analysis_cache().report()["sources"]["shared"] == 1
+        assert get_shared_cache().report()["backend"] == "memory"
@@ -0,0 +1,26 @@
+"""
+text_pause.py のユニットテスト
+
+入力の監視と送信はブラウザ側（JavaScript）なので、ここではマウントと状態の読み出しを検証する。
+"""
+from streamlit.testing.v1 import AppTest
+
+
+def _script():
+    import streamlit as st
+
+    from text_pause import paused_text, watch_text_pause
+
+    st.text_area("食べたもの", key="food_text")
+    watch_text_pause("food_text", 800, key="food_text_pause", on_pause=lambda: None)
+    st.session_state["paused"] = paused_text("food_text_pause")
+    st.session_state["missing"] = paused_text("no_such_key")
+
+
+class TestTextPause:
+    def test_mount_without_pause_yet(self):
+        at = AppTest.from_function(_script).run()
+        assert not at.exception
+        assert at.session_state["paused"] is None  # まだ入力が止まっていない
+        assert at.session_state["missing"] is None
+        assert at.text_area(key="food_text").value == ""  # テキストエリアの値には触れない
@@ -0,0 +1,150 @@
+"""
+tracing.py のユニットテスト
+
+Supabase / Gemini のクライアントは MagicMock で置き換え、代理オブジェクトがスパンを記録することを確認する。
+"""
+import threading
+from unittest.mock import MagicMock
+
+import pytest
+
+import tracing
+from tracing import (
+    SpanStats, finish_trace, instrument_gemini, instrument_supabase, span, span_stats, start_trace, traced,
+)
+
+
+@pytest.fixture(autouse=True)
+def _clear_stats():
+    span_stats.clear()
+    yield
+    tracing._current_trace.set(None)
+
+
+class TestTrace:
+    """start_trace / span / finish_trace: リランごとのスパンの記録"""
+
+    def test_nested_spans_in_start_order_with_depth(self):
+        trace = start_trace("食事記録")
+        with span("outer"):
+            with span("inner", table="meal_logs"):
+                pass
+        with span("second"):
+            pass
+        finish_trace(trace)
+
+        assert [s["name"] for s in trace.spans] == ["outer", "inner", "second"]
+        assert [s["depth"] for s in trace.spans] == [0, 1, 0]
+        assert trace.spans[1]["attrs"] == {"table": "meal_logs"}
+        outer, inner, second = trace.spans
+        assert outer["start_ms"] <= inner["start_ms"]
+        assert inner["start_ms"] + inner["duration_ms"] <= outer["start_ms"] + outer["duration_ms"] + 1e-6
+        assert second["start_ms"] >= outer["start_ms"] + outer["duration_ms"] - 1e-6
+
+    def test_span_records_even_when_body_raises(self):
+        trace = start_trace()
+        with pytest.raises(ValueError):
+            with span("fails"):
+                raise ValueError("x")
+        finish_trace(trace)
+        assert trace.spans[0]["name"] == "fails"
+        assert span_stats.report()[0]["count"] == 1
+
+    def test_spans_after_finish_only_feed_stats(self):
+        trace = finish_trace(start_trace())
+        with span("late"):
+            pass
+        assert trace.spans == []
+        assert [r["name"] for r in span_stats.report()] == ["late"]
+
+    def test_background_thread_does_not_touch_trace(self):
+        """バックグラウンドのスレッドのスパンはスクリプトのトレースに載らない"""
+        trace = start_trace()
+        worker = threading.Thread(target=_run_span, args=("bg",))
+        worker.start()
+        worker.join()
+        finish_trace(trace)
+        assert trace.spans == []
+        assert [r["name"] for r in span_stats.report()] == ["bg"]
+
+    def test_traced_decorator(self):
+        @traced("calc")
+        def add(a, b):
+            return a + b
+
+        trace = start_trace()
+        assert add(1, 2) == 3
+        finish_trace(trace)
+        assert add.__name__ == "add"
+        assert [s["name"] for s in trace.spans] == ["calc"]
+
+
+def _run_span(name):
+    with span(name):
+        pass
+
+
+class TestSpanStats:
+    """SpanStats: スパン名ごとの直近の p50 / p95"""
+
+    def test_percentiles(self):
+        stats = SpanStats()
+        for ms in range(1, 101):
+            stats.record("q", float(ms))
+        (row,) = stats.report()
+        assert row["count"] == 100
+        assert row["p50"] == pytest.approx(50.5)
+        assert row["p95"] == pytest.approx(95.05)
+        assert row["max"] == 100
+
+    def test_rolling_window_keeps_latest(self):
+        stats = SpanStats(window=10)
+        for ms in range(100):
+            stats.record("q", float(ms))
+        (row,) = stats.report()
+        assert row["count"] == 10
+        assert row["p50"] == pytest.approx(94.5)
+
+    def test_sorted_by_p95_desc(self):
+        stats = SpanStats()
+        stats.record("fast", 1.0)
+        stats.record("slow", 100.0)
+        assert [r["name"] for r in stats.report()] == ["slow", "fast"]
+
+
+class TestInstrumentedClients:
+    """instrument_supabase / instrument_gemini: クライアントの代理"""
+
+    def test_supabase_query_span_named_by_table_and_op(self):
+        client = MagicMock()
+        client.table.return_value.insert.return_value.execute.return_value.data = [{"id": 1}]
+        supabase = instrument_supabase(client)
+
+        trace = start_trace()
+        res = supabase.table("meal_logs").insert({"a": 1}).execute()
+        supabase.table("profiles").select("*").eq("id", "u").execute()
+        finish_trace(trace)
+
+        assert res.data == [{"id": 1}]
+        client.table.return_value.insert.assert_called_once_with({"a": 1})
+        assert [s["name"] for s in trace.spans] == ["supabase.meal_logs.insert", "supabase.profiles.select"]
+
+    def test_supabase_other_attributes_pass_through(self):
+        client = MagicMock()
+        supabase = instrument_supabase(client)
+        assert supabase.auth is client.auth
+        assert instrument_supabase(None) is None
+
+    def test_gemini_models_span_with_model_attr(self):
+        client = MagicMock()
+        client.models.generate_content.return_value.text = "{}"
+        gemini = instrument_gemini(client)
+
+        trace = start_trace()
+        res = gemini.models.generate_content(model="gemini-flash-latest", contents="x")
+        finish_trace(trace)
+
+        assert res.text == "{}"
+        assert trace.spans[0]["name"] == "gemini.generate_content"
+        assert trace.spans[0]["attrs"] == {"model": "gemini-flash-latest"}
+        assert instrument_gemini(None) is None
@@ -0,0 +1,62 @@
+"""
+テキストエリアの入力が止まったことを知らせる小さなコンポーネント（st.components.v2）
+
+st.text_area には st.text_input の live= がなく、値は入力欄から離れる・Ctrl+Enter で確定するまで
+サーバーに届かない（スマホでは、ほぼ記録ボタンを押したとき）。watch_text_pause(target, ...) は
+同じページのテキストエリア（key=target）の入力をブラウザ側で監視し、pause_ms のあいだ入力が止まるたびに
+その時点のテキストを送って on_pause を呼ぶ。テキストエリアの値（st.session_state[target]）は変えないので、
+記録などは従来どおり確定した値を使う。
+
+    def _on_pause():
+        text = paused_text("food_text_pause")
+        ...
+
+    watch_text_pause("food_text", 800, key="food_text_pause", on_pause=_on_pause)
+"""
+
+import streamlit as st
+
+# テキストエリアは React が描き直すことがあるので、要素ではなく document で input を受けて振り分ける
+_JS = """
+export default function(component) {
+    const { data, setStateValue } = component;
+    const selector = `.st-key-${data.target} textarea`;
+    let timer = null;
+    let sent = null;
+    const onInput = (event) => {
+        if (!event.target.matches || !event.target.matches(selector)) return;
+        const text = event.target.value;
+        clearTimeout(timer);
+        timer = setTimeout(() => {
+            if (text !== sent) {
+                sent = text;
+                setStateValue("text", text);
+            }
+        }, data.pause_ms);
+    };
+    document.addEventListener("input", onInput, true);
+    return () => {
+        clearTimeout(timer);
+        document.removeEventListener("input", onInput, true);
+    };
+}
+"""
+
+_text_pause = st.components.v2.component("text_pause", js=_JS, isolate_styles=False)
+
+
+def watch_text_pause(target, pause_ms, *, key, on_pause):
+    """
+    テキストエリア（key=target）の入力が pause_ms 止まるたびに on_pause を呼ぶ（画面には何も表示しない）
+    フラグメントの中に置くと、入力が止まったときのリランはそのフラグメントだけになる
+    """
+    _text_pause(
+        key=key, data={"target": target, "pause_ms": pause_ms}, default={"text": None},
+        on_text_change=on_pause, height=0,
+    )
+
+
+def paused_text(key):
+    """最後に入力が止まったときのテキスト（まだなければ None）"""
+    state = st.session_state.get(key)
+    return state.get("text") if state else None
@@ -0,0 +1,290 @@
+"""
+リランごとの処理時間の計測（軽量なスパン）
+
+app.py が1回のリランを1つのトレースとして開始・終了し、その間に span() / @traced で
+囲んだ処理（Supabase のクエリ・Gemini の呼び出し・DataFrame やグラフの構築など）の
+開始時刻と所要時間を記録する。スパン名ごとの直近の所要時間はプロセス全体で集計し、
+デバッグパネル（?debug=<secrets の [debug] token>）でウォーターフォールと p50 / p95 を表示する。
+
+    with span("dataframe.aggregate_daily"):
+        ...
+
+    @traced("chart.summary")
+    def create_summary_chart(data_dict): ...
+
+Supabase / Gemini のクライアントは config.py で instrument_supabase() / instrument_gemini() を
+通して返すので、個々のクエリ・呼び出しを囲まなくてもスパンが記録される（あわせて metrics.py の
+所要時間・トークン数・エラーのメトリクスも記録する）。
+"""
+
+import contextlib
+import contextvars
+import functools
+import threading
+import time
+from collections import deque
+
+import numpy as np
+import streamlit as st
+
+import metrics
+
+ROLLING_WINDOW = 200  # スパン名ごとに p50 / p95 の計算に使う直近の件数
+DEBUG_PARAM = "debug"
+
+# 実行中のリランのトレース（スクリプトのスレッドごと。get_executor() はコンテキストを引き継ぐので、
+# バックグラウンドのスレッドでは span() が Trace.thread で見分けてトレースに載せない）
+_current_trace = contextvars.ContextVar("pfc_trace", default=None)
+
+
+class Trace:
+    """1回のリランで記録したスパン（開始順）"""
+
+    __slots__ = ("label", "thread", "started", "finished", "spans", "_depth")
+
+    def __init__(self, label=""):
+        self.label = label
+        self.thread = threading.get_ident()
+        self.started = time.perf_counter()
+        self.finished = None
+        self.spans = []  # [{"name", "start_ms", "duration_ms", "depth", "attrs"}, ...]
+        self._depth = 0
+
+    @property
+    def duration_ms(self):
+        end = self.finished if self.finished is not None else time.perf_counter()
+        return (end - self.started) * 1000
+
+    def _enter(self):
+        depth = self._depth
+        self._depth += 1
+        # 開始順に並べるため、終了時ではなく開始時に枠を確保する
+        entry = {"name": None, "start_ms": 0.0, "duration_ms": 0.0, "depth": depth, "attrs": None}
+        self.spans.append(entry)
+        return entry
+
+    def _exit(self, entry, name, start, end, attrs):
+        self._depth -= 1
+        entry.update(name=name, start_ms=(start - self.started) * 1000, duration_ms=(end - start) * 1000, attrs=attrs)
+
+
+class SpanStats:
+    """スパン名ごとの直近 ROLLING_WINDOW 件の所要時間（ミリ秒）"""
+
+    def __init__(self, window=ROLLING_WINDOW):
+        self._lock = threading.Lock()
+        self._window = window
+        self._durations = {}
+
+    def record(self, name, duration_ms):
+        with self._lock:
+            durations = self._durations.get(name)
+            if durations is None:
+                durations = self._durations[name] = deque(maxlen=self._window)
+            durations.append(duration_ms)
+
+    def clear(self):
+        with self._lock:
+            self._durations.clear()
+
+    def report(self):
+        """[{"name", "count", "p50", "p95", "max"}, ...]（p95 の大きい順）"""
+        with self._lock:
+            snapshot = {name: np.fromiter(d, dtype=float) for name, d in self._durations.items()}
+        rows = []
+        for name, values in snapshot.items():
+            p50, p95 = np.percentile(values, [50, 95])
+            rows.append({"name": name, "count": len(values), "p50": p50, "p95": p95, "max": values.max()})
+        rows.sort(key=lambda r: r["p95"], reverse=True)
+        return rows
+
+
+# スパンごとに呼ぶため、@st.cache_resource の関数呼び出しを挟まずモジュールで1つだけ持つ
+span_stats = SpanStats()
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """処理を囲んで所要時間を記録する（トレース中ならウォーターフォールにも載せる）"""
+    trace = _current_trace.get()
+    if trace is not None and trace.thread != threading.get_ident():
+        trace = None
+    entry = trace._enter() if trace is not None else None
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        span_stats.record(name, (end - start) * 1000)
+        if entry is not None:
+            trace._exit(entry, name, start, end, attrs or None)
+
+
+def traced(name):
+    """関数全体を span(name) で囲むデコレーター"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_trace(label=""):
+    """このリランのトレースを開始する（app.py の先頭で呼ぶ）"""
+    trace = Trace(label)
+    _current_trace.set(trace)
+    return trace
+
+
+def finish_trace(trace):
+    """トレースを終了する（以降のスパンはトレースに載せない）"""
+    trace.finished = time.perf_counter()
+    if _current_trace.get() is trace:
+        _current_trace.set(None)
+    return trace
+
+
+# --- クライアントの計測 ---
+
+QUERY_OPS = ("select", "insert", "upsert", "update", "delete")
+
+
+class _TracedQuery:
+    """Supabase のクエリビルダーの代理。execute() を span("supabase.<テーブル>.<操作>") で囲み、所要時間とエラーを数える"""
+
+    __slots__ = ("_query", "_table", "_op")
+
+    def __init__(self, query, table, op=None):
+        self._query = query
+        self._table = table
+        self._op = op
+
+    def __getattr__(self, attr):
+        value = getattr(self._query, attr)
+        if not callable(value):
+            return value
+        if attr == "execute":
+            def execute(*args, **kwargs):
+                op = self._op or "select"
+                start = time.perf_counter()
+                try:
+                    with span(f"supabase.{self._table}.{op}", table=self._table, op=op):
+                        return value(*args, **kwargs)
+                except Exception:
+                    metrics.supabase_errors.inc(table=self._table, op=op)
+                    raise
+                finally:
+                    metrics.supabase_latency.observe(time.perf_counter() - start, table=self._table, op=op)
+            return execute
+
+        def chain(*args, **kwargs):
+            op = self._op or (attr if attr in QUERY_OPS else None)
+            return _TracedQuery(value(*args, **kwargs), self._table, op)
+        return chain
+
+
+class TracedSupabase:
+    """Supabase クライアントの代理（table() 以外はそのまま元のクライアントに渡す）"""
+
+    __slots__ = ("_client",)
+
+    def __init__(self, client):
+        self._client = client
+
+    def table(self, name):
+        return _TracedQuery(self._client.table(name), name)
+
+    def __getattr__(self, attr):
+        return getattr(self._client, attr)
+
+
+class _TracedModels:
+    """Gemini の client.models の代理。各メソッドを span("gemini.<メソッド>") で囲み、所要時間・トークン数・エラーを数える"""
+
+    __slots__ = ("_models",)
+
+    def __init__(self, models):
+        self._models = models
+
+    def __getattr__(self, attr):
+        value = getattr(self._models, attr)
+        if not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            model = kwargs.get("model")
+            start = time.perf_counter()
+            try:
+                with span(f"gemini.{attr}", model=model):
+                    response = value(*args, **kwargs)
+            except Exception as e:
+                metrics.gemini_errors.inc(model=model, code=metrics.error_code(e))
+                raise
+            finally:
+                metrics.gemini_latency.observe(time.perf_counter() - start, model=model, method=attr)
+            metrics.record_gemini_usage(model, response)
+            return response
+        return call
+
+
+class TracedGemini:
+    """Gemini クライアントの代理（models 以外はそのまま元のクライアントに渡す）"""
+
+    __slots__ = ("_client", "models")
+
+    def __init__(self, client):
+        self._client = client
+        self.models = _TracedModels(client.models)
+
+    def __getattr__(self, attr):
+        return getattr(self._client, attr)
+
+
+def instrument_supabase(client):
+    return TracedSupabase(client) if client is not None else None
+
+
+def instrument_gemini(client):
+    return TracedGemini(client) if client is not None else None
+
+
+# --- デバッグパネル ---
+
+def debug_panel_enabled():
+    """
+    デバッグパネルを表示するか
+    secrets の [debug] panel = true なら常に、?debug=<[debug] token> で開いたセッションではページを移っても表示する
+    """
+    if st.session_state.get("debug_panel"):
+        return True
+    try:
+        conf = st.secrets.get("debug", {})
+    except Exception:
+        return False
+    if conf.get("panel"):
+        return True
+    token = conf.get("token")
+    if token and st.query_params.get(DEBUG_PARAM) == token:
+        st.session_state["debug_panel"] = True
+        return True
+    return False
+
+
+def render_debug_panel(trace):
+    """このリランのウォーターフォールと、スパン名ごとの直近の p50 / p95"""
+    from charts import create_trace_waterfall
+
+    with st.sidebar.expander(f"🐢 パフォーマンス（{trace.duration_ms:.0f}ms）", expanded=True):
+        if trace.spans:
+            st.plotly_chart(create_trace_waterfall(trace.spans), use_container_width=True,
+                            config={"staticPlot": True})
+        st.dataframe(
+            [
+                {"スパン": r["name"], "件数": r["count"], "p50(ms)": round(r["p50"], 1),
+                 "p95(ms)": round(r["p95"], 1), "最大(ms)": round(r["max"], 1)}
+                for r in span_stats.report()
+            ],
+            hide_index=True,
+        )